@@ -0,0 +1,164 @@
+import os
+import json
+import hashlib
+import math
+
+import numpy as np
+from PIL import Image
+
+# Formats covered by the corpus and the Pillow encoder used for each
+CORPUS_FORMATS = {
+    'jpeg': ('JPEG', '.jpg'),
+    'png': ('PNG', '.png'),
+    'tiff': ('TIFF', '.tif'),
+    'heic': ('HEIF', '.heic'),
+    'webp': ('WEBP', '.webp'),
+}
+
+# Megapixel sizes per corpus profile
+CORPUS_PROFILES = {
+    'quick': [0.3, 2],
+    'standard': [0.3, 2, 12],
+    'full': [0.3, 2, 12, 24, 50],
+}
+
+DEFAULT_SEED = 20240601
+
+# Longest side of the thumbnail embedded in HEIC corpus files, about what phones write
+HEIF_THUMBNAIL_SIZE = 320
+MANIFEST_NAME = 'manifest.json'
+
+
+def corpus_specs(profile='quick', formats=None):
+    """
+    List the files that make up a corpus profile.
+
+    Args:
+        profile (str): One of CORPUS_PROFILES
+        formats (list): Subset of CORPUS_FORMATS to include (optional)
+
+    Returns:
+        list: Spec dicts with format, megapixels, width, height and with_metadata
+    """
+    specs = []
+    for fmt in formats or CORPUS_FORMATS:
+        for megapixels in CORPUS_PROFILES[profile]:
+            # 3:2 aspect ratio, like most camera sensors
+            width = int(round(math.sqrt(megapixels * 1_000_000 * 1.5)))
+            height = int(round(width / 1.5))
+            for with_metadata in (False, True):
+                specs.append({
+                    'format': fmt,
+                    'megapixels': megapixels,
+                    'width': width,
+                    'height': height,
+                    'with_metadata': with_metadata,
+                    'name': f"{fmt}_{megapixels:g}mp_{'meta' if with_metadata else 'bare'}{CORPUS_FORMATS[fmt][1]}",
+                })
+    return specs
+
+
+def synthesize_pixels(width, height, seed):
+    """
+    Build a deterministic RGB image that compresses roughly like a photograph.
+
+    Smooth gradients give the encoders something to predict, and low-amplitude
+    noise keeps them from collapsing the image to a handful of bytes.
+    """
+    rng = np.random.default_rng(seed)
+    x = np.linspace(0.0, 1.0, width, dtype=np.float32)
+    y = np.linspace(0.0, 1.0, height, dtype=np.float32)[:, None]
+    phase = rng.uniform(0, 2 * math.pi, size=3)
+
+    pixels = np.empty((height, width, 3), dtype=np.uint8)
+    for channel in range(3):
+        plane = 127.5 + 80.0 * np.sin(6.0 * x + phase[channel]) * np.cos(4.0 * y + phase[channel])
+        plane += rng.normal(0.0, 6.0, size=(height, width)).astype(np.float32)
+        pixels[:, :, channel] = np.clip(plane, 0, 255).astype(np.uint8)
+    return Image.fromarray(pixels, 'RGB')
+
+
+def build_sample_exif(seed):
+    """Build an EXIF block with camera, date and GPS tags like a phone would write."""
+    rng = np.random.default_rng(seed)
+    exif = Image.Exif()
+    exif[0x010F] = 'BenchCam'          # Make
+    exif[0x0110] = 'Synthetic 1'       # Model
+    exif[0x013B] = 'Benchmark Corpus'  # Artist
+    exif.get_ifd(0x8769)[0x9003] = '2024:06:01 12:00:00'  # DateTimeOriginal
+    lat = float(rng.uniform(25.0, 48.0))
+    lng = float(rng.uniform(70.0, 120.0))
+    exif.get_ifd(0x8825).update({
+        1: 'N',
+        2: (float(int(lat)), float(int(lat * 60) % 60), round(lat * 3600 % 60, 2)),
+        3: 'W',
+        4: (float(int(lng)), float(int(lng * 60) % 60), round(lng * 3600 % 60, 2)),
+    })
+    return exif
+
+
+def generate_corpus(output_dir, profile='quick', formats=None, seed=DEFAULT_SEED, force=False):
+    """
+    Generate (or reuse) a deterministic synthetic image corpus.
+
+    Files that already exist with the expected checksum are kept, so repeated
+    runs only pay for generation once.
+
+    Args:
+        output_dir (str): Directory to write the corpus to
+        profile (str): One of CORPUS_PROFILES
+        formats (list): Subset of CORPUS_FORMATS to include (optional)
+        seed (int): Base seed; the same seed always produces the same pixels
+        force (bool): Regenerate every file even if it already exists
+
+    Returns:
+        list: Spec dicts extended with path, bytes and sha256
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    manifest_path = os.path.join(output_dir, MANIFEST_NAME)
+    previous = {}
+    if os.path.exists(manifest_path) and not force:
+        with open(manifest_path, 'r') as f:
+            previous = {entry['name']: entry for entry in json.load(f).get('files', [])}
+
+    if any(spec['format'] == 'heic' for spec in corpus_specs(profile, formats)):
+        import pillow_heif
+        pillow_heif.register_heif_opener()
+
+    entries = []
+    for index, spec in enumerate(corpus_specs(profile, formats)):
+        path = os.path.join(output_dir, spec['name'])
+        cached = previous.get(spec['name'])
+        if cached and os.path.exists(path) and os.path.getsize(path) == cached['bytes']:
+            entries.append(dict(cached, path=path))
+            continue
+
+        # Seed from the pixel dimensions, not the index, so the same size is identical across formats
+        file_seed = seed + spec['width']
+        img = synthesize_pixels(spec['width'], spec['height'], file_seed)
+        pil_format = CORPUS_FORMATS[spec['format']][0]
+        save_kwargs = {}
+        if spec['with_metadata']:
+            save_kwargs['exif'] = build_sample_exif(file_seed + index).tobytes()
+        if pil_format == 'JPEG':
+            save_kwargs['quality'] = 90
+        if pil_format == 'HEIF':
+            # Phones embed a small thumbnail in every HEIC; the resize and preview fast paths use it
+            save_kwargs['thumbnails'] = [HEIF_THUMBNAIL_SIZE]
+        # TIFFs stay uncompressed like scanner/camera exports (libtiff also rejects nested EXIF IFDs)
+        img.save(path, pil_format, **save_kwargs)
+        img.close()
+
+        sha256 = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                sha256.update(chunk)
+        entries.append(dict(spec, path=path, bytes=os.path.getsize(path), sha256=sha256.hexdigest()))
+
+    with open(manifest_path, 'w') as f:
+        json.dump({
+            'profile': profile,
+            'seed': seed,
+            'files': [{k: v for k, v in entry.items() if k != 'path'} for entry in entries],
+        }, f, indent=2)
+    return entries
@@ -0,0 +1,80 @@
+import io
+import json
+import shutil
+
+from benchmarks.report import measure
+from benchmarks.stages import load_city_presets, sample_form_payload
+
+# Extra form fields each blueprint's /process endpoint needs
+ENDPOINT_FORMS = {
+    'geotagging': lambda: {'exif_data': json.dumps(sample_form_payload(load_city_presets()[0])), 'output_format': 'jpeg'},
+    'conversion': lambda: {'output_format': 'jpeg'},
+    'resizing': lambda: {'resize_mode': 'fit', 'width': '1600', 'height': '1600', 'output_format': 'jpeg'},
+    'watermark': lambda: {'watermark_type': 'text', 'watermark_text': 'Benchmark', 'position': 'bottom_right',
+                          'opacity': '50', 'size': '10', 'output_format': 'jpeg'},
+}
+
+
+def session_id_from_response(payload):
+    """Pull the session id out of a /process response so the session can be cleaned up."""
+    if payload.get('session_id'):
+        return payload['session_id']
+    parts = payload.get('download_url', '').split('/')
+    return parts[-2] if len(parts) >= 2 else None
+
+
+def post_batch(client, blueprint, batch, form_fields):
+    """POST one batch of corpus files to a blueprint's /process endpoint and clean up afterwards."""
+    data = dict(form_fields)
+    data['files[]'] = [(io.BytesIO(content), name) for name, content in batch]
+    data['file_paths[]'] = [f"bench/{name}" for name, _ in batch]
+    response = client.post(f'/api/{blueprint}/process', data=data, content_type='multipart/form-data')
+    payload = response.get_json(silent=True) or {}
+    if response.status_code != 200:
+        raise RuntimeError(f"/api/{blueprint}/process returned {response.status_code}: {payload}")
+
+    session_id = session_id_from_response(payload)
+    if session_id:
+        client.post(f'/api/{blueprint}/cleanup/{session_id}')
+
+
+def run_endpoints(app, corpus, blueprints=None, repeat=3, batch_formats=None):
+    """
+    Run end-to-end /process benchmarks through the Flask test client.
+
+    Each corpus size becomes one batch containing that size in every format,
+    so a result shows the cost of a realistic mixed upload.
+
+    Args:
+        app (Flask): Application under test
+        corpus (list): Corpus entries from benchmarks.corpus.generate_corpus
+        blueprints (list): Blueprints to exercise (default: all of ENDPOINT_FORMS)
+        repeat (int): Timed runs per benchmark
+        batch_formats (list): Restrict batches to these corpus formats (optional)
+
+    Returns:
+        dict: Benchmark name -> timing statistics
+    """
+    app.config['TESTING'] = True
+    client = app.test_client()
+
+    batches = {}
+    for entry in corpus:
+        if batch_formats and entry['format'] not in batch_formats:
+            continue
+        with open(entry['path'], 'rb') as f:
+            batches.setdefault(entry['megapixels'], []).append((entry['name'], f.read()))
+
+    results = {}
+    for blueprint in blueprints or ENDPOINT_FORMS:
+        if blueprint == 'geotagging' and not shutil.which('exiftool'):
+            print('exiftool not found in PATH, skipping endpoint.geotagging')
+            continue
+        form_fields = ENDPOINT_FORMS[blueprint]()
+        for megapixels, batch in sorted(batches.items()):
+            nbytes = sum(len(content) for _, content in batch)
+            results[f"endpoint.{blueprint}.{megapixels:g}mp"] = measure(
+                lambda: post_batch(client, blueprint, batch, form_fields),
+                repeat=repeat, warmup=0, items=len(batch), nbytes=nbytes,
+            )
+    return results
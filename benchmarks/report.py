@@ -0,0 +1,163 @@
+import os
+import sys
+import json
+import time
+import platform
+import statistics
+from datetime import datetime
+
+# A benchmark is flagged when its median moves by more than this fraction
+DEFAULT_THRESHOLD = 0.10
+
+
+def measure(fn, repeat=5, warmup=1, items=1, nbytes=0):
+    """
+    Time a callable and summarise the samples.
+
+    Args:
+        fn (callable): Zero-argument function to time
+        repeat (int): Number of timed runs
+        warmup (int): Untimed runs before measuring
+        items (int): Work items per run, used for per-item throughput
+        nbytes (int): Bytes processed per run, used for MB/s throughput
+
+    Returns:
+        dict: Timing statistics in seconds plus throughput figures
+    """
+    for _ in range(warmup):
+        fn()
+
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - start)
+
+    samples.sort()
+    median = statistics.median(samples)
+    result = {
+        'median': median,
+        'min': samples[0],
+        'max': samples[-1],
+        'p95': samples[min(len(samples) - 1, int(round(0.95 * (len(samples) - 1))))],
+        'mean': statistics.fmean(samples),
+        'runs': len(samples),
+        'items': items,
+        'unit': 's',
+    }
+    if items and median > 0:
+        result['items_per_second'] = items / median
+    if nbytes and median > 0:
+        result['mb_per_second'] = nbytes / median / (1024 * 1024)
+    return result
+
+
+def environment_info():
+    """Describe the machine and library versions a result set was recorded on."""
+    info = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'machine': platform.machine(),
+        'cpu_count': os.cpu_count(),
+        'recorded_at': datetime.now().isoformat(timespec='seconds'),
+    }
+    try:
+        import PIL
+        info['pillow'] = PIL.__version__
+    except ImportError:
+        pass
+    try:
+        import pillow_heif
+        info['pillow_heif'] = pillow_heif.__version__
+    except ImportError:
+        pass
+    return info
+
+
+def save_results(path, results, meta=None):
+    """Write a result set to a JSON file that can later serve as a baseline."""
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump({'meta': dict(environment_info(), **(meta or {})), 'results': results}, f, indent=2, sort_keys=True)
+
+
+def load_results(path):
+    """Load a result set written by save_results."""
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def compare_results(baseline, current, threshold=DEFAULT_THRESHOLD):
+    """
+    Compare two result sets benchmark by benchmark.
+
+    Args:
+        baseline (dict): Result set loaded from the baseline file
+        current (dict): Result set from this run
+        threshold (float): Relative change in median treated as significant
+
+    Returns:
+        list: Rows with name, baseline, current, change and status
+              ('regression', 'improvement', 'ok', 'new' or 'missing')
+    """
+    base_results = baseline.get('results', {})
+    current_results = current.get('results', {})
+    rows = []
+    for name in sorted(set(base_results) | set(current_results)):
+        base = base_results.get(name)
+        cur = current_results.get(name)
+        if base is None:
+            rows.append({'name': name, 'baseline': None, 'current': cur['median'], 'change': None, 'status': 'new'})
+            continue
+        if cur is None:
+            rows.append({'name': name, 'baseline': base['median'], 'current': None, 'change': None, 'status': 'missing'})
+            continue
+
+        change = (cur['median'] - base['median']) / base['median'] if base['median'] else 0.0
+        if change > threshold:
+            status = 'regression'
+        elif change < -threshold:
+            status = 'improvement'
+        else:
+            status = 'ok'
+        rows.append({'name': name, 'baseline': base['median'], 'current': cur['median'], 'change': change, 'status': status})
+    return rows
+
+
+def format_comparison(rows):
+    """Render comparison rows as a plain-text table."""
+    def fmt_time(value):
+        if value is None:
+            return '-'
+        if value < 1e-3:
+            return f"{value * 1e6:.1f}us"
+        if value < 1:
+            return f"{value * 1e3:.2f}ms"
+        return f"{value:.3f}s"
+
+    name_width = max([len('benchmark')] + [len(row['name']) for row in rows])
+    lines = [f"{'benchmark':<{name_width}}  {'baseline':>10}  {'current':>10}  {'change':>8}  status"]
+    lines.append('-' * len(lines[0]))
+    for row in rows:
+        change = '-' if row['change'] is None else f"{row['change'] * 100:+.1f}%"
+        lines.append(
+            f"{row['name']:<{name_width}}  {fmt_time(row['baseline']):>10}  {fmt_time(row['current']):>10}  {change:>8}  {row['status']}"
+        )
+
+    counts = {}
+    for row in rows:
+        counts[row['status']] = counts.get(row['status'], 0) + 1
+    lines.append('')
+    lines.append(', '.join(f"{count} {status}" for status, count in sorted(counts.items())))
+    return '\n'.join(lines)
+
+
+def print_results(results, stream=sys.stdout):
+    """Print a compact summary of a result dictionary."""
+    for name, stats in sorted(results.items()):
+        extra = ''
+        if 'mb_per_second' in stats:
+            extra = f"  {stats['mb_per_second']:.1f} MB/s"
+        elif 'items_per_second' in stats and stats.get('items', 1) > 1:
+            extra = f"  {stats['items_per_second']:.1f} items/s"
+        stream.write(f"{name:<55} median {stats['median'] * 1e3:10.3f}ms  p95 {stats['p95'] * 1e3:10.3f}ms{extra}\n")
@@ -0,0 +1,79 @@
+"""
+Benchmark runner.
+
+Examples:
+    python -m benchmarks.run --profile quick --save benchmarks/results/baseline.json
+    python -m benchmarks.run --profile quick --compare benchmarks/results/baseline.json
+    python -m benchmarks.run --suite stages --stage decode --stage zip
+"""
+import os
+import sys
+import argparse
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+from benchmarks.corpus import CORPUS_FORMATS, CORPUS_PROFILES, DEFAULT_SEED, generate_corpus
+from benchmarks.report import (DEFAULT_THRESHOLD, compare_results, format_comparison, load_results,
+                               print_results, save_results)
+from benchmarks.stages import STAGES, run_stages
+from benchmarks.endpoints import ENDPOINT_FORMS, run_endpoints
+
+DEFAULT_CORPUS_DIR = os.path.join(REPO_ROOT, 'benchmarks', '.corpus')
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the image processing stages and endpoints.')
+    parser.add_argument('--suite', choices=['all', 'stages', 'endpoints'], default='all')
+    parser.add_argument('--profile', choices=sorted(CORPUS_PROFILES), default='quick',
+                        help='Corpus size profile (quick: up to 2 MP, full: up to 50 MP)')
+    parser.add_argument('--format', dest='formats', action='append', choices=sorted(CORPUS_FORMATS),
+                        help='Limit the corpus to these formats (repeatable)')
+    parser.add_argument('--stage', dest='stages', action='append', choices=sorted(STAGES),
+                        help='Limit the microbenchmarks to these stages (repeatable)')
+    parser.add_argument('--endpoint', dest='endpoints', action='append', choices=sorted(ENDPOINT_FORMS),
+                        help='Limit the end-to-end runs to these blueprints (repeatable)')
+    parser.add_argument('--repeat', type=int, default=3, help='Timed runs per benchmark')
+    parser.add_argument('--corpus-dir', default=DEFAULT_CORPUS_DIR)
+    parser.add_argument('--seed', type=int, default=DEFAULT_SEED)
+    parser.add_argument('--regenerate', action='store_true', help='Regenerate the corpus even if cached')
+    parser.add_argument('--save', metavar='PATH', help='Write the results as a JSON baseline')
+    parser.add_argument('--compare', metavar='PATH', help='Compare the results against a JSON baseline')
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD,
+                        help='Relative median change reported as a regression (default: 0.10)')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    print(f"Preparing '{args.profile}' corpus in {args.corpus_dir}")
+    corpus = generate_corpus(args.corpus_dir, args.profile, args.formats, args.seed, args.regenerate)
+    print(f"Corpus ready: {len(corpus)} files, {sum(e['bytes'] for e in corpus) / (1024 * 1024):.1f} MB")
+
+    from src.app import app
+
+    results = {}
+    if args.suite in ('all', 'stages'):
+        results.update(run_stages(app, corpus, args.stages, args.repeat))
+    if args.suite in ('all', 'endpoints'):
+        results.update(run_endpoints(app, corpus, args.endpoints, args.repeat))
+
+    print_results(results)
+
+    current = {'meta': {'profile': args.profile, 'seed': args.seed}, 'results': results}
+    if args.save:
+        save_results(args.save, results, current['meta'])
+        print(f"Saved results to {args.save}")
+
+    if args.compare:
+        rows = compare_results(load_results(args.compare), current, args.threshold)
+        print()
+        print(format_comparison(rows))
+        if any(row['status'] == 'regression' for row in rows):
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
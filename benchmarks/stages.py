@@ -0,0 +1,233 @@
+import os
+import json
+import shutil
+import tempfile
+import zipfile
+
+from PIL import Image
+
+from benchmarks.report import measure
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CITY_PRESETS_PATH = os.path.join(REPO_ROOT, 'src', 'static', 'data', 'city_presets.json')
+CLIENT_PRESETS_PATH = os.path.join(REPO_ROOT, 'src', 'static', 'data', 'client_presets.json')
+
+
+def load_city_presets():
+    """Flatten the country -> state -> city preset tree into a list of presets."""
+    with open(CITY_PRESETS_PATH, 'r') as f:
+        data = json.load(f)
+    presets = []
+    for country, states in data.get('countries', {}).items():
+        for state, cities in states.items():
+            for city in cities:
+                presets.append(dict(city, country=country, state_province=state))
+    return presets
+
+
+def sample_form_payload(city_preset):
+    """Build an `exif_data` payload like the geotagging form sends with a client preset applied."""
+    with open(CLIENT_PRESETS_PATH, 'r') as f:
+        client = json.load(f)['presets'][0]
+    contact = client.get('contact_info', {})
+    return {
+        'Creator': contact.get('byline'),
+        'CreatorTitle': contact.get('byline_title'),
+        'Address': contact.get('address'),
+        'ContactCity': contact.get('city'),
+        'ContactState': contact.get('state_province'),
+        'ContactCountry': contact.get('country'),
+        'PostalCode': contact.get('postal_code'),
+        'Phone': contact.get('phone'),
+        'Email': contact.get('email'),
+        'URL': contact.get('url'),
+        'Keywords': client.get('keywords', []),
+        'datetime': '2024-06-01T12:00',
+        'use_random_coordinates': True,
+        'preset': city_preset,
+    }
+
+
+def bench_coordinate_sampling(app, repeat=5, calls=2000):
+    """Time random point sampling inside every city preset quadrilateral."""
+    from src.routes.geotagging import generate_random_coordinates_in_quadrilateral
+
+    presets = load_city_presets()
+
+    def run():
+        for i in range(calls):
+            generate_random_coordinates_in_quadrilateral(presets[i % len(presets)])
+
+    return {'stage.coordinate_sampling': measure(run, repeat=repeat, items=calls)}
+
+
+def bench_tag_mapping(app, repeat=5, calls=500):
+    """Time the form -> ExifTool tag mapping for a full client + city preset payload."""
+    from src.routes.geotagging import build_exif_write_plan
+
+    payload = sample_form_payload(load_city_presets()[0])
+
+    def run():
+        for _ in range(calls):
+            build_exif_write_plan(payload, None, True)
+
+    with app.app_context():
+        return {'stage.tag_mapping': measure(run, repeat=repeat, items=calls)}
+
+
+def bench_decode(app, corpus, repeat=3):
+    """Time a full decode of every corpus file."""
+    results = {}
+    for entry in corpus:
+        def run(path=entry['path']):
+            with Image.open(path) as img:
+                img.load()
+
+        results[f"stage.decode.{entry['name']}"] = measure(run, repeat=repeat, nbytes=entry['bytes'])
+    return results
+
+
+def bench_exiftool_write(app, corpus, repeat=3):
+    """Time an ExifTool metadata write on every JPEG corpus file."""
+    from src.routes.geotagging import build_exif_write_plan, process_image_with_exiftool
+
+    if not shutil.which('exiftool'):
+        print('exiftool not found in PATH, skipping stage.exiftool_write')
+        return {}
+
+    payload = sample_form_payload(load_city_presets()[0])
+    results = {}
+    work_dir = tempfile.mkdtemp(prefix='bench_exiftool_')
+    try:
+        with app.app_context():
+            plan = build_exif_write_plan(payload, None, True)
+            for entry in corpus:
+                if entry['format'] != 'jpeg':
+                    continue
+                output_path = os.path.join(work_dir, entry['name'])
+
+                def run(path=entry['path'], output_path=output_path):
+                    if os.path.exists(output_path):
+                        os.remove(output_path)
+                    if not process_image_with_exiftool(path, output_path, plan):
+                        raise RuntimeError(f"ExifTool write failed for {path}")
+
+                results[f"stage.exiftool_write.{entry['name']}"] = measure(run, repeat=repeat, nbytes=entry['bytes'])
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return results
+
+
+def bench_heif(app, corpus, repeat=3, calls=1000, preview_width=256):
+    """
+    Compare the HEIF fast paths with the full-decode paths they replace.
+
+    - opener: registering the pillow_heif opener for every file vs once per process
+    - resize: a small resize from the full image vs from the embedded thumbnail
+    - geotag: decode + JPEG re-encode + ExifTool write vs an in-place ExifTool write into the HEIC
+    """
+    import pillow_heif
+    from src.utils import heif
+    from src.routes.geotagging import build_exif_write_plan, process_image_with_exiftool
+
+    results = {
+        'stage.heif.opener_per_file': measure(
+            lambda: [pillow_heif.register_heif_opener() for _ in range(calls)], repeat=repeat, items=calls),
+        'stage.heif.opener_once': measure(
+            lambda: [heif.register_opener() for _ in range(calls)], repeat=repeat, items=calls),
+    }
+    entries = [entry for entry in corpus if entry['format'] == 'heic']
+    for entry in entries:
+        size = (preview_width, round(preview_width * entry['height'] / entry['width']))
+
+        def resize_full(path=entry['path'], size=size):
+            with Image.open(path) as img:
+                img.load()
+                img.resize(size, Image.LANCZOS)
+
+        def resize_thumbnail(path=entry['path'], size=size):
+            img = heif.open_reduced(path, size)
+            if img is None:
+                raise RuntimeError(f"{path} has no thumbnail of at least {size}")
+            img.resize(size, Image.LANCZOS)
+
+        results[f"stage.heif.resize_full.{entry['name']}"] = measure(resize_full, repeat=repeat, nbytes=entry['bytes'])
+        results[f"stage.heif.resize_thumbnail.{entry['name']}"] = measure(resize_thumbnail, repeat=repeat, nbytes=entry['bytes'])
+
+    if not shutil.which('exiftool'):
+        print('exiftool not found in PATH, skipping stage.heif.geotag_*')
+        return results
+
+    payload = sample_form_payload(load_city_presets()[0])
+    work_dir = tempfile.mkdtemp(prefix='bench_heif_')
+    try:
+        with app.app_context():
+            plan = build_exif_write_plan(payload, None, True)
+            for entry in entries:
+                jpeg_path = os.path.join(work_dir, entry['name'] + '.jpg')
+                heic_path = os.path.join(work_dir, entry['name'])
+
+                def geotag_jpeg(path=entry['path'], jpeg_path=jpeg_path):
+                    temp_path = jpeg_path + '.tmp.jpg'
+                    with Image.open(path) as img:
+                        img.convert('RGB').save(temp_path, 'JPEG', quality=95)
+                    ok = process_image_with_exiftool(temp_path, jpeg_path, plan)
+                    os.remove(temp_path)
+                    if not ok:
+                        raise RuntimeError(f"ExifTool write failed for {path}")
+
+                def geotag_in_place(path=entry['path'], heic_path=heic_path):
+                    if not process_image_with_exiftool(path, heic_path, plan):
+                        raise RuntimeError(f"ExifTool write failed for {path}")
+
+                results[f"stage.heif.geotag_jpeg.{entry['name']}"] = measure(geotag_jpeg, repeat=repeat, nbytes=entry['bytes'])
+                results[f"stage.heif.geotag_in_place.{entry['name']}"] = measure(geotag_in_place, repeat=repeat, nbytes=entry['bytes'])
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return results
+
+
+def bench_zip(app, corpus, repeat=3):
+    """Time zipping the whole corpus the way the blueprints build their downloads."""
+    total_bytes = sum(entry['bytes'] for entry in corpus)
+    work_dir = tempfile.mkdtemp(prefix='bench_zip_')
+    zip_path = os.path.join(work_dir, 'corpus.zip')
+
+    def run():
+        with zipfile.ZipFile(zip_path, 'w') as zipf:
+            for entry in corpus:
+                zipf.write(entry['path'], entry['name'])
+
+    try:
+        return {'stage.zip': measure(run, repeat=repeat, items=len(corpus), nbytes=total_bytes)}
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+STAGES = {
+    'coordinate_sampling': lambda app, corpus, repeat: bench_coordinate_sampling(app, repeat),
+    'tag_mapping': lambda app, corpus, repeat: bench_tag_mapping(app, repeat),
+    'decode': bench_decode,
+    'exiftool_write': bench_exiftool_write,
+    'zip': bench_zip,
+    'heif': bench_heif,
+}
+
+
+def run_stages(app, corpus, names=None, repeat=3):
+    """
+    Run the per-stage microbenchmarks.
+
+    Args:
+        app (Flask): Application providing the context the helpers log through
+        corpus (list): Corpus entries from benchmarks.corpus.generate_corpus
+        names (list): Stage names to run (default: all of STAGES)
+        repeat (int): Timed runs per benchmark
+
+    Returns:
+        dict: Benchmark name -> timing statistics
+    """
+    results = {}
+    for name in names or STAGES:
+        results.update(STAGES[name](app, corpus, repeat))
+    return results
@@ -0,0 +1,22 @@
+"""
+gunicorn settings, read automatically from the working directory (see Procfile).
+
+The app is built once in the master and the workers are forked from it, so
+they share Pillow, the route modules and the parsed presets copy-on-write (see
+src/utils/prefork.py). Settings given on the command line or in
+GUNICORN_CMD_ARGS take precedence; set GUNICORN_PRELOAD=0 to have every worker
+import the app itself.
+"""
+import os
+
+preload_app = os.environ.get('GUNICORN_PRELOAD', '1') != '0'
+
+
+def pre_fork(server, worker):
+    from src.utils import prefork
+    prefork.before_fork()
+
+
+def post_fork(server, worker):
+    from src.utils import prefork
+    prefork.after_fork()
@@ -2,7 +2,7 @@ import sys
 import os
 sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))  # DON'T CHANGE THIS !!!
 
-from flask import Flask, render_template, request, jsonify, send_file, redirect, url_for
+from flask import Flask, render_template, request, jsonify, send_file, redirect, url_for, current_app
 import json
 import uuid
 import shutil
@@ -28,38 +28,13 @@ from src.routes.conversion import conversion_bp
 from src.routes.resizing import resizing_bp
 from src.routes.watermark import watermark_bp
 from src.routes.presets import presets_bp
-
-# Create Flask app
-app = Flask(__name__)
-
-# Register blueprints
-app.register_blueprint(geotagging_bp, url_prefix='/api/geotagging')
-app.register_blueprint(conversion_bp, url_prefix='/api/conversion')
-app.register_blueprint(resizing_bp, url_prefix='/api/resizing')
-app.register_blueprint(watermark_bp, url_prefix='/api/watermark')
-app.register_blueprint(presets_bp, url_prefix='/api/presets')
-
-# Configure upload folder
-app.config['UPLOAD_FOLDER'] = os.path.join(tempfile.gettempdir(), 'image_processor_uploads')
-app.config['MAX_CONTENT_LENGTH'] = 2048 * 1024 * 1024  # 2GB max upload size
-app.config['SESSION_FOLDER'] = os.path.join(tempfile.gettempdir(), 'image_processor_sessions')
-app.config['PROCESSED_FOLDER'] = os.path.join(tempfile.gettempdir(), 'image_processor_processed')
-
-# Create necessary folders
-os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
-os.makedirs(app.config['SESSION_FOLDER'], exist_ok=True)
-os.makedirs(app.config['PROCESSED_FOLDER'], exist_ok=True)
-
-# Ensure static data directory exists
-static_data_dir = os.path.join(os.path.dirname(__file__), 'static', 'data')
-os.makedirs(static_data_dir, exist_ok=True)
+from src.routes.uploads import uploads_bp
+from src.utils import metrics, admission, exiftool_runner, storage, heif, sniff, scratch, prefork
 
 # Main route
-@app.route('/')
 def index():
     return render_template('index.html')
 
-@app.route('/exif', methods=['GET', 'POST'])
 def exif_viewer():
     if request.method == 'POST':
         if 'image' not in request.files:
@@ -97,9 +72,9 @@ def exif_viewer():
             exiftool_found_data = False
             try:
                 # Create a temporary file in a controlled temporary directory
-                # Use a specific session directory if possible, or app.config['UPLOAD_FOLDER']
+                # Use a specific session directory if possible, or current_app.config['UPLOAD_FOLDER']
                 session_id = str(uuid.uuid4())
-                temp_dir = os.path.join(app.config['UPLOAD_FOLDER'], session_id)
+                temp_dir = os.path.join(current_app.config['UPLOAD_FOLDER'], session_id)
                 os.makedirs(temp_dir, exist_ok=True)
                 
                 temp_file_path = os.path.join(temp_dir, secure_filename(file.filename or 'temp_image.jpg'))
@@ -112,8 +87,7 @@ def exif_viewer():
                 # -G1: Group tags by family 1
                 # -a: Allow duplicate tags
                 # -u: Unknown tags
-                result = subprocess.run(['exiftool', '-j', '-a', '-u', '-G1', '-s', temp_file_path],
-                                         capture_output=True, text=True, check=False)
+                result = exiftool_runner.run(['exiftool', '-j', '-a', '-u', '-G1', '-s', temp_file_path])
                 
                 if result.returncode == 0 and result.stdout:
                     exiftool_output = json.loads(result.stdout)[0]
@@ -328,6 +302,8 @@ def exif_viewer():
             # Create a preview image (re-read from stream to ensure it's at the beginning)
             image_stream.seek(0)
             image = Image.open(image_stream)
+            # HEIC photos carry a downscaled copy, which is enough for the preview and far cheaper to decode
+            image = heif.preview_image(image, image_stream)
             buffered = BytesIO()
             # Convert to RGB before saving as JPEG if it's not (e.g., some PNGs or GIFs might be RGBA/P)
             if image.mode in ('RGBA', 'P'):
@@ -344,41 +320,38 @@ def exif_viewer():
     return render_template('exif.html')
 
 # Serve static files
-@app.route('/<path:filename>')
 def serve_static(filename):
-    return app.send_static_file(filename)
+    return current_app.send_static_file(filename)
 
 # Download processed files
-@app.route('/download/<session_id>')
 def download_file(session_id):
-    session_dir = os.path.join(app.config['SESSION_FOLDER'], session_id)
-    
-    if not os.path.exists(session_dir):
-        return jsonify({'error': 'Session not found'}), 404
-    
-    # Check if there's a zip file already
-    zip_path = os.path.join(session_dir, 'processed.zip')
+    session_dir = os.path.join(current_app.config['SESSION_FOLDER'], session_id)
+    store = storage.get_storage()
+    zip_key = storage.session_key(session_id, 'processed.zip')
     
-    if not os.path.exists(zip_path):
+    # Check if there's a zip file already (possibly published by another node)
+    if not store.exists(zip_key):
+        if not os.path.exists(session_dir):
+            return jsonify({'error': 'Session not found'}), 404
+
         # Create a zip file of all processed files
-        with zipfile.ZipFile(zip_path, 'w') as zipf:
-            for root, _, files in os.walk(session_dir):
-                if root == session_dir:
-                    continue
-                    
-                for file in files:
-                    file_path = os.path.join(root, file)
-                    arcname = os.path.relpath(file_path, session_dir)
-                    zipf.write(file_path, arcname)
+        with store.open_write(zip_key) as fp:
+            with zipfile.ZipFile(fp, 'w') as zipf:
+                for root, _, files in os.walk(session_dir):
+                    if root == session_dir:
+                        continue
+                        
+                    for file in files:
+                        file_path = os.path.join(root, file)
+                        arcname = os.path.relpath(file_path, session_dir)
+                        zipf.write(file_path, arcname)
     
-    return send_file(zip_path, as_attachment=True, download_name='processed_images.zip')
+    return store.send_download(zip_key, download_name='processed_images.zip', mimetype='application/zip')
 
 # Error handlers
-@app.errorhandler(404)
 def not_found(error):
     return jsonify({'error': 'Not found'}), 404
 
-@app.errorhandler(500)
 def server_error(error):
     return jsonify({'error': 'Server error'}), 500
 
@@ -391,20 +364,87 @@ def allowed_file(filename):
 def create_session():
     """Create a new session directory and return its ID."""
     session_id = str(uuid.uuid4())
-    session_dir = os.path.join(app.config['SESSION_FOLDER'], session_id)
+    session_dir = os.path.join(current_app.config['SESSION_FOLDER'], session_id)
     os.makedirs(session_dir, exist_ok=True)
     return session_id, session_dir
 
 def cleanup_old_sessions():
     """Clean up sessions older than 1 hour."""
     now = time.time()
-    for session_id in os.listdir(app.config['SESSION_FOLDER']):
-        session_dir = os.path.join(app.config['SESSION_FOLDER'], session_id)
+    for session_id in os.listdir(current_app.config['SESSION_FOLDER']):
+        session_dir = os.path.join(current_app.config['SESSION_FOLDER'], session_id)
         if os.path.isdir(session_dir) and (now - os.path.getmtime(session_dir)) > 3600:
             shutil.rmtree(session_dir, ignore_errors=True)
 
-# Run cleanup on startup
-cleanup_old_sessions()
+def create_app():
+    """
+    Build the application.
+
+    Everything done here survives fork(), so gunicorn can run it once in the
+    master with preload_app and fork the workers from the result; per-worker
+    resources are created after the fork (see src/utils/prefork.py).
+    """
+    app = Flask(__name__)
+
+    # Register blueprints
+    app.register_blueprint(geotagging_bp, url_prefix='/api/geotagging')
+    app.register_blueprint(conversion_bp, url_prefix='/api/conversion')
+    app.register_blueprint(resizing_bp, url_prefix='/api/resizing')
+    app.register_blueprint(watermark_bp, url_prefix='/api/watermark')
+    app.register_blueprint(presets_bp, url_prefix='/api/presets')
+    app.register_blueprint(uploads_bp, url_prefix='/api/uploads')
+
+    # Expose per-stage processing metrics on /metrics
+    metrics.init_app(app)
+
+    # Bound concurrent decodes by a host-wide memory budget and reject decompression bombs
+    admission.init_app(app)
+
+    # Check the first bytes of uploaded images while the body streams in; mislabeled files are never written
+    sniff.init_app(app)
+
+    # Configure upload folder
+    app.config['UPLOAD_FOLDER'] = os.path.join(tempfile.gettempdir(), 'image_processor_uploads')
+    app.config['MAX_CONTENT_LENGTH'] = 2048 * 1024 * 1024  # 2GB max upload size
+    app.config['SESSION_FOLDER'] = os.path.join(tempfile.gettempdir(), 'image_processor_sessions')
+    app.config['PROCESSED_FOLDER'] = os.path.join(tempfile.gettempdir(), 'image_processor_processed')
+
+    # Create necessary folders
+    os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+    os.makedirs(app.config['SESSION_FOLDER'], exist_ok=True)
+    os.makedirs(app.config['PROCESSED_FOLDER'], exist_ok=True)
+
+    # Publish downloads and progress through the configured storage backend (local folders or S3)
+    storage.init_app(app)
+
+    # Keep uploads and intermediate files in RAM-backed scratch space (/dev/shm) while they fit
+    scratch.init_app(app)
+
+    # Open HEIF/HEIC files through Pillow (registered once here instead of per file)
+    heif.register_opener()
+
+    # Ensure static data directory exists
+    static_data_dir = os.path.join(os.path.dirname(__file__), 'static', 'data')
+    os.makedirs(static_data_dir, exist_ok=True)
+
+    # Routes and error handlers
+    app.add_url_rule('/', view_func=index)
+    app.add_url_rule('/exif', view_func=exif_viewer, methods=['GET', 'POST'])
+    app.add_url_rule('/<path:filename>', view_func=serve_static)
+    app.add_url_rule('/download/<session_id>', view_func=download_file)
+    app.register_error_handler(404, not_found)
+    app.register_error_handler(500, server_error)
+
+    # Run cleanup on startup
+    with app.app_context():
+        cleanup_old_sessions()
+
+    # Load Pillow's plugins and parse the presets now, so preloaded workers share them
+    prefork.init_app(app)
+
+    return app
+
+app = create_app()
 
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=5000, debug=True)
@@ -0,0 +1,251 @@
+"""
+ASGI entry point.
+
+    uvicorn src.asgi:app --host 0.0.0.0 --port $PORT --workers 2
+    gunicorn -k uvicorn.workers.UvicornWorker --workers 2 src.asgi:app
+
+Serves the same routes as src/app.py, but slow clients no longer tie up a
+worker:
+
+- Request bodies are received on the event loop and spooled to a temporary
+  file. The Flask app only sees a request once its body is complete, so a
+  1 GB upload over a slow link costs a coroutine rather than a thread.
+- Resumable upload chunks (PUT /api/uploads/<id>) are handled natively: they
+  are streamed from the socket straight into the upload file with positioned
+  writes.
+- The Flask views themselves (PIL decoding, encoding, zipping) run in a
+  bounded thread pool of ASGI_WORKER_THREADS threads.
+- ExifTool is started with asyncio.create_subprocess_exec on the event loop
+  (see src/utils/exiftool_runner.py).
+- Response bodies, including file downloads, are read in the thread pool and
+  sent from the event loop.
+"""
+import sys
+import os
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+
+import asyncio
+import tempfile
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
+from starlette.applications import Starlette
+from starlette.requests import ClientDisconnect
+from starlette.responses import JSONResponse
+from starlette.routing import Route, Mount
+
+from src.app import app as flask_app
+from src.routes import uploads
+from src.utils import metrics, exiftool_runner, sniff
+
+SPOOL_MAX_MEMORY = 1024 * 1024  # request bodies larger than this are spooled to disk
+DEFAULT_WORKER_THREADS = min(32, (os.cpu_count() or 1) + 4)
+
+executor = ThreadPoolExecutor(
+    max_workers=int(os.environ.get('ASGI_WORKER_THREADS') or DEFAULT_WORKER_THREADS),
+    thread_name_prefix='asgi-wsgi',
+)
+
+
+def _in_app_context(func, *args):
+    with flask_app.app_context():
+        return func(*args)
+
+
+async def _run_sync(func, *args):
+    """Run blocking work in the Flask thread pool without blocking the event loop."""
+    return await asyncio.get_running_loop().run_in_executor(executor, func, *args)
+
+
+async def _run_io(func, *args):
+    """Run short blocking file I/O in the default pool, so it never queues behind image processing."""
+    return await asyncio.get_running_loop().run_in_executor(None, func, *args)
+
+
+def build_environ(scope, body):
+    """Build a WSGI environ for an ASGI HTTP scope and its (already received) body."""
+    script_name = scope.get('root_path', '').encode('utf8').decode('latin1')
+    path_info = scope['path'].encode('utf8').decode('latin1')
+    if path_info.startswith(script_name):
+        path_info = path_info[len(script_name):]
+    server = scope.get('server') or ('localhost', 80)
+
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': script_name,
+        'PATH_INFO': path_info,
+        'QUERY_STRING': scope['query_string'].decode('ascii'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': f"HTTP/{scope['http_version']}",
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': body,
+        'wsgi.input_terminated': True,
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    if scope.get('client'):
+        environ['REMOTE_ADDR'] = scope['client'][0]
+
+    for name, value in scope.get('headers', []):
+        name = name.decode('latin1')
+        if name == 'content-length':
+            key = 'CONTENT_LENGTH'
+        elif name == 'content-type':
+            key = 'CONTENT_TYPE'
+        else:
+            key = 'HTTP_' + name.upper().replace('-', '_')
+        value = value.decode('latin1')
+        environ[key] = f"{environ[key]},{value}" if key in environ else value
+    return environ
+
+
+class SpooledWSGIApp:
+    """
+    Serve a WSGI app from ASGI, receiving request bodies on the event loop.
+
+    Unlike starlette's WSGIMiddleware, bodies are spooled to a temporary file
+    instead of being held in memory, and requests larger than the app's
+    MAX_CONTENT_LENGTH are refused: before their body is read when they
+    declare a Content-Length, otherwise as soon as the limit is passed.
+    """
+
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return
+
+        headers = dict(scope.get('headers', []))
+        max_length = flask_app.config.get('MAX_CONTENT_LENGTH')
+        declared = headers.get(b'content-length', b'')
+        if max_length and declared.isdigit() and int(declared) > max_length:
+            await self._too_large(max_length, scope, receive, send)
+            return
+
+        body = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_MEMORY, dir=flask_app.config.get('UPLOAD_FOLDER'))
+        try:
+            received = 0
+            more_body = True
+            while more_body:
+                message = await receive()
+                if message['type'] == 'http.disconnect':
+                    return  # Client went away mid-upload; nothing reached the app
+                chunk = message.get('body', b'')
+                received += len(chunk)
+                # Chunked bodies (or a wrong Content-Length) are only caught while they are read
+                if max_length and received > max_length:
+                    await self._too_large(max_length, scope, receive, send)
+                    return
+                body.write(chunk)
+                more_body = message.get('more_body', False)
+            body.seek(0)
+            await self._respond(build_environ(scope, body), send)
+        finally:
+            body.close()
+
+    @staticmethod
+    async def _too_large(max_length, scope, receive, send):
+        await JSONResponse({'error': 'Request too large',
+                            'details': f'The request exceeds the {max_length} byte limit'}, status_code=413)(scope, receive, send)
+
+    async def _respond(self, environ, send):
+        loop = asyncio.get_running_loop()
+        started = {}
+
+        def start_response(status, response_headers, exc_info=None):
+            started['status'] = int(status.split(' ', 1)[0])
+            started['headers'] = [(name.lower().encode('latin1'), value.encode('latin1'))
+                                  for name, value in response_headers]
+            return lambda data: None  # The legacy write() callable is not used by Flask
+
+        iterable = await _run_sync(self.wsgi_app, environ, start_response)
+        iterator = iter(iterable)
+        try:
+            await send({'type': 'http.response.start', 'status': started['status'], 'headers': started['headers']})
+            while True:
+                chunk = await loop.run_in_executor(executor, next, iterator, None)
+                if chunk is None:
+                    break
+                if chunk:
+                    await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+            await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+        finally:
+            if hasattr(iterable, 'close'):
+                await _run_sync(iterable.close)
+
+
+async def upload_chunk(request):
+    """
+    Write one chunk of a resumable upload, streaming it from the socket into the upload file.
+
+    Same contract as PUT /api/uploads/<id> in src/routes/uploads.py.
+    """
+    upload_id = request.path_params['upload_id']
+    content_length = request.headers.get('content-length', '')
+    try:
+        offset, length = await _run_io(
+            _in_app_context, uploads.check_chunk, upload_id, request.headers,
+            int(content_length) if content_length.isdigit() else None)
+        path = await _run_io(_in_app_context, uploads.data_path, upload_id)
+    except uploads.UploadError as e:
+        return JSONResponse({'error': e.message, 'details': e.details}, status_code=e.status)
+
+    written = 0
+    # The chunk at offset 0 starts with the file signature: hold it back until it is checked
+    head = b'' if offset == 0 else None
+    needed = min(sniff.SNIFF_BYTES, length)
+    with metrics.stage_timer('uploads', 'upload_save'):
+        fd = os.open(path, os.O_WRONLY)
+        try:
+            async for buf in request.stream():
+                if head is not None:
+                    head += buf
+                    if len(head) < needed:
+                        continue
+                    await _run_io(_in_app_context, uploads.check_head, upload_id, head[:needed])
+                    buf, head = head, None
+                buf = buf[:length - written]
+                if buf:
+                    await _run_io(os.pwrite, fd, buf, offset + written)
+                    written += len(buf)
+            if head:
+                # Shorter than the signature check needs (the client went away); finalize checks the head again
+                await _run_io(os.pwrite, fd, head[:length], offset)
+                written = len(head[:length])
+        except ClientDisconnect:
+            pass  # What arrived is kept; the client resumes from Upload-Offset
+        except uploads.UploadError as e:
+            return JSONResponse({'error': e.message, 'details': e.details}, status_code=e.status)
+        finally:
+            os.close(fd)
+    metrics.count_bytes('uploads', 'in', written)
+    await _run_io(metrics.flush)
+
+    meta = await _run_io(_in_app_context, uploads.record_chunk, upload_id, offset, written)
+    state, upload_offset = uploads.chunk_response_state(meta)
+    return JSONResponse(state, status_code=200 if written == length else 400,
+                        headers={'Upload-Offset': upload_offset})
+
+
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    exiftool_runner.bind_event_loop(asyncio.get_running_loop())
+    try:
+        yield
+    finally:
+        exiftool_runner.bind_event_loop(None)
+        metrics.flush()
+
+
+app = Starlette(
+    routes=[
+        Route('/api/uploads/{upload_id}', upload_chunk, methods=['PUT', 'PATCH']),
+        # Everything else is served by the Flask app
+        Mount('', app=SpooledWSGIApp(flask_app.wsgi_app)),
+    ],
+    lifespan=lifespan,
+)
@@ -0,0 +1,485 @@
+"""
+Command-line bulk runner for images that already live on the server.
+
+    python -m src.cli geotag --output /nas/tagged --city-preset "USA/NC/charlotte" --client-preset 1 /nas/shoot
+    python -m src.cli convert --output /nas/webp --format webp --profile web-small /nas/shoot
+    python -m src.cli resize --output /nas/small --width 1600 --mode fit /nas/shoot
+    python -m src.cli watermark --output /nas/marked --text "(c) Studio" --position bottom_right /nas/shoot
+
+Runs the same per-file code as the web endpoints (geotagging.geotag_batch,
+conversion.convert_file, resizing.resize_file, watermark.watermark_file) on
+local directory trees, without uploading anything:
+
+- Every image keeps its path relative to the directory it was found in, as
+  `original_relative_path` does for browser uploads (prefixed with the
+  directory's name when several directories are given). Inputs are never
+  modified.
+- Files are processed by a pool of --workers processes (default: one per CPU).
+  Geotagging hands each worker EXIFTOOL_BATCH_SIZE files at a time, so files
+  still share ExifTool runs.
+- Progress is shown on stderr, and a JSON summary (counts, size report, the
+  geotagging reports and every error) is written to --summary (default:
+  summary.json in the output directory).
+
+The exit status is 0 when every file was processed, 1 when some failed and
+2 for invalid arguments.
+"""
+import sys
+import os
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+
+import time
+import json
+import logging
+import argparse
+import datetime
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+OPERATIONS = ('geotag', 'convert', 'resize', 'watermark')
+
+# Files per task for the pixel operations; geotagging uses EXIFTOOL_BATCH_SIZE
+CHUNK_SIZE = 8
+
+# Set in each worker process by _init_worker
+_worker = {}
+
+
+def find_images(roots, output_dir, allowed_file):
+    """
+    All images below `roots`, with their relative paths.
+
+    Args:
+        roots (list): Directories (or single files)
+        output_dir (str): Output directory, skipped if it lies inside a root
+        allowed_file (callable): Extension check of the operation's blueprint
+
+    Returns:
+        list: (path, relative_path) pairs, sorted by relative path
+    """
+    output_dir = os.path.realpath(output_dir)
+    found = []
+    for root in roots:
+        root = os.path.realpath(root)
+        if os.path.isfile(root):
+            if allowed_file(os.path.basename(root)):
+                found.append((root, os.path.basename(root)))
+            continue
+        prefix = os.path.basename(root) if len(roots) > 1 else ''
+        for directory, subdirs, files in os.walk(root):
+            subdirs[:] = sorted(d for d in subdirs if not d.startswith('.')
+                                and os.path.realpath(os.path.join(directory, d)) != output_dir)
+            for name in files:
+                if name.startswith('.') or not allowed_file(name):
+                    continue
+                path = os.path.join(directory, name)
+                relative = os.path.relpath(path, root)
+                if prefix:
+                    relative = os.path.join(prefix, relative)
+                found.append((path, relative.replace(os.sep, '/')))
+    return sorted(found, key=lambda item: item[1])
+
+
+def output_paths(images, output_dir, output_format):
+    """
+    Output path for every image: its relative path with the new extension.
+
+    'a.png' and 'a.jpg' in the same folder would both become 'a.webp'; the
+    second keeps its old extension in the name ('a_jpg.webp') instead of
+    overwriting the first.
+    """
+    taken = set()
+    paths = []
+    for _, relative in images:
+        stem, extension = os.path.splitext(relative)
+        output = f"{stem}.{output_format}"
+        if output.lower() in taken:
+            output = f"{stem}_{extension[1:].lower()}.{output_format}"
+        taken.add(output.lower())
+        paths.append(os.path.join(output_dir, *output.split('/')))
+    return paths
+
+
+def _init_worker(operation, options, verbose):
+    """Process pool initializer: an app context and the operation's settings for this worker."""
+    from src.app import app
+    from src.utils import prefork
+    # Forked workers share the parent's app; give them their own storage clients
+    prefork.after_fork()
+    if not verbose:
+        app.logger.setLevel(logging.WARNING)
+    app.app_context().push()
+    _worker.update(operation=operation, options=dict(options))
+
+    if operation == 'watermark' and options.get('watermark_image'):
+        from PIL import Image
+        with Image.open(options['watermark_image']) as img:
+            _worker['watermark_img'] = img.convert('RGBA')
+    if options.get('target_bytes'):
+        from src.utils import encoders
+        _worker['target_encoder'] = encoders.TargetSizeEncoder(
+            options['target_bytes'], options['output_format'], options['encoder_profile'], options['allow_downscale'])
+
+
+def _run_chunk(tasks):
+    """
+    Process one chunk of files in a worker.
+
+    Args:
+        tasks (list): (path, relative_path, output_path) tuples; output_path is None for geotagging
+
+    Returns:
+        dict: 'files' (one result dict per task) and, for geotagging, the batch's reports
+    """
+    operation, options = _worker['operation'], _worker['options']
+    if operation == 'geotag':
+        return _geotag_chunk(tasks, options)
+
+    from src.routes import conversion, resizing, watermark
+    results = []
+    for path, relative, output_path in tasks:
+        result = {'source': path, 'relative_path': relative}
+        try:
+            os.makedirs(os.path.dirname(output_path), exist_ok=True)
+            target_report = None
+            if operation == 'convert':
+                size_report, target_report = conversion.convert_file(
+                    path, output_path, options['output_format'], options['encoder_profile'], _worker.get('target_encoder'))
+            elif operation == 'resize':
+                size_report, target_report = resizing.resize_file(
+                    path, output_path, options['output_format'], options['resize_mode'], options['width'],
+                    options['height'], options['percentage'], options['encoder_profile'], _worker.get('target_encoder'))
+            else:
+                size_report = watermark.watermark_file(
+                    path, output_path, options['output_format'], options['watermark_type'], options['watermark_text'],
+                    _worker.get('watermark_img'), options['position'], options['opacity'], options['size'],
+                    options['encoder_profile'])
+            result.update(output=output_path, size_report=dict(size_report, file=relative))
+            if target_report:
+                result['target_report'] = dict(target_report, file=relative)
+        except Exception as e:
+            result['error'] = str(e)
+        results.append(result)
+    return {'files': results}
+
+
+def _geotag_chunk(tasks, options):
+    from src.routes import geotagging
+    items = [{'original_relative_path': relative, 'uploaded_temp_path': path, 'original_filename': os.path.basename(path)}
+             for path, relative, _ in tasks]
+    try:
+        batch = geotagging.geotag_batch(
+            items, options['output_dir'], options['exif_data'], file_manifest=options.get('manifest'),
+            manifest_fields=options.get('manifest_fields'), track=options.get('track'),
+            track_offset_ms=options['track_offset_ms'], track_max_gap=options['track_max_gap'],
+            reconcile_mode=options['reconcile_mode'], jpeg_options=options['jpeg_options'],
+            keep_heic=options['keep_heic'], consume_inputs=False)
+    except Exception as e:
+        return {'files': [{'source': path, 'relative_path': relative, 'error': str(e)} for path, relative, _ in tasks]}
+
+    done = {entry['original_relative_path']: entry for entry in batch['processed_files']}
+    sizes = {report.get('file'): report for report in batch['size_reports']}
+    results = []
+    for path, relative, _ in tasks:
+        result = {'source': path, 'relative_path': relative}
+        entry = done.get(relative)
+        if entry is None:
+            name = os.path.basename(path)
+            result['error'] = next((e for e in batch['errors'] if name in e), 'Geotagging failed')
+        else:
+            result['output'] = entry['processed_path']
+            if entry.get('unchanged'):
+                result['unchanged'] = True
+            size_report = sizes.get(relative)
+            if size_report:
+                result['size_report'] = size_report
+        results.append(result)
+    return {'files': results, 'track_report': batch['track_report'], 'reconcile_report': batch['reconcile_report']}
+
+
+def merge_reports(total, report):
+    """Add a chunk's report to the running total: numbers are summed and lists joined."""
+    if report is None:
+        return total
+    if total is None:
+        return {key: list(value) if isinstance(value, list) else value for key, value in report.items()}
+    for key, value in report.items():
+        if isinstance(value, bool) or not isinstance(value, (int, float, list)):
+            total.setdefault(key, value)
+        elif isinstance(value, list):
+            total[key] = total.get(key, []) + value
+        else:
+            total[key] = total.get(key, 0) + value
+    return total
+
+
+class Progress:
+    """One-line progress display on stderr (a line every few seconds when stderr is not a terminal)."""
+
+    def __init__(self, label, total, enabled=True):
+        self.label = label
+        self.total = total
+        self.enabled = enabled
+        self.done = 0
+        self.failed = 0
+        self.started = time.monotonic()
+        self._last = 0.0
+        self._tty = sys.stderr.isatty()
+
+    def update(self, done, failed):
+        self.done += done
+        self.failed += failed
+        now = time.monotonic()
+        if not self.enabled or (now - self._last < (0.2 if self._tty else 5.0) and self.done < self.total):
+            return
+        self._last = now
+        elapsed = now - self.started
+        rate = self.done / elapsed if elapsed > 0 else 0.0
+        eta = f", {int((self.total - self.done) / rate)}s left" if rate and self.done < self.total else ''
+        line = (f"{self.label}: {self.done}/{self.total} files ({self.done * 100 // max(self.total, 1)}%), "
+                f"{self.failed} failed, {rate:.1f} files/s{eta}")
+        if self._tty:
+            sys.stderr.write('\r' + line.ljust(79))
+            if self.done >= self.total:
+                sys.stderr.write('\n')
+        else:
+            sys.stderr.write(line + '\n')
+        sys.stderr.flush()
+
+
+def _options(args, app):
+    """
+    Settings for the operation, validated the way the endpoints validate their forms.
+
+    Raises:
+        SystemExit: For invalid settings
+    """
+    from src.utils import encoders
+    options = {'output_dir': os.path.realpath(args.output)}
+
+    if args.operation == 'geotag':
+        from src.routes import geotagging, presets
+        from src.utils import manifest, tracklog, reconcile
+        from src.watcher import load_presets
+        exif_data = load_presets(app, args.city_preset, args.client_preset) if (args.city_preset or args.client_preset) else {}
+        if args.exif_data:
+            try:
+                exif_data.update(json.loads(args.exif_data))
+            except json.JSONDecodeError as e:
+                raise SystemExit(f"Invalid --exif-data: {e}")
+        if args.profile and args.profile not in encoders.PROFILES:
+            raise SystemExit(f"Unknown encoder profile '{args.profile}' (available: {', '.join(encoders.PROFILES)})")
+        options.update(exif_data=exif_data, reconcile_mode=args.reconcile, keep_heic=args.keep_heic, track=None, track_offset_ms=0,
+                       track_max_gap=args.track_max_gap,
+                       jpeg_options=encoders.save_options('jpeg', args.profile) if args.profile else {'quality': 95})
+        if args.track:
+            try:
+                options['track_offset_ms'] = tracklog.parse_offset(args.track_offset)
+                options['track'] = tracklog.Track.concatenate([tracklog.parse_track(path) for path in args.track])
+            except ValueError as e:
+                raise SystemExit(f"Invalid track log: {e}")
+        if args.manifest:
+            try:
+                with open(args.manifest, 'rb') as f:
+                    file_manifest = manifest.parse_manifest(f.read(), args.manifest)
+                client_presets = None
+                if 'client_preset' in file_manifest.columns:
+                    with app.app_context():
+                        client_presets = {str(p.get('id')): p for p in presets.client_document().read().get('presets', [])}
+                options['manifest'] = file_manifest
+                options['manifest_fields'] = [manifest.form_fields(group, client_presets) for group in file_manifest.groups]
+            except (OSError, manifest.ManifestError) as e:
+                raise SystemExit(f"Invalid manifest: {e}")
+        if not (exif_data or options['track'] or args.manifest):
+            raise SystemExit('Nothing to write: give presets, --exif-data, --track or --manifest')
+        return options
+
+    try:
+        output_format, encoder_profile = encoders.resolve(args.format, args.profile)
+        target_bytes = encoders.parse_byte_size(getattr(args, 'target_size', None))
+    except encoders.EncoderError as e:
+        raise SystemExit(str(e))
+    options.update(output_format=output_format, encoder_profile=encoder_profile, target_bytes=target_bytes,
+                   allow_downscale=getattr(args, 'allow_downscale', False))
+
+    if args.operation == 'resize':
+        if args.mode == 'percentage' and not 0 < args.percentage <= 1000:
+            raise SystemExit('Percentage must be between 1 and 1000')
+        if args.mode != 'percentage' and not args.width and not args.height:
+            raise SystemExit('Width or height must be provided')
+        options.update(resize_mode=args.mode, width=args.width, height=args.height, percentage=args.percentage)
+    elif args.operation == 'watermark':
+        if not args.text and not args.image:
+            raise SystemExit('Give --text or --image')
+        options.update(watermark_type='image' if args.image else 'text', watermark_text=args.text or '',
+                       watermark_image=os.path.realpath(args.image) if args.image else None, position=args.position,
+                       opacity=min(max(args.opacity, 0), 100), size=min(max(args.size, 1), 100))
+    return options
+
+
+def run(args):
+    """
+    Run one bulk operation.
+
+    Returns:
+        dict: The JSON summary
+    """
+    from src.app import app
+    from src.routes import geotagging, conversion, resizing, watermark
+    from src.utils import encoders
+
+    allowed_file = {'geotag': geotagging.allowed_file, 'convert': conversion.allowed_file,
+                    'resize': resizing.allowed_file, 'watermark': watermark.allowed_file}[args.operation]
+    options = _options(args, app)
+    os.makedirs(options['output_dir'], exist_ok=True)
+
+    images = find_images(args.directories, options['output_dir'], allowed_file)
+    if args.operation == 'geotag':
+        tasks = [(path, relative, None) for path, relative in images]
+        with app.app_context():
+            chunk_size = geotagging.get_exiftool_batch_size()
+    else:
+        tasks = [(path, relative, output) for (path, relative), output
+                 in zip(images, output_paths(images, options['output_dir'], options['output_format']))]
+        chunk_size = CHUNK_SIZE
+    workers = max(1, min(args.workers or os.cpu_count() or 1, len(tasks) or 1))
+    # Spread small runs over all workers rather than filling one chunk at a time
+    chunk_size = max(1, min(chunk_size, -(-len(tasks) // workers)))
+    chunks = [tasks[i:i + chunk_size] for i in range(0, len(tasks), chunk_size)]
+
+    started_at = datetime.datetime.now(datetime.timezone.utc)
+    progress = Progress(args.operation, len(tasks), enabled=not args.quiet)
+    files, track_report, reconcile_report = [], None, None
+    interrupted = False
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                             initargs=(args.operation, options, args.verbose)) as pool:
+        futures = [pool.submit(_run_chunk, chunk) for chunk in chunks]
+        try:
+            for future in as_completed(futures):
+                result = future.result()
+                files.extend(result['files'])
+                track_report = merge_reports(track_report, result.get('track_report'))
+                reconcile_report = merge_reports(reconcile_report, result.get('reconcile_report'))
+                progress.update(len(result['files']), sum(1 for f in result['files'] if 'error' in f))
+        except KeyboardInterrupt:
+            interrupted = True
+            for future in futures:
+                future.cancel()
+
+    files.sort(key=lambda f: f['relative_path'])
+    processed = [f for f in files if 'error' not in f]
+    size_reports = [f['size_report'] for f in processed if 'size_report' in f]
+    summary = {
+        'operation': args.operation,
+        'started_at': started_at.isoformat(timespec='seconds'),
+        'elapsed_seconds': round((datetime.datetime.now(datetime.timezone.utc) - started_at).total_seconds(), 3),
+        'interrupted': interrupted,
+        'workers': workers,
+        'directories': [os.path.realpath(d) for d in args.directories],
+        'output': options['output_dir'],
+        'file_count': len(tasks),
+        'processed': len(processed),
+        'failed': len(files) - len(processed),
+        'not_run': len(tasks) - len(files),
+        'size_report': encoders.summarize(size_reports),
+        'errors': [{'file': f['relative_path'], 'error': f['error']} for f in files if 'error' in f],
+        'files': [{key: f[key] for key in ('relative_path', 'source', 'output', 'unchanged') if key in f}
+                  for f in processed],
+    }
+    if options.get('target_bytes'):
+        summary['target_size_report'] = encoders.summarize_targets([f['target_report'] for f in processed if 'target_report' in f])
+    if args.operation == 'geotag':
+        summary['track_report'] = track_report
+        summary['reconcile_report'] = reconcile_report
+        file_manifest = options.get('manifest')
+        if file_manifest is not None:
+            rows = {relative: file_manifest.row_for(relative) for _, relative, _ in tasks}
+            used_rows = {row for row in rows.values() if row is not None}
+            summary['manifest_report'] = {
+                'rows': len(file_manifest),
+                'groups': len({file_manifest.group_of[row] for row in used_rows}),
+                'matched': len(used_rows),
+                'unlisted': [relative for relative, row in rows.items() if row is None],
+                'unused_rows': [file_manifest.paths[row] for row in range(len(file_manifest)) if row not in used_rows],
+            }
+    return summary
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Geotag, convert, resize or watermark images in local directories.')
+    subparsers = parser.add_subparsers(dest='operation', required=True)
+
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument('directories', nargs='+', help='Directories (or files) to process')
+    common.add_argument('--output', '-o', required=True, help='Output directory')
+    common.add_argument('--workers', '-j', type=int, default=None, help='Worker processes (default: one per CPU)')
+    common.add_argument('--summary', help='JSON summary file (default: summary.json in the output directory, - for stdout)')
+    common.add_argument('--quiet', '-q', action='store_true', help='No progress display')
+    common.add_argument('--verbose', '-v', action='store_true', help='Log every file')
+    common.add_argument('--profile', help='Encoder profile (default, web-small, archive, lossless)')
+
+    encoding = argparse.ArgumentParser(add_help=False)
+    encoding.add_argument('--format', '-f', help='Output format (jpeg, png, tiff, webp, avif, heic, bmp; default jpeg)')
+    encoding.add_argument('--target-size', help='Byte budget per output file, e.g. 500KB')
+    encoding.add_argument('--allow-downscale', action='store_true', help='Also shrink images that do not fit the budget')
+
+    geotag = subparsers.add_parser('geotag', parents=[common], help='Write GPS, location and contact metadata')
+    geotag.add_argument('--city-preset', help='City preset as COUNTRY/STATE_PROVINCE/ID (random point inside the city)')
+    geotag.add_argument('--client-preset', help='Client preset id')
+    geotag.add_argument('--exif-data', help='Geotagging form fields as JSON, e.g. \'{"Caption": "Kitchen"}\'')
+    geotag.add_argument('--manifest', help='CSV or JSON manifest with per-file metadata')
+    geotag.add_argument('--track', action='append', help='GPX or KML track log (repeatable)')
+    geotag.add_argument('--track-offset', default='', help='Seconds or [+-]H:MM to add to the camera clock to get UTC')
+    geotag.add_argument('--track-max-gap', type=float, default=300, help='Longest gap between fixes to interpolate across, in seconds')
+    geotag.add_argument('--keep-heic', action='store_true', help='Keep HEIC files as HEIC and write their metadata in place')
+    geotag.add_argument('--reconcile', choices=('off', 'changed', 'fill_missing'), default='off',
+                        help='Only write tags that differ or are missing')
+
+    subparsers.add_parser('convert', parents=[common, encoding], help='Convert to another format')
+
+    resize = subparsers.add_parser('resize', parents=[common, encoding], help='Resize')
+    resize.add_argument('--mode', choices=('exact', 'fit', 'fill', 'percentage'), default='fit')
+    resize.add_argument('--width', type=int)
+    resize.add_argument('--height', type=int)
+    resize.add_argument('--percentage', type=int, default=100)
+
+    mark = subparsers.add_parser('watermark', parents=[common, encoding], help='Add a text or image watermark')
+    mark.add_argument('--text', help='Watermark text')
+    mark.add_argument('--image', help='Watermark image')
+    mark.add_argument('--position', choices=('center', 'top_left', 'top_right', 'bottom_left', 'bottom_right'),
+                      default='bottom_right')
+    mark.add_argument('--opacity', type=int, default=50, help='0-100')
+    mark.add_argument('--size', type=int, default=30, help='Size in percent of the image, 1-100')
+
+    args = parser.parse_args(argv)
+    for directory in args.directories:
+        if not os.path.exists(directory):
+            parser.error(f"not found: {directory}")
+    return args
+
+
+def main(argv=None):
+    logging.basicConfig(level=logging.WARNING, format='%(levelname)s %(name)s: %(message)s')
+    args = parse_args(argv)
+    try:
+        summary = run(args)
+    except SystemExit as e:
+        if isinstance(e.code, str):
+            sys.stderr.write(f"error: {e.code}\n")
+            return 2
+        raise
+
+    text = json.dumps(summary, indent=2)
+    if args.summary == '-':
+        print(text)
+    else:
+        summary_path = args.summary or os.path.join(summary['output'], 'summary.json')
+        with open(summary_path, 'w') as f:
+            f.write(text + '\n')
+        if not args.quiet:
+            sys.stderr.write(f"{summary['processed']} of {summary['file_count']} files processed, "
+                             f"{summary['failed']} failed; summary written to {summary_path}\n")
+    return 0 if summary['processed'] == summary['file_count'] else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
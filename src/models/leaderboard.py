@@ -0,0 +1,491 @@
+"""
+SQLite-backed snake game leaderboard.
+
+Scores are kept twice: every game in `snake_scores` (history) and the best
+score per (username, location) in `snake_best_scores`, which is maintained on
+insert. Leaderboard reads are index range scans on the best-score table, so
+they stay fast no matter how many games have been played.
+
+Submitted scores go through a write-behind buffer: they are acknowledged
+immediately and written in batched transactions every SNAKE_FLUSH_INTERVAL
+seconds or once SNAKE_FLUSH_BATCH_SIZE scores are pending. Set
+SNAKE_WRITE_BEHIND=0 to write every score synchronously instead.
+"""
+import os
+import queue
+import atexit
+import logging
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_DB_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))), 'snake_scores.db')
+DEFAULT_POOL_SIZE = 4
+DEFAULT_LIMIT = 10
+MAX_CACHED_BOARDS = 256
+DEFAULT_FLUSH_INTERVAL = 0.25  # seconds
+DEFAULT_FLUSH_BATCH_SIZE = 500
+
+# UPSERT needs SQLite 3.24, RETURNING needs 3.35
+HAS_RETURNING = sqlite3.sqlite_version_info >= (3, 35, 0)
+
+SCHEMA = [
+    '''
+    CREATE TABLE IF NOT EXISTS locations (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        country TEXT NOT NULL,
+        state_province TEXT,
+        city TEXT,
+        UNIQUE(country, state_province, city)
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS snake_scores (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        username TEXT NOT NULL,
+        score INTEGER NOT NULL,
+        location_id INTEGER,
+        timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY (location_id) REFERENCES locations (id)
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS snake_best_scores (
+        username TEXT NOT NULL,
+        location_id INTEGER NOT NULL,
+        score INTEGER NOT NULL,
+        PRIMARY KEY (username, location_id)
+    ) WITHOUT ROWID
+    ''',
+]
+
+INDEXES = [
+    # Covering index for per-location history queries
+    'CREATE INDEX IF NOT EXISTS idx_snake_scores_location_score ON snake_scores (location_id, score DESC, username)',
+    # Top-N per location is a range scan on this index
+    'CREATE INDEX IF NOT EXISTS idx_snake_best_location_score ON snake_best_scores (location_id, score DESC, username)',
+    # Top-N across many locations (country / state filters, global board)
+    'CREATE INDEX IF NOT EXISTS idx_snake_best_score ON snake_best_scores (score DESC, location_id, username)',
+    'CREATE INDEX IF NOT EXISTS idx_locations_state ON locations (state_province, city)',
+]
+
+
+def get_db_path():
+    """Database path, overridable with the SNAKE_DB_PATH environment variable."""
+    return os.environ.get('SNAKE_DB_PATH', DEFAULT_DB_PATH)
+
+
+def write_behind_enabled():
+    return os.environ.get('SNAKE_WRITE_BEHIND', '1').lower() not in ('0', 'false', 'no')
+
+
+def normalize_location(country, state, city):
+    """Store missing state/city as '' so the UNIQUE constraint applies (NULLs never collide)."""
+    return (country or '').strip(), (state or '').strip(), (city or '').strip()
+
+
+class ConnectionPool:
+    """
+    Small per-process pool of SQLite connections in WAL mode.
+
+    Connections are created lazily and reused across requests. The pool notices
+    when it has been inherited through fork() and starts over, because SQLite
+    connections must not be shared between processes.
+    """
+
+    def __init__(self, db_path, size=DEFAULT_POOL_SIZE):
+        self.db_path = db_path
+        self.size = size
+        self._pid = os.getpid()
+        self._idle = queue.LifoQueue()
+        self._created = 0
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=30, check_same_thread=False, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute('PRAGMA busy_timeout=5000')
+        conn.execute('PRAGMA temp_store=MEMORY')
+        conn.execute('PRAGMA cache_size=-16000')  # 16 MB page cache
+        conn.execute('PRAGMA foreign_keys=ON')
+        return conn
+
+    def _check_fork(self):
+        if self._pid != os.getpid():
+            # Drop inherited connections without closing them; the parent still owns them
+            self._pid = os.getpid()
+            self._idle = queue.LifoQueue()
+            self._created = 0
+
+    @contextmanager
+    def connection(self):
+        """Borrow a connection for the duration of a with-block."""
+        with self._lock:
+            self._check_fork()
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                conn = None
+                if self._created < self.size:
+                    self._created += 1
+                    try:
+                        conn = self._connect()
+                    except Exception:
+                        self._created -= 1
+                        raise
+        if conn is None:
+            conn = self._idle.get()
+        try:
+            yield conn
+        finally:
+            if conn.in_transaction:
+                conn.rollback()
+            self._idle.put(conn)
+
+    def close_all(self):
+        """Close idle connections (used on shutdown and before forking workers)."""
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+        self._created = 0
+
+
+class LeaderboardCache:
+    """
+    In-memory top-N cache keyed by the (country, state, city, limit) filter.
+
+    Entries are dropped when a score is saved for a matching location in this
+    process, and are also tagged with the highest score id at fill time, so a
+    score saved by another worker invalidates them on the next read.
+    """
+
+    def __init__(self, max_entries=MAX_CACHED_BOARDS):
+        self.max_entries = max_entries
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, version):
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry and entry[0] == version:
+            return entry[1]
+        return None
+
+    def put(self, key, version, rows):
+        with self._lock:
+            if len(self._entries) >= self.max_entries:
+                self._entries.pop(next(iter(self._entries)))
+            self._entries[key] = (version, rows)
+
+    def invalidate_location(self, country, state, city):
+        """Drop every cached board whose filter includes this location."""
+        with self._lock:
+            for key in list(self._entries):
+                f_country, f_state, f_city, _ = key
+                if ((f_country is None or f_country == country) and
+                        (f_state is None or f_state == state) and
+                        (f_city is None or f_city == city)):
+                    del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class ScoreWriteBuffer:
+    """
+    Write-behind buffer for submitted scores.
+
+    submit() only appends to an in-memory list. A background thread flushes
+    the list in one transaction when it reaches `max_batch` entries or
+    `flush_interval` seconds after the first pending score, whichever comes
+    first. Best-score updates for the same (username, location) are coalesced
+    into one upsert per flush. Pending scores are flushed at interpreter exit.
+    """
+
+    def __init__(self, flush_interval=DEFAULT_FLUSH_INTERVAL, max_batch=DEFAULT_FLUSH_BATCH_SIZE):
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        self._pending = []
+        self._condition = threading.Condition()
+        self._flush_lock = threading.Lock()
+        self._thread = None
+        self._pid = os.getpid()
+        self._stopping = False
+
+    def _ensure_thread(self):
+        # Threads do not survive fork(); start a fresh flusher in each worker
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._pending = []
+            self._thread = None
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name='snake-score-flusher', daemon=True)
+            self._thread.start()
+
+    def submit(self, username, score, location):
+        """Queue one score; `location` is a normalized (country, state, city) tuple."""
+        with self._condition:
+            self._ensure_thread()
+            self._pending.append((username, score, location))
+            if len(self._pending) >= self.max_batch:
+                self._condition.notify()
+
+    def pending_count(self):
+        with self._condition:
+            return len(self._pending)
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._pending and not self._stopping:
+                    self._condition.wait()
+                if self._stopping:
+                    return
+                # Give the batch time to fill unless it is already full
+                if len(self._pending) < self.max_batch:
+                    self._condition.wait(self.flush_interval)
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"Error flushing snake scores, will retry: {e}")
+                with self._condition:
+                    self._condition.wait(self.flush_interval)
+
+    def flush(self):
+        """Write all pending scores now. Failed batches are put back for the next attempt."""
+        with self._flush_lock:
+            with self._condition:
+                batch, self._pending = self._pending, []
+            if not batch:
+                return 0
+            try:
+                with get_pool().connection() as conn:
+                    rows = [(username, score, get_location_id(conn, *location)) for username, score, location in batch]
+                    record_scores(conn, rows)
+            except Exception:
+                with self._condition:
+                    self._pending[:0] = batch
+                raise
+            return len(batch)
+
+    def close(self):
+        """Stop the flusher thread and write whatever is still pending."""
+        with self._condition:
+            self._stopping = True
+            self._condition.notify_all()
+        if self._thread is not None and self._thread.is_alive() and self._pid == os.getpid():
+            self._thread.join(timeout=5)
+        self.flush()
+
+
+_pool = None
+_pool_lock = threading.Lock()
+_cache = LeaderboardCache()
+_location_ids = {}  # normalized (country, state, city) -> locations.id
+_buffer = ScoreWriteBuffer(
+    flush_interval=float(os.environ.get('SNAKE_FLUSH_INTERVAL', DEFAULT_FLUSH_INTERVAL)),
+    max_batch=int(os.environ.get('SNAKE_FLUSH_BATCH_SIZE', DEFAULT_FLUSH_BATCH_SIZE)),
+)
+
+
+def get_pool():
+    """Return the process-wide connection pool, creating it on first use."""
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ConnectionPool(get_db_path())
+    return _pool
+
+
+def init_db():
+    """Create tables and indexes, migrate older databases and backfill best scores."""
+    with get_pool().connection() as conn:
+        for statement in SCHEMA:
+            conn.execute(statement)
+
+        # Databases created before locations existed have no location_id column
+        columns = {row['name'] for row in conn.execute('PRAGMA table_info(snake_scores)')}
+        if 'location_id' not in columns:
+            conn.execute('ALTER TABLE snake_scores ADD COLUMN location_id INTEGER REFERENCES locations (id)')
+
+        for statement in INDEXES:
+            conn.execute(statement)
+
+        # Backfill the best-score table the first time it is created on an existing history
+        has_best = conn.execute('SELECT 1 FROM snake_best_scores LIMIT 1').fetchone()
+        if not has_best:
+            conn.execute('''
+                INSERT OR IGNORE INTO snake_best_scores (username, location_id, score)
+                SELECT username, location_id, MAX(score)
+                FROM snake_scores
+                WHERE location_id IS NOT NULL
+                GROUP BY username, location_id
+            ''')
+        conn.execute('PRAGMA optimize')
+
+        # Warm the location id cache so score inserts never need a lookup query
+        _location_ids.clear()
+        for row in conn.execute('SELECT id, country, state_province, city FROM locations'):
+            _location_ids[normalize_location(row['country'], row['state_province'], row['city'])] = row['id']
+    _cache.clear()
+
+
+def resolve_location_id(conn, country, state, city):
+    """Get or create the id of a location in a single round-trip where SQLite allows it."""
+    if HAS_RETURNING:
+        return conn.execute('''
+            INSERT INTO locations (country, state_province, city)
+            VALUES (?, ?, ?)
+            ON CONFLICT (country, state_province, city) DO UPDATE SET country = excluded.country
+            RETURNING id
+        ''', (country, state, city)).fetchone()[0]
+
+    conn.execute('INSERT OR IGNORE INTO locations (country, state_province, city) VALUES (?, ?, ?)',
+                 (country, state, city))
+    return conn.execute('SELECT id FROM locations WHERE country = ? AND state_province = ? AND city = ?',
+                        (country, state, city)).fetchone()[0]
+
+
+def get_location_id(conn, country, state, city):
+    """Resolve a normalized location to its id, from the in-memory cache when possible."""
+    key = (country, state, city)
+    location_id = _location_ids.get(key)
+    if location_id is None:
+        location_id = _location_ids[key] = resolve_location_id(conn, country, state, city)
+    return location_id
+
+
+def record_scores(conn, rows):
+    """
+    Insert score rows and fold them into the best-score table inside one transaction.
+
+    Args:
+        conn (sqlite3.Connection): Pooled connection (autocommit mode)
+        rows (list): (username, score, location_id) tuples
+    """
+    # Coalesce to one best-score upsert per (username, location)
+    best = {}
+    for username, score, location_id in rows:
+        key = (username, location_id)
+        if key not in best or score > best[key]:
+            best[key] = score
+
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        conn.executemany('''
+            INSERT INTO snake_scores (username, score, location_id, timestamp)
+            VALUES (?, ?, ?, datetime('now'))
+        ''', rows)
+        conn.executemany('''
+            INSERT INTO snake_best_scores (username, location_id, score)
+            VALUES (?, ?, ?)
+            ON CONFLICT (username, location_id) DO UPDATE SET score = excluded.score
+            WHERE excluded.score > snake_best_scores.score
+        ''', [(username, location_id, score) for (username, location_id), score in best.items()])
+        conn.execute('COMMIT')
+    except Exception:
+        conn.execute('ROLLBACK')
+        raise
+
+
+def save_score(username, score, country, state=None, city=None):
+    """
+    Save one game's score and invalidate the cached boards it affects.
+
+    With write-behind enabled the score is only queued; it reaches the
+    database within the flush interval (or on the next leaderboard read in
+    this process).
+    """
+    location = normalize_location(country, state, city)
+    if write_behind_enabled():
+        _buffer.submit(username, int(score), location)
+    else:
+        with get_pool().connection() as conn:
+            record_scores(conn, [(username, int(score), get_location_id(conn, *location))])
+    _cache.invalidate_location(*location)
+
+
+def flush_scores():
+    """Write any buffered scores to the database now."""
+    return _buffer.flush()
+
+
+def shutdown():
+    """Flush buffered scores and close pooled connections (worker exit)."""
+    try:
+        _buffer.close()
+    except Exception as e:
+        logger.error(f"Error flushing snake scores on shutdown: {e}")
+    if _pool is not None:
+        _pool.close_all()
+
+
+atexit.register(shutdown)
+
+
+def _scores_version(conn):
+    # Scores are append-only, so the highest id changes whenever any worker inserts one
+    return conn.execute('SELECT MAX(id) FROM snake_scores').fetchone()[0]
+
+
+def get_top_scores(country=None, state=None, city=None, limit=DEFAULT_LIMIT):
+    """
+    Best score per (username, location) for the locations matching the filter.
+
+    Args:
+        country (str): Filter by country (optional)
+        state (str): Filter by state/province (optional)
+        city (str): Filter by city (optional)
+        limit (int): Number of entries to return
+
+    Returns:
+        list: Dicts with username, score, country, state and city, best first
+    """
+    # Make this worker's own recent submissions visible before reading
+    if _buffer.pending_count():
+        _buffer.flush()
+
+    key = (country or None, state or None, city or None, limit)
+    with get_pool().connection() as conn:
+        version = _scores_version(conn)
+        cached = _cache.get(key, version)
+        if cached is not None:
+            return cached
+
+        query = '''
+            SELECT b.username, b.score, l.country, l.state_province, l.city
+            FROM snake_best_scores b
+            JOIN locations l ON l.id = b.location_id
+            WHERE 1=1
+        '''
+        params = []
+        if country:
+            query += ' AND l.country = ?'
+            params.append(country)
+        if state:
+            query += ' AND l.state_province = ?'
+            params.append(state)
+        if city:
+            query += ' AND l.city = ?'
+            params.append(city)
+        query += ' ORDER BY b.score DESC, b.username LIMIT ?'
+        params.append(limit)
+
+        rows = [{
+            'username': row['username'],
+            'score': row['score'],
+            'country': row['country'],
+            'state': row['state_province'] or None,
+            'city': row['city'] or None,
+        } for row in conn.execute(query, params)]
+
+    _cache.put(key, version, rows)
+    return rows
@@ -0,0 +1,368 @@
+"""
+Indexed, queryable catalog of city presets.
+
+The city presets document (city_presets.json plus its change journal, see
+preset_store.py) stays the source of truth; this module mirrors it into SQLite so the UI can ask for one country's states or
+one state's city names instead of downloading and filtering the whole
+country -> state -> city tree.
+
+The mirror records which version of the document it was built from (the
+inode, mtime and size of the file and the journal). Single-preset changes made
+through the API are applied to it row by row in the same lock as the journal
+write. Any other change
+to the file (a whole-document POST, an edit by hand, a deploy) is noticed on
+the next query and triggers a rebuild.
+
+Every query is an index range scan:
+- countries / states: GROUP BY on the (country, state_province, id) primary key
+- city lists: (country, state_province, name_key, id), paged with a keyset cursor
+- name prefix search: name_key range on (name_key, id)
+- lookup by id: (id)
+"""
+import os
+import json
+import base64
+import logging
+import tempfile
+import threading
+from contextlib import contextmanager
+from src.models.leaderboard import ConnectionPool
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_DB_PATH = os.path.join(tempfile.gettempdir(), 'image_processor_preset_catalog.db')
+DEFAULT_LIMIT = 50
+MAX_LIMIT = 1000
+
+# Fields a query can ask for; 'boundaries' (and 'full') need the stored JSON document
+FIELDS = ('id', 'name', 'country', 'state_province', 'center', 'zoom_level', 'boundaries')
+DEFAULT_FIELDS = ('id', 'name')
+
+SCHEMA = [
+    '''
+    CREATE TABLE IF NOT EXISTS city_presets (
+        country TEXT NOT NULL,
+        state_province TEXT NOT NULL,
+        id TEXT NOT NULL,
+        name TEXT NOT NULL,
+        name_key TEXT NOT NULL,
+        center_lat REAL,
+        center_lng REAL,
+        zoom_level INTEGER,
+        data TEXT NOT NULL,
+        PRIMARY KEY (country, state_province, id)
+    ) WITHOUT ROWID
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS catalog_meta (
+        key TEXT PRIMARY KEY,
+        value TEXT NOT NULL
+    )
+    ''',
+]
+
+INDEXES = [
+    # City lists within a state, in display order
+    'CREATE INDEX IF NOT EXISTS idx_city_presets_state_name ON city_presets (country, state_province, name_key, id)',
+    # Name prefix search across the whole catalog
+    'CREATE INDEX IF NOT EXISTS idx_city_presets_name ON city_presets (name_key, id)',
+    'CREATE INDEX IF NOT EXISTS idx_city_presets_id ON city_presets (id)',
+]
+
+
+def get_db_path():
+    """Database path, overridable with the PRESET_CATALOG_DB_PATH environment variable."""
+    return os.environ.get('PRESET_CATALOG_DB_PATH', DEFAULT_DB_PATH)
+
+
+def name_key(name):
+    """Case-insensitive sort and prefix-search key for a city name."""
+    return (name or '').casefold()
+
+
+def parse_fields(value):
+    """
+    Parse a comma-separated field list.
+
+    Args:
+        value (str): e.g. 'id,name,center', or 'full' for complete presets (None for the defaults)
+
+    Returns:
+        tuple: Field names, or ('full',)
+
+    Raises:
+        ValueError: For unknown field names
+    """
+    if not value:
+        return DEFAULT_FIELDS
+    fields = tuple(f.strip() for f in value.split(',') if f.strip())
+    if fields == ('full',):
+        return fields
+    unknown = [f for f in fields if f not in FIELDS]
+    if unknown:
+        raise ValueError(f"Unknown fields: {', '.join(unknown)} (available: {', '.join(FIELDS)}, or 'full')")
+    return fields
+
+
+def encode_cursor(row):
+    return base64.urlsafe_b64encode(
+        json.dumps([row['country'], row['state_province'], row['name_key'], row['id']]).encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor):
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+    except (ValueError, UnicodeError):
+        raise ValueError('Invalid cursor')
+    if not isinstance(values, list) or len(values) != 4 or not all(isinstance(v, str) for v in values):
+        raise ValueError('Invalid cursor')
+    return values
+
+
+def _number(value):
+    """`value` if it is a number (not a bool), else None."""
+    return value if isinstance(value, (int, float)) and not isinstance(value, bool) else None
+
+
+def _row_values(country, state_province, preset):
+    """
+    Catalog row for one preset.
+
+    Fields of the wrong type (a non-string name, a center that is not an
+    object) are stored as if they were missing, so a hand-edited preset cannot
+    break the catalog. The complete preset is kept in `data` either way.
+    """
+    name = preset.get('name')
+    name = '' if name is None else str(name)
+    center = preset.get('center')
+    if not isinstance(center, dict):
+        center = {}
+    return (country, state_province, str(preset['id']), name, name_key(name),
+            _number(center.get('lat')), _number(center.get('lng')), _number(preset.get('zoom_level')),
+            json.dumps(preset))
+
+
+def _document_rows(document):
+    """Catalog rows for every city preset of a document, skipping (with a warning) entries that are not presets."""
+    rows = []
+    for country, states in (document.get('countries') or {}).items():
+        for state_province, cities in (states.items() if isinstance(states, dict) else ()):
+            for preset in (cities if isinstance(cities, list) else ()):
+                if not isinstance(preset, dict) or preset.get('id') is None:
+                    continue
+                try:
+                    rows.append(_row_values(country, state_province, preset))
+                except (TypeError, ValueError) as e:
+                    logger.warning(f"Skipping city preset {preset.get('id')!r} in {country}/{state_province}: {e}")
+    return rows
+
+
+INSERT_SQL = ('INSERT OR REPLACE INTO city_presets '
+              '(country, state_province, id, name, name_key, center_lat, center_lng, zoom_level, data) '
+              'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)')
+
+
+class PresetCatalog:
+    """SQLite mirror of one city presets document."""
+
+    def __init__(self, document, db_path):
+        """
+        Args:
+            document (PresetDocument): The city presets document
+            db_path (str): SQLite database file
+        """
+        self.document = document
+        self.pool = ConnectionPool(db_path)
+        self._synced = None  # Source identity this process last saw in the catalog
+        self._schema_ready = False
+        self._lock = threading.Lock()
+
+    def _ensure_schema(self, conn):
+        if self._schema_ready:
+            return
+        for statement in SCHEMA + INDEXES:
+            conn.execute(statement)
+        self._schema_ready = True
+
+    @staticmethod
+    def _stored_source(conn):
+        row = conn.execute("SELECT value FROM catalog_meta WHERE key = 'source'").fetchone()
+        return row[0] if row else None
+
+    @staticmethod
+    def _set_source(conn, source):
+        conn.execute("INSERT OR REPLACE INTO catalog_meta (key, value) VALUES ('source', ?)", (source,))
+
+    def _rebuild(self, conn, source):
+        # Identity is taken before reading, so a concurrent change can only cause another rebuild
+        rows = _document_rows(self.document.read())
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            if self._stored_source(conn) != source:
+                conn.execute('DELETE FROM city_presets')
+                conn.executemany(INSERT_SQL, rows)
+                self._set_source(conn, source)
+                logger.info(f"Rebuilt preset catalog with {len(rows)} cities")
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+
+    @contextmanager
+    def _connection(self):
+        """Borrow a connection to a catalog that matches the JSON file."""
+        source = self.document.identity()
+        with self.pool.connection() as conn:
+            with self._lock:
+                self._ensure_schema(conn)
+            if source != self._synced and self._stored_source(conn) != source:
+                self._rebuild(conn, source)
+            self._synced = source
+            yield conn
+
+    def _query(self, sql, params=()):
+        with self._connection() as conn:
+            return conn.execute(sql, params).fetchall()
+
+    def countries(self):
+        """[{name, cities}] for every country, sorted by name."""
+        rows = self._query('SELECT country, COUNT(*) AS cities FROM city_presets GROUP BY country ORDER BY country')
+        return [{'name': row['country'], 'cities': row['cities']} for row in rows]
+
+    def states(self, country):
+        """[{name, cities}] for every state or province of `country`, sorted by name."""
+        rows = self._query(
+            'SELECT state_province, COUNT(*) AS cities FROM city_presets WHERE country = ? '
+            'GROUP BY state_province ORDER BY state_province', (country,))
+        return [{'name': row['state_province'], 'cities': row['cities']} for row in rows]
+
+    def get(self, country, state_province, preset_id):
+        """The complete preset (with its country and state_province), or None."""
+        rows = self._query('SELECT country, state_province, data FROM city_presets '
+                           'WHERE country = ? AND state_province = ? AND id = ?', (country, state_province, preset_id))
+        return self._project(rows[0], ('full',)) if rows else None
+
+    def search(self, country=None, state_province=None, prefix=None, preset_id=None,
+               fields=DEFAULT_FIELDS, limit=DEFAULT_LIMIT, cursor=None):
+        """
+        Find city presets, ordered by country, state/province and name.
+
+        Args:
+            country (str): Only cities in this country
+            state_province (str): Only cities in this state or province
+            prefix (str): Only cities whose name starts with this (case-insensitive)
+            preset_id (str): Only cities with this id
+            fields (tuple): Fields to return (see parse_fields)
+            limit (int): Page size (at most MAX_LIMIT)
+            cursor (str): next_cursor of the previous page
+
+        Returns:
+            tuple: (list of presets, next_cursor or None)
+        """
+        where, params = [], []
+        if country:
+            where.append('country = ?')
+            params.append(country)
+        if state_province:
+            where.append('state_province = ?')
+            params.append(state_province)
+        if prefix:
+            key = name_key(prefix)
+            where.append('name_key >= ? AND name_key < ?')
+            params.extend([key, key + '\U0010ffff'])
+        if preset_id:
+            where.append('id = ?')
+            params.append(preset_id)
+        if cursor:
+            where.append('(country, state_province, name_key, id) > (?, ?, ?, ?)')
+            params.extend(decode_cursor(cursor))
+
+        limit = max(1, min(int(limit), MAX_LIMIT))
+        columns = 'country, state_province, id, name, name_key, center_lat, center_lng, zoom_level'
+        if 'full' in fields or 'boundaries' in fields:
+            columns += ', data'
+        sql = f'SELECT {columns} FROM city_presets'
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+        sql += ' ORDER BY country, state_province, name_key, id LIMIT ?'
+        rows = self._query(sql, params + [limit + 1])
+
+        next_cursor = encode_cursor(rows[limit - 1]) if len(rows) > limit else None
+        return [self._project(row, fields) for row in rows[:limit]], next_cursor
+
+    @staticmethod
+    def _project(row, fields):
+        if 'full' in fields:
+            return dict(json.loads(row['data']), country=row['country'], state_province=row['state_province'])
+        preset = {}
+        for field in fields:
+            if field == 'center':
+                preset['center'] = {'lat': row['center_lat'], 'lng': row['center_lng']}
+            elif field == 'boundaries':
+                preset['boundaries'] = json.loads(row['data']).get('boundaries')
+            else:
+                preset[field] = row[field]
+        return preset
+
+    def _apply(self, before, after, statements):
+        """
+        Apply row changes for a write the catalog was current for; otherwise leave it to the next rebuild.
+
+        `statements` is a function returning the (sql, params) pairs. It runs in
+        here, so a preset that cannot be turned into a row only costs the
+        incremental update, not the request whose write already succeeded.
+        """
+        try:
+            with self.pool.connection() as conn:
+                with self._lock:
+                    self._ensure_schema(conn)
+                conn.execute('BEGIN IMMEDIATE')
+                try:
+                    if self._stored_source(conn) == before:
+                        for sql, params in statements():
+                            conn.execute(sql, params)
+                        self._set_source(conn, after)
+                        self._synced = after
+                    conn.execute('COMMIT')
+                except Exception:
+                    conn.execute('ROLLBACK')
+                    raise
+        except Exception as e:
+            # The JSON write succeeded; a stale catalog is rebuilt on the next query
+            logger.warning(f"Could not update preset catalog incrementally: {e}")
+
+    def after_upsert(self, country, state_province):
+        """after_write callback (see PresetDocument.update) for preset_store.upsert_city."""
+        def after_write(before, after, result):
+            stored, _ = result
+            self._apply(before, after, lambda: [(INSERT_SQL, _row_values(country, state_province, stored))])
+        return after_write
+
+    def after_delete(self, country, state_province, preset_id):
+        """after_write callback (see PresetDocument.update) for preset_store.delete_city."""
+        def after_write(before, after, result):
+            self._apply(before, after, lambda: [(
+                'DELETE FROM city_presets WHERE country = ? AND state_province = ? AND id = ?',
+                (country, state_province, preset_id))])
+        return after_write
+
+
+_catalogs = {}
+_catalogs_lock = threading.Lock()
+
+
+def get_catalog(document):
+    """The shared PresetCatalog for a city presets document."""
+    db_path = get_db_path()
+    with _catalogs_lock:
+        catalog = _catalogs.get((document.path, db_path))
+        if catalog is None:
+            catalog = _catalogs[(document.path, db_path)] = PresetCatalog(document, db_path)
+        return catalog
+
+
+def close_all():
+    """Close the idle connections of every catalog in this process (before fork(), or on shutdown)."""
+    with _catalogs_lock:
+        for catalog in _catalogs.values():
+            catalog.pool.close_all()
@@ -0,0 +1,406 @@
+"""
+City and client preset documents with atomic, per-preset updates.
+
+Each document is a JSON file in static/data. Every change happens under an
+exclusive lock (a thread lock plus flock() on a lock file in the temp
+directory, so all gunicorn workers share it). Readers never see a
+half-written document.
+
+A single-preset change is not written into the JSON file. It is appended, as
+one line, to a change journal next to it (.city_presets.json.changes), so a
+PUT, PATCH or DELETE writes and fsyncs a few hundred bytes, not the whole
+catalog. The journal's first line names the version of the JSON file it
+applies to (inode, mtime and size). A journal left over from an older file,
+after a whole-document replace, an edit by hand or a deploy, is ignored.
+
+The document is the JSON file with the journal replayed on top. Both are
+cached per process: when another process appends, only the new lines are
+read and applied, and each one copies just the branch it touches. The JSON
+file is parsed again only when it is replaced. That happens on a
+whole-document POST, and when the journal reaches COMPACT_AFTER changes, at
+which point the change that crosses the limit rewrites the JSON file (an
+O(catalog) write, once per COMPACT_AFTER changes) and the journal is removed.
+Until then static/data/*.json on disk lags behind the API; read the documents
+through read() or the GET endpoints.
+
+Documents carry an integer `revision` that is incremented by every write.
+Writers can pass the revision they started from and get a RevisionConflict
+instead of overwriting someone else's change.
+"""
+import os
+import json
+import stat
+import logging
+import hashlib
+import tempfile
+import threading
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+# Corners of a city's boundaries, as geotagging.generate_random_coordinates_in_quadrilateral reads them
+BOUNDARY_CORNERS = ('top_left', 'top_right', 'bottom_right', 'bottom_left')
+
+# Journal entries after which the next change rewrites the JSON file and starts over
+COMPACT_AFTER = 1000
+
+
+class PresetNotFound(Exception):
+    """Raised when a preset to update or delete does not exist."""
+
+
+class RevisionConflict(Exception):
+    """Raised when a write was based on an older revision of the document."""
+
+    def __init__(self, current):
+        super().__init__(f"Presets were changed by someone else (current revision {current})")
+        self.current = current
+
+
+class InvalidPreset(ValueError):
+    """Raised when a preset does not have the shape the geotagger reads."""
+
+
+class PresetDocument:
+    """One preset JSON file and its change journal."""
+
+    def __init__(self, path, empty):
+        """
+        Args:
+            path (str): JSON file
+            empty (dict): Document to use while the file does not exist
+        """
+        self.path = path
+        self.journal_path = os.path.join(os.path.dirname(path), '.' + os.path.basename(path) + '.changes')
+        self.empty = empty
+        self._lock = threading.Lock()
+        self._base = (None, None)  # (JSON file identity, parsed file)
+        self._state = None  # ((JSON file identity, journal inode), bytes replayed, entries replayed, document)
+
+    @staticmethod
+    def _file_identity(path):
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return 'missing'
+        return f'{st.st_ino}:{st.st_mtime_ns}:{st.st_size}'
+
+    def identity(self):
+        """String that changes whenever the document changes (the JSON file's and the journal's)."""
+        return self._file_identity(self.path) + '+' + self._file_identity(self.journal_path)
+
+    def _read_base(self):
+        """(identity, document) of the JSON file, parsed only when it changed."""
+        try:
+            f = open(self.path, 'r')
+        except FileNotFoundError:
+            return 'missing', dict(self.empty, revision=0)
+        with f:
+            st = os.fstat(f.fileno())
+            identity = f'{st.st_ino}:{st.st_mtime_ns}:{st.st_size}'
+            cached_identity, cached = self._base
+            if cached_identity == identity:
+                return identity, cached
+            document = json.load(f)
+        document.setdefault('revision', 0)
+        self._base = (identity, document)
+        return identity, document
+
+    def _replay_journal(self, f, base_identity, base):
+        """Apply the journal lines not seen yet. Returns the new state, or None if the journal is for another file."""
+        inode = os.fstat(f.fileno()).st_ino
+        state = self._state
+        if state is None or state[0] != (base_identity, inode):
+            header = f.readline()
+            try:
+                if not header.endswith(b'\n') or json.loads(header).get('base') != base_identity:
+                    return None
+            except (ValueError, AttributeError):
+                return None
+            state = ((base_identity, inode), f.tell(), 0, base)
+        key, offset, entries, document = state
+        f.seek(offset)
+        tail = f.read()
+        # A line without its newline is still being written (or was cut off by a crash)
+        tail = tail[:tail.rfind(b'\n') + 1]
+        for line in tail.splitlines():
+            try:
+                document = _replay(document, json.loads(line))
+            except (ValueError, KeyError, TypeError, PresetNotFound) as e:
+                logger.warning(f"Skipping unreadable change in {self.journal_path}: {e}")
+            entries += 1
+        state = (key, offset + len(tail), entries, document)
+        self._state = state
+        return state
+
+    def _load(self):
+        """Current (JSON file identity, state); the state's journal key is None if there is no journal."""
+        while True:
+            base_identity, base = self._read_base()
+            try:
+                f = open(self.journal_path, 'rb')
+            except FileNotFoundError:
+                f = None
+            if f is not None:
+                with f:
+                    state = self._replay_journal(f, base_identity, base)
+                if state is not None:
+                    return base_identity, state
+            # No journal for this file, unless the file was replaced (and its journal removed) in between
+            if self._file_identity(self.path) == base_identity:
+                return base_identity, (None, 0, 0, base)
+
+    def read(self):
+        """
+        The current document.
+
+        The returned object is shared with other requests and must not be modified.
+        """
+        return self._load()[1][3]
+
+    @contextmanager
+    def _exclusive(self):
+        with self._lock:
+            if fcntl is None:
+                yield
+                return
+            # Kept out of static/data, which is served to browsers
+            digest = hashlib.sha1(os.path.realpath(self.path).encode('utf-8')).hexdigest()[:16]
+            with open(os.path.join(tempfile.gettempdir(), f'preset_{digest}.lock'), 'a') as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+    @staticmethod
+    def _replace_file(path, data):
+        """Write `data` (bytes) to a temporary file and rename it over `path`, keeping its permissions."""
+        directory = os.path.dirname(path)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.' + os.path.basename(path), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            try:
+                mode = stat.S_IMODE(os.stat(path).st_mode)
+            except FileNotFoundError:
+                mode = 0o644
+            os.chmod(tmp_path, mode)
+            os.replace(tmp_path, path)
+        except BaseException:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            raise
+
+    def _write(self, document):
+        """Write the whole document to the JSON file, which makes the journal obsolete."""
+        self._replace_file(self.path, json.dumps(document, indent=2).encode('utf-8'))
+        # A crash before this leaves a journal naming the old file, which is ignored
+        try:
+            os.remove(self.journal_path)
+        except FileNotFoundError:
+            pass
+        self._base = (self._file_identity(self.path), document)
+        self._state = None
+
+    def _append(self, entry, document, base_identity, state):
+        """Append one change to the journal (starting one for the current JSON file if there is none)."""
+        line = (json.dumps(entry) + '\n').encode('utf-8')
+        key, offset, entries, _ = state
+        if key is None:
+            header = (json.dumps({'base': base_identity}) + '\n').encode('utf-8')
+            self._replace_file(self.journal_path, header + line)
+            key = (base_identity, os.stat(self.journal_path).st_ino)
+            offset = len(header)
+        else:
+            with open(self.journal_path, 'r+b') as f:
+                # Drops a partial line a crashed writer left behind
+                f.truncate(offset)
+                f.seek(offset)
+                f.write(line)
+                f.flush()
+                os.fsync(f.fileno())
+        self._state = (key, offset + len(line), entries + 1, document)
+
+    def update(self, change, expected_revision=None, after_write=None):
+        """
+        Apply a change and record it atomically.
+
+        Args:
+            change (callable): Takes the current document and returns (new document, result, journal entry).
+                The journal entry is a JSON object that redoes the change (see _JOURNAL_CHANGES), or None
+                to write the whole document. It must not modify the document it is given.
+            expected_revision (int): Raise RevisionConflict unless this is the current revision
+            after_write (callable): Called as after_write(identity before, identity after, result)
+                once the change is recorded, while the lock is still held
+
+        Returns:
+            tuple: (new revision, result returned by change)
+        """
+        with self._exclusive():
+            before = self.identity()
+            base_identity, state = self._load()
+            current = state[3]
+            if expected_revision is not None and expected_revision != current['revision']:
+                raise RevisionConflict(current['revision'])
+            document, result, entry = change(current)
+            revision = current['revision'] + 1
+            document = dict(document, revision=revision)
+            if entry is None or state[2] + 1 >= COMPACT_AFTER:
+                self._write(document)
+            else:
+                self._append(dict(entry, revision=revision), document, base_identity, state)
+            if after_write is not None:
+                after_write(before, self.identity(), result)
+            return revision, result
+
+    def replace(self, document, expected_revision=None):
+        """Replace the whole document. Returns the new revision."""
+        return self.update(lambda current: (document, None, None), expected_revision)[0]
+
+
+def _upsert(presets, preset, merge):
+    """Copy of `presets` with `preset` added or updated by id. Returns (presets, stored preset, created)."""
+    presets = list(presets)
+    for index, existing in enumerate(presets):
+        if existing.get('id') == preset['id']:
+            presets[index] = dict(existing, **preset) if merge else preset
+            return presets, presets[index], False
+    if merge:
+        raise PresetNotFound(f"Preset '{preset['id']}' not found")
+    presets.append(preset)
+    return presets, preset, True
+
+
+def _is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def _check_point(value, field):
+    if not isinstance(value, dict) or not _is_number(value.get('lat')) or not _is_number(value.get('lng')):
+        raise InvalidPreset(f"'{field}' must be an object with numeric 'lat' and 'lng'")
+
+
+def validate_city(preset):
+    """
+    Check the fields of a city preset that geotagging reads.
+
+    Raises:
+        InvalidPreset: If name is not a string, center is not a point, or
+            boundaries lack one of the four corner points
+    """
+    if 'name' in preset and not isinstance(preset['name'], str):
+        raise InvalidPreset("'name' must be a string")
+    if 'center' in preset:
+        _check_point(preset['center'], 'center')
+    if 'boundaries' in preset:
+        boundaries = preset['boundaries']
+        if not isinstance(boundaries, dict):
+            raise InvalidPreset("'boundaries' must be an object with top_left, top_right, bottom_right and bottom_left")
+        for corner in BOUNDARY_CORNERS:
+            _check_point(boundaries.get(corner), f'boundaries.{corner}')
+
+
+def _remove(presets, preset_id):
+    remaining = [p for p in presets if p.get('id') != preset_id]
+    if len(remaining) == len(presets):
+        raise PresetNotFound(f"Preset '{preset_id}' not found")
+    return remaining
+
+
+def upsert_city(country, state_province, preset, merge=False):
+    """
+    Change that adds or updates one city preset (see PresetDocument.update).
+
+    Args:
+        country (str): Country the city is filed under
+        state_province (str): State or province the city is filed under
+        preset (dict): City preset including its id
+        merge (bool): Update the fields given in `preset` of an existing city instead of replacing it
+
+    Returns:
+        callable: Change whose result is (stored preset, created); it raises InvalidPreset for a malformed preset
+    """
+    def change(document):
+        countries = dict(document.get('countries', {}))
+        states = dict(countries.get(country, {}))
+        cities, stored, created = _upsert(states.get(state_province, []), preset, merge)
+        # Checked after merging, so a PATCH cannot leave a preset geotagging fails on
+        validate_city(stored)
+        states[state_province] = cities
+        countries[country] = states
+        entry = {'op': 'upsert_city', 'country': country, 'state_province': state_province, 'preset': stored}
+        return dict(document, countries=countries), (stored, created), entry
+    return change
+
+
+def delete_city(country, state_province, preset_id):
+    """Change that removes one city preset, dropping the state and country once they are empty."""
+    def change(document):
+        countries = dict(document.get('countries', {}))
+        states = dict(countries.get(country, {}))
+        cities = _remove(states.get(state_province, []), preset_id)
+        if cities:
+            states[state_province] = cities
+        else:
+            states.pop(state_province, None)
+        if states:
+            countries[country] = states
+        else:
+            countries.pop(country, None)
+        entry = {'op': 'delete_city', 'country': country, 'state_province': state_province, 'id': preset_id}
+        return dict(document, countries=countries), None, entry
+    return change
+
+
+def upsert_client(preset, merge=False):
+    """Change that adds or updates one client preset. Its result is (stored preset, created)."""
+    def change(document):
+        presets, stored, created = _upsert(document.get('presets', []), preset, merge)
+        return dict(document, presets=presets), (stored, created), {'op': 'upsert_client', 'preset': stored}
+    return change
+
+
+def delete_client(preset_id):
+    """Change that removes one client preset."""
+    def change(document):
+        presets = _remove(document.get('presets', []), preset_id)
+        return dict(document, presets=presets), None, {'op': 'delete_client', 'id': preset_id}
+    return change
+
+
+# Journal entry -> the change it redoes. Upserts store the merged preset, so they replay as a plain PUT.
+_JOURNAL_CHANGES = {
+    'upsert_city': lambda entry: upsert_city(entry['country'], entry['state_province'], entry['preset']),
+    'delete_city': lambda entry: delete_city(entry['country'], entry['state_province'], entry['id']),
+    'upsert_client': lambda entry: upsert_client(entry['preset']),
+    'delete_client': lambda entry: delete_client(entry['id']),
+}
+
+
+def _replay(document, entry):
+    """`document` with one journal entry applied."""
+    document = _JOURNAL_CHANGES[entry['op']](entry)(document)[0]
+    return dict(document, revision=entry['revision'])
+
+
+_documents = {}
+_documents_lock = threading.Lock()
+
+
+def get_document(path, empty):
+    """The shared PresetDocument for `path`."""
+    with _documents_lock:
+        document = _documents.get(path)
+        if document is None:
+            document = _documents[path] = PresetDocument(path, empty)
+        return document
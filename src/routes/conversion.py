@@ -1,4 +1,4 @@
-from flask import Blueprint, request, jsonify, send_file, current_app
+from flask import Blueprint, request, jsonify, current_app
 import os
 import json
 import uuid
@@ -7,16 +7,98 @@ import shutil
 from werkzeug.utils import secure_filename
 from PIL import Image
 import zipfile
+from src.utils import metrics, admission, largeimage, encoders, storage, heif, scratch, frames
+from src.routes import uploads
 
 conversion_bp = Blueprint('conversion', __name__)
 
 # Allowed file extensions
-ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'tiff', 'tif', 'bmp', 'heic', 'heif', 'webp'}
+ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'tiff', 'tif', 'bmp', 'heic', 'heif', 'webp', 'gif'}
 
 def allowed_file(filename):
     """Check if file has an allowed extension."""
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
+def convert_large_image(file_path, output_path, output_format, encoder_profile=None):
+    """
+    Convert a very large image strip by strip, keeping memory proportional to the strip size.
+
+    Args:
+        file_path (str): Path to the source image
+        output_path (str): Path to save the converted image
+        output_format (str): Output format (see src/utils/encoders.py)
+        encoder_profile (str): Encoder profile name
+    """
+    with largeimage.StripReader(file_path) as reader:
+        mode = reader.mode
+        # Convert RGBA to RGB if saving as JPEG
+        if output_format in ["jpeg", "jpg"] and mode == "RGBA":
+            mode = "RGB"
+        rows = largeimage.strip_rows(reader.width, current_app)
+        writer = largeimage.open_strip_writer(output_path, output_format, (reader.width, reader.height), mode,
+                                              encoders.save_options(output_format, encoder_profile))
+        largeimage.write_strips(writer, (
+            reader.read(top, bottom) for top, bottom in largeimage.iter_bands(reader.height, rows)
+        ))
+
+def convert_file(file_path, output_path, output_format, encoder_profile=None, target_encoder=None):
+    """
+    Convert one image. Shared by the conversion endpoint and the CLI.
+
+    Args:
+        file_path (str): Path to the source image
+        output_path (str): Path to save the converted image
+        output_format (str): Output format (see src/utils/encoders.py)
+        encoder_profile (str): Encoder profile name
+        target_encoder (TargetSizeEncoder): Byte budget encoder (optional)
+
+    Returns:
+        tuple: (size report, target size report or None)
+    """
+    target_report = None
+
+    # Multi-page TIFFs and animations keep every frame, converted one frame at a time
+    if frames.keeps_frames(file_path, output_format):
+        with metrics.stage_timer('conversion', 'convert'):
+            frames.save(file_path, output_path, output_format, encoder_profile)
+        if target_encoder:
+            # Frames are streamed to the encoder, so the file is encoded once with the profile settings
+            target_report = encoders.strip_target_report(output_path, target_encoder.target_bytes)
+        metrics.count_bytes('conversion', 'out', metrics.file_size(output_path))
+        return encoders.size_report(file_path, output_path), target_report
+
+    # Very large images are converted in strips to bound memory
+    if largeimage.is_large_file(file_path, current_app):
+        with metrics.stage_timer('conversion', 'convert'):
+            convert_large_image(file_path, output_path, output_format, encoder_profile)
+        if target_encoder:
+            # Strip output is never held in memory, so it is encoded once with the profile settings
+            target_report = encoders.strip_target_report(output_path, target_encoder.target_bytes)
+        metrics.count_bytes('conversion', 'out', metrics.file_size(output_path))
+        return encoders.size_report(file_path, output_path), target_report
+
+    # Open and convert image
+    with Image.open(file_path) as img:
+        with metrics.stage_timer('conversion', 'decode'):
+            img.load()
+
+        # Convert to a mode the output format can store (e.g. RGBA to RGB for JPEG)
+        with metrics.stage_timer('conversion', 'convert'):
+            img = encoders.prepare_image(img, output_format)
+
+        # Save image
+        with metrics.stage_timer('conversion', 'encode'):
+            if target_encoder:
+                # Trial encodes happen in memory; only the one that fits is written
+                data, target_report = target_encoder.encode(img)
+                with open(output_path, 'wb') as f:
+                    f.write(data)
+                target_report = dict(target_report, file=os.path.basename(output_path))
+            else:
+                encoders.encode(img, output_path, output_format, encoder_profile)
+    metrics.count_bytes('conversion', 'out', metrics.file_size(output_path))
+    return encoders.size_report(file_path, output_path), target_report
+
 @conversion_bp.route('/process', methods=['POST'])
 def process_images():
     """
@@ -24,149 +106,188 @@ def process_images():
     
     Expects:
     - files: Image files to process
-    - output_format: Output format (jpeg, png, tiff)
+    - upload_ids: Finalized resumable upload ids (instead of or in addition to files)
+    - output_format: Output format (jpeg, png, tiff, webp, avif, heic, bmp)
+    - encoder_profile: Encoder profile (default, web-small, archive, lossless)
+    - target_size: Byte budget per output file, e.g. 500KB (optional)
+    - allow_downscale: Also shrink images that do not fit the budget at the lowest quality (optional)
     
     Returns:
     - JSON response with status and download URL
     """
-    # Check if files were uploaded
-    if 'files[]' not in request.files:
+    # Check if files were uploaded (inline or through /api/uploads)
+    upload_ids = request.form.getlist('upload_ids[]')
+    if 'files[]' not in request.files and not upload_ids:
         return jsonify({'error': 'No files provided'}), 400
     
     files = request.files.getlist('files[]')
-    if not files or files[0].filename == '':
+    if not upload_ids and (not files or files[0].filename == ''):
         return jsonify({'error': 'No files selected'}), 400
     
-    # Get output format
-    output_format = request.form.get('output_format', 'jpeg').lower()
-    if output_format not in ['jpeg', 'png', 'tiff']:
-        output_format = 'jpeg'
+    # Get output format and encoder profile
+    try:
+        output_format, encoder_profile = encoders.resolve(request.form.get('output_format'), request.form.get('encoder_profile'))
+    except encoders.EncoderError as e:
+        return jsonify({'error': 'Unsupported output options', 'details': str(e)}), 400
+
+    # Optional byte budget per output file
+    try:
+        target_bytes = encoders.parse_byte_size(request.form.get('target_size'))
+    except encoders.EncoderError as e:
+        return jsonify({'error': 'Invalid target size', 'details': str(e)}), 400
+    target_encoder = None
+    if target_bytes:
+        allow_downscale = request.form.get('allow_downscale', '').lower() in ('1', 'true', 'on', 'yes')
+        target_encoder = encoders.TargetSizeEncoder(target_bytes, output_format, encoder_profile, allow_downscale)
     
     # Create a unique session ID for this batch
     session_id = str(uuid.uuid4())
-    upload_folder = os.path.join(current_app.config['UPLOAD_FOLDER'], session_id)
-    processed_folder = os.path.join(current_app.config['PROCESSED_FOLDER'], session_id)
+    workspace = scratch.open_session(session_id)
+    upload_folder, processed_folder = workspace.upload_folder, workspace.processed_folder
     
     os.makedirs(upload_folder, exist_ok=True)
     os.makedirs(processed_folder, exist_ok=True)
     
     # Save uploaded files
     saved_files = []
-    for file in files:
-        if file and allowed_file(file.filename):
-            filename = secure_filename(file.filename)
-            file_path = os.path.join(upload_folder, filename)
-            file.save(file_path)
-            saved_files.append(file_path)
+    with metrics.stage_timer('conversion', 'upload_save'):
+        for file in files:
+            if file and allowed_file(file.filename):
+                file_path = workspace.save_upload(file, secure_filename(file.filename))
+                metrics.count_bytes('conversion', 'in', metrics.file_size(file_path))
+                saved_files.append(file_path)
+
+    # Files sent ahead through the resumable upload API
+    try:
+        claimed = uploads.claim_uploads(upload_ids, upload_folder)
+    except uploads.UploadError as e:
+        shutil.rmtree(upload_folder, ignore_errors=True)
+        shutil.rmtree(processed_folder, ignore_errors=True)
+        return jsonify({'error': e.message, 'details': e.details}), e.status
+    for item in claimed:
+        metrics.count_bytes('conversion', 'in', metrics.file_size(item['path']))
+        saved_files.append(item['path'])
     
     if not saved_files:
         return jsonify({'error': 'No valid image files provided'}), 400
+
+    # Reserve memory for the largest decode before touching any pixels
+    try:
+        reservation = admission.admit(current_app, saved_files, 'conversion')
+    except admission.AdmissionError as e:
+        shutil.rmtree(upload_folder, ignore_errors=True)
+        shutil.rmtree(processed_folder, ignore_errors=True)
+        return admission.error_response(e)
     
     # Process files
     processed_files = []
+    size_reports = []
+    target_reports = []
     
     for file_path in saved_files:
         try:
-            # Register HEIF opener if needed
-            if file_path.lower().endswith(('.heic', '.heif')):
-                try:
-                    import pillow_heif
-                    pillow_heif.register_heif_opener()
-                except ImportError:
-                    return jsonify({'error': 'HEIF/HEIC support not available'}), 500
+            # HEIF/HEIC files need pillow_heif (its opener is registered once at startup)
+            if heif.is_heif(file_path) and not heif.register_opener():
+                return jsonify({'error': 'HEIF/HEIC support not available'}), 500
             
-            # Open and convert image
-            with Image.open(file_path) as img:
-                base_name = os.path.splitext(os.path.basename(file_path))[0]
-                output_path = os.path.join(processed_folder, f"{base_name}.{output_format}")
-                
-                # Convert RGBA to RGB if saving as JPEG
-                if output_format.lower() in ["jpeg", "jpg"] and img.mode == "RGBA":
-                    img = img.convert("RGB")
-                
-                # Save image
-                img.save(output_path, output_format.upper())
-                processed_files.append(output_path)
+            base_name = os.path.splitext(os.path.basename(file_path))[0]
+            output_path = os.path.join(processed_folder, f"{base_name}.{output_format}")
+            size_report, target_report = convert_file(file_path, output_path, output_format, encoder_profile, target_encoder)
+            processed_files.append(output_path)
+            size_reports.append(size_report)
+            if target_report:
+                target_reports.append(target_report)
                 
         except Exception as e:
             print(f"Error processing {file_path}: {str(e)}")
     
+    reservation.release()
+
+    metrics.count_files('conversion', 'processed', len(processed_files))
+    metrics.count_files('conversion', 'failed', len(saved_files) - len(processed_files))
+
     if not processed_files:
         return jsonify({'error': 'Failed to process any files'}), 500
     
+    store = storage.get_storage()
+
     # Create a zip file if multiple files were processed
     if len(processed_files) > 1:
         zip_filename = f"converted_images_{session_id}.zip"
-        zip_path = os.path.join(processed_folder, zip_filename)
         
-        with zipfile.ZipFile(zip_path, 'w') as zipf:
-            for file in processed_files:
-                zipf.write(file, os.path.basename(file))
+        # The archive is streamed straight to storage
+        with metrics.stage_timer('conversion', 'zip'):
+            with store.open_write(storage.processed_key(session_id, zip_filename)) as fp:
+                with zipfile.ZipFile(fp, 'w') as zipf:
+                    for file in processed_files:
+                        zipf.write(file, os.path.basename(file))
+        store.discard_scratch(upload_folder, processed_folder)
         
         return jsonify({
             'status': 'success',
             'message': f'Successfully converted {len(processed_files)} images',
             'download_url': f'/api/conversion/download/{session_id}/zip',
-            'file_count': len(processed_files)
+            'file_count': len(processed_files),
+            'size_report': {'files': size_reports, 'total': encoders.summarize(size_reports)},
+            'target_size_report': encoders.summarize_targets(target_reports) if target_encoder else None
         })
     else:
         # Single file
+        with metrics.stage_timer('conversion', 'publish'):
+            store.publish(processed_files[0], storage.processed_key(session_id, os.path.basename(processed_files[0])))
+        store.discard_scratch(upload_folder, processed_folder)
         return jsonify({
             'status': 'success',
             'message': 'Successfully converted image',
             'download_url': f'/api/conversion/download/{session_id}/single',
-            'file_count': 1
+            'file_count': 1,
+            'size_report': {'files': size_reports, 'total': encoders.summarize(size_reports)},
+            'target_size_report': encoders.summarize_targets(target_reports) if target_encoder else None
         })
 
 @conversion_bp.route('/download/<session_id>/zip', methods=['GET'])
 def download_zip(session_id):
     """Download processed images as a zip file."""
-    processed_folder = os.path.join(current_app.config['PROCESSED_FOLDER'], session_id)
-    zip_path = os.path.join(processed_folder, f"converted_images_{session_id}.zip")
-    
-    if not os.path.exists(zip_path):
-        return jsonify({'error': 'Zip file not found'}), 404
-    
-    return send_file(
-        zip_path,
-        as_attachment=True,
+    return storage.send_stored(
+        storage.processed_key(session_id, f"converted_images_{session_id}.zip"),
         download_name=f"converted_images.zip",
-        mimetype='application/zip'
+        mimetype='application/zip',
+        missing='Zip file not found'
     )
 
 @conversion_bp.route('/download/<session_id>/single', methods=['GET'])
 def download_single(session_id):
     """Download a single processed image."""
-    processed_folder = os.path.join(current_app.config['PROCESSED_FOLDER'], session_id)
+    store = storage.get_storage()
     
-    # Find the first file in the processed folder
-    files = os.listdir(processed_folder)
-    image_files = [f for f in files if f.lower().endswith(('.png', '.jpg', '.jpeg', '.tiff', '.tif'))]
+    # Find the first image published for the session
+    files = store.list(storage.processed_key(session_id))
+    image_files = [f for f in files if f.lower().endswith(encoders.OUTPUT_EXTENSIONS)]
     
     if not image_files:
         return jsonify({'error': 'Processed image not found'}), 404
     
-    file_path = os.path.join(processed_folder, image_files[0])
-    
-    return send_file(
-        file_path,
-        as_attachment=True,
-        download_name=image_files[0],
+    return store.send_download(
+        storage.processed_key(session_id, image_files[0]),
+        download_name=os.path.basename(image_files[0]),
         mimetype=f'image/{os.path.splitext(image_files[0])[1][1:].lower()}'
     )
 
 @conversion_bp.route('/cleanup/<session_id>', methods=['POST'])
 def cleanup_session(session_id):
     """Clean up temporary files for a session."""
-    upload_folder = os.path.join(current_app.config['UPLOAD_FOLDER'], session_id)
-    processed_folder = os.path.join(current_app.config['PROCESSED_FOLDER'], session_id)
+    upload_folder, processed_folder = scratch.session_folders(session_id)
     
-    # Clean up upload folder
-    if os.path.exists(upload_folder):
-        shutil.rmtree(upload_folder)
-    
-    # Clean up processed folder
-    if os.path.exists(processed_folder):
-        shutil.rmtree(processed_folder)
+    with metrics.stage_timer('conversion', 'cleanup'):
+        # Clean up upload folder
+        if os.path.exists(upload_folder):
+            shutil.rmtree(upload_folder)
+        
+        # Clean up processed folder
+        if os.path.exists(processed_folder):
+            shutil.rmtree(processed_folder)
+
+        # Remove published outputs (a no-op for local storage, where they were the processed folder)
+        storage.get_storage().delete_prefix(storage.processed_key(session_id))
     
     return jsonify({'status': 'success', 'message': 'Session cleaned up'})
@@ -1,4 +1,4 @@
-from flask import Blueprint, request, jsonify, send_file, current_app, url_for
+from flask import Blueprint, request, jsonify, current_app, url_for
 import os
 import json
 import uuid
@@ -8,17 +8,29 @@ from werkzeug.utils import secure_filename
 from PIL import Image, UnidentifiedImageError
 import piexif
 import datetime
-import subprocess
 import zipfile
 import random
 import pillow_heif
 import threading
+from src.utils import metrics, admission, exiftool_runner, encoders, storage, tracklog, manifest, reconcile, heif, scratch
+from src.routes import uploads, presets
 
 geotagging_bp = Blueprint('geotagging', __name__)
 
 # Allowed file extensions
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'tiff', 'tif', 'bmp', 'heic', 'heif', 'webp'}
 
+# Files written by one ExifTool run when they share the same metadata
+DEFAULT_EXIFTOOL_BATCH_SIZE = 50
+
+# ioctl from linux/fs.h that makes a file share another file's blocks (btrfs, XFS, bcachefs)
+FICLONE = 0x40049409
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
 # Helper to flatten nested ExifTool JSON output for easier processing
 def flatten_exiftool_metadata(exiftool_dict):
     """Flattens the grouped ExifTool metadata into a single dictionary with Group:TagName keys."""
@@ -133,6 +145,39 @@ def generate_random_coordinates_in_quadrilateral(preset):
         center_lng + random.uniform(-0.0001, 0.0001)
     )
 
+def exiftool_write_args(exif_data):
+    """
+    ExifTool command line (without file names) that writes `exif_data`.
+
+    Args:
+        exif_data (dict): Flattened dictionary of ExifTool tags (e.g., {"GPS:GPSLatitude": 12.34})
+
+    Returns:
+        list: Arguments starting with the exiftool executable
+    """
+    # Base exiftool command with UTF8 options (output files are named with -o per file)
+    # -m: ignore minor warnings
+    exif_args = ["exiftool", "-codedcharacterset=utf8", "-m"]
+
+    # Add metadata arguments based on the structured exif_data
+    for exiftool_tag, value in exif_data.items():
+        # Skip if value is None, empty string, or empty list
+        if value is None or (isinstance(value, (str, list)) and not value):
+            continue
+
+        # Special handling for multi-value tags (like Keywords, Subject)
+        if isinstance(value, list):
+            for item in value:
+                exif_args.append(f"-{exiftool_tag}={item}")
+        else:
+            exif_args.append(f"-{exiftool_tag}={value}")
+    return exif_args
+
+def get_exiftool_batch_size():
+    """Files per shared ExifTool run, from EXIFTOOL_BATCH_SIZE (environment or app config)."""
+    value = os.environ.get('EXIFTOOL_BATCH_SIZE') or current_app.config.get('EXIFTOOL_BATCH_SIZE')
+    return max(1, int(value)) if value else DEFAULT_EXIFTOOL_BATCH_SIZE
+
 def process_image_with_exiftool(input_path, output_path, exif_data):
     """
     Process a single image file with ExifTool to add EXIF data.
@@ -145,64 +190,737 @@ def process_image_with_exiftool(input_path, output_path, exif_data):
     Returns:
         bool: True if successful, False otherwise
     """
-    try:
-        # Copy the file first to the output path to modify it in place with exiftool
-        shutil.copy2(input_path, output_path)
-        
-        # Base exiftool command with overwrite_original and UTF8 options
-        # -m: ignore minor warnings
-        exif_args = ["exiftool", "-overwrite_original", "-codedcharacterset=utf8", "-m"]
-        
-        # Add metadata arguments based on the structured exif_data
-        for exiftool_tag, value in exif_data.items():
-            # Skip if value is None, empty string, or empty list
-            if value is None or (isinstance(value, (str, list)) and not value):
-                continue
-
-            # Special handling for multi-value tags (like Keywords, Subject)
-            if isinstance(value, list):
-                for item in value:
-                    exif_args.append(f"-{exiftool_tag}={item}")
-            else:
-                exif_args.append(f"-{exiftool_tag}={value}")
-        
-        # Add the output file path as the last argument
-        exif_args.append(output_path)
-        
-        current_app.logger.info(f"Executing ExifTool command: {' '.join(exif_args)}")
-        # Execute the exiftool command
-        process = subprocess.run(exif_args, capture_output=True, text=True, check=False, encoding='utf-8')
-        
+    return process_images_with_exiftool([(input_path, output_path)], exif_data)[0]
+
+def process_images_with_exiftool(jobs, exif_data):
+    """
+    Write the same EXIF data to several image files.
+
+    ExifTool reads each input and writes its output directly (-o), so every file is
+    written once and the input is left as it was. The files are written by one
+    ExifTool run per EXIFTOOL_BATCH_SIZE files instead of one run each, with one
+    -execute command per file. If a shared run fails, its files are retried one by
+    one so a single bad file does not fail the others.
+
+    Args:
+        jobs (list): (input_path, output_path) pairs
+        exif_data (dict): Flattened dictionary of ExifTool tags (e.g., {"GPS:GPSLatitude": 12.34})
+
+    Returns:
+        list: True or False for each job, in order
+    """
+    results = [False] * len(jobs)
+    exif_args = exiftool_write_args(exif_data)
+    batch_size = get_exiftool_batch_size()
+
+    def run(indexes):
+        # One command per file; -common_args adds the options and tags to each of them
+        command = exif_args[:1]
+        for i in indexes:
+            input_path, output_path = jobs[i]
+            if os.path.exists(output_path) and not os.path.samefile(input_path, output_path):
+                os.remove(output_path)  # -o never overwrites an existing file
+            if len(command) > 1:
+                command.append("-execute")
+            command += ["-o", output_path, input_path]
+        command += ["-common_args"] + exif_args[1:]
+        current_app.logger.info(f"Executing ExifTool command: {' '.join(command)}")
+        try:
+            process = exiftool_runner.run(command)
+        except Exception as e:
+            current_app.logger.error(f"Error processing image with ExifTool: {e}")
+            metrics.count_exiftool('failure')
+            return False
+        metrics.count_exiftool('success' if process.returncode == 0 else 'failure')
         if process.returncode != 0:
             current_app.logger.error(f"ExifTool write error (return code {process.returncode}): {process.stderr.strip()}")
             current_app.logger.error(f"ExifTool stdout: {process.stdout.strip()}")
             return False
-        
-        current_app.logger.info(f"ExifTool write successful for {output_path}")
+        current_app.logger.info(f"ExifTool write successful for {len(indexes)} file(s)")
         current_app.logger.info(f"ExifTool stdout: {process.stdout.strip()}")
-        return True
-        
-    except Exception as e:
-        current_app.logger.error(f"Error processing image with ExifTool: {e}")
-        return False
+        return all(os.path.exists(jobs[i][1]) for i in indexes)
+
+    for start in range(0, len(jobs), batch_size):
+        batch = list(range(start, min(start + batch_size, len(jobs))))
+        if run(batch):
+            for i in batch:
+                results[i] = True
+        elif len(batch) > 1:
+            # Find out which files failed; the inputs are untouched, so each one is simply run again
+            for i in batch:
+                results[i] = run([i])
+    return results
+
+def copy_file(src, dst):
+    """
+    Copy a file with its metadata, sharing its blocks instead (a reflink) where the filesystem supports it.
+
+    Args:
+        src (str): File to copy
+        dst (str): Destination path (overwritten if it exists)
+    """
+    if fcntl is not None and not (os.path.exists(dst) and os.path.samefile(src, dst)):
+        try:
+            with open(src, 'rb') as source, open(dst, 'wb') as dest:
+                fcntl.ioctl(dest.fileno(), FICLONE, source.fileno())
+            shutil.copystat(src, dst)
+            return
+        except OSError:
+            pass  # No reflinks here (ext4, tmpfs, across filesystems): copy the bytes
+    shutil.copy2(src, dst)
+
+
+# Define mapping from frontend friendly names to ExifTool tags
+# This mapping should be exhaustive for all fields we want to write
+FRIENDLY_TO_EXIFTOOL_TAG_MAP = {
+    # GPS Data (handled separately for Lat/Lng Ref, but can include other GPS tags)
+    # Note: GPSLatitude/Longitude are special-cased for writing format
+    "GPSVersionID": "GPS:GPSVersionID",
+    "GPSMapDatum": "GPS:GPSMapDatum",
+
+    # Location (using common IPTC/XMP tags)
+    "Country": ["IPTC:Country-PrimaryLocationName", "XMP-iptcCore:CountryName"],
+    "State": ["IPTC:Province-State", "XMP-iptcCore:ProvinceState"],
+    "City": ["IPTC:City", "XMP-iptcCore:City"],
+    "Sublocation": ["IPTC:Sub-location", "XMP-iptcCore:Location"],
+
+    # Artist/Source/Description
+    "Creator": ["IFD0:Artist", "XMP-tiff:Artist", "XMP-dc:Creator"],
+    "CreatorTitle": ["IPTC:By-lineTitle", "XMP-photoshop:CaptionWriter"],
+    "Credit": ["IPTC:Credit", "XMP-photoshop:Credit"],
+    "Source": ["IPTC:Source", "XMP-photoshop:Source"],
+    "URL": ["Photoshop:URL", "XMP-xmp:BaseURL"], # General URLs
+    "ObjectName": "IPTC:ObjectName",
+    "Headline": "XMP-photoshop:Headline",
+    "Caption": ["IPTC:Caption-Abstract", "XMP-dc:Description"],
+    "Copyright": ["IFD0:Copyright", "IPTC:CopyrightNotice", "XMP-dc:Rights"],
+    "Rating": ["IFD0:Rating", "XMP-xmp:Rating"],
+    "RatingPercent": "XMP-microsoft:RatingPercent",
+    "SpecialInstructions": "XMP-xmp:Instructions",
+
+    # Categories/Keywords
+    "Category": "IPTC:Category",
+    "SupplementalCategories": "IPTC:SupplementalCategories",
+    "Keywords": ["IPTC:Keywords", "XMP-dc:Subject"], # These should be multi-valued tags
+
+    # Contact Information
+    # These are keys from the geotagging form (e.g., from client presets)
+    "Address": ["IPTC:ContactInfoAddress", "XMP-iptcCore:CreatorWorkAddress"],
+    "PostalCode": ["IPTC:ContactInfoPostalCode", "XMP-iptcCore:CreatorPostalCode"],
+    "Phone": ["IPTC:ContactInfoPhone", "XMP-iptcCore:CreatorWorkTelephone"],
+    "Email": ["IPTC:ContactInfoEmail", "XMP-iptcCore:CreatorWorkEmail"],
+    "URL": ["Photoshop:URL", "XMP-xmp:BaseURL"], # General URLs from form
+
+    # These are keys from the Comprehensive Metadata (ExifTool) from the /exif page
+    "Contact Byline": ["IPTC:By-line", "XMP-dc:Creator"], # Re-use Creator mapping
+    "Contact Byline Title": ["IPTC:By-lineTitle", "XMP-photoshop:CaptionWriter"], # Re-use CreatorTitle mapping
+    "Contact Address": ["IPTC:ContactInfoAddress", "XMP-iptcCore:CreatorWorkAddress"],
+    "Contact City": ["IPTC:ContactInfoCity", "XMP-iptcCore:CreatorCity"],
+    "Contact PostalCode": ["IPTC:ContactInfoPostalCode", "XMP-iptcCore:CreatorPostalCode"],
+    "Contact State/Province": ["IPTC:ContactInfoStateProvince", "XMP-iptcCore:CreatorRegion"],
+    "Contact Country": ["IPTC:ContactInfoCountry", "XMP-iptcCore:CreatorCountry"],
+    "Contact Phone": ["IPTC:ContactInfoPhone", "XMP-iptcCore:CreatorWorkTelephone"],
+    "Contact E-Mail": ["IPTC:ContactInfoEmail", "XMP-iptcCore:CreatorWorkEmail"],
+    "Contact URL": ["IPTC:ContactInfoWebURL", "XMP-iptcCore:CreatorWorkURL"], # Specific Contact URL
+
+    # Location fields from /exif page (if they come as top-level category keys)
+    "Sublocation": ["IPTC:Sub-location", "XMP-iptcCore:Location"],
+
+    # Date/Time
+    "GPSDateStamp": "GPS:GPSDateStamp", # Direct GPS tag
+    "GPSTimeStamp": "GPS:GPSTimeStamp", # Direct GPS tag
+    "GPS Date Time": "XMP:GPSDateTime", # XMP equivalent
+    "Creation Date": ["EXIF:CreateDate", "XMP-xmp:CreateDate"],
+    "Modification Date": ["EXIF:ModifyDate", "XMP-xmp:ModifyDate"],
+    "Taken Date": ["EXIF:DateTimeOriginal", "XMP-xmp:CreateDate"], # Often maps to DateTimeOriginal
+}
+
+# Tags ExifTool adds for info but are not meant for writing or might cause conflicts
+UNWANTED_WRITE_TAGS = [
+    # System/File Info (read-only from ExifTool)
+    "ExifTool:ExifToolVersion", "System:FileName", "System:Directory", 
+    "System:FileSize", "System:FileModifyDate", "System:FileAccessDate", 
+    "System:FileCreateDate", "System:FilePermissions", "File:FileType", 
+    "File:FileTypeExtension", "File:MIMEType", 
+
+    # Image characteristics that ExifTool might derive but are not directly writable in this context
+    "File:ExifByteOrder", "File:ImageWidth", "File:ImageHeight", 
+    "File:EncodingProcess", "File:BitsPerSample", "File:ColorComponents", 
+    "File:YCbCrSubSampling", 
+
+    # Composite tags that are derived and not directly writable
+    "Composite:ImageSize", "Composite:Megapixels", 
+    "Composite:GPSDateTime", "Composite:GPSLatitude", "Composite:GPSLongitude", 
+    "Composite:GPSLatitudeRef", "Composite:GPSLongitudeRef", "Composite:GPSPosition",
+
+    # Other potentially problematic tags that should not be written directly
+    "SourceFile", # This is a meta-tag from ExifTool output, not a writable tag
+    # Add any other tags identified as problematic during testing here
+]
+
+
+def build_exif_write_plan(exif_data, incoming_metadata=None, use_random=False):
+    """
+    Map the geotagging form data (and optional /exif page metadata) to ExifTool tags.
+
+    Args:
+        exif_data (dict): EXIF data from the geotagging form
+        incoming_metadata (dict): Parsed `all_metadata` from the /exif page (optional)
+        use_random (bool): Whether random coordinates should be drawn from the preset
+
+    Returns:
+        dict: Flattened dictionary of ExifTool tags ready for process_image_with_exiftool
+    """
+    exif_data_to_write = {}
+
+    # Prioritize comprehensive ExifTool data if available
+    if incoming_metadata and "Comprehensive Metadata (ExifTool)" in incoming_metadata:
+        # Flatten the "Other ExifTool Tags" section
+        other_exiftool_tags = incoming_metadata["Comprehensive Metadata (ExifTool)"].get("Other ExifTool Tags", {})
+        exif_data_to_write.update(flatten_exiftool_metadata(other_exiftool_tags))
+
+        # Process top-level ExifTool categories (e.g., GPS Data, Location, Contact)
+        for category_name, category_data in incoming_metadata["Comprehensive Metadata (ExifTool)"].items():
+            if category_name not in ["Image Information (PIL)", "Other ExifTool Tags"] and isinstance(category_data, dict):
+                for friendly_field_name, value in category_data.items():
+                    # Attempt to map the friendly name to ExifTool tags for writing
+                    mapped_tags = FRIENDLY_TO_EXIFTOOL_TAG_MAP.get(friendly_field_name)
+                    if mapped_tags:
+                        if not isinstance(mapped_tags, list):
+                            mapped_tags = [mapped_tags]
+                        for tag in mapped_tags:
+                            exif_data_to_write[tag] = value
+                    elif ':' in friendly_field_name: # If it's already a Group:TagName format
+                        exif_data_to_write[friendly_field_name] = value
+                    else:
+                        current_app.logger.debug(f"Comprehensive metadata field '{friendly_field_name}' from category '{category_name}' not mapped for writing.")
+
+    # --- OVERWRITE / ADD DATA FROM GEOTAGGING FORM (`exif_data` from request.form) ---
+    # Process incoming form data and map to ExifTool tags, prioritizing these.
+    for form_friendly_name, form_value in exif_data.items():
+        # Only process if value is not None or empty (string/list)
+        if form_value is None or (isinstance(form_value, (str, list)) and not form_value):
+            continue
+
+        # Special handling for coordinates (latitude/longitude from form/preset)
+        if form_friendly_name == "GPSLatitude" and form_value is not None:
+            try:
+                lat_float = float(form_value)
+                exif_data_to_write["GPS:GPSLatitude"] = lat_float
+                exif_data_to_write["GPS:GPSLatitudeRef"] = "N" if lat_float >= 0 else "S"
+            except ValueError:
+                current_app.logger.warning(f"Invalid GPSLatitude value from form: {form_value}")
+        elif form_friendly_name == "GPSLongitude" and form_value is not None:
+            try:
+                lon_float = float(form_value)
+                exif_data_to_write["GPS:GPSLongitude"] = lon_float
+                exif_data_to_write["GPS:GPSLongitudeRef"] = "E" if lon_float >= 0 else "W"
+            except ValueError:
+                current_app.logger.warning(f"Invalid GPSLongitude value from form: {form_value}")
+        # Special handling for datetime from the form (it's a single field 'datetime')
+        elif form_friendly_name == "datetime" and form_value:
+            try:
+                # datetime from frontend is like '2025-06-16T12:49'
+                dt = datetime.datetime.fromisoformat(form_value)
+                # Update GPS date/time tags
+                exif_data_to_write["GPS:GPSDateStamp"] = dt.strftime("%Y:%m:%d")
+                exif_data_to_write["GPS:GPSTimeStamp"] = dt.strftime("%H:%M:%S")
+                exif_data_to_write["XMP:GPSDateTime"] = dt.isoformat(timespec='seconds') + "Z"
+                # Also update general date/time tags
+                exif_data_to_write["EXIF:DateTimeOriginal"] = dt.strftime("%Y:%m:%d %H:%M:%S")
+                exif_data_to_write["EXIF:CreateDate"] = dt.strftime("%Y:%m:%d %H:%M:%S")
+                exif_data_to_write["EXIF:ModifyDate"] = dt.strftime("%Y:%m:%d %H:%M:%S")
+                exif_data_to_write["XMP-xmp:CreateDate"] = dt.isoformat(timespec='seconds') # No Z for XMP CreateDate
+                exif_data_to_write["XMP-xmp:ModifyDate"] = dt.isoformat(timespec='seconds') # No Z for XMP ModifyDate
+            except ValueError:
+                current_app.logger.warning(f"Invalid datetime format from form: {form_value}")
+        # Special handling for keywords (can be list or comma-separated string)
+        elif form_friendly_name == "Keywords":
+            keywords_list = []
+            if isinstance(form_value, list):
+                keywords_list = form_value
+            elif isinstance(form_value, str):
+                keywords_list = [k.strip() for k in form_value.split(',') if k.strip()]
+
+            # Store as list in exif_data_to_write; process_image_with_exiftool handles multi-value
+            exif_data_to_write["IPTC:Keywords"] = keywords_list
+            exif_data_to_write["XMP-dc:Subject"] = keywords_list
+        # Handle preset for random coordinates (only if use_random is true)
+        elif form_friendly_name == "preset" and form_value and use_random:
+            random_lat, random_lng = generate_random_coordinates_in_quadrilateral(form_value) # form_value is the preset object
+            if random_lat is not None and random_lng is not None:
+                exif_data_to_write["GPS:GPSLatitude"] = random_lat
+                exif_data_to_write["GPS:GPSLatitudeRef"] = "N" if random_lat >= 0 else "S"
+                exif_data_to_write["GPS:GPSLongitude"] = random_lng
+                exif_data_to_write["GPS:GPSLongitudeRef"] = "E" if random_lng >= 0 else "W"
+                exif_data_to_write["GPS:GPSMapDatum"] = "WGS-84"
+                current_app.logger.info(f"Applied random coordinates from preset: {random_lat}, {random_lng}")
+
+                # --- ALWAYS OVERRIDE LOCATION FIELDS WITH CITY PRESET IF PRESENT ---
+                if exif_data.get("preset"):
+                    city_preset = exif_data["preset"]
+                    preset_country = city_preset.get("country", "")
+                    preset_state_province = city_preset.get("state_province", "")
+                    preset_city = city_preset.get("name", "")
+                    preset_sublocation = city_preset.get("sublocation", "")
+
+                    # Write to all relevant tags for maximum compatibility
+                    for tag in [
+                        "IPTC:Country-PrimaryLocationName",
+                        "XMP-iptcCore:CreatorCountry",
+                        "XMP-iptcCore:CountryName",
+                        "XMP-photoshop:Country"
+                    ]:
+                        exif_data_to_write[tag] = preset_country
+                    for tag in [
+                        "IPTC:Province-State",
+                        "XMP-iptcCore:CreatorRegion",
+                        "XMP-iptcCore:ProvinceState",
+                        "XMP-photoshop:State"
+                    ]:
+                        exif_data_to_write[tag] = preset_state_province
+                    for tag in [
+                        "IPTC:City",
+                        "XMP-iptcCore:CreatorCity",
+                        "XMP-iptcCore:City",
+                        "XMP-photoshop:City"
+                    ]:
+                        exif_data_to_write[tag] = preset_city
+                    for tag in [
+                        "IPTC:Sub-location",
+                        "XMP-iptcCore:Location"
+                    ]:
+                        exif_data_to_write[tag] = preset_sublocation
+        # Explicit handling for general location fields
+        elif form_friendly_name == "Country":
+            for tag in ["IPTC:Country-PrimaryLocationName", "XMP-iptcCore:CountryName"]:
+                exif_data_to_write[tag] = form_value
+        elif form_friendly_name == "State":
+            for tag in ["IPTC:Province-State", "XMP-iptcCore:ProvinceState"]:
+                exif_data_to_write[tag] = form_value
+        elif form_friendly_name == "City":
+            for tag in ["IPTC:City", "XMP-iptcCore:City"]:
+                exif_data_to_write[tag] = form_value
+        # Explicit handling for contact info fields
+        elif form_friendly_name == "ContactCountry":
+            for tag in ["IPTC:ContactInfoCountry", "XMP-iptcCore:CreatorCountry"]:
+                exif_data_to_write[tag] = form_value
+        elif form_friendly_name == "ContactState":
+            for tag in ["IPTC:ContactInfoStateProvince", "XMP-iptcCore:CreatorRegion"]:
+                exif_data_to_write[tag] = form_value
+        elif form_friendly_name == "ContactCity":
+            for tag in ["IPTC:ContactInfoCity", "XMP-iptcCore:CreatorCity"]:
+                exif_data_to_write[tag] = form_value
+        elif form_friendly_name == "ContactURL":
+            for tag in ["IPTC:ContactInfoWebURL", "XMP-iptcCore:CreatorWorkURL"]:
+                exif_data_to_write[tag] = form_value
+        elif form_friendly_name == "Creator":
+            for tag in ["IFD0:Artist", "XMP-tiff:Artist", "XMP-dc:Creator"]:
+                exif_data_to_write[tag] = form_value
+        else:
+            # For other friendly names, map them to their ExifTool tags
+            mapped_tags = FRIENDLY_TO_EXIFTOOL_TAG_MAP.get(form_friendly_name)
+            if mapped_tags:
+                if not isinstance(mapped_tags, list):
+                    mapped_tags = [mapped_tags] # Ensure it's always a list for consistent iteration
+                for tag in mapped_tags:
+                    exif_data_to_write[tag] = form_value
+            else:
+                # If the form field name itself is an ExifTool tag (e.g., from client presets),
+                # add it directly if it contains a colon.
+                if ':' in form_friendly_name:
+                    exif_data_to_write[form_friendly_name] = form_value
+                else:
+                    current_app.logger.debug(f"Frontend field '{form_friendly_name}' not explicitly mapped or a direct ExifTool tag for writing.")
+
+    # After processing all form fields, set contact address if present
+    if 'address' in exif_data and exif_data['address']:
+        exif_data_to_write['IPTC:ContactInfoAddress'] = exif_data['address']
+
+    # Clean up any undesirable tags that might have come from the read operation
+    # Remove unwanted tags. Iterate over a copy of keys to allow modification during iteration.
+    for tag_key in list(exif_data_to_write.keys()):
+        # Check if the tag_key (e.g., 'File:FileName') starts with any of the unwanted tags or is an exact match
+        for unwanted_prefix in UNWANTED_WRITE_TAGS:
+            if tag_key.startswith(unwanted_prefix):
+                exif_data_to_write.pop(tag_key, None)
+                break # Break inner loop, as this tag_key is handled
+
+    return exif_data_to_write
+
+def exif_data_from_presets(city_preset=None, client_preset=None):
+    """
+    Geotagging form data for a city and/or client preset, as the geotagging form fills it in.
+
+    Args:
+        city_preset (dict): Complete city preset including 'country' and 'state_province' (optional)
+        client_preset (dict): Client preset (optional)
+
+    Returns:
+        dict: EXIF data for geotag_batch; files get random coordinates inside the city's boundaries
+    """
+    exif_data = {}
+    if client_preset:
+        exif_data.update(manifest.form_fields({'client_preset': client_preset['id']}, {client_preset['id']: client_preset}))
+    if city_preset:
+        exif_data.update({
+            'GPSLatitude': city_preset['center']['lat'],
+            'GPSLongitude': city_preset['center']['lng'],
+            'use_random_coordinates': True,
+            'preset': city_preset,
+            'CityDisplayName': city_preset.get('name'),
+            'State': city_preset.get('state_province'),
+            'Country': city_preset.get('country'),
+        })
+    return exif_data
+
+def geotag_batch(items, processed_folder, exif_data, incoming_metadata=None, file_manifest=None,
+                 manifest_fields=None, track=None, track_offset_ms=0, track_max_gap=tracklog.DEFAULT_MAX_GAP,
+                 reconcile_mode='off', jpeg_options=None, keep_heic=False, consume_inputs=True, scratch=None,
+                 on_progress=None):
+    """
+    Geotag a batch of image files. Shared by the geotagging endpoint, the watch-folder daemon and the CLI.
+
+    Args:
+        items (list): Dicts with 'original_relative_path', 'uploaded_temp_path' and 'original_filename'
+        processed_folder (str): Folder the geotagged files are written to, keeping their relative paths
+        exif_data (dict): EXIF data from the geotagging form (applies to every file)
+        incoming_metadata (dict): Parsed `all_metadata` from the /exif page (optional)
+        file_manifest (Manifest): Per-file metadata (optional)
+        manifest_fields (list): Form fields of each manifest group (see manifest.form_fields)
+        track (Track): GPS track to place files by capture time (optional)
+        track_offset_ms (int): Milliseconds to add to the camera clock to get UTC
+        track_max_gap (float): Longest gap between track fixes to interpolate across, in seconds
+        reconcile_mode (str): 'off', 'changed' or 'fill_missing' (see src/utils/reconcile.py)
+        jpeg_options (dict): Encoder options for files re-encoded to JPEG (default: quality 95)
+        keep_heic (bool): Write HEIC/HEIF files in place instead of converting them to JPEG
+        consume_inputs (bool): Delete (or move) the input files once they are processed
+        scratch (ScratchSession): Scratch space for the temporary JPEGs (default: next to the outputs)
+        on_progress (callable): Called with the percentage of files done
+
+    Returns:
+        dict: processed_files, errors, size_reports and the track, manifest and reconcile reports
+    """
+    jpeg_options = jpeg_options or {'quality': 95}
+
+    # Process files while preserving folder structure
+    processed_files_with_paths = []
+    processing_errors = []
+    size_reports = []
+
+    # Check if using random coordinates for bulk processing
+    use_random = exif_data.get("use_random_coordinates", False)
+
+    # Per-file form fields from the manifest: one dict per distinct manifest row
+    file_fields = [None] * len(items)
+    file_groups = [None] * len(items)
+    manifest_report = None
+    if file_manifest is not None:
+        rows = [file_manifest.row_for(item['original_relative_path']) for item in items]
+        used_rows = {row for row in rows if row is not None}
+        for i, row in enumerate(rows):
+            if row is not None:
+                file_groups[i] = file_manifest.group_of[row]
+                file_fields[i] = manifest_fields[file_groups[i]]
+        manifest_report = {
+            'rows': len(file_manifest),
+            'groups': len({file_manifest.group_of[row] for row in used_rows}),
+            'matched': len(used_rows),
+            'unlisted': [item['original_relative_path'] for i, item in enumerate(items)
+                         if rows[i] is None],
+            'unused_rows': [file_manifest.paths[row] for row in range(len(file_manifest)) if row not in used_rows],
+        }
+
+    # Match every photo against the track in one vectorized pass.
+    # Coordinates from the manifest are explicit and win over the track.
+    track_positions = {}
+    track_report = None
+    if track is not None:
+        track_indexes = [i for i in range(len(items))
+                         if not (file_fields[i] and 'GPSLatitude' in file_fields[i])]
+        with metrics.stage_timer('geotagging', 'track_match'):
+            photo_times = [tracklog.photo_time(items[i]['uploaded_temp_path'], track_offset_ms)
+                           for i in track_indexes]
+            lats, lons, eles, matched = track.match(photo_times, track_max_gap)
+        for j, i in enumerate(track_indexes):
+            if matched[j]:
+                track_positions[i] = (float(lats[j]), float(lons[j]), float(eles[j]))
+        track_report = {
+            'points': len(track),
+            'matched': len(track_positions),
+            'unmatched': [items[i]['original_relative_path'] for i in track_indexes
+                          if i not in track_positions],
+        }
+
+    # Files whose write plans are identical share ExifTool runs. Each pending group
+    # is written once it has EXIFTOOL_BATCH_SIZE files, and the rest after the loop.
+    pending_writes = {}  # write plan as JSON -> {'plan', 'jobs', 'files'}
+    plan_cache = {}  # manifest group -> write plan, for files whose plan does not vary
+    batch_size = get_exiftool_batch_size()
+    total_files = len(items)
+    completed = 0
+
+    # Removing through the scratch session also returns the file's share of the RAM tier
+    remove_file = scratch.remove if scratch is not None else os.remove
+
+    def cleanup_file(uploaded_file_path, temp_jpeg_path):
+        with metrics.stage_timer('geotagging', 'cleanup'):
+            # Clean up the temporary JPEG file created for ExifTool processing, if it exists
+            if temp_jpeg_path and os.path.exists(temp_jpeg_path):
+                remove_file(temp_jpeg_path)
+                current_app.logger.info(f"Cleaned up temporary JPEG: {temp_jpeg_path}")
+            # Clean up the original uploaded temp file after processing each file
+            if consume_inputs and os.path.exists(uploaded_file_path):
+                remove_file(uploaded_file_path)
+                current_app.logger.info(f"Cleaned up uploaded file: {uploaded_file_path}")
+
+    def file_done():
+        nonlocal completed
+        completed += 1
+        if on_progress is not None:
+            on_progress(int((completed / total_files) * 100))
+
+    def flush_writes(plan_key):
+        pending = pending_writes.pop(plan_key)
+        # Process the images with updated metadata using ExifTool
+        with metrics.stage_timer('geotagging', 'metadata_write'):
+            results = process_images_with_exiftool(pending['jobs'], pending['plan'])
+        for exiftool_ok, (_, final_output_path), written in zip(results, pending['jobs'], pending['files']):
+            original_filename = written['original_filename']
+            original_relative_path = written['original_relative_path']
+            if exiftool_ok:
+                metrics.count_bytes('geotagging', 'out', metrics.file_size(final_output_path))
+                size_reports.append(encoders.size_report(written['uploaded_file_path'], final_output_path, original_relative_path))
+                # Store info for successful files
+                base_filename_no_ext = os.path.splitext(os.path.basename(original_relative_path))[0]
+                processed_relative_dir_for_zip = os.path.dirname(original_relative_path)
+                # Use the original relative path's structure with the output's extension (.jpg unless kept as HEIC)
+                arcname_in_zip = os.path.join(processed_relative_dir_for_zip, base_filename_no_ext + os.path.splitext(final_output_path)[1])
+
+                processed_files_with_paths.append({
+                    'original_name': original_filename,
+                    'original_relative_path': original_relative_path,
+                    'processed_path': final_output_path,
+                    'arcname_in_zip': arcname_in_zip
+                })
+                current_app.logger.info(f"Successfully processed and added {original_filename} to processed_files_with_paths.")
+            else:
+                metrics.count_error('geotagging', 'metadata_write')
+                processing_errors.append(f"Error processing {original_filename}: Geotagging failed during ExifTool write.")
+                current_app.logger.error(f"Failed to process {original_filename} with ExifTool.")
+            cleanup_file(written['uploaded_file_path'], written['temp_jpeg_path'])
+            file_done()
+
+    # Write plan for every file, worked out before any file is touched so reconcile
+    # mode can read the current tags of the whole batch in one pass
+    write_plans = [None] * total_files  # None for files that are skipped with an error
+    for idx, item in enumerate(items):
+        original_filename = item['original_filename']
+        # The batch's form data, with this file's manifest row on top
+        file_exif_data = dict(exif_data, **file_fields[idx]) if file_fields[idx] else exif_data
+        has_own_coordinates = bool(file_fields[idx]) and 'GPSLatitude' in file_fields[idx]
+        file_use_random = use_random and not has_own_coordinates
+
+        # Initialize current file's random lat/lng, even if not used, to prevent NameError
+        current_file_random_lat = None
+        current_file_random_lng = None
+
+        # Determine coordinates based on input (explicit lat/lng take precedence over preset)
+        # Note: `lat` and `lng` come from the form for the whole batch, or per file from the manifest.
+        if file_exif_data.get('GPSLatitude') is not None and file_exif_data.get('GPSLongitude') is not None:
+            try:
+                current_file_random_lat = float(file_exif_data['GPSLatitude'])
+                current_file_random_lng = float(file_exif_data['GPSLongitude'])
+            except ValueError:
+                processing_errors.append(f'Invalid latitude or longitude format for {original_filename}.')
+                continue # Skip this file
+        elif file_use_random and file_exif_data.get("preset"): # Use preset if random is enabled
+            current_file_random_lat, current_file_random_lng = generate_random_coordinates_in_quadrilateral(file_exif_data["preset"])
+            current_app.logger.info(f"Generated random coordinates for {original_filename}: {current_file_random_lat}, {current_file_random_lng}")
+
+        # Prepare EXIF data for writing for the current file
+        # This will be a flattened dictionary of ExifTool-compatible tags
+        if idx in track_positions:
+            # A track fix beats both the batch coordinates and random preset coordinates
+            track_lat, track_lng, track_ele = track_positions[idx]
+            track_exif_data = dict(file_exif_data, GPSLatitude=track_lat, GPSLongitude=track_lng)
+            exif_data_to_write = build_exif_write_plan(track_exif_data, incoming_metadata, False)
+            exif_data_to_write["GPS:GPSMapDatum"] = "WGS-84"
+            if track_ele == track_ele:  # NaN when the track has no elevation
+                exif_data_to_write["GPS:GPSAltitude"] = abs(track_ele)
+                exif_data_to_write["GPS:GPSAltitudeRef"] = "Above Sea Level" if track_ele >= 0 else "Below Sea Level"
+        elif file_use_random:
+            exif_data_to_write = build_exif_write_plan(file_exif_data, incoming_metadata, True)
+        else:
+            # Same plan for every file of the batch, or of the same manifest group
+            if file_groups[idx] not in plan_cache:
+                plan_cache[file_groups[idx]] = build_exif_write_plan(file_exif_data, incoming_metadata, False)
+            exif_data_to_write = plan_cache[file_groups[idx]]
+        write_plans[idx] = exif_data_to_write
+
+    # Read what the files already carry and keep only what still has to be written
+    current_tags = {}
+    reconcile_report = None
+    if reconcile_mode != 'off':
+        planned = [i for i in range(total_files) if write_plans[i] is not None]
+        current_tags = reconcile.read_tags(
+            [items[i]['uploaded_temp_path'] for i in planned],
+            {tag for i in planned for tag in write_plans[i]})
+        reconcile_report = {'mode': reconcile_mode, 'written': 0, 'skipped': 0, 'skipped_files': [],
+                            'tags_written': 0, 'tags_unchanged': 0}
+
+    for idx, item in enumerate(items):
+        original_relative_path = item['original_relative_path']
+        uploaded_file_path = item['uploaded_temp_path']
+        original_filename = item['original_filename']
+        temp_jpeg_path = None # Initialize for cleanup
+        queued = False # Set once the file waits for a shared ExifTool run, which cleans it up
+
+        try:
+            exif_data_to_write = write_plans[idx]
+            if exif_data_to_write is None:
+                continue # Skipped above with an error
+
+            current = None
+            if reconcile_mode != 'off':
+                current = current_tags.get(uploaded_file_path)
+                needed = reconcile.diff_plan(exif_data_to_write, current, reconcile_mode)
+                reconcile_report['tags_written'] += len(needed)
+                reconcile_report['tags_unchanged'] += len(exif_data_to_write) - len(needed)
+                if not needed:
+                    # Nothing to change: pass the original file through without copying or re-encoding
+                    final_output_path = os.path.join(processed_folder, original_relative_path)
+                    os.makedirs(os.path.dirname(final_output_path), exist_ok=True)
+                    (shutil.move if consume_inputs else copy_file)(uploaded_file_path, final_output_path)
+                    metrics.count_bytes('geotagging', 'out', metrics.file_size(final_output_path))
+                    processed_files_with_paths.append({
+                        'original_name': original_filename,
+                        'original_relative_path': original_relative_path,
+                        'processed_path': final_output_path,
+                        'arcname_in_zip': original_relative_path,
+                        'unchanged': True
+                    })
+                    reconcile_report['skipped'] += 1
+                    reconcile_report['skipped_files'].append(original_relative_path)
+                    continue
+                reconcile_report['written'] += 1
+                exif_data_to_write = needed
+
+            current_app.logger.info(f"Final exif_data_to_write for {original_filename}: {json.dumps(exif_data_to_write, indent=2)}")
+
+            # --- Image Format Handling & Conversion to JPEG for ExifTool ---
+            # ExifTool works best with JPEG for writing, and PIL can handle various inputs.
+            # We will convert input to JPEG in a temp file if it's not already.
+            file_to_process_for_exiftool = uploaded_file_path # Default to original
+            original_ext = os.path.splitext(original_filename)[1].lower()
+            # HEIC kept as HEIC: ExifTool writes straight into the container, so the pixels are never decoded
+            in_place = keep_heic and heif.is_heif(original_filename)
+
+            # Open the image first to check its mode or convert if necessary
+            img = None # Initialize img to None
+            try:
+                current_app.logger.info(f"Attempting to open image: {uploaded_file_path}. Exists: {os.path.exists(uploaded_file_path)}")
+                img = Image.open(uploaded_file_path)
+
+                if not in_place and (original_ext not in ['.jpg', '.jpeg'] or img.mode != 'RGB'): # Use img.mode here
+                    # Create a temp JPEG for ExifTool if conversion is needed
+                    temp_filename_for_exiftool = f"{uuid.uuid4()}.jpg"
+                    if scratch is not None:
+                        # Sized at about 4 bits per pixel, what quality 95 takes for a photo
+                        temp_jpeg_path = scratch.path('work', temp_filename_for_exiftool, img.width * img.height // 2)
+                    else:
+                        temp_dir_for_conversion = os.path.join(processed_folder, os.path.dirname(original_relative_path))
+                        os.makedirs(temp_dir_for_conversion, exist_ok=True)
+                        temp_jpeg_path = os.path.join(temp_dir_for_conversion, temp_filename_for_exiftool)
+
+                    current_app.logger.info(f"Converting {original_filename} to JPEG for ExifTool: {temp_jpeg_path}")
+                    with metrics.stage_timer('geotagging', 'decode'):
+                        img.load()
+                    with metrics.stage_timer('geotagging', 'convert'):
+                        rgb_img = img.convert('RGB')
+                    with metrics.stage_timer('geotagging', 'encode'):
+                        rgb_img.save(temp_jpeg_path, 'JPEG', **jpeg_options) # High quality JPEG unless a profile says otherwise
+                    file_to_process_for_exiftool = temp_jpeg_path
+                    if reconcile_mode != 'off':
+                        # Re-encoding drops the file's metadata, so write back everything it should keep
+                        exif_data_to_write = reconcile.full_plan(write_plans[idx], current, reconcile_mode)
+            except UnidentifiedImageError as img_ident_error:
+                metrics.count_error('geotagging', 'decode')
+                current_app.logger.error(f"Cannot identify image file {original_filename}: {img_ident_error}")
+                processing_errors.append(f"Cannot identify image file {original_filename}. Please ensure it's a valid image file.")
+                continue # Skip this file
+            except Exception as img_open_conv_error:
+                current_app.logger.error(f"Error opening or converting image {original_filename} to JPEG for ExifTool: {img_open_conv_error}")
+                processing_errors.append(f"Error processing {original_filename}: {img_open_conv_error}")
+                continue # Skip this file
+            finally:
+                if img: # Ensure image is closed
+                    img.close()
+
+            # Determine the final output path preserving the folder structure
+            # Ensure the original directory structure is maintained within the processed_folder
+            # by joining processed_folder with the original_relative_path's directory.
+            base_name = os.path.splitext(os.path.basename(original_relative_path))[0]
+            processed_relative_dir = os.path.dirname(original_relative_path)
+            final_output_dir = os.path.join(processed_folder, processed_relative_dir)
+            os.makedirs(final_output_dir, exist_ok=True)  # Ensure output directory exists
+
+            # Save the final geotagged image as JPEG for broad compatibility (HEIC stays HEIC with keep_heic)
+            final_output_path = os.path.join(final_output_dir, f"{base_name}{original_ext if in_place else '.jpg'}")
+
+            current_app.logger.info(f"Processing {original_filename}. Input: {file_to_process_for_exiftool}, Output: {final_output_path}")
+
+            # Queue the ExifTool write with the other files that get exactly the same tags
+            plan_key = json.dumps(exif_data_to_write, sort_keys=True, default=str)
+            pending = pending_writes.setdefault(plan_key, {'plan': exif_data_to_write, 'jobs': [], 'files': []})
+            pending['jobs'].append((file_to_process_for_exiftool, final_output_path))
+            pending['files'].append({
+                'original_filename': original_filename,
+                'original_relative_path': original_relative_path,
+                'uploaded_file_path': uploaded_file_path,
+                'temp_jpeg_path': temp_jpeg_path,
+            })
+            queued = True
+            if len(pending['jobs']) >= batch_size:
+                flush_writes(plan_key)
+
+        except Exception as e:
+            error_msg = f"Unhandled error processing {original_filename}: {str(e)}"
+            current_app.logger.error(error_msg)
+            processing_errors.append(error_msg)
+        finally:
+            if not queued:
+                cleanup_file(uploaded_file_path, temp_jpeg_path)
+                file_done()
+
+    for plan_key in list(pending_writes):
+        try:
+            flush_writes(plan_key)
+        except Exception as e:
+            error_msg = f"Unhandled error writing metadata: {str(e)}"
+            current_app.logger.error(error_msg)
+            processing_errors.append(error_msg)
+
+    return {
+        'processed_files': processed_files_with_paths,
+        'errors': processing_errors,
+        'size_reports': size_reports,
+        'track_report': track_report,
+        'manifest_report': manifest_report,
+        'reconcile_report': reconcile_report,
+    }
 
 progress_lock = threading.Lock()
 
 def set_progress(session_id, percent):
-    progress_file = os.path.join(current_app.config['PROCESSED_FOLDER'], session_id, 'progress.json')
+    # Kept in storage so a progress poll can be answered by any node
     with progress_lock:
-        with open(progress_file, 'w') as f:
-            json.dump({'progress': percent}, f)
+        storage.get_storage().put_json(storage.processed_key(session_id, 'progress.json'), {'progress': percent})
 
 def get_progress(session_id):
-    progress_file = os.path.join(current_app.config['PROCESSED_FOLDER'], session_id, 'progress.json')
-    if os.path.exists(progress_file):
-        with open(progress_file, 'r') as f:
-            try:
-                data = json.load(f)
-                return data.get('progress', 0)
-            except Exception:
-                return 0
+    data = storage.get_storage().get_json(storage.processed_key(session_id, 'progress.json'))
+    if isinstance(data, dict):
+        return data.get('progress', 0)
     return 0
 
 @geotagging_bp.route('/progress/<session_id>', methods=['GET'])
@@ -217,16 +935,28 @@ def process_images():
     
     Expects:
     - files: Image files to process
+    - upload_ids: Finalized resumable upload ids (instead of or in addition to files)
     - exif_data: JSON string with EXIF data to apply (from geotagging form)
     - all_metadata: JSON string with comprehensive metadata from the /exif page (optional)
     - output_format: Output format (jpeg, png, tiff)
+    - encoder_profile: Encoder profile for files that are re-encoded to JPEG (default: quality 95)
+    - keep_heic: Keep HEIC/HEIF files as HEIC and write their metadata in place instead of
+      converting them to JPEG (optional)
+    - track_files: GPX or KML track logs; photos are placed by their capture time (optional)
+    - track_time_offset: Seconds or [+-]H:MM to add to the camera clock to get UTC (default 0)
+    - track_max_gap: Longest gap between fixes, in seconds, to interpolate across (default 300)
+    - manifest: CSV or JSON mapping file_paths entries to their own coordinates, datetime,
+      keywords and client preset (optional, see src/utils/manifest.py)
+    - reconcile: 'off' (default), 'changed' to write only tags that differ from the file's
+      current values, or 'fill_missing' to write only tags the file lacks
     
     Returns:
     - JSON response with status and download URL
     """
     try:
-        # Check if files were uploaded
-        if 'files[]' not in request.files:
+        # Check if files were uploaded (inline or through /api/uploads)
+        upload_ids = request.form.getlist('upload_ids[]')
+        if 'files[]' not in request.files and not upload_ids:
             return jsonify({
                 'error': 'No files provided',
                 'details': 'The request did not contain any files'
@@ -235,7 +965,7 @@ def process_images():
         files = request.files.getlist('files[]')
         file_paths = request.form.getlist('file_paths[]')
 
-        if not files or files[0].filename == '':
+        if not upload_ids and (not files or files[0].filename == ''):
             return jsonify({
                 'error': 'No files selected',
                 'details': 'The file list is empty or the first file has no filename'
@@ -262,11 +992,65 @@ def process_images():
         output_format = request.form.get('output_format', 'jpeg').lower()
         if output_format not in ['jpeg', 'png', 'tiff']:
             output_format = 'jpeg'
+
+        # Encoder options for inputs that have to be re-encoded as JPEG for ExifTool
+        encoder_profile = request.form.get('encoder_profile')
+        if encoder_profile and encoder_profile not in encoders.PROFILES:
+            return jsonify({
+                'error': 'Unsupported output options',
+                'details': f"Unknown encoder profile '{encoder_profile}' (available: {', '.join(encoders.PROFILES)})"
+            }), 400
+        jpeg_options = encoders.save_options('jpeg', encoder_profile) if encoder_profile else {'quality': 95}
+        keep_heic = request.form.get('keep_heic', '').lower() in ('1', 'true', 'on', 'yes')
+
+        # Reconcile mode: skip tags (and files) whose metadata is already right
+        reconcile_mode = request.form.get('reconcile') or 'off'
+        if reconcile_mode not in reconcile.MODES:
+            return jsonify({
+                'error': 'Invalid reconcile mode',
+                'details': f"Unknown reconcile mode '{reconcile_mode}' (available: {', '.join(reconcile.MODES)})"
+            }), 400
+
+        # Optional track logs, parsed straight from the upload streams into compact arrays
+        track = None
+        track_offset_ms = 0
+        track_max_gap = tracklog.DEFAULT_MAX_GAP
+        track_files = [f for f in request.files.getlist('track_files[]') if f and f.filename]
+        if track_files:
+            try:
+                track_offset_ms = tracklog.parse_offset(request.form.get('track_time_offset'))
+                track_max_gap = float(request.form.get('track_max_gap') or tracklog.DEFAULT_MAX_GAP)
+                with metrics.stage_timer('geotagging', 'track_parse'):
+                    track = tracklog.Track.concatenate(
+                        [tracklog.parse_track(f.stream, f.filename) for f in track_files])
+            except ValueError as e:
+                return jsonify({
+                    'error': 'Invalid track log',
+                    'details': str(e)
+                }), 400
+
+        # Optional per-file metadata manifest (CSV or JSON, as a file or a form field)
+        file_manifest = None
+        manifest_fields = None
+        manifest_upload = request.files.get('manifest')
+        manifest_data = manifest_upload.read() if manifest_upload and manifest_upload.filename else request.form.get('manifest')
+        if manifest_data:
+            try:
+                file_manifest = manifest.parse_manifest(manifest_data, manifest_upload.filename if manifest_upload else '')
+                client_presets = None
+                if 'client_preset' in file_manifest.columns:
+                    client_presets = {str(p.get('id')): p for p in presets.client_document().read().get('presets', [])}
+                manifest_fields = [manifest.form_fields(group, client_presets) for group in file_manifest.groups]
+            except manifest.ManifestError as e:
+                return jsonify({
+                    'error': 'Invalid manifest',
+                    'details': str(e)
+                }), 400
         
         # Create a unique session ID for this batch
         session_id = str(uuid.uuid4())
-        upload_folder = os.path.join(current_app.config['UPLOAD_FOLDER'], session_id)
-        processed_folder = os.path.join(current_app.config['PROCESSED_FOLDER'], session_id)
+        workspace = scratch.open_session(session_id)
+        upload_folder, processed_folder = workspace.upload_folder, workspace.processed_folder
         
         # Create the base session directories
         try:
@@ -290,13 +1074,11 @@ def process_images():
                     # Generate a unique, short filename for the temporary uploaded file
                     # This avoids issues with long paths and special characters in temp dir
                     unique_temp_filename = f"{uuid.uuid4()}{os.path.splitext(original_filename)[1].lower()}"
-                    upload_path = os.path.join(upload_folder, unique_temp_filename)
-                    
-                    # Create parent directories if they don't exist (for the session_id folder)
-                    os.makedirs(os.path.dirname(upload_path), exist_ok=True)
-                    
-                    # Save the file
-                    file.save(upload_path)
+
+                    # Save the file (in memory-backed scratch space when it fits)
+                    with metrics.stage_timer('geotagging', 'upload_save'):
+                        upload_path = workspace.save_upload(file, unique_temp_filename)
+                    metrics.count_bytes('geotagging', 'in', metrics.file_size(upload_path))
                     current_app.logger.info(f"Saved uploaded file to: {upload_path}. Exists: {os.path.exists(upload_path)}")
                     saved_files_with_paths.append({
                         'original_relative_path': original_relative_path, # Store original path for later reference
@@ -306,425 +1088,92 @@ def process_images():
                 except Exception as e:
                     current_app.logger.error(f"Error saving file {file.filename}: {str(e)}")
                     continue
+
+        # Files sent ahead through the resumable upload API carry their own relative paths
+        try:
+            claimed = uploads.claim_uploads(upload_ids, upload_folder, unique_names=True)
+        except uploads.UploadError as e:
+            shutil.rmtree(upload_folder, ignore_errors=True)
+            shutil.rmtree(processed_folder, ignore_errors=True)
+            return jsonify({'error': e.message, 'details': e.details}), e.status
+        for item in claimed:
+            metrics.count_bytes('geotagging', 'in', metrics.file_size(item['path']))
+            saved_files_with_paths.append({
+                'original_relative_path': item['relative_path'],
+                'uploaded_temp_path': item['path'],
+                'original_filename': item['filename']
+            })
         
         if not saved_files_with_paths:
             return jsonify({
                 'error': 'No valid image files provided',
                 'details': 'None of the uploaded files could be saved successfully'
             }), 400
-        
-        # Process files while preserving folder structure
-        processed_files_with_paths = []
-        processing_errors = []
-        
-        # Check if using random coordinates for bulk processing
-        use_random = exif_data.get("use_random_coordinates", False)
-        
-        total_files = len(saved_files_with_paths)
-        for idx, item in enumerate(saved_files_with_paths):
-            original_relative_path = item['original_relative_path']
-            uploaded_file_path = item['uploaded_temp_path']
-            original_filename = item['original_filename']
-            temp_jpeg_path = None # Initialize for cleanup
 
+        # Reserve memory for the largest decode before touching any pixels.
+        # Only files that need a JPEG conversion for ExifTool are decoded.
+        try:
+            reservation = admission.admit(
+                current_app, [item['uploaded_temp_path'] for item in saved_files_with_paths], 'geotagging',
+                decodes=lambda path, mode: not (path.lower().endswith(('.jpg', '.jpeg')) and mode == 'RGB'
+                                                or keep_heic and heif.is_heif(path)),
+            )
+        except admission.AdmissionError as e:
+            shutil.rmtree(upload_folder, ignore_errors=True)
+            shutil.rmtree(processed_folder, ignore_errors=True)
+            return admission.error_response(e)
+        
+        # Extract existing metadata if provided from the frontend (from /exif page)
+        incoming_metadata = None
+        all_metadata_str = request.form.get('all_metadata')
+        if all_metadata_str:
             try:
-                # Initialize current file's random lat/lng, even if not used, to prevent NameError
-                current_file_random_lat = None
-                current_file_random_lng = None
-
-                # Determine coordinates based on input (explicit lat/lng take precedence over preset)
-                # Note: `lat` and `lng` are from the form for the whole batch.
-                # If individual lat/lng are needed per image, the frontend must provide them.
-                # For now, assuming batch lat/lng or preset applies to all.
-                if exif_data.get('GPSLatitude') is not None and exif_data.get('GPSLongitude') is not None:
-                    try:
-                        current_file_random_lat = float(exif_data['GPSLatitude'])
-                        current_file_random_lng = float(exif_data['GPSLongitude'])
-                    except ValueError:
-                        processing_errors.append(f'Invalid latitude or longitude format for {original_filename}.')
-                        continue # Skip this file
-                elif use_random and exif_data.get("preset"): # Use preset if random is enabled
-                    current_file_random_lat, current_file_random_lng = generate_random_coordinates_in_quadrilateral(exif_data["preset"])
-                    current_app.logger.info(f"Generated random coordinates for {original_filename}: {current_file_random_lat}, {current_file_random_lng}")
-
-                # Prepare EXIF data for writing for the current file
-                # This will be a flattened dictionary of ExifTool-compatible tags
-                exif_data_to_write = {}
-
-                # Extract existing metadata if provided from the frontend (from /exif page)
-                all_metadata_str = request.form.get('all_metadata')
-                if all_metadata_str:
-                    try:
-                        incoming_metadata = json.loads(all_metadata_str)
-                        
-                        # Prioritize comprehensive ExifTool data if available
-                        if "Comprehensive Metadata (ExifTool)" in incoming_metadata:
-                            # Flatten the "Other ExifTool Tags" section
-                            other_exiftool_tags = incoming_metadata["Comprehensive Metadata (ExifTool)"].get("Other ExifTool Tags", {})
-                            exif_data_to_write.update(flatten_exiftool_metadata(other_exiftool_tags))
-
-                            # Process top-level ExifTool categories (e.g., GPS Data, Location, Contact)
-                            for category_name, category_data in incoming_metadata["Comprehensive Metadata (ExifTool)"].items():
-                                if category_name not in ["Image Information (PIL)", "Other ExifTool Tags"] and isinstance(category_data, dict):
-                                    for friendly_field_name, value in category_data.items():
-                                        # Attempt to map the friendly name to ExifTool tags for writing
-                                        mapped_tags = friendly_to_exiftool_tag_map.get(friendly_field_name)
-                                        if mapped_tags:
-                                            if not isinstance(mapped_tags, list):
-                                                mapped_tags = [mapped_tags]
-                                            for tag in mapped_tags:
-                                                exif_data_to_write[tag] = value
-                                        elif ':' in friendly_field_name: # If it's already a Group:TagName format
-                                            exif_data_to_write[friendly_field_name] = value
-                                        else:
-                                            current_app.logger.debug(f"Comprehensive metadata field '{friendly_field_name}' from category '{category_name}' not mapped for writing.")
-
-                    except json.JSONDecodeError as e:
-                        current_app.logger.error(f"Error decoding all_metadata JSON for {original_filename}: {e}")
-                        processing_errors.append(f'Invalid metadata provided for {original_filename}: {e}')
-                        continue # Skip this file
-
-                # Define mapping from frontend friendly names to ExifTool tags
-                # This mapping should be exhaustive for all fields we want to write
-                friendly_to_exiftool_tag_map = {
-                    # GPS Data (handled separately for Lat/Lng Ref, but can include other GPS tags)
-                    # Note: GPSLatitude/Longitude are special-cased for writing format
-                    "GPSVersionID": "GPS:GPSVersionID",
-                    "GPSMapDatum": "GPS:GPSMapDatum",
-
-                    # Location (using common IPTC/XMP tags)
-                    "Country": ["IPTC:Country-PrimaryLocationName", "XMP-iptcCore:CountryName"],
-                    "State": ["IPTC:Province-State", "XMP-iptcCore:ProvinceState"],
-                    "City": ["IPTC:City", "XMP-iptcCore:City"],
-                    "Sublocation": ["IPTC:Sub-location", "XMP-iptcCore:Location"],
-
-                    # Artist/Source/Description
-                    "Creator": ["IFD0:Artist", "XMP-tiff:Artist", "XMP-dc:Creator"],
-                    "CreatorTitle": ["IPTC:By-lineTitle", "XMP-photoshop:CaptionWriter"],
-                    "Credit": ["IPTC:Credit", "XMP-photoshop:Credit"],
-                    "Source": ["IPTC:Source", "XMP-photoshop:Source"],
-                    "URL": ["Photoshop:URL", "XMP-xmp:BaseURL"], # General URLs
-                    "ObjectName": "IPTC:ObjectName",
-                    "Headline": "XMP-photoshop:Headline",
-                    "Caption": ["IPTC:Caption-Abstract", "XMP-dc:Description"],
-                    "Copyright": ["IFD0:Copyright", "IPTC:CopyrightNotice", "XMP-dc:Rights"],
-                    "Rating": ["IFD0:Rating", "XMP-xmp:Rating"],
-                    "RatingPercent": "XMP-microsoft:RatingPercent",
-                    "SpecialInstructions": "XMP-xmp:Instructions",
-
-                    # Categories/Keywords
-                    "Category": "IPTC:Category",
-                    "SupplementalCategories": "IPTC:SupplementalCategories",
-                    "Keywords": ["IPTC:Keywords", "XMP-dc:Subject"], # These should be multi-valued tags
-
-                    # Contact Information
-                    # These are keys from the geotagging form (e.g., from client presets)
-                    "Address": ["IPTC:ContactInfoAddress", "XMP-iptcCore:CreatorWorkAddress"],
-                    "PostalCode": ["IPTC:ContactInfoPostalCode", "XMP-iptcCore:CreatorPostalCode"],
-                    "Phone": ["IPTC:ContactInfoPhone", "XMP-iptcCore:CreatorWorkTelephone"],
-                    "Email": ["IPTC:ContactInfoEmail", "XMP-iptcCore:CreatorWorkEmail"],
-                    "URL": ["Photoshop:URL", "XMP-xmp:BaseURL"], # General URLs from form
-                    
-                    # These are keys from the Comprehensive Metadata (ExifTool) from the /exif page
-                    "Contact Byline": ["IPTC:By-line", "XMP-dc:Creator"], # Re-use Creator mapping
-                    "Contact Byline Title": ["IPTC:By-lineTitle", "XMP-photoshop:CaptionWriter"], # Re-use CreatorTitle mapping
-                    "Contact Address": ["IPTC:ContactInfoAddress", "XMP-iptcCore:CreatorWorkAddress"],
-                    "Contact City": ["IPTC:ContactInfoCity", "XMP-iptcCore:CreatorCity"],
-                    "Contact PostalCode": ["IPTC:ContactInfoPostalCode", "XMP-iptcCore:CreatorPostalCode"],
-                    "Contact State/Province": ["IPTC:ContactInfoStateProvince", "XMP-iptcCore:CreatorRegion"],
-                    "Contact Country": ["IPTC:ContactInfoCountry", "XMP-iptcCore:CreatorCountry"],
-                    "Contact Phone": ["IPTC:ContactInfoPhone", "XMP-iptcCore:CreatorWorkTelephone"],
-                    "Contact E-Mail": ["IPTC:ContactInfoEmail", "XMP-iptcCore:CreatorWorkEmail"],
-                    "Contact URL": ["IPTC:ContactInfoWebURL", "XMP-iptcCore:CreatorWorkURL"], # Specific Contact URL
-
-                    # Location fields from /exif page (if they come as top-level category keys)
-                    "Sublocation": ["IPTC:Sub-location", "XMP-iptcCore:Location"],
-                    
-                    # Date/Time
-                    "GPSDateStamp": "GPS:GPSDateStamp", # Direct GPS tag
-                    "GPSTimeStamp": "GPS:GPSTimeStamp", # Direct GPS tag
-                    "GPS Date Time": "XMP:GPSDateTime", # XMP equivalent
-                    "Creation Date": ["EXIF:CreateDate", "XMP-xmp:CreateDate"],
-                    "Modification Date": ["EXIF:ModifyDate", "XMP-xmp:ModifyDate"],
-                    "Taken Date": ["EXIF:DateTimeOriginal", "XMP-xmp:CreateDate"], # Often maps to DateTimeOriginal
-                }
-
-                # --- OVERWRITE / ADD DATA FROM GEOTAGGING FORM (`exif_data` from request.form) ---
-                # Process incoming form data and map to ExifTool tags, prioritizing these.
-                for form_friendly_name, form_value in exif_data.items():
-                    # Only process if value is not None or empty (string/list)
-                    if form_value is None or (isinstance(form_value, (str, list)) and not form_value):
-                        continue
-
-                    # Special handling for coordinates (latitude/longitude from form/preset)
-                    if form_friendly_name == "GPSLatitude" and form_value is not None:
-                        try:
-                            lat_float = float(form_value)
-                            exif_data_to_write["GPS:GPSLatitude"] = lat_float
-                            exif_data_to_write["GPS:GPSLatitudeRef"] = "N" if lat_float >= 0 else "S"
-                        except ValueError:
-                            current_app.logger.warning(f"Invalid GPSLatitude value from form: {form_value}")
-                    elif form_friendly_name == "GPSLongitude" and form_value is not None:
-                        try:
-                            lon_float = float(form_value)
-                            exif_data_to_write["GPS:GPSLongitude"] = lon_float
-                            exif_data_to_write["GPS:GPSLongitudeRef"] = "E" if lon_float >= 0 else "W"
-                        except ValueError:
-                            current_app.logger.warning(f"Invalid GPSLongitude value from form: {form_value}")
-                    # Special handling for datetime from the form (it's a single field 'datetime')
-                    elif form_friendly_name == "datetime" and form_value:
-                        try:
-                            # datetime from frontend is like '2025-06-16T12:49'
-                            dt = datetime.datetime.fromisoformat(form_value)
-                            # Update GPS date/time tags
-                            exif_data_to_write["GPS:GPSDateStamp"] = dt.strftime("%Y:%m:%d")
-                            exif_data_to_write["GPS:GPSTimeStamp"] = dt.strftime("%H:%M:%S")
-                            exif_data_to_write["XMP:GPSDateTime"] = dt.isoformat(timespec='seconds') + "Z"
-                            # Also update general date/time tags
-                            exif_data_to_write["EXIF:DateTimeOriginal"] = dt.strftime("%Y:%m:%d %H:%M:%S")
-                            exif_data_to_write["EXIF:CreateDate"] = dt.strftime("%Y:%m:%d %H:%M:%S")
-                            exif_data_to_write["EXIF:ModifyDate"] = dt.strftime("%Y:%m:%d %H:%M:%S")
-                            exif_data_to_write["XMP-xmp:CreateDate"] = dt.isoformat(timespec='seconds') # No Z for XMP CreateDate
-                            exif_data_to_write["XMP-xmp:ModifyDate"] = dt.isoformat(timespec='seconds') # No Z for XMP ModifyDate
-                        except ValueError:
-                            current_app.logger.warning(f"Invalid datetime format from form: {form_value}")
-                    # Special handling for keywords (can be list or comma-separated string)
-                    elif form_friendly_name == "Keywords":
-                        keywords_list = []
-                        if isinstance(form_value, list):
-                            keywords_list = form_value
-                        elif isinstance(form_value, str):
-                            keywords_list = [k.strip() for k in form_value.split(',') if k.strip()]
-                        
-                        # Store as list in exif_data_to_write; process_image_with_exiftool handles multi-value
-                        exif_data_to_write["IPTC:Keywords"] = keywords_list
-                        exif_data_to_write["XMP-dc:Subject"] = keywords_list
-                    # Handle preset for random coordinates (only if use_random is true)
-                    elif form_friendly_name == "preset" and form_value and use_random:
-                        random_lat, random_lng = generate_random_coordinates_in_quadrilateral(form_value) # form_value is the preset object
-                        if random_lat is not None and random_lng is not None:
-                            exif_data_to_write["GPS:GPSLatitude"] = random_lat
-                            exif_data_to_write["GPS:GPSLatitudeRef"] = "N" if random_lat >= 0 else "S"
-                            exif_data_to_write["GPS:GPSLongitude"] = random_lng
-                            exif_data_to_write["GPS:GPSLongitudeRef"] = "E" if random_lng >= 0 else "W"
-                            exif_data_to_write["GPS:GPSMapDatum"] = "WGS-84"
-                            current_app.logger.info(f"Applied random coordinates from preset: {random_lat}, {random_lng}")
-
-                            # --- ALWAYS OVERRIDE LOCATION FIELDS WITH CITY PRESET IF PRESENT ---
-                            if exif_data.get("preset"):
-                                city_preset = exif_data["preset"]
-                                preset_country = city_preset.get("country", "")
-                                preset_state_province = city_preset.get("state_province", "")
-                                preset_city = city_preset.get("name", "")
-                                preset_sublocation = city_preset.get("sublocation", "")
-
-                                # Write to all relevant tags for maximum compatibility
-                                for tag in [
-                                    "IPTC:Country-PrimaryLocationName",
-                                    "XMP-iptcCore:CreatorCountry",
-                                    "XMP-iptcCore:CountryName",
-                                    "XMP-photoshop:Country"
-                                ]:
-                                    exif_data_to_write[tag] = preset_country
-                                for tag in [
-                                    "IPTC:Province-State",
-                                    "XMP-iptcCore:CreatorRegion",
-                                    "XMP-iptcCore:ProvinceState",
-                                    "XMP-photoshop:State"
-                                ]:
-                                    exif_data_to_write[tag] = preset_state_province
-                                for tag in [
-                                    "IPTC:City",
-                                    "XMP-iptcCore:CreatorCity",
-                                    "XMP-iptcCore:City",
-                                    "XMP-photoshop:City"
-                                ]:
-                                    exif_data_to_write[tag] = preset_city
-                                for tag in [
-                                    "IPTC:Sub-location",
-                                    "XMP-iptcCore:Location"
-                                ]:
-                                    exif_data_to_write[tag] = preset_sublocation
-                    # Explicit handling for general location fields
-                    elif form_friendly_name == "Country":
-                        for tag in ["IPTC:Country-PrimaryLocationName", "XMP-iptcCore:CountryName"]:
-                            exif_data_to_write[tag] = form_value
-                    elif form_friendly_name == "State":
-                        for tag in ["IPTC:Province-State", "XMP-iptcCore:ProvinceState"]:
-                            exif_data_to_write[tag] = form_value
-                    elif form_friendly_name == "City":
-                        for tag in ["IPTC:City", "XMP-iptcCore:City"]:
-                            exif_data_to_write[tag] = form_value
-                    # Explicit handling for contact info fields
-                    elif form_friendly_name == "ContactCountry":
-                        for tag in ["IPTC:ContactInfoCountry", "XMP-iptcCore:CreatorCountry"]:
-                            exif_data_to_write[tag] = form_value
-                    elif form_friendly_name == "ContactState":
-                        for tag in ["IPTC:ContactInfoStateProvince", "XMP-iptcCore:CreatorRegion"]:
-                            exif_data_to_write[tag] = form_value
-                    elif form_friendly_name == "ContactCity":
-                        for tag in ["IPTC:ContactInfoCity", "XMP-iptcCore:CreatorCity"]:
-                            exif_data_to_write[tag] = form_value
-                    elif form_friendly_name == "ContactURL":
-                        for tag in ["IPTC:ContactInfoWebURL", "XMP-iptcCore:CreatorWorkURL"]:
-                            exif_data_to_write[tag] = form_value
-                    elif form_friendly_name == "Creator":
-                        for tag in ["IFD0:Artist", "XMP-tiff:Artist", "XMP-dc:Creator"]:
-                            exif_data_to_write[tag] = form_value
-                    else:
-                        # For other friendly names, map them to their ExifTool tags
-                        mapped_tags = friendly_to_exiftool_tag_map.get(form_friendly_name)
-                        if mapped_tags:
-                            if not isinstance(mapped_tags, list):
-                                mapped_tags = [mapped_tags] # Ensure it's always a list for consistent iteration
-                            for tag in mapped_tags:
-                                exif_data_to_write[tag] = form_value
-                        else:
-                            # If the form field name itself is an ExifTool tag (e.g., from client presets),
-                            # add it directly if it contains a colon.
-                            if ':' in form_friendly_name:
-                                exif_data_to_write[form_friendly_name] = form_value
-                            else:
-                                current_app.logger.debug(f"Frontend field '{form_friendly_name}' not explicitly mapped or a direct ExifTool tag for writing.")
-
-                # After processing all form fields, set contact address if present
-                if 'address' in exif_data and exif_data['address']:
-                    exif_data_to_write['IPTC:ContactInfoAddress'] = exif_data['address']
-
-                # Clean up any undesirable tags that might have come from the read operation
-                # These are tags ExifTool adds for info but are not meant for writing or might cause conflicts
-                unwanted_write_tags = [
-                    # System/File Info (read-only from ExifTool)
-                    "ExifTool:ExifToolVersion", "System:FileName", "System:Directory", 
-                    "System:FileSize", "System:FileModifyDate", "System:FileAccessDate", 
-                    "System:FileCreateDate", "System:FilePermissions", "File:FileType", 
-                    "File:FileTypeExtension", "File:MIMEType", 
-                    
-                    # Image characteristics that ExifTool might derive but are not directly writable in this context
-                    "File:ExifByteOrder", "File:ImageWidth", "File:ImageHeight", 
-                    "File:EncodingProcess", "File:BitsPerSample", "File:ColorComponents", 
-                    "File:YCbCrSubSampling", 
-
-                    # Composite tags that are derived and not directly writable
-                    "Composite:ImageSize", "Composite:Megapixels", 
-                    "Composite:GPSDateTime", "Composite:GPSLatitude", "Composite:GPSLongitude", 
-                    "Composite:GPSLatitudeRef", "Composite:GPSLongitudeRef", "Composite:GPSPosition",
-
-                    # Other potentially problematic tags that should not be written directly
-                    "SourceFile", # This is a meta-tag from ExifTool output, not a writable tag
-                    # Add any other tags identified as problematic during testing here
-                ]
-                # Remove unwanted tags. Iterate over a copy of keys to allow modification during iteration.
-                for tag_key in list(exif_data_to_write.keys()):
-                    # Check if the tag_key (e.g., 'File:FileName') starts with any of the unwanted tags or is an exact match
-                    for unwanted_prefix in unwanted_write_tags:
-                        if tag_key.startswith(unwanted_prefix):
-                            exif_data_to_write.pop(tag_key, None)
-                            break # Break inner loop, as this tag_key is handled
-
-                current_app.logger.info(f"Final exif_data_to_write for {original_filename}: {json.dumps(exif_data_to_write, indent=2)}")
-
-                # --- Image Format Handling & Conversion to JPEG for ExifTool ---
-                # ExifTool works best with JPEG for writing, and PIL can handle various inputs.
-                # We will convert input to JPEG in a temp file if it's not already.
-                file_to_process_for_exiftool = uploaded_file_path # Default to original
-                original_ext = os.path.splitext(original_filename)[1].lower()
-
-                # Open the image first to check its mode or convert if necessary
-                img = None # Initialize img to None
-                try:
-                    current_app.logger.info(f"Attempting to open image: {uploaded_file_path}. Exists: {os.path.exists(uploaded_file_path)}")
-                    img = Image.open(uploaded_file_path)
-
-                    if original_ext not in ['.jpg', '.jpeg'] or img.mode != 'RGB': # Use img.mode here
-                        # Create a temp JPEG for ExifTool if conversion is needed
-                        temp_filename_for_exiftool = f"{uuid.uuid4()}.jpg"
-                        temp_dir_for_conversion = os.path.join(processed_folder, os.path.dirname(original_relative_path))
-                        os.makedirs(temp_dir_for_conversion, exist_ok=True)
-                        temp_jpeg_path = os.path.join(temp_dir_for_conversion, temp_filename_for_exiftool)
-                        
-                        current_app.logger.info(f"Converting {original_filename} to JPEG for ExifTool: {temp_jpeg_path}")
-                        img.convert('RGB').save(temp_jpeg_path, 'JPEG', quality=95) # Save as high quality JPEG
-                        file_to_process_for_exiftool = temp_jpeg_path
-                except UnidentifiedImageError as img_ident_error:
-                    current_app.logger.error(f"Cannot identify image file {original_filename}: {img_ident_error}")
-                    processing_errors.append(f"Cannot identify image file {original_filename}. Please ensure it's a valid image file.")
-                    continue # Skip this file
-                except Exception as img_open_conv_error:
-                    current_app.logger.error(f"Error opening or converting image {original_filename} to JPEG for ExifTool: {img_open_conv_error}")
-                    processing_errors.append(f"Error processing {original_filename}: {img_open_conv_error}")
-                    continue # Skip this file
-                finally:
-                    if img: # Ensure image is closed
-                        img.close()
-
-                # Determine the final output path preserving the folder structure
-                # Ensure the original directory structure is maintained within the processed_folder
-                # by joining processed_folder with the original_relative_path's directory.
-                base_name = os.path.splitext(os.path.basename(original_relative_path))[0]
-                processed_relative_dir = os.path.dirname(original_relative_path)
-                final_output_dir = os.path.join(processed_folder, processed_relative_dir)
-                os.makedirs(final_output_dir, exist_ok=True)  # Ensure output directory exists
-                
-                # Always save the final geotagged image as JPEG for broad compatibility
-                final_output_path = os.path.join(final_output_dir, f"{base_name}.jpg")
-
-                current_app.logger.info(f"Processing {original_filename}. Input: {file_to_process_for_exiftool}, Output: {final_output_path}")
-
-                # Process the image with updated metadata using ExifTool
-                if process_image_with_exiftool(file_to_process_for_exiftool, final_output_path, exif_data_to_write):
-                    # Store info for successful files
-                    base_filename_no_ext = os.path.splitext(os.path.basename(original_relative_path))[0]
-                    processed_relative_dir_for_zip = os.path.dirname(original_relative_path)
-                    # Use the original relative path's structure but enforce .jpg extension
-                    arcname_in_zip = os.path.join(processed_relative_dir_for_zip, f"{base_filename_no_ext}.jpg")
-
-                    processed_files_with_paths.append({
-                        'original_name': original_filename,
-                        'processed_path': final_output_path,
-                        'arcname_in_zip': arcname_in_zip,
-                        'url': url_for('geotagging.download_single', session_id=session_id, filename=os.path.basename(final_output_path)) # Direct URL to base filename
-                    })
-                    current_app.logger.info(f"Successfully processed and added {original_filename} to processed_files_with_paths.")
-                else:
-                    processing_errors.append(f"Error processing {original_filename}: Geotagging failed during ExifTool write.")
-                    current_app.logger.error(f"Failed to process {original_filename} with ExifTool.")
+                incoming_metadata = json.loads(all_metadata_str)
+            except json.JSONDecodeError as e:
+                current_app.logger.error(f"Error decoding all_metadata JSON: {e}")
+                return jsonify({
+                    'error': 'Invalid metadata format',
+                    'details': str(e)
+                }), 400
+
+        result = geotag_batch(
+            saved_files_with_paths, processed_folder, exif_data, incoming_metadata=incoming_metadata,
+            file_manifest=file_manifest, manifest_fields=manifest_fields, track=track,
+            track_offset_ms=track_offset_ms, track_max_gap=track_max_gap, reconcile_mode=reconcile_mode,
+            jpeg_options=jpeg_options, keep_heic=keep_heic, scratch=workspace,
+            on_progress=lambda percent: set_progress(session_id, percent))
+        processed_files_with_paths = result['processed_files']
+        processing_errors = result['errors']
+        size_reports = result['size_reports']
+        total_files = len(saved_files_with_paths)
+        for item in processed_files_with_paths:
+            item['url'] = url_for('geotagging.download_single', session_id=session_id, filename=os.path.basename(item['processed_path'])) # Direct URL to base filename
 
-                # At the end of each file processing (success or fail):
-                percent = int(((idx + 1) / total_files) * 100)
-                set_progress(session_id, percent)
+        reservation.release()
 
-            except Exception as e:
-                error_msg = f"Unhandled error processing {original_filename}: {str(e)}"
-                current_app.logger.error(error_msg)
-                processing_errors.append(error_msg)
-            finally:
-                # Clean up the temporary JPEG file created for ExifTool processing, if it exists
-                if temp_jpeg_path and os.path.exists(temp_jpeg_path):
-                    os.remove(temp_jpeg_path)
-                    current_app.logger.info(f"Cleaned up temporary JPEG: {temp_jpeg_path}")
-                # Clean up the original uploaded temp file after processing each file
-                if os.path.exists(uploaded_file_path):
-                    os.remove(uploaded_file_path)
-                    current_app.logger.info(f"Cleaned up uploaded file: {uploaded_file_path}")
+        metrics.count_files('geotagging', 'processed', len(processed_files_with_paths))
+        metrics.count_files('geotagging', 'failed', total_files - len(processed_files_with_paths))
 
-        
         if not processed_files_with_paths:
             return jsonify({
                 'error': 'Failed to process any files',
                 'details': 'No files were successfully geotagged or converted. Errors:\n' + '\n'.join(processing_errors)
             }), 500
         
-        # Create a zip file preserving folder structure
+        store = storage.get_storage()
+
+        # Create a zip file preserving folder structure, streamed straight to storage
         try:
             zip_filename = f"geotagged_images_{session_id}.zip"
-            zip_path = os.path.join(processed_folder, zip_filename)
-
-            current_app.logger.info(f"Creating zip file: {zip_path}")
-            with zipfile.ZipFile(zip_path, 'w') as zipf:
-                for item in processed_files_with_paths:
-                    current_app.logger.info(f"Adding {item['processed_path']} to zip as {item['arcname_in_zip']}")
-                    zipf.write(item['processed_path'], item['arcname_in_zip'])
+            zip_key = storage.processed_key(session_id, zip_filename)
+
+            current_app.logger.info(f"Creating zip file: {zip_key}")
+            with metrics.stage_timer('geotagging', 'zip'):
+                with store.open_write(zip_key) as fp:
+                    with zipfile.ZipFile(fp, 'w') as zipf:
+                        for item in processed_files_with_paths:
+                            current_app.logger.info(f"Adding {item['processed_path']} to zip as {item['arcname_in_zip']}")
+                            zipf.write(item['processed_path'], item['arcname_in_zip'])
             current_app.logger.info(f"Successfully created zip file.")
         except Exception as e:
             current_app.logger.error(f"Failed to create zip file: {e}")
@@ -733,6 +1182,19 @@ def process_images():
                 'details': str(e)
             }), 500
 
+        # Publish the individual images for their single-file download links
+        try:
+            with metrics.stage_timer('geotagging', 'publish'):
+                for item in processed_files_with_paths:
+                    store.publish(item['processed_path'], storage.processed_key(session_id, item['arcname_in_zip']))
+        except Exception as e:
+            current_app.logger.error(f"Failed to publish processed files: {e}")
+            return jsonify({
+                'error': 'Failed to store processed files',
+                'details': str(e)
+            }), 500
+        store.discard_scratch(upload_folder, processed_folder)
+
         # After all processing is done, ensure progress is 100%
         set_progress(session_id, 100)
 
@@ -742,6 +1204,10 @@ def process_images():
             'download_url': f'/api/geotagging/download/{session_id}/zip',
             'processed_files': processed_files_with_paths, # Return details of processed files
             'errors': processing_errors if processing_errors else None, # Return any individual file errors
+            'size_report': {'files': size_reports, 'total': encoders.summarize(size_reports)},
+            'track_report': result['track_report'],
+            'manifest_report': result['manifest_report'],
+            'reconcile_report': result['reconcile_report'],
             'session_id': session_id
         })
         
@@ -755,17 +1221,16 @@ def process_images():
 @geotagging_bp.route('/download/<session_id>/zip', methods=['GET'])
 def download_zip(session_id):
     """Download processed images as a zip file."""
-    processed_folder = os.path.join(current_app.config['PROCESSED_FOLDER'], session_id)
-    zip_path = os.path.join(processed_folder, f"geotagged_images_{session_id}.zip")
+    store = storage.get_storage()
+    zip_key = storage.processed_key(session_id, f"geotagged_images_{session_id}.zip")
     
-    if not os.path.exists(zip_path):
-        current_app.logger.error(f"Zip file not found for session {session_id}: {zip_path}")
+    if not store.exists(zip_key):
+        current_app.logger.error(f"Zip file not found for session {session_id}: {zip_key}")
         return jsonify({'error': 'Zip file not found'}), 404
     
-    current_app.logger.info(f"Serving zip file: {zip_path}")
-    return send_file(
-        zip_path,
-        as_attachment=True,
+    current_app.logger.info(f"Serving zip file: {zip_key}")
+    return store.send_download(
+        zip_key,
         download_name=f"geotagged_images.zip",
         mimetype='application/zip'
     )
@@ -780,27 +1245,27 @@ def download_single(session_id):
         current_app.logger.error(f"Filename not provided for single download in session {session_id}")
         return jsonify({'error': 'Filename not provided'}), 400
 
-    processed_folder = os.path.join(current_app.config['PROCESSED_FOLDER'], session_id)
+    store = storage.get_storage()
+    session_prefix = storage.processed_key(session_id)
     
-    # We need to search for the file within the session's processed folder, as it might be in a subdirectory
-    found_file_path = None
-    for root, _, files in os.walk(processed_folder):
-        if filename in files:
-            found_file_path = os.path.join(root, filename)
+    # We need to search for the file within the session's published files, as it might be in a subdirectory
+    found_key = None
+    for name in store.list(session_prefix):
+        if name.rsplit('/', 1)[-1] == filename:
+            found_key = storage.processed_key(session_id, name)
             break
 
-    if not found_file_path or not os.path.exists(found_file_path):
-        current_app.logger.error(f"File {filename} not found in session {session_id}. Searched in {processed_folder}")
+    if not found_key:
+        current_app.logger.error(f"File {filename} not found in session {session_id}. Searched in {session_prefix}")
         return jsonify({'error': f'File {filename} not found in session {session_id}'}), 404
 
     mimetype = f'image/{os.path.splitext(filename)[1][1:].lower()}'
     if mimetype == 'image/': # Default to jpeg if extension is weird or missing
         mimetype = 'image/jpeg'
 
-    current_app.logger.info(f"Serving single file: {found_file_path} with mimetype {mimetype}")
-    return send_file(
-        found_file_path,
-        as_attachment=True,
+    current_app.logger.info(f"Serving single file: {found_key} with mimetype {mimetype}")
+    return store.send_download(
+        found_key,
         download_name=filename,
         mimetype=mimetype
     )
@@ -808,31 +1273,29 @@ def download_single(session_id):
 @geotagging_bp.route('/cleanup/<session_id>', methods=['POST'])
 def cleanup_session(session_id):
     """Clean up temporary files for a session."""
-    upload_folder = os.path.join(current_app.config['UPLOAD_FOLDER'], session_id)
-    processed_folder = os.path.join(current_app.config['PROCESSED_FOLDER'], session_id)
+    upload_folder, processed_folder = scratch.session_folders(session_id)
 
-    # Clean up upload folder and its contents
-    if os.path.exists(upload_folder):
-        try:
-            shutil.rmtree(upload_folder)
-            current_app.logger.info(f"Cleaned up upload folder: {upload_folder}")
-        except Exception as e:
-            current_app.logger.warning(f"Error cleaning up upload folder {upload_folder}: {e}")
+    with metrics.stage_timer('geotagging', 'cleanup'):
+        # Clean up upload folder and its contents
+        if os.path.exists(upload_folder):
+            try:
+                shutil.rmtree(upload_folder)
+                current_app.logger.info(f"Cleaned up upload folder: {upload_folder}")
+            except Exception as e:
+                current_app.logger.warning(f"Error cleaning up upload folder {upload_folder}: {e}")
 
-    # Clean up processed folder and its contents
-    if os.path.exists(processed_folder):
-        try:
-            shutil.rmtree(processed_folder)
-            current_app.logger.info(f"Cleaned up processed folder: {processed_folder}")
-        except Exception as e:
-            current_app.logger.warning(f"Error cleaning up processed folder {processed_folder}: {e}")
+        # Clean up processed folder and its contents
+        if os.path.exists(processed_folder):
+            try:
+                shutil.rmtree(processed_folder)
+                current_app.logger.info(f"Cleaned up processed folder: {processed_folder}")
+            except Exception as e:
+                current_app.logger.warning(f"Error cleaning up processed folder {processed_folder}: {e}")
 
-    # Remove progress file if exists
-    progress_file = os.path.join(current_app.config['PROCESSED_FOLDER'], session_id, 'progress.json')
-    if os.path.exists(progress_file):
+        # Remove published outputs and the progress file (for local storage they lived in the processed folder)
         try:
-            os.remove(progress_file)
-        except Exception:
-            pass
+            storage.get_storage().delete_prefix(storage.processed_key(session_id))
+        except Exception as e:
+            current_app.logger.warning(f"Error removing stored outputs for session {session_id}: {e}")
 
     return jsonify({'status': 'success', 'message': 'Session cleaned up'})
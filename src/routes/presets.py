@@ -1,9 +1,68 @@
 from flask import Blueprint, request, jsonify, current_app
 import os
-import json
+from src.models import preset_store, preset_catalog
 
 presets_bp = Blueprint('presets', __name__)
 
+EMPTY_CITY_PRESETS = {'version': '2.0', 'countries': {}}
+EMPTY_CLIENT_PRESETS = {'version': '1.0', 'presets': []}
+
+def city_document():
+    """The city presets document (static/data/city_presets.json)."""
+    return preset_store.get_document(
+        os.path.join(current_app.static_folder, 'data', 'city_presets.json'), EMPTY_CITY_PRESETS)
+
+def city_catalog():
+    """Indexed catalog mirroring the city presets document."""
+    return preset_catalog.get_catalog(city_document())
+
+def client_document():
+    """The client presets document (static/data/client_presets.json)."""
+    return preset_store.get_document(
+        os.path.join(current_app.static_folder, 'data', 'client_presets.json'), EMPTY_CLIENT_PRESETS)
+
+def expected_revision():
+    """Revision from the If-Match header (the ETag of an earlier response), or None."""
+    value = request.headers.get('If-Match', '').strip()
+    if value.startswith('W/'):
+        value = value[2:]
+    value = value.strip('"')
+    return int(value) if value.isdigit() else None
+
+def document_response(document):
+    """JSON response for a whole document, answering If-None-Match with 304."""
+    response = jsonify(document)
+    response.set_etag(str(document['revision']))
+    return response.make_conditional(request)
+
+def change_response(document, change, message, status=200, after_write=None):
+    """Apply a single-preset change and build its JSON response."""
+    try:
+        revision, result = document.update(change, expected_revision(), after_write)
+    except preset_store.PresetNotFound as e:
+        return jsonify({'error': 'Preset not found', 'details': str(e)}), 404
+    except preset_store.RevisionConflict as e:
+        return jsonify({'error': 'Revision conflict', 'details': str(e), 'revision': e.current}), 412
+    except preset_store.InvalidPreset as e:
+        return jsonify({'error': 'Invalid preset', 'details': str(e)}), 400
+
+    body = {'status': 'success', 'message': message, 'revision': revision}
+    if result is not None:
+        body['preset'], created = result
+        if created:
+            status = 201
+    response = jsonify(body)
+    response.status_code = status
+    response.set_etag(str(revision))
+    return response
+
+def preset_from_request(preset_id):
+    """The preset object in the request body, with its id taken from the URL."""
+    preset = request.get_json(silent=True)
+    if not isinstance(preset, dict):
+        return None
+    return dict(preset, id=preset_id)
+
 @presets_bp.route('/city', methods=['GET'])
 def get_city_presets():
     """
@@ -13,21 +72,8 @@ def get_city_presets():
     - JSON response with city presets
     """
     try:
-        # Check if city_presets.json exists in the static/data folder
-        presets_path = os.path.join(current_app.static_folder, 'data', 'city_presets.json')
-        
-        if not os.path.exists(presets_path):
-            # Return empty presets if file doesn't exist
-            return jsonify({
-                'version': '1.0',
-                'presets': []
-            })
-        
-        # Read presets from file
-        with open(presets_path, 'r') as f:
-            presets = json.load(f)
-        
-        return jsonify(presets)
+        # Parsed once per change on disk; empty presets if the file doesn't exist
+        return document_response(city_document().read())
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -40,21 +86,8 @@ def get_client_presets():
     - JSON response with client presets
     """
     try:
-        # Check if client_presets.json exists in the static/data folder
-        presets_path = os.path.join(current_app.static_folder, 'data', 'client_presets.json')
-        
-        if not os.path.exists(presets_path):
-            # Return empty presets if file doesn't exist
-            return jsonify({
-                'version': '1.0',
-                'presets': []
-            })
-        
-        # Read presets from file
-        with open(presets_path, 'r') as f:
-            presets = json.load(f)
-        
-        return jsonify(presets)
+        # Parsed once per change on disk; empty presets if the file doesn't exist
+        return document_response(client_document().read())
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -76,17 +109,17 @@ def update_city_presets():
         if not presets:
             return jsonify({'error': 'No presets provided'}), 400
         
-        # Validate presets structure
-        if 'version' not in presets or 'presets' not in presets:
+        # Validate presets structure (version 2.0 files group cities by country and state)
+        if 'version' not in presets or ('countries' not in presets and 'presets' not in presets):
             return jsonify({'error': 'Invalid presets format'}), 400
         
-        # Save presets to file
-        presets_path = os.path.join(current_app.static_folder, 'data', 'city_presets.json')
-        
-        with open(presets_path, 'w') as f:
-            json.dump(presets, f, indent=2)
+        # Save presets atomically
+        try:
+            revision = city_document().replace(presets, expected_revision())
+        except preset_store.RevisionConflict as e:
+            return jsonify({'error': 'Revision conflict', 'details': str(e), 'revision': e.current}), 412
         
-        return jsonify({'status': 'success', 'message': 'City presets updated'})
+        return jsonify({'status': 'success', 'message': 'City presets updated', 'revision': revision})
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -112,12 +145,140 @@ def update_client_presets():
         if 'version' not in presets or 'presets' not in presets:
             return jsonify({'error': 'Invalid presets format'}), 400
         
-        # Save presets to file
-        presets_path = os.path.join(current_app.static_folder, 'data', 'client_presets.json')
-        
-        with open(presets_path, 'w') as f:
-            json.dump(presets, f, indent=2)
+        # Save presets atomically
+        try:
+            revision = client_document().replace(presets, expected_revision())
+        except preset_store.RevisionConflict as e:
+            return jsonify({'error': 'Revision conflict', 'details': str(e), 'revision': e.current}), 412
         
-        return jsonify({'status': 'success', 'message': 'Client presets updated'})
+        return jsonify({'status': 'success', 'message': 'Client presets updated', 'revision': revision})
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@presets_bp.route('/city/countries', methods=['GET'])
+def get_city_countries():
+    """
+    List the countries that have city presets.
+    
+    Returns:
+    - JSON response with countries: [{name, cities}]
+    """
+    try:
+        return jsonify({'countries': city_catalog().countries()})
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@presets_bp.route('/city/countries/<country>/states', methods=['GET'])
+def get_city_states(country):
+    """
+    List the states/provinces of a country that have city presets.
+    
+    Returns:
+    - JSON response with states: [{name, cities}]
+    """
+    try:
+        return jsonify({'country': country, 'states': city_catalog().states(country)})
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@presets_bp.route('/city/search', methods=['GET'])
+def search_city_presets():
+    """
+    Query city presets, one page at a time.
+    
+    Expects (query string, all optional):
+    - country, state_province: Filter by location
+    - q: City name prefix (case-insensitive)
+    - id: Preset id
+    - fields: Comma-separated fields to return (id, name, country, state_province, center,
+      zoom_level, boundaries) or 'full' (default: id,name)
+    - limit: Page size (default 50, at most 1000)
+    - cursor: next_cursor from the previous page
+    
+    Returns:
+    - JSON response with presets and next_cursor (null on the last page)
+    """
+    try:
+        fields = preset_catalog.parse_fields(request.args.get('fields'))
+        limit = request.args.get('limit', preset_catalog.DEFAULT_LIMIT, type=int)
+        presets, next_cursor = city_catalog().search(
+            country=request.args.get('country'),
+            state_province=request.args.get('state_province'),
+            prefix=request.args.get('q'),
+            preset_id=request.args.get('id'),
+            fields=fields,
+            limit=limit,
+            cursor=request.args.get('cursor'),
+        )
+    except ValueError as e:
+        return jsonify({'error': 'Invalid query', 'details': str(e)}), 400
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+    return jsonify({'presets': presets, 'next_cursor': next_cursor})
+
+@presets_bp.route('/city/<country>/<state_province>/<preset_id>', methods=['GET', 'PUT', 'PATCH', 'DELETE'])
+def change_city_preset(country, state_province, preset_id):
+    """
+    Get, add, update or remove a single city preset.
+    
+    Expects:
+    - GET: no body; returns the complete preset (with boundaries)
+    - PUT: JSON city preset, stored as given (added if new); name must be a string, center a {lat, lng}
+      point and boundaries have top_left, top_right, bottom_right and bottom_left points
+    - PATCH: JSON object with the fields to change in an existing city preset (the result is checked the same way)
+    - DELETE: no body
+    - If-Match (optional header): revision the change is based on
+    
+    Returns:
+    - JSON response with the preset (GET), or status, the new revision and (PUT/PATCH) the stored preset
+    """
+    try:
+        catalog = city_catalog()
+        if request.method == 'GET':
+            preset = catalog.get(country, state_province, preset_id)
+            if preset is None:
+                return jsonify({'error': 'Preset not found'}), 404
+            return jsonify(preset)
+
+        # The catalog is updated row by row under the same lock as the file
+        if request.method == 'DELETE':
+            return change_response(city_document(), preset_store.delete_city(country, state_province, preset_id),
+                                   'City preset deleted',
+                                   after_write=catalog.after_delete(country, state_province, preset_id))
+
+        preset = preset_from_request(preset_id)
+        if preset is None:
+            return jsonify({'error': 'No preset provided'}), 400
+        return change_response(
+            city_document(),
+            preset_store.upsert_city(country, state_province, preset, merge=request.method == 'PATCH'),
+            'City preset saved',
+            after_write=catalog.after_upsert(country, state_province))
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@presets_bp.route('/client/<preset_id>', methods=['PUT', 'PATCH', 'DELETE'])
+def change_client_preset(preset_id):
+    """
+    Add, update or remove a single client preset.
+    
+    Expects:
+    - PUT: JSON client preset, stored as given (added if new)
+    - PATCH: JSON object with the fields to change in an existing client preset
+    - DELETE: no body
+    - If-Match (optional header): revision the change is based on
+    
+    Returns:
+    - JSON response with status, the new revision and (PUT/PATCH) the stored preset
+    """
+    try:
+        if request.method == 'DELETE':
+            return change_response(client_document(), preset_store.delete_client(preset_id), 'Client preset deleted')
+
+        preset = preset_from_request(preset_id)
+        if preset is None:
+            return jsonify({'error': 'No preset provided'}), 400
+        return change_response(client_document(), preset_store.upsert_client(preset, merge=request.method == 'PATCH'),
+                               'Client preset saved')
     except Exception as e:
         return jsonify({'error': str(e)}), 500
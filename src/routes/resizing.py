@@ -1,4 +1,4 @@
-from flask import Blueprint, request, jsonify, send_file, current_app
+from flask import Blueprint, request, jsonify, current_app
 import os
 import json
 import uuid
@@ -6,17 +6,227 @@ import tempfile
 import shutil
 from werkzeug.utils import secure_filename
 from PIL import Image
+import math
 import zipfile
+from src.utils import metrics, admission, largeimage, encoders, storage, heif, scratch, frames
+from src.routes import uploads
 
 resizing_bp = Blueprint('resizing', __name__)
 
 # Allowed file extensions
-ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'tiff', 'tif', 'bmp', 'heic', 'heif', 'webp'}
+ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'tiff', 'tif', 'bmp', 'heic', 'heif', 'webp', 'gif'}
 
 def allowed_file(filename):
     """Check if file has an allowed extension."""
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
+def calculate_dimensions(orig_width, orig_height, resize_mode, width, height, percentage):
+    """
+    Calculate the size an image is resized to (before any fill-mode crop).
+
+    Args:
+        orig_width (int): Original width
+        orig_height (int): Original height
+        resize_mode (str): 'exact', 'fit', 'fill' or 'percentage'
+        width (int): Requested width (optional)
+        height (int): Requested height (optional)
+        percentage (int): Scale percentage for 'percentage' mode
+
+    Returns:
+        tuple: (new_width, new_height)
+    """
+    # Calculate new dimensions based on resize mode
+    if resize_mode == 'percentage':
+        new_width = int(orig_width * percentage / 100)
+        new_height = int(orig_height * percentage / 100)
+    elif resize_mode == 'exact':
+        new_width = width if width else orig_width
+        new_height = height if height else orig_height
+    elif resize_mode == 'fit':
+        # Maintain aspect ratio, fit within dimensions
+        if width and height:
+            ratio = min(width / orig_width, height / orig_height)
+            new_width = int(orig_width * ratio)
+            new_height = int(orig_height * ratio)
+        elif width:
+            ratio = width / orig_width
+            new_width = width
+            new_height = int(orig_height * ratio)
+        elif height:
+            ratio = height / orig_height
+            new_width = int(orig_width * ratio)
+            new_height = height
+        else:
+            new_width, new_height = orig_width, orig_height
+    elif resize_mode == 'fill':
+        # Maintain aspect ratio, fill dimensions (may crop)
+        if width and height:
+            ratio = max(width / orig_width, height / orig_height)
+            new_width = int(orig_width * ratio)
+            new_height = int(orig_height * ratio)
+        elif width:
+            ratio = width / orig_width
+            new_width = width
+            new_height = int(orig_height * ratio)
+        elif height:
+            ratio = height / orig_height
+            new_width = int(orig_width * ratio)
+            new_height = height
+        else:
+            new_width, new_height = orig_width, orig_height
+
+    return new_width, new_height
+
+# Lanczos kernel radius in input pixels at 1:1 scale
+LANCZOS_SUPPORT = 3
+
+def resize_large_image(file_path, output_path, output_format, resize_mode, width, height, percentage, encoder_profile=None):
+    """
+    Resize a very large image strip by strip, keeping memory proportional to the strip size.
+
+    Each output strip is resampled from the input rows it depends on, plus the
+    filter's support on both sides, so strips join without seams.
+
+    Args:
+        file_path (str): Path to the source image
+        output_path (str): Path to save the resized image
+        output_format (str): Output format (see src/utils/encoders.py)
+        resize_mode, width, height, percentage: As for the /process endpoint
+        encoder_profile (str): Encoder profile name
+    """
+    with largeimage.StripReader(file_path) as reader:
+        new_width, new_height = calculate_dimensions(reader.width, reader.height, resize_mode, width, height, percentage)
+
+        # JPEG can decode at 1/2 to 1/8 scale directly when the output is that small anyway
+        reader.draft(reader.mode, (new_width, new_height))
+        src_width, src_height = reader.width, reader.height
+
+        # If fill mode and both dimensions specified, only the cropped window is produced
+        crop_left, crop_top, crop_right, crop_bottom = 0, 0, new_width, new_height
+        if resize_mode == 'fill' and width and height:
+            crop_left = round((new_width - width) / 2)
+            crop_top = round((new_height - height) / 2)
+            crop_right, crop_bottom = crop_left + width, crop_top + height
+
+        # Palette and bilevel images are resampled as RGB(A) / L, as Image.resize would
+        mode = {'P': 'RGBA' if 'transparency' in reader.img.info else 'RGB', '1': 'L'}.get(reader.mode, reader.mode)
+        out_mode = "RGB" if output_format in ["jpeg", "jpg"] and mode == "RGBA" else mode
+
+        scale_y = src_height / new_height
+        support = LANCZOS_SUPPORT * max(scale_y, 1.0)
+        core_rows = max(largeimage.strip_rows(src_width, current_app), int(4 * support))
+        out_rows = max(1, int(core_rows / scale_y))
+
+        def strips():
+            for top, bottom in largeimage.iter_bands(crop_bottom - crop_top, out_rows):
+                top, bottom = top + crop_top, bottom + crop_top
+                # Source rows that map onto this output band, widened by the filter support
+                src_top, src_bottom = top * scale_y, bottom * scale_y
+                read_top = max(0, math.floor(src_top - support))
+                read_bottom = min(src_height, math.ceil(src_bottom + support))
+                strip = reader.read(read_top, read_bottom)
+                if strip.mode != mode:
+                    strip = strip.convert(mode)
+                resized = strip.resize(
+                    (new_width, bottom - top), Image.LANCZOS,
+                    box=(0, src_top - read_top, src_width, src_bottom - read_top),
+                )
+                if crop_left or crop_right != new_width:
+                    resized = resized.crop((crop_left, 0, crop_right, resized.height))
+                yield resized.convert(out_mode) if resized.mode != out_mode else resized
+
+        writer = largeimage.open_strip_writer(output_path, output_format, (crop_right - crop_left, crop_bottom - crop_top), out_mode,
+                                              encoders.save_options(output_format, encoder_profile))
+        largeimage.write_strips(writer, strips())
+
+def resize_file(file_path, output_path, output_format, resize_mode, width, height, percentage, encoder_profile=None,
+                target_encoder=None):
+    """
+    Resize one image. Shared by the resizing endpoint and the CLI.
+
+    Args:
+        file_path (str): Path to the source image
+        output_path (str): Path to save the resized image
+        output_format (str): Output format (see src/utils/encoders.py)
+        resize_mode, width, height, percentage: As for the /process endpoint
+        encoder_profile (str): Encoder profile name
+        target_encoder (TargetSizeEncoder): Byte budget encoder (optional)
+
+    Returns:
+        tuple: (size report, target size report or None)
+    """
+    target_report = None
+
+    with Image.open(file_path) as img:
+        orig_width, orig_height = img.size
+    new_width, new_height = calculate_dimensions(orig_width, orig_height, resize_mode, width, height, percentage)
+
+    def resize_frame(img):
+        resized_img = img.resize((new_width, new_height), Image.LANCZOS)
+
+        # If fill mode and both dimensions specified, crop to fit
+        if resize_mode == 'fill' and width and height:
+            left = (new_width - width) / 2
+            top = (new_height - height) / 2
+            right = (new_width + width) / 2
+            bottom = (new_height + height) / 2
+            resized_img = resized_img.crop((left, top, right, bottom))
+        return resized_img
+
+    # Multi-page TIFFs and animations keep every frame, resized one frame at a time
+    if frames.keeps_frames(file_path, output_format):
+        with metrics.stage_timer('resizing', 'convert'):
+            frames.save(file_path, output_path, output_format, encoder_profile, transform=resize_frame)
+        if target_encoder:
+            # Frames are streamed to the encoder, so the file is encoded once with the profile settings
+            target_report = encoders.strip_target_report(output_path, target_encoder.target_bytes)
+        metrics.count_bytes('resizing', 'out', metrics.file_size(output_path))
+        return encoders.size_report(file_path, output_path), target_report
+
+    # Small outputs of HEIC photos are resampled from the embedded thumbnail instead of the full image
+    reduced = None
+    if heif.is_heif(file_path):
+        with metrics.stage_timer('resizing', 'decode'):
+            reduced = heif.open_reduced(file_path, (new_width, new_height))
+
+    # Very large inputs or outputs are resized in strips to bound memory
+    large = reduced is None and (largeimage.is_large_image(orig_width, orig_height, current_app) or
+                                 largeimage.is_large_image(new_width, new_height, current_app))
+    if large:
+        with metrics.stage_timer('resizing', 'convert'):
+            resize_large_image(file_path, output_path, output_format, resize_mode, width, height, percentage, encoder_profile)
+        if target_encoder:
+            # Strip output is never held in memory, so it is encoded once with the profile settings
+            target_report = encoders.strip_target_report(output_path, target_encoder.target_bytes)
+        metrics.count_bytes('resizing', 'out', metrics.file_size(output_path))
+        return encoders.size_report(file_path, output_path), target_report
+
+    # Open image
+    with reduced or Image.open(file_path) as img:
+        if reduced is None:
+            with metrics.stage_timer('resizing', 'decode'):
+                img.load()
+
+        with metrics.stage_timer('resizing', 'convert'):
+            # Resize image
+            resized_img = resize_frame(img)
+
+            # Convert to a mode the output format can store (e.g. RGBA to RGB for JPEG)
+            resized_img = encoders.prepare_image(resized_img, output_format)
+
+        # Save resized image
+        with metrics.stage_timer('resizing', 'encode'):
+            if target_encoder:
+                # Trial encodes happen in memory; only the one that fits is written
+                data, target_report = target_encoder.encode(resized_img)
+                with open(output_path, 'wb') as f:
+                    f.write(data)
+                target_report = dict(target_report, file=os.path.basename(output_path))
+            else:
+                encoders.encode(resized_img, output_path, output_format, encoder_profile)
+    metrics.count_bytes('resizing', 'out', metrics.file_size(output_path))
+    return encoders.size_report(file_path, output_path), target_report
+
 @resizing_bp.route('/process', methods=['POST'])
 def process_images():
     """
@@ -24,21 +234,26 @@ def process_images():
     
     Expects:
     - files: Image files to process
+    - upload_ids: Finalized resumable upload ids (instead of or in addition to files)
     - width: New width (optional)
     - height: New height (optional)
     - resize_mode: 'exact', 'fit', 'fill', or 'percentage'
     - percentage: Scale percentage if resize_mode is 'percentage'
-    - output_format: Output format (jpeg, png, tiff)
+    - output_format: Output format (jpeg, png, tiff, webp, avif, heic, bmp)
+    - encoder_profile: Encoder profile (default, web-small, archive, lossless)
+    - target_size: Byte budget per output file, e.g. 500KB (optional)
+    - allow_downscale: Also shrink images that do not fit the budget at the lowest quality (optional)
     
     Returns:
     - JSON response with status and download URL
     """
-    # Check if files were uploaded
-    if 'files[]' not in request.files:
+    # Check if files were uploaded (inline or through /api/uploads)
+    upload_ids = request.form.getlist('upload_ids[]')
+    if 'files[]' not in request.files and not upload_ids:
         return jsonify({'error': 'No files provided'}), 400
     
     files = request.files.getlist('files[]')
-    if not files or files[0].filename == '':
+    if not upload_ids and (not files or files[0].filename == ''):
         return jsonify({'error': 'No files selected'}), 400
     
     # Get resize parameters
@@ -66,189 +281,174 @@ def process_images():
     except ValueError:
         return jsonify({'error': 'Invalid numeric parameters'}), 400
     
-    # Get output format
-    output_format = request.form.get('output_format', 'jpeg').lower()
-    if output_format not in ['jpeg', 'png', 'tiff']:
-        output_format = 'jpeg'
+    # Get output format and encoder profile
+    try:
+        output_format, encoder_profile = encoders.resolve(request.form.get('output_format'), request.form.get('encoder_profile'))
+    except encoders.EncoderError as e:
+        return jsonify({'error': 'Unsupported output options', 'details': str(e)}), 400
+
+    # Optional byte budget per output file
+    try:
+        target_bytes = encoders.parse_byte_size(request.form.get('target_size'))
+    except encoders.EncoderError as e:
+        return jsonify({'error': 'Invalid target size', 'details': str(e)}), 400
+    target_encoder = None
+    if target_bytes:
+        allow_downscale = request.form.get('allow_downscale', '').lower() in ('1', 'true', 'on', 'yes')
+        target_encoder = encoders.TargetSizeEncoder(target_bytes, output_format, encoder_profile, allow_downscale)
     
     # Create a unique session ID for this batch
     session_id = str(uuid.uuid4())
-    upload_folder = os.path.join(current_app.config['UPLOAD_FOLDER'], session_id)
-    processed_folder = os.path.join(current_app.config['PROCESSED_FOLDER'], session_id)
+    workspace = scratch.open_session(session_id)
+    upload_folder, processed_folder = workspace.upload_folder, workspace.processed_folder
     
     os.makedirs(upload_folder, exist_ok=True)
     os.makedirs(processed_folder, exist_ok=True)
     
     # Save uploaded files
     saved_files = []
-    for file in files:
-        if file and allowed_file(file.filename):
-            filename = secure_filename(file.filename)
-            file_path = os.path.join(upload_folder, filename)
-            file.save(file_path)
-            saved_files.append(file_path)
+    with metrics.stage_timer('resizing', 'upload_save'):
+        for file in files:
+            if file and allowed_file(file.filename):
+                file_path = workspace.save_upload(file, secure_filename(file.filename))
+                metrics.count_bytes('resizing', 'in', metrics.file_size(file_path))
+                saved_files.append(file_path)
+
+    # Files sent ahead through the resumable upload API
+    try:
+        claimed = uploads.claim_uploads(upload_ids, upload_folder)
+    except uploads.UploadError as e:
+        shutil.rmtree(upload_folder, ignore_errors=True)
+        shutil.rmtree(processed_folder, ignore_errors=True)
+        return jsonify({'error': e.message, 'details': e.details}), e.status
+    for item in claimed:
+        metrics.count_bytes('resizing', 'in', metrics.file_size(item['path']))
+        saved_files.append(item['path'])
     
     if not saved_files:
         return jsonify({'error': 'No valid image files provided'}), 400
+
+    # Reserve memory for the largest decode (and resized output) before touching any pixels
+    try:
+        reservation = admission.admit(
+            current_app, saved_files, 'resizing',
+            output_size=lambda w, h: calculate_dimensions(w, h, resize_mode, width, height, percentage),
+        )
+    except admission.AdmissionError as e:
+        shutil.rmtree(upload_folder, ignore_errors=True)
+        shutil.rmtree(processed_folder, ignore_errors=True)
+        return admission.error_response(e)
     
     # Process files
     processed_files = []
+    size_reports = []
+    target_reports = []
     
     for file_path in saved_files:
         try:
-            # Register HEIF opener if needed
-            if file_path.lower().endswith(('.heic', '.heif')):
-                try:
-                    import pillow_heif
-                    pillow_heif.register_heif_opener()
-                except ImportError:
-                    return jsonify({'error': 'HEIF/HEIC support not available'}), 500
+            # HEIF/HEIC files need pillow_heif (its opener is registered once at startup)
+            if heif.is_heif(file_path) and not heif.register_opener():
+                return jsonify({'error': 'HEIF/HEIC support not available'}), 500
             
-            # Open image
-            with Image.open(file_path) as img:
-                # Get original dimensions
-                orig_width, orig_height = img.size
-                
-                # Calculate new dimensions based on resize mode
-                if resize_mode == 'percentage':
-                    new_width = int(orig_width * percentage / 100)
-                    new_height = int(orig_height * percentage / 100)
-                elif resize_mode == 'exact':
-                    new_width = width if width else orig_width
-                    new_height = height if height else orig_height
-                elif resize_mode == 'fit':
-                    # Maintain aspect ratio, fit within dimensions
-                    if width and height:
-                        ratio = min(width / orig_width, height / orig_height)
-                        new_width = int(orig_width * ratio)
-                        new_height = int(orig_height * ratio)
-                    elif width:
-                        ratio = width / orig_width
-                        new_width = width
-                        new_height = int(orig_height * ratio)
-                    elif height:
-                        ratio = height / orig_height
-                        new_width = int(orig_width * ratio)
-                        new_height = height
-                    else:
-                        new_width, new_height = orig_width, orig_height
-                elif resize_mode == 'fill':
-                    # Maintain aspect ratio, fill dimensions (may crop)
-                    if width and height:
-                        ratio = max(width / orig_width, height / orig_height)
-                        new_width = int(orig_width * ratio)
-                        new_height = int(orig_height * ratio)
-                    elif width:
-                        ratio = width / orig_width
-                        new_width = width
-                        new_height = int(orig_height * ratio)
-                    elif height:
-                        ratio = height / orig_height
-                        new_width = int(orig_width * ratio)
-                        new_height = height
-                    else:
-                        new_width, new_height = orig_width, orig_height
-                
-                # Resize image
-                resized_img = img.resize((new_width, new_height), Image.LANCZOS)
-                
-                # If fill mode and both dimensions specified, crop to fit
-                if resize_mode == 'fill' and width and height:
-                    left = (new_width - width) / 2
-                    top = (new_height - height) / 2
-                    right = (new_width + width) / 2
-                    bottom = (new_height + height) / 2
-                    resized_img = resized_img.crop((left, top, right, bottom))
-                
-                # Convert RGBA to RGB if saving as JPEG
-                if output_format.lower() in ["jpeg", "jpg"] and resized_img.mode == "RGBA":
-                    resized_img = resized_img.convert("RGB")
-                
-                # Save resized image
-                base_name = os.path.splitext(os.path.basename(file_path))[0]
-                output_path = os.path.join(processed_folder, f"{base_name}.{output_format}")
-                resized_img.save(output_path, output_format.upper())
-                processed_files.append(output_path)
+            base_name = os.path.splitext(os.path.basename(file_path))[0]
+            output_path = os.path.join(processed_folder, f"{base_name}.{output_format}")
+            size_report, target_report = resize_file(file_path, output_path, output_format, resize_mode, width, height,
+                                                     percentage, encoder_profile, target_encoder)
+            processed_files.append(output_path)
+            size_reports.append(size_report)
+            if target_report:
+                target_reports.append(target_report)
                 
         except Exception as e:
             print(f"Error processing {file_path}: {str(e)}")
     
+    reservation.release()
+
+    metrics.count_files('resizing', 'processed', len(processed_files))
+    metrics.count_files('resizing', 'failed', len(saved_files) - len(processed_files))
+
     if not processed_files:
         return jsonify({'error': 'Failed to process any files'}), 500
     
+    store = storage.get_storage()
+
     # Create a zip file if multiple files were processed
     if len(processed_files) > 1:
         zip_filename = f"resized_images_{session_id}.zip"
-        zip_path = os.path.join(processed_folder, zip_filename)
         
-        with zipfile.ZipFile(zip_path, 'w') as zipf:
-            for file in processed_files:
-                zipf.write(file, os.path.basename(file))
+        # The archive is streamed straight to storage
+        with metrics.stage_timer('resizing', 'zip'):
+            with store.open_write(storage.processed_key(session_id, zip_filename)) as fp:
+                with zipfile.ZipFile(fp, 'w') as zipf:
+                    for file in processed_files:
+                        zipf.write(file, os.path.basename(file))
+        store.discard_scratch(upload_folder, processed_folder)
         
         return jsonify({
             'status': 'success',
             'message': f'Successfully resized {len(processed_files)} images',
             'download_url': f'/api/resizing/download/{session_id}/zip',
-            'file_count': len(processed_files)
+            'file_count': len(processed_files),
+            'size_report': {'files': size_reports, 'total': encoders.summarize(size_reports)},
+            'target_size_report': encoders.summarize_targets(target_reports) if target_encoder else None
         })
     else:
         # Single file
+        with metrics.stage_timer('resizing', 'publish'):
+            store.publish(processed_files[0], storage.processed_key(session_id, os.path.basename(processed_files[0])))
+        store.discard_scratch(upload_folder, processed_folder)
         return jsonify({
             'status': 'success',
             'message': 'Successfully resized image',
             'download_url': f'/api/resizing/download/{session_id}/single',
-            'file_count': 1
+            'file_count': 1,
+            'size_report': {'files': size_reports, 'total': encoders.summarize(size_reports)},
+            'target_size_report': encoders.summarize_targets(target_reports) if target_encoder else None
         })
 
 @resizing_bp.route('/download/<session_id>/zip', methods=['GET'])
 def download_zip(session_id):
     """Download processed images as a zip file."""
-    processed_folder = os.path.join(current_app.config['PROCESSED_FOLDER'], session_id)
-    zip_path = os.path.join(processed_folder, f"resized_images_{session_id}.zip")
-    
-    if not os.path.exists(zip_path):
-        return jsonify({'error': 'Zip file not found'}), 404
-    
-    return send_file(
-        zip_path,
-        as_attachment=True,
+    return storage.send_stored(
+        storage.processed_key(session_id, f"resized_images_{session_id}.zip"),
         download_name=f"resized_images.zip",
-        mimetype='application/zip'
+        mimetype='application/zip',
+        missing='Zip file not found'
     )
 
 @resizing_bp.route('/download/<session_id>/single', methods=['GET'])
 def download_single(session_id):
     """Download a single processed image."""
-    processed_folder = os.path.join(current_app.config['PROCESSED_FOLDER'], session_id)
+    store = storage.get_storage()
     
-    # Find the first file in the processed folder
-    files = os.listdir(processed_folder)
-    image_files = [f for f in files if f.lower().endswith(('.png', '.jpg', '.jpeg', '.tiff', '.tif'))]
+    # Find the first image published for the session
+    files = store.list(storage.processed_key(session_id))
+    image_files = [f for f in files if f.lower().endswith(encoders.OUTPUT_EXTENSIONS)]
     
     if not image_files:
         return jsonify({'error': 'Processed image not found'}), 404
     
-    file_path = os.path.join(processed_folder, image_files[0])
-    
-    return send_file(
-        file_path,
-        as_attachment=True,
-        download_name=image_files[0],
+    return store.send_download(
+        storage.processed_key(session_id, image_files[0]),
+        download_name=os.path.basename(image_files[0]),
         mimetype=f'image/{os.path.splitext(image_files[0])[1][1:].lower()}'
     )
 
 @resizing_bp.route('/cleanup/<session_id>', methods=['POST'])
 def cleanup_session(session_id):
     """Clean up temporary files for a session."""
-    upload_folder = os.path.join(current_app.config['UPLOAD_FOLDER'], session_id)
-    processed_folder = os.path.join(current_app.config['PROCESSED_FOLDER'], session_id)
+    upload_folder, processed_folder = scratch.session_folders(session_id)
     
-    # Clean up upload folder
-    if os.path.exists(upload_folder):
-        shutil.rmtree(upload_folder)
-    
-    # Clean up processed folder
-    if os.path.exists(processed_folder):
-        shutil.rmtree(processed_folder)
+    with metrics.stage_timer('resizing', 'cleanup'):
+        # Clean up upload folder
+        if os.path.exists(upload_folder):
+            shutil.rmtree(upload_folder)
+        
+        # Clean up processed folder
+        if os.path.exists(processed_folder):
+            shutil.rmtree(processed_folder)
+
+        # Remove published outputs (a no-op for local storage, where they were the processed folder)
+        storage.get_storage().delete_prefix(storage.processed_key(session_id))
     
     return jsonify({'status': 'success', 'message': 'Session cleaned up'})
@@ -0,0 +1,478 @@
+from flask import Blueprint, request, jsonify, current_app, make_response
+import os
+import re
+import json
+import time
+import uuid
+import hashlib
+import tempfile
+import threading
+from contextlib import contextmanager, ExitStack
+from werkzeug.utils import secure_filename
+from src.utils import metrics, sniff
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+uploads_bp = Blueprint('uploads', __name__)
+
+# Resumable uploads, modelled on the tus protocol:
+#   POST   /api/uploads                 create an upload (filename, length) -> upload_id
+#   PUT    /api/uploads/<id>            write a chunk at the byte offset given in Upload-Offset
+#   HEAD   /api/uploads/<id>            Upload-Offset / Upload-Length headers, to resume
+#   GET    /api/uploads/<id>            received byte ranges as JSON
+#   POST   /api/uploads/<id>/finalize   check the upload is complete (and its sha256 if given)
+#   DELETE /api/uploads/<id>            abandon an upload
+# Finalized uploads are passed to the processing endpoints as upload_ids[] instead of files[].
+
+ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'tiff', 'tif', 'bmp', 'heic', 'heif', 'webp', 'gif'}
+UPLOAD_ID_PATTERN = re.compile(r'^[0-9a-f]{32}$')
+DEFAULT_UPLOAD_TTL = 24 * 3600  # seconds an unclaimed upload is kept
+DEFAULT_CHUNK_SIZE = 8 * 1024 * 1024  # suggested to clients
+COPY_BUFFER_SIZE = 1024 * 1024
+
+_local_locks = {}
+_local_locks_guard = threading.Lock()
+
+
+class UploadError(Exception):
+    """Raised when an upload id cannot be used."""
+
+    def __init__(self, message, details, status=400):
+        super().__init__(message)
+        self.message = message
+        self.details = details
+        self.status = status
+
+
+def allowed_file(filename):
+    """Check if file has an allowed extension."""
+    return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
+
+def _setting(key, default=None, cast=str):
+    """Config value, overridden by an environment variable of the same name."""
+    value = os.environ.get(key) or current_app.config.get(key)
+    return cast(value) if value else default
+
+def get_upload_folder():
+    folder = _setting('CHUNKED_UPLOAD_FOLDER', os.path.join(tempfile.gettempdir(), 'image_processor_chunked'))
+    os.makedirs(folder, exist_ok=True)
+    return folder
+
+def _paths(upload_id):
+    folder = get_upload_folder()
+    return (os.path.join(folder, f"{upload_id}.data"),
+            os.path.join(folder, f"{upload_id}.json"),
+            os.path.join(folder, f"{upload_id}.lock"))
+
+def _check_id(upload_id):
+    if not UPLOAD_ID_PATTERN.match(upload_id or ''):
+        raise UploadError('Invalid upload id', f'"{upload_id}" is not an upload id', 404)
+
+@contextmanager
+def _locked(upload_id):
+    """Serialize updates to one upload across threads and worker processes."""
+    if fcntl is None:
+        with _local_locks_guard:
+            lock = _local_locks.setdefault(upload_id, threading.Lock())
+        with lock:
+            yield
+        return
+
+    with open(_paths(upload_id)[2], 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+def _load_meta(upload_id):
+    _check_id(upload_id)
+    meta_path = _paths(upload_id)[1]
+    try:
+        with open(meta_path, 'r') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        raise UploadError('Upload not found', f'No upload with id {upload_id}', 404)
+
+def _save_meta(meta):
+    meta_path = _paths(meta['upload_id'])[1]
+    tmp_path = meta_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(meta, f)
+    os.replace(tmp_path, meta_path)
+
+def _merge_range(ranges, start, end):
+    """Add [start, end) to a sorted list of disjoint [start, end) ranges."""
+    merged = []
+    for r_start, r_end in sorted(ranges + [[start, end]]):
+        if merged and r_start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], r_end)
+        else:
+            merged.append([r_start, r_end])
+    return merged
+
+def _contiguous_offset(meta):
+    """Bytes received without gaps from the start of the file (the tus Upload-Offset)."""
+    ranges = meta['received']
+    return ranges[0][1] if ranges and ranges[0][0] == 0 else 0
+
+def _is_complete(meta):
+    return _contiguous_offset(meta) == meta['length']
+
+def _state(meta):
+    return {
+        'upload_id': meta['upload_id'],
+        'filename': meta['filename'],
+        'relative_path': meta['relative_path'],
+        'length': meta['length'],
+        'offset': _contiguous_offset(meta),
+        'received': meta['received'],
+        'complete': _is_complete(meta),
+        'finalized': meta['finalized'],
+    }
+
+def _error(e):
+    return jsonify({'error': e.message, 'details': e.details}), e.status
+
+def cleanup_expired(max_age=None):
+    """Remove uploads that were created more than `max_age` seconds ago and never claimed."""
+    max_age = max_age or _setting('CHUNKED_UPLOAD_TTL', DEFAULT_UPLOAD_TTL, float)
+    folder = get_upload_folder()
+    now = time.time()
+    for filename in os.listdir(folder):
+        path = os.path.join(folder, filename)
+        try:
+            if now - os.path.getmtime(path) > max_age:
+                os.remove(path)
+        except OSError:
+            continue  # Removed concurrently
+
+def data_path(upload_id):
+    """Path of an upload's (preallocated) data file."""
+    return _paths(upload_id)[0]
+
+def check_chunk(upload_id, headers, content_length):
+    """
+    Validate a chunk request before any of its body is read.
+
+    Args:
+        upload_id (str): Upload id
+        headers (Mapping): Request headers (Upload-Offset or Content-Range)
+        content_length (int): Chunk size from Content-Length, or None
+
+    Returns:
+        tuple: (offset, length) of the chunk
+
+    Raises:
+        UploadError: If the upload is unknown or finalized, or the chunk does not fit
+    """
+    meta = _load_meta(upload_id)
+    if meta['finalized']:
+        raise UploadError('Upload already finalized', 'Create a new upload to send this file again', 409)
+
+    offset_header = headers.get('Upload-Offset')
+    match = re.match(r'bytes (\d+)-\d+/(\d+|\*)', headers.get('Content-Range', ''))
+    try:
+        offset = int(offset_header) if offset_header is not None else int(match.group(1))
+    except (TypeError, ValueError, AttributeError):
+        raise UploadError('Missing offset', 'Send the chunk offset in an Upload-Offset header')
+
+    if content_length is None:
+        raise UploadError('Missing length', 'Chunks must be sent with a Content-Length header', 411)
+    if offset < 0 or offset + content_length > meta['length']:
+        raise UploadError('Chunk out of range', f"Chunk {offset}-{offset + content_length} exceeds the upload length {meta['length']}", 416)
+    return offset, content_length
+
+def check_head(upload_id, head):
+    """
+    Check the first bytes of an upload against the image signatures (on the chunk at offset 0, and again on finalize).
+
+    Raises:
+        UploadError: If they match no supported image format; the upload is deleted
+    """
+    if sniff.detect(head) is None:
+        discard(upload_id)
+        raise UploadError('Not an image', f'{sniff.REJECTED_REASON}, so the upload was deleted', 415)
+
+def discard(upload_id):
+    """Delete an upload's data and state."""
+    for path in _paths(upload_id):
+        if os.path.exists(path):
+            os.remove(path)
+
+def record_chunk(upload_id, offset, written):
+    """Add the byte range a chunk wrote to the upload's state. Returns the updated state."""
+    with _locked(upload_id):
+        meta = _load_meta(upload_id)
+        if written:
+            meta['received'] = _merge_range(meta['received'], offset, offset + written)
+        _save_meta(meta)
+    return meta
+
+def chunk_response_state(meta):
+    """JSON body and Upload-Offset header value for a chunk response."""
+    return _state(meta), str(_contiguous_offset(meta))
+
+def claim_uploads(upload_ids, dest_folder, unique_names=False):
+    """
+    Move finalized uploads into a processing session folder.
+
+    Each upload can be claimed once; its data file is moved (not copied) and its
+    bookkeeping files are removed. Either every upload is claimed or none is:
+    all ids are checked, under their locks, before any file is moved.
+
+    Args:
+        upload_ids (list): Finalized upload ids
+        dest_folder (str): Session upload folder
+        unique_names (bool): Store files under random names instead of their secured filenames
+
+    Returns:
+        list: Dicts with path, filename and relative_path
+
+    Raises:
+        UploadError: If an id is unknown, repeated or the upload is not finalized
+    """
+    for upload_id in upload_ids:
+        _check_id(upload_id)
+    if len(set(upload_ids)) != len(upload_ids):
+        raise UploadError('Duplicate upload id', 'Each upload can only be passed once', 400)
+
+    claimed = []
+    with ExitStack() as stack:
+        # Sorted, so two requests claiming overlapping sets cannot deadlock
+        for upload_id in sorted(upload_ids):
+            stack.enter_context(_locked(upload_id))
+
+        metas = [_load_meta(upload_id) for upload_id in upload_ids]
+        for meta in metas:
+            if not meta['finalized']:
+                raise UploadError('Upload not finalized', f"Upload {meta['upload_id']} ({meta['filename']}) has not been finalized", 409)
+
+        moved = []
+        try:
+            for meta in metas:
+                data_path = _paths(meta['upload_id'])[0]
+                if unique_names:
+                    dest_name = f"{uuid.uuid4()}{os.path.splitext(meta['filename'])[1].lower()}"
+                else:
+                    dest_name = secure_filename(meta['filename'])
+                dest_path = os.path.join(dest_folder, dest_name)
+                os.replace(data_path, dest_path)
+                moved.append((data_path, dest_path))
+                claimed.append({'path': dest_path, 'filename': meta['filename'], 'relative_path': meta['relative_path']})
+        except OSError:
+            # Put back what was already moved, so the uploads can still be claimed
+            for data_path, dest_path in reversed(moved):
+                os.replace(dest_path, data_path)
+            raise
+        for meta in metas:
+            os.remove(_paths(meta['upload_id'])[1])
+
+    for upload_id in upload_ids:
+        try:
+            os.remove(_paths(upload_id)[2])
+        except OSError:
+            pass
+    return claimed
+
+@uploads_bp.route('', methods=['POST'])
+def create_upload():
+    """
+    Create a resumable upload.
+
+    Expects (JSON or form):
+    - filename: Original file name
+    - length: Total size in bytes (or an Upload-Length header)
+    - relative_path: Path of the file inside the selected folder (optional)
+    - checksum: Hex sha256 of the whole file, verified on finalize (optional)
+
+    Returns:
+    - JSON response with upload_id and the suggested chunk size
+    """
+    data = request.get_json(silent=True) or request.form
+    filename = data.get('filename', '')
+    relative_path = data.get('relative_path') or filename
+    checksum = (data.get('checksum') or '').lower() or None
+
+    try:
+        length = int(data.get('length', request.headers.get('Upload-Length', '')))
+    except (TypeError, ValueError):
+        return jsonify({'error': 'Invalid length', 'details': 'length must be the file size in bytes'}), 400
+    if not filename or not allowed_file(filename):
+        return jsonify({'error': 'Invalid file type', 'details': f'"{filename}" is not a supported image file'}), 400
+    max_length = _setting('CHUNKED_UPLOAD_MAX_LENGTH', current_app.config.get('MAX_CONTENT_LENGTH'), int)
+    if length <= 0 or (max_length and length > max_length):
+        return jsonify({'error': 'Invalid length', 'details': f'length must be between 1 and {max_length} bytes'}), 400
+
+    cleanup_expired()
+
+    upload_id = uuid.uuid4().hex
+    data_path = _paths(upload_id)[0]
+
+    # Reserve the space up front so a full disk fails here, not halfway through the upload
+    fd = os.open(data_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    try:
+        if hasattr(os, 'posix_fallocate'):
+            os.posix_fallocate(fd, 0, length)
+        else:
+            os.ftruncate(fd, length)
+    except OSError as e:
+        os.close(fd)
+        os.remove(data_path)
+        current_app.logger.error(f"Could not preallocate {length} bytes for upload: {e}")
+        return jsonify({'error': 'Insufficient storage', 'details': str(e)}), 507
+    os.close(fd)
+
+    meta = {
+        'upload_id': upload_id,
+        'filename': filename,
+        'relative_path': relative_path,
+        'length': length,
+        'checksum': checksum,
+        'received': [],
+        'finalized': False,
+        'created': time.time(),
+    }
+    _save_meta(meta)
+
+    response = jsonify(dict(_state(meta), chunk_size=DEFAULT_CHUNK_SIZE))
+    response.status_code = 201
+    response.headers['Location'] = f'/api/uploads/{upload_id}'
+    return response
+
+@uploads_bp.route('/<upload_id>', methods=['PUT', 'PATCH'])
+def upload_chunk(upload_id):
+    """
+    Write one chunk of an upload.
+
+    Expects:
+    - Upload-Offset header: Byte offset of the chunk (or Content-Range: bytes start-end/total)
+    - Body: The chunk's raw bytes
+
+    Returns:
+    - JSON response with the received ranges; the Upload-Offset header holds the contiguous offset
+    """
+    try:
+        offset, length = check_chunk(upload_id, request.headers, request.content_length)
+    except UploadError as e:
+        return _error(e)
+
+    # The chunk at offset 0 starts with the file signature: check it before anything is written
+    head = b''
+    if offset == 0:
+        needed = min(sniff.SNIFF_BYTES, length)
+        while len(head) < needed:
+            buf = request.stream.read(needed - len(head))
+            if not buf:
+                break
+            head += buf
+        if len(head) == needed:
+            try:
+                check_head(upload_id, head)
+            except UploadError as e:
+                return _error(e)
+
+    # Positioned writes: chunks can arrive in any order, in parallel, from any worker
+    written = 0
+    with metrics.stage_timer('uploads', 'upload_save'):
+        fd = os.open(data_path(upload_id), os.O_WRONLY)
+        try:
+            if head:
+                os.pwrite(fd, head, offset)
+                written = len(head)
+            while written < length:
+                buf = request.stream.read(min(COPY_BUFFER_SIZE, length - written))
+                if not buf:
+                    break
+                os.pwrite(fd, buf, offset + written)
+                written += len(buf)
+        finally:
+            os.close(fd)
+    metrics.count_bytes('uploads', 'in', written)
+
+    state, upload_offset = chunk_response_state(record_chunk(upload_id, offset, written))
+    response = jsonify(state)
+    response.headers['Upload-Offset'] = upload_offset
+    if written < length:
+        # Connection dropped mid-chunk; what arrived is kept and the client resumes from Upload-Offset
+        response.status_code = 400
+    return response
+
+@uploads_bp.route('/<upload_id>', methods=['HEAD'])
+def upload_offset(upload_id):
+    """Report how much of an upload has arrived (tus-style resume check)."""
+    try:
+        meta = _load_meta(upload_id)
+    except UploadError as e:
+        return make_response('', e.status)
+    response = make_response('', 200)
+    response.headers['Upload-Offset'] = str(_contiguous_offset(meta))
+    response.headers['Upload-Length'] = str(meta['length'])
+    response.headers['Cache-Control'] = 'no-store'
+    return response
+
+@uploads_bp.route('/<upload_id>', methods=['GET'])
+def upload_status(upload_id):
+    """Get the received byte ranges of an upload."""
+    try:
+        return jsonify(_state(_load_meta(upload_id)))
+    except UploadError as e:
+        return _error(e)
+
+@uploads_bp.route('/<upload_id>/finalize', methods=['POST'])
+def finalize_upload(upload_id):
+    """
+    Mark an upload as complete so it can be passed to a processing endpoint.
+
+    Expects:
+    - checksum: Hex sha256 of the whole file (optional, overrides the one given on create)
+
+    Returns:
+    - JSON response with the upload state
+    """
+    try:
+        meta = _load_meta(upload_id)
+    except UploadError as e:
+        return _error(e)
+    data = request.get_json(silent=True) or request.form
+    checksum = (data.get('checksum') or meta.get('checksum') or '').lower()
+
+    if not _is_complete(meta):
+        missing = meta['length'] - sum(end - start for start, end in meta['received'])
+        return jsonify(dict(_state(meta), error='Upload incomplete', details=f'{missing} bytes have not been received')), 409
+
+    if checksum and not meta['finalized']:
+        sha256 = hashlib.sha256()
+        with open(_paths(upload_id)[0], 'rb') as f:
+            for chunk in iter(lambda: f.read(COPY_BUFFER_SIZE), b''):
+                sha256.update(chunk)
+        if sha256.hexdigest() != checksum:
+            return jsonify({'error': 'Checksum mismatch', 'details': 'The uploaded data does not match the given sha256'}), 422
+
+    if not meta['finalized']:
+        # A short chunk at offset 0 is written unchecked, so the head is checked again on the complete file
+        with open(_paths(upload_id)[0], 'rb') as f:
+            head = f.read(min(sniff.SNIFF_BYTES, meta['length']))
+        try:
+            check_head(upload_id, head)
+        except UploadError as e:
+            return _error(e)
+
+    with _locked(upload_id):
+        meta = _load_meta(upload_id)
+        meta['finalized'] = True
+        _save_meta(meta)
+    return jsonify(_state(meta))
+
+@uploads_bp.route('/<upload_id>', methods=['DELETE'])
+def delete_upload(upload_id):
+    """Abandon an upload and delete its data."""
+    try:
+        _check_id(upload_id)
+    except UploadError as e:
+        return _error(e)
+    discard(upload_id)
+    return jsonify({'status': 'success', 'message': 'Upload deleted'})
@@ -1,4 +1,4 @@
-from flask import Blueprint, request, jsonify, send_file, current_app
+from flask import Blueprint, request, jsonify, current_app
 import os
 import json
 import uuid
@@ -7,16 +7,229 @@ import shutil
 from werkzeug.utils import secure_filename
 from PIL import Image, ImageDraw, ImageFont
 import zipfile
+from src.utils import metrics, admission, largeimage, encoders, storage, heif, scratch, frames
+from src.routes import uploads
 
 watermark_bp = Blueprint('watermark', __name__)
 
 # Allowed file extensions
-ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'tiff', 'tif', 'bmp', 'heic', 'heif', 'webp'}
+ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'tiff', 'tif', 'bmp', 'heic', 'heif', 'webp', 'gif'}
 
 def allowed_file(filename):
     """Check if file has an allowed extension."""
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
+def build_watermark_patch(image_size, watermark_type, watermark_text, watermark_img, position, opacity, size):
+    """
+    Render the watermark as an RGBA patch covering only the area it occupies.
+
+    Args:
+        image_size (tuple): (width, height) of the image being watermarked
+        watermark_type (str): 'text' or 'image'
+        watermark_text (str): Text to use as watermark
+        watermark_img (Image): RGBA watermark image (if type is 'image')
+        position (str): 'center', 'top_left', 'top_right', 'bottom_left', 'bottom_right'
+        opacity (int): Watermark opacity (0-100)
+        size (int): Watermark size percentage (1-100)
+
+    Returns:
+        tuple: (patch, x, y) with the patch's position in the image, or None if there is nothing to draw
+    """
+    img_width, img_height = image_size
+
+    if watermark_type == 'text' and watermark_text:
+        # Try to load a font, fall back to default if not available
+        try:
+            # Calculate font size based on image dimensions and size parameter
+            font_size = int(min(img_width, img_height) * size / 100)
+            font = ImageFont.truetype("Arial", font_size)
+        except IOError:
+            # Use default font
+            font = ImageFont.load_default()
+
+        # Get text size (ImageDraw.textsize was removed in Pillow 10)
+        left, top, right, bottom = ImageDraw.Draw(Image.new('RGBA', (1, 1))).textbbox((0, 0), watermark_text, font=font)
+        text_width, text_height = right - left, bottom - top
+
+        # Calculate position
+        if position == 'center':
+            x = (img_width - text_width) // 2
+            y = (img_height - text_height) // 2
+        elif position == 'top_left':
+            x, y = 10, 10
+        elif position == 'top_right':
+            x, y = img_width - text_width - 10, 10
+        elif position == 'bottom_left':
+            x, y = 10, img_height - text_height - 10
+        else:  # bottom_right
+            x, y = img_width - text_width - 10, img_height - text_height - 10
+
+        # The patch spans the text and its shadow, clipped to the image
+        patch_left, patch_top = max(0, x + min(0, left)), max(0, y + min(0, top))
+        patch_right, patch_bottom = min(img_width, x + right + 2), min(img_height, y + bottom + 2)
+        if patch_right <= patch_left or patch_bottom <= patch_top:
+            return None
+        patch = Image.new('RGBA', (patch_right - patch_left, patch_bottom - patch_top), (0, 0, 0, 0))
+        draw = ImageDraw.Draw(patch)
+        x, y = x - patch_left, y - patch_top
+
+        # Draw text with shadow for better visibility
+        draw.text((x+2, y+2), watermark_text, font=font, fill=(0, 0, 0, int(255 * opacity / 100)))
+        draw.text((x, y), watermark_text, font=font, fill=(255, 255, 255, int(255 * opacity / 100)))
+        return patch, patch_left, patch_top
+
+    if watermark_type == 'image' and watermark_img:
+        # Resize watermark image based on size parameter
+        wm_width = int(img_width * size / 100)
+        wm_height = int(watermark_img.height * wm_width / watermark_img.width)
+
+        # Ensure watermark isn't larger than the image
+        if wm_width > img_width:
+            wm_width = img_width
+            wm_height = int(watermark_img.height * wm_width / watermark_img.width)
+        if wm_height > img_height:
+            wm_height = img_height
+            wm_width = int(watermark_img.width * wm_height / watermark_img.height)
+
+        resized_wm = watermark_img.resize((wm_width, wm_height), Image.LANCZOS)
+
+        # Apply opacity
+        if opacity < 100:
+            alpha = resized_wm.split()[3]
+            alpha = alpha.point(lambda p: p * opacity / 100)
+            resized_wm.putalpha(alpha)
+
+        # Calculate position
+        if position == 'center':
+            x = (img_width - wm_width) // 2
+            y = (img_height - wm_height) // 2
+        elif position == 'top_left':
+            x, y = 10, 10
+        elif position == 'top_right':
+            x, y = img_width - wm_width - 10, 10
+        elif position == 'bottom_left':
+            x, y = 10, img_height - wm_height - 10
+        else:  # bottom_right
+            x, y = img_width - wm_width - 10, img_height - wm_height - 10
+
+        # Paste watermark onto a transparent layer, clipped to the image
+        # (tiny images can push the 10px margin off-canvas)
+        crop_left, crop_top = max(0, -x), max(0, -y)
+        if crop_left or crop_top:
+            resized_wm = resized_wm.crop((crop_left, crop_top, wm_width, wm_height))
+        patch = Image.new('RGBA', resized_wm.size, (0, 0, 0, 0))
+        patch.paste(resized_wm, (0, 0), resized_wm)
+        return patch, x + crop_left, y + crop_top
+
+    return None
+
+def composite_patch(img, patch, x, y):
+    """
+    Alpha-composite a watermark patch onto an RGBA image in place.
+
+    `y` may be negative or the patch may overhang the image (strip processing);
+    only the overlapping part is composited.
+    """
+    top = max(0, -y)
+    bottom = min(patch.height, img.height - y)
+    if bottom <= top or x >= img.width:
+        return
+    if top or bottom != patch.height:
+        patch = patch.crop((0, top, patch.width, bottom))
+    img.alpha_composite(patch, (x, y + top))
+
+def watermark_large_image(file_path, output_path, output_format, watermark_type, watermark_text, watermark_img, position, opacity, size,
+                          encoder_profile=None):
+    """
+    Watermark a very large image strip by strip, keeping memory proportional to the strip size.
+
+    Strips that the watermark does not touch are passed through unchanged.
+    """
+    with largeimage.StripReader(file_path) as reader:
+        patch = build_watermark_patch((reader.width, reader.height), watermark_type, watermark_text, watermark_img, position, opacity, size)
+        out_mode = "RGB" if output_format in ["jpeg", "jpg", "bmp"] else "RGBA"
+        rows = largeimage.strip_rows(reader.width, current_app)
+
+        def strips():
+            for top, bottom in largeimage.iter_bands(reader.height, rows):
+                strip = reader.read(top, bottom)
+                if strip.mode != 'RGBA':
+                    strip = strip.convert('RGBA')
+                if patch:
+                    wm, x, y = patch
+                    composite_patch(strip, wm, x, y - top)
+                yield strip.convert(out_mode) if out_mode != 'RGBA' else strip
+
+        writer = largeimage.open_strip_writer(output_path, output_format, (reader.width, reader.height), out_mode,
+                                              encoders.save_options(output_format, encoder_profile))
+        largeimage.write_strips(writer, strips())
+
+def watermark_file(file_path, output_path, output_format, watermark_type, watermark_text, watermark_img, position, opacity, size,
+                   encoder_profile=None):
+    """
+    Watermark one image. Shared by the watermark endpoint and the CLI.
+
+    Args:
+        file_path (str): Path to the source image
+        output_path (str): Path to save the watermarked image
+        output_format (str): Output format (see src/utils/encoders.py)
+        watermark_type, watermark_text, watermark_img, position, opacity, size: As for build_watermark_patch
+        encoder_profile (str): Encoder profile name
+
+    Returns:
+        dict: Size report
+    """
+    # Multi-page TIFFs and animations keep every frame, watermarked one frame at a time
+    if frames.keeps_frames(file_path, output_format):
+        patches = {}  # frames share one canvas size, so the patch is rendered once
+
+        def watermark_frame(img):
+            img = img.convert('RGBA')
+            if img.size not in patches:
+                patches[img.size] = build_watermark_patch(img.size, watermark_type, watermark_text, watermark_img,
+                                                          position, opacity, size)
+            if patches[img.size]:
+                composite_patch(img, *patches[img.size])
+            return img
+
+        with metrics.stage_timer('watermark', 'convert'):
+            frames.save(file_path, output_path, output_format, encoder_profile, transform=watermark_frame)
+        metrics.count_bytes('watermark', 'out', metrics.file_size(output_path))
+        return encoders.size_report(file_path, output_path)
+
+    # Very large images are watermarked in strips to bound memory
+    if largeimage.is_large_file(file_path, current_app):
+        with metrics.stage_timer('watermark', 'convert'):
+            watermark_large_image(file_path, output_path, output_format, watermark_type, watermark_text,
+                                  watermark_img, position, opacity, size, encoder_profile)
+        metrics.count_bytes('watermark', 'out', metrics.file_size(output_path))
+        return encoders.size_report(file_path, output_path)
+
+    # Open image
+    with Image.open(file_path) as img:
+        with metrics.stage_timer('watermark', 'decode'):
+            img.load()
+
+        with metrics.stage_timer('watermark', 'convert'):
+            # Convert to RGBA for watermarking
+            if img.mode != 'RGBA':
+                img = img.convert('RGBA')
+
+            # Composite the watermark onto the region it covers only
+            patch = build_watermark_patch(img.size, watermark_type, watermark_text, watermark_img, position, opacity, size)
+            if patch:
+                composite_patch(img, *patch)
+            watermarked_img = img
+
+            # Convert to a mode the output format can store (e.g. back to RGB for JPEG)
+            watermarked_img = encoders.prepare_image(watermarked_img, output_format)
+
+        # Save watermarked image
+        with metrics.stage_timer('watermark', 'encode'):
+            encoders.encode(watermarked_img, output_path, output_format, encoder_profile)
+    metrics.count_bytes('watermark', 'out', metrics.file_size(output_path))
+    return encoders.size_report(file_path, output_path)
+
 @watermark_bp.route('/process', methods=['POST'])
 def process_images():
     """
@@ -24,23 +237,26 @@ def process_images():
     
     Expects:
     - files: Image files to process
+    - upload_ids: Finalized resumable upload ids (instead of or in addition to files)
     - watermark_type: 'text' or 'image'
     - watermark_text: Text to use as watermark (if type is 'text')
     - watermark_image: Image file to use as watermark (if type is 'image')
     - position: 'center', 'top_left', 'top_right', 'bottom_left', 'bottom_right'
     - opacity: Watermark opacity (0-100)
     - size: Watermark size percentage (1-100)
-    - output_format: Output format (jpeg, png, tiff)
+    - output_format: Output format (jpeg, png, tiff, webp, avif, heic, bmp)
+    - encoder_profile: Encoder profile (default, web-small, archive, lossless)
     
     Returns:
     - JSON response with status and download URL
     """
-    # Check if files were uploaded
-    if 'files[]' not in request.files:
+    # Check if files were uploaded (inline or through /api/uploads)
+    upload_ids = request.form.getlist('upload_ids[]')
+    if 'files[]' not in request.files and not upload_ids:
         return jsonify({'error': 'No files provided'}), 400
     
     files = request.files.getlist('files[]')
-    if not files or files[0].filename == '':
+    if not upload_ids and (not files or files[0].filename == ''):
         return jsonify({'error': 'No files selected'}), 400
     
     # Get watermark parameters
@@ -60,38 +276,57 @@ def process_images():
     except ValueError:
         return jsonify({'error': 'Invalid numeric parameters'}), 400
     
-    # Get output format
-    output_format = request.form.get('output_format', 'jpeg').lower()
-    if output_format not in ['jpeg', 'png', 'tiff']:
-        output_format = 'jpeg'
+    # Get output format and encoder profile
+    try:
+        output_format, encoder_profile = encoders.resolve(request.form.get('output_format'), request.form.get('encoder_profile'))
+    except encoders.EncoderError as e:
+        return jsonify({'error': 'Unsupported output options', 'details': str(e)}), 400
     
     # Create a unique session ID for this batch
     session_id = str(uuid.uuid4())
-    upload_folder = os.path.join(current_app.config['UPLOAD_FOLDER'], session_id)
-    processed_folder = os.path.join(current_app.config['PROCESSED_FOLDER'], session_id)
+    workspace = scratch.open_session(session_id)
+    upload_folder, processed_folder = workspace.upload_folder, workspace.processed_folder
     
     os.makedirs(upload_folder, exist_ok=True)
     os.makedirs(processed_folder, exist_ok=True)
     
     # Save uploaded files
     saved_files = []
-    for file in files:
-        if file and allowed_file(file.filename):
-            filename = secure_filename(file.filename)
-            file_path = os.path.join(upload_folder, filename)
-            file.save(file_path)
-            saved_files.append(file_path)
+    with metrics.stage_timer('watermark', 'upload_save'):
+        for file in files:
+            if file and allowed_file(file.filename):
+                file_path = workspace.save_upload(file, secure_filename(file.filename))
+                metrics.count_bytes('watermark', 'in', metrics.file_size(file_path))
+                saved_files.append(file_path)
+
+    # Files sent ahead through the resumable upload API
+    try:
+        claimed = uploads.claim_uploads(upload_ids, upload_folder)
+    except uploads.UploadError as e:
+        shutil.rmtree(upload_folder, ignore_errors=True)
+        shutil.rmtree(processed_folder, ignore_errors=True)
+        return jsonify({'error': e.message, 'details': e.details}), e.status
+    for item in claimed:
+        metrics.count_bytes('watermark', 'in', metrics.file_size(item['path']))
+        saved_files.append(item['path'])
     
     if not saved_files:
         return jsonify({'error': 'No valid image files provided'}), 400
+
+    # Reserve memory for the largest decode before touching any pixels
+    try:
+        reservation = admission.admit(current_app, saved_files, 'watermark')
+    except admission.AdmissionError as e:
+        shutil.rmtree(upload_folder, ignore_errors=True)
+        shutil.rmtree(processed_folder, ignore_errors=True)
+        return admission.error_response(e)
     
     # Handle watermark image if provided
     watermark_img = None
     if watermark_type == 'image' and 'watermark_image' in request.files:
         wm_file = request.files['watermark_image']
         if wm_file and allowed_file(wm_file.filename):
-            wm_path = os.path.join(upload_folder, 'watermark_' + secure_filename(wm_file.filename))
-            wm_file.save(wm_path)
+            wm_path = workspace.save_upload(wm_file, 'watermark_' + secure_filename(wm_file.filename))
             try:
                 watermark_img = Image.open(wm_path).convert('RGBA')
             except Exception as e:
@@ -100,188 +335,108 @@ def process_images():
     
     # Process files
     processed_files = []
+    size_reports = []
     
     for file_path in saved_files:
         try:
-            # Register HEIF opener if needed
-            if file_path.lower().endswith(('.heic', '.heif')):
-                try:
-                    import pillow_heif
-                    pillow_heif.register_heif_opener()
-                except ImportError:
-                    return jsonify({'error': 'HEIF/HEIC support not available'}), 500
+            # HEIF/HEIC files need pillow_heif (its opener is registered once at startup)
+            if heif.is_heif(file_path) and not heif.register_opener():
+                return jsonify({'error': 'HEIF/HEIC support not available'}), 500
             
-            # Open image
-            with Image.open(file_path) as img:
-                # Convert to RGBA for watermarking
-                if img.mode != 'RGBA':
-                    img = img.convert('RGBA')
-                
-                # Create watermark layer
-                watermark_layer = Image.new('RGBA', img.size, (0, 0, 0, 0))
-                
-                if watermark_type == 'text' and watermark_text:
-                    # Create text watermark
-                    draw = ImageDraw.Draw(watermark_layer)
-                    
-                    # Try to load a font, fall back to default if not available
-                    try:
-                        # Calculate font size based on image dimensions and size parameter
-                        font_size = int(min(img.width, img.height) * size / 100)
-                        font = ImageFont.truetype("Arial", font_size)
-                    except IOError:
-                        # Use default font
-                        font = ImageFont.load_default()
-                    
-                    # Get text size
-                    text_width, text_height = draw.textsize(watermark_text, font=font)
-                    
-                    # Calculate position
-                    if position == 'center':
-                        x = (img.width - text_width) // 2
-                        y = (img.height - text_height) // 2
-                    elif position == 'top_left':
-                        x, y = 10, 10
-                    elif position == 'top_right':
-                        x, y = img.width - text_width - 10, 10
-                    elif position == 'bottom_left':
-                        x, y = 10, img.height - text_height - 10
-                    else:  # bottom_right
-                        x, y = img.width - text_width - 10, img.height - text_height - 10
-                    
-                    # Draw text with shadow for better visibility
-                    draw.text((x+2, y+2), watermark_text, font=font, fill=(0, 0, 0, int(255 * opacity / 100)))
-                    draw.text((x, y), watermark_text, font=font, fill=(255, 255, 255, int(255 * opacity / 100)))
-                
-                elif watermark_type == 'image' and watermark_img:
-                    # Resize watermark image based on size parameter
-                    wm_width = int(img.width * size / 100)
-                    wm_height = int(watermark_img.height * wm_width / watermark_img.width)
-                    
-                    # Ensure watermark isn't larger than the image
-                    if wm_width > img.width:
-                        wm_width = img.width
-                        wm_height = int(watermark_img.height * wm_width / watermark_img.width)
-                    if wm_height > img.height:
-                        wm_height = img.height
-                        wm_width = int(watermark_img.width * wm_height / watermark_img.height)
-                    
-                    resized_wm = watermark_img.resize((wm_width, wm_height), Image.LANCZOS)
-                    
-                    # Apply opacity
-                    if opacity < 100:
-                        alpha = resized_wm.split()[3]
-                        alpha = alpha.point(lambda p: p * opacity / 100)
-                        resized_wm.putalpha(alpha)
-                    
-                    # Calculate position
-                    if position == 'center':
-                        x = (img.width - wm_width) // 2
-                        y = (img.height - wm_height) // 2
-                    elif position == 'top_left':
-                        x, y = 10, 10
-                    elif position == 'top_right':
-                        x, y = img.width - wm_width - 10, 10
-                    elif position == 'bottom_left':
-                        x, y = 10, img.height - wm_height - 10
-                    else:  # bottom_right
-                        x, y = img.width - wm_width - 10, img.height - wm_height - 10
-                    
-                    # Paste watermark onto layer
-                    watermark_layer.paste(resized_wm, (x, y), resized_wm)
-                
-                # Composite the watermark layer with the original image
-                watermarked_img = Image.alpha_composite(img, watermark_layer)
-                
-                # Convert back to RGB if saving as JPEG
-                if output_format.lower() in ["jpeg", "jpg"]:
-                    watermarked_img = watermarked_img.convert("RGB")
-                
-                # Save watermarked image
-                base_name = os.path.splitext(os.path.basename(file_path))[0]
-                output_path = os.path.join(processed_folder, f"{base_name}.{output_format}")
-                watermarked_img.save(output_path, output_format.upper())
-                processed_files.append(output_path)
+            base_name = os.path.splitext(os.path.basename(file_path))[0]
+            output_path = os.path.join(processed_folder, f"{base_name}.{output_format}")
+            size_reports.append(watermark_file(file_path, output_path, output_format, watermark_type, watermark_text,
+                                               watermark_img, position, opacity, size, encoder_profile))
+            processed_files.append(output_path)
                 
         except Exception as e:
             print(f"Error processing {file_path}: {str(e)}")
     
+    reservation.release()
+
+    metrics.count_files('watermark', 'processed', len(processed_files))
+    metrics.count_files('watermark', 'failed', len(saved_files) - len(processed_files))
+
     if not processed_files:
         return jsonify({'error': 'Failed to process any files'}), 500
     
+    store = storage.get_storage()
+
     # Create a zip file if multiple files were processed
     if len(processed_files) > 1:
         zip_filename = f"watermarked_images_{session_id}.zip"
-        zip_path = os.path.join(processed_folder, zip_filename)
         
-        with zipfile.ZipFile(zip_path, 'w') as zipf:
-            for file in processed_files:
-                zipf.write(file, os.path.basename(file))
+        # The archive is streamed straight to storage
+        with metrics.stage_timer('watermark', 'zip'):
+            with store.open_write(storage.processed_key(session_id, zip_filename)) as fp:
+                with zipfile.ZipFile(fp, 'w') as zipf:
+                    for file in processed_files:
+                        zipf.write(file, os.path.basename(file))
+        store.discard_scratch(upload_folder, processed_folder)
         
         return jsonify({
             'status': 'success',
             'message': f'Successfully watermarked {len(processed_files)} images',
             'download_url': f'/api/watermark/download/{session_id}/zip',
-            'file_count': len(processed_files)
+            'file_count': len(processed_files),
+            'size_report': {'files': size_reports, 'total': encoders.summarize(size_reports)}
         })
     else:
         # Single file
+        with metrics.stage_timer('watermark', 'publish'):
+            store.publish(processed_files[0], storage.processed_key(session_id, os.path.basename(processed_files[0])))
+        store.discard_scratch(upload_folder, processed_folder)
         return jsonify({
             'status': 'success',
             'message': 'Successfully watermarked image',
             'download_url': f'/api/watermark/download/{session_id}/single',
-            'file_count': 1
+            'file_count': 1,
+            'size_report': {'files': size_reports, 'total': encoders.summarize(size_reports)}
         })
 
 @watermark_bp.route('/download/<session_id>/zip', methods=['GET'])
 def download_zip(session_id):
     """Download processed images as a zip file."""
-    processed_folder = os.path.join(current_app.config['PROCESSED_FOLDER'], session_id)
-    zip_path = os.path.join(processed_folder, f"watermarked_images_{session_id}.zip")
-    
-    if not os.path.exists(zip_path):
-        return jsonify({'error': 'Zip file not found'}), 404
-    
-    return send_file(
-        zip_path,
-        as_attachment=True,
+    return storage.send_stored(
+        storage.processed_key(session_id, f"watermarked_images_{session_id}.zip"),
         download_name=f"watermarked_images.zip",
-        mimetype='application/zip'
+        mimetype='application/zip',
+        missing='Zip file not found'
     )
 
 @watermark_bp.route('/download/<session_id>/single', methods=['GET'])
 def download_single(session_id):
     """Download a single processed image."""
-    processed_folder = os.path.join(current_app.config['PROCESSED_FOLDER'], session_id)
+    store = storage.get_storage()
     
-    # Find the first file in the processed folder
-    files = os.listdir(processed_folder)
-    image_files = [f for f in files if f.lower().endswith(('.png', '.jpg', '.jpeg', '.tiff', '.tif'))]
+    # Find the first image published for the session
+    files = store.list(storage.processed_key(session_id))
+    image_files = [f for f in files if f.lower().endswith(encoders.OUTPUT_EXTENSIONS)]
     
     if not image_files:
         return jsonify({'error': 'Processed image not found'}), 404
     
-    file_path = os.path.join(processed_folder, image_files[0])
-    
-    return send_file(
-        file_path,
-        as_attachment=True,
-        download_name=image_files[0],
+    return store.send_download(
+        storage.processed_key(session_id, image_files[0]),
+        download_name=os.path.basename(image_files[0]),
         mimetype=f'image/{os.path.splitext(image_files[0])[1][1:].lower()}'
     )
 
 @watermark_bp.route('/cleanup/<session_id>', methods=['POST'])
 def cleanup_session(session_id):
     """Clean up temporary files for a session."""
-    upload_folder = os.path.join(current_app.config['UPLOAD_FOLDER'], session_id)
-    processed_folder = os.path.join(current_app.config['PROCESSED_FOLDER'], session_id)
+    upload_folder, processed_folder = scratch.session_folders(session_id)
     
-    # Clean up upload folder
-    if os.path.exists(upload_folder):
-        shutil.rmtree(upload_folder)
-    
-    # Clean up processed folder
-    if os.path.exists(processed_folder):
-        shutil.rmtree(processed_folder)
+    with metrics.stage_timer('watermark', 'cleanup'):
+        # Clean up upload folder
+        if os.path.exists(upload_folder):
+            shutil.rmtree(upload_folder)
+        
+        # Clean up processed folder
+        if os.path.exists(processed_folder):
+            shutil.rmtree(processed_folder)
+
+        # Remove published outputs (a no-op for local storage, where they were the processed folder)
+        storage.get_storage().delete_prefix(storage.processed_key(session_id))
     
     return jsonify({'status': 'success', 'message': 'Session cleaned up'})
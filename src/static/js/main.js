@@ -15,7 +15,7 @@ let clientPresets = {
 let selectedGeotaggingFiles = [];
 
 // Global variable to store hierarchical city preset data
-let cityPresetsData = {};
+let selectedCityPreset = null; // Complete preset (with boundaries) chosen in the geotagging form
 
 document.addEventListener('DOMContentLoaded', function() {
     // Initialize Bootstrap components
@@ -254,6 +254,62 @@ function formatFileSize(bytes) {
     return parseFloat((bytes / Math.pow(k, i)).toFixed(2)) + ' ' + sizes[i];
 }
 
+// Batches larger than this are sent through the resumable upload API (/api/uploads)
+const RESUMABLE_UPLOAD_THRESHOLD = 256 * 1024 * 1024;
+const RESUMABLE_UPLOAD_RETRIES = 5;
+
+// Send one file in chunks; after a dropped connection only the missing bytes are resent
+async function uploadResumable(file, relativePath, onProgress) {
+    const createResponse = await fetch('/api/uploads', {
+        method: 'POST',
+        headers: { 'Content-Type': 'application/json' },
+        body: JSON.stringify({ filename: file.name, length: file.size, relative_path: relativePath })
+    });
+    const upload = await createResponse.json();
+    if (!createResponse.ok) {
+        throw new Error(upload.details || upload.error);
+    }
+
+    let offset = 0;
+    let retries = 0;
+    while (offset < file.size) {
+        const end = Math.min(offset + upload.chunk_size, file.size);
+        try {
+            const response = await fetch(`/api/uploads/${upload.upload_id}`, {
+                method: 'PUT',
+                headers: { 'Upload-Offset': String(offset) },
+                body: file.slice(offset, end)
+            });
+            if (!response.ok) {
+                const result = await response.json().catch(() => ({}));
+                const message = result.details || result.error || `Chunk upload failed (${response.status})`;
+                // 400 means the chunk was cut short and 5xx may be transient; both are retried
+                throw Object.assign(new Error(message), { fatal: response.status > 400 && response.status < 500 });
+            }
+            offset = parseInt(response.headers.get('Upload-Offset'), 10);
+            retries = 0;
+        } catch (error) {
+            if (error.fatal || ++retries > RESUMABLE_UPLOAD_RETRIES) {
+                throw error;
+            }
+            // Ask the server how much arrived before resuming
+            await new Promise(resolve => setTimeout(resolve, 1000 * retries));
+            const head = await fetch(`/api/uploads/${upload.upload_id}`, { method: 'HEAD' }).catch(() => null);
+            if (head && head.ok) {
+                offset = parseInt(head.headers.get('Upload-Offset'), 10);
+            }
+        }
+        onProgress(offset);
+    }
+
+    const finalizeResponse = await fetch(`/api/uploads/${upload.upload_id}/finalize`, { method: 'POST' });
+    if (!finalizeResponse.ok) {
+        const result = await finalizeResponse.json();
+        throw new Error(result.details || result.error);
+    }
+    return upload.upload_id;
+}
+
 // Initialize form handlers
 function initializeFormHandlers() {
     // Geotagging form
@@ -294,10 +350,13 @@ function initializeGeotaggingForm() {
         
         const latitudeInput = document.getElementById('latitude');
         const longitudeInput = document.getElementById('longitude');
+        selectedCityPreset = null;
 
-        if (selectedCityId && selectedCountry && selectedState && cityPresetsData[selectedCountry] && cityPresetsData[selectedCountry][selectedState]) {
-            const selectedCity = cityPresetsData[selectedCountry][selectedState].find(city => city.id === selectedCityId);
-            if (selectedCity) {
+        if (selectedCityId && selectedCountry && selectedState) {
+            // Only names are loaded for the dropdown; fetch the full preset on selection
+            fetchCityPreset(selectedCountry, selectedState, selectedCityId).then(selectedCity => {
+                if (cityPresetSelect.value !== selectedCityId) return; // Selection changed meanwhile
+                selectedCityPreset = selectedCity;
                 latitudeInput.value = selectedCity.center.lat.toFixed(6);
                 longitudeInput.value = selectedCity.center.lng.toFixed(6);
                 // Automatically enable random coordinates when a city preset is selected
@@ -306,7 +365,7 @@ function initializeGeotaggingForm() {
                 if (document.getElementById('sublocation')) {
                     document.getElementById('sublocation').value = selectedCity.sublocation || '';
                 }
-            }
+            }).catch(error => console.error('Error loading city preset:', error));
         } else {
             // If no city preset is selected, clear coordinates and disable random coordinates
             latitudeInput.value = '';
@@ -319,6 +378,7 @@ function initializeGeotaggingForm() {
     cityPresetCountrySelect.addEventListener('change', function() {
         loadStatesForCityPresets(this.value);
         // Reset city and coordinates when country changes
+        selectedCityPreset = null;
         document.getElementById('city-preset').value = '';
         document.getElementById('latitude').value = '';
         document.getElementById('longitude').value = '';
@@ -329,6 +389,7 @@ function initializeGeotaggingForm() {
     cityPresetStateProvinceSelect.addEventListener('change', function() {
         loadCitiesForCityPresets(cityPresetCountrySelect.value, this.value);
         // Reset city and coordinates when state/province changes
+        selectedCityPreset = null;
         document.getElementById('city-preset').value = '';
         document.getElementById('latitude').value = '';
         document.getElementById('longitude').value = '';
@@ -368,11 +429,34 @@ function initializeGeotaggingForm() {
 
         const formData = new FormData();
 
-        // Append files and their original paths
-        selectedGeotaggingFiles.forEach(item => {
-            formData.append('files[]', item.file);
-            formData.append('file_paths[]', item.path);
-        });
+        const totalSize = selectedGeotaggingFiles.reduce((sum, item) => sum + item.file.size, 0);
+        if (totalSize > RESUMABLE_UPLOAD_THRESHOLD) {
+            // Large batch: upload each file in resumable chunks, then process by upload id
+            const progressBar = document.getElementById('progress-bar');
+            let uploadedBefore = 0;
+            try {
+                for (const item of selectedGeotaggingFiles) {
+                    const uploadId = await uploadResumable(item.file, item.path, offset => {
+                        const percentComplete = ((uploadedBefore + offset) / totalSize) * 100;
+                        progressBar.style.width = percentComplete + '%';
+                        progressBar.textContent = Math.round(percentComplete) + '%';
+                    });
+                    uploadedBefore += item.file.size;
+                    formData.append('upload_ids[]', uploadId);
+                }
+            } catch (error) {
+                console.error('Resumable upload failed:', error);
+                showAlert('Error', `Uploading the files failed: ${error.message}`);
+                progressContainer.classList.add('d-none');
+                return;
+            }
+        } else {
+            // Append files and their original paths
+            selectedGeotaggingFiles.forEach(item => {
+                formData.append('files[]', item.file);
+                formData.append('file_paths[]', item.path);
+            });
+        }
 
         // Collect EXIF data
         const exifData = {};
@@ -384,7 +468,7 @@ function initializeGeotaggingForm() {
         }
         let selectedCity = null;
         if (cityPresetSelect.value) {
-            selectedCity = findCityPreset(cityPresetSelect.value);
+            selectedCity = selectedCityPreset && selectedCityPreset.id === cityPresetSelect.value ? selectedCityPreset : null;
             exifData.preset = selectedCity;
             if (selectedCity && selectedCity.name) {
                 exifData.CityDisplayName = selectedCity.name;
@@ -423,6 +507,19 @@ function initializeGeotaggingForm() {
 
         formData.append('exif_data', JSON.stringify(exifData));
         formData.append('output_format', document.getElementById('output-format').value);
+        formData.append('reconcile', document.getElementById('reconcile-mode').value);
+        if (document.getElementById('keep-heic').checked) {
+            formData.append('keep_heic', 'true');
+        }
+        const manifestFile = document.getElementById('manifest-file').files[0];
+        if (manifestFile) {
+            formData.append('manifest', manifestFile);
+        }
+        for (const trackFile of document.getElementById('track-files').files) {
+            formData.append('track_files[]', trackFile);
+        }
+        formData.append('track_time_offset', document.getElementById('track-time-offset').value);
+        formData.append('track_max_gap', document.getElementById('track-max-gap').value);
 
         try {
             const xhr = new XMLHttpRequest();
@@ -465,7 +562,18 @@ function initializeGeotaggingForm() {
                         }, 1000);
 
                         // Show success message
-                        document.getElementById('success-message').textContent = response.message;
+                        let successText = response.message;
+                        if (response.reconcile_report && response.reconcile_report.skipped) {
+                            successText += ` (${response.reconcile_report.skipped} already up to date)`;
+                        }
+                        if (response.track_report) {
+                            successText += ` (${response.track_report.matched} placed from the track log`;
+                            if (response.track_report.unmatched.length) {
+                                successText += `, ${response.track_report.unmatched.length} outside it`;
+                            }
+                            successText += ')';
+                        }
+                        document.getElementById('success-message').textContent = successText;
                         document.getElementById('results-card').classList.remove('d-none');
                         
                         // Set download link
@@ -646,6 +754,12 @@ function initializeConversionForm() {
         
         // Add output format
         formData.append('output_format', document.getElementById('conversion-output-format').value);
+        formData.append('encoder_profile', document.getElementById('conversion-encoder-profile').value);
+        const targetSize = document.getElementById('conversion-target-size').value.trim();
+        if (targetSize) {
+            formData.append('target_size', targetSize);
+            formData.append('allow_downscale', document.getElementById('conversion-allow-downscale').checked ? 'true' : 'false');
+        }
         
         // Show progress
         const progressContainer = document.getElementById('conversion-progress-container');
@@ -787,6 +901,12 @@ function initializeResizingForm() {
         
         // Add output format
         formData.append('output_format', document.getElementById('resizing-output-format').value);
+        formData.append('encoder_profile', document.getElementById('resizing-encoder-profile').value);
+        const targetSize = document.getElementById('resizing-target-size').value.trim();
+        if (targetSize) {
+            formData.append('target_size', targetSize);
+            formData.append('allow_downscale', document.getElementById('resizing-allow-downscale').checked ? 'true' : 'false');
+        }
         
         // Show progress
         const progressContainer = document.getElementById('resizing-progress-container');
@@ -952,6 +1072,7 @@ function initializeWatermarkForm() {
         
         // Add output format
         formData.append('output_format', document.getElementById('watermark-output-format').value);
+        formData.append('encoder_profile', document.getElementById('watermark-encoder-profile').value);
         
         // Show progress
         const progressContainer = document.getElementById('watermark-progress-container');
@@ -1062,6 +1183,8 @@ function initializeCityPresetManager() {
         // Reset form
         form.reset();
         document.getElementById('city-preset-id').value = '';
+        delete form.dataset.originalCountry;
+        delete form.dataset.originalStateProvince;
         document.getElementById('city-preset-modal-title').textContent = 'Add City Preset';
         
         // Show modal
@@ -1080,6 +1203,7 @@ function initializeCityPresetManager() {
         const id = document.getElementById('city-preset-id').value || generateId(document.getElementById('city-preset-name').value);
         const name = document.getElementById('city-preset-name').value;
         const country = document.getElementById('city-preset-country').value;
+        const stateProvince = document.getElementById('city-preset-state-province').value;
         const centerLat = parseFloat(document.getElementById('city-preset-center-lat').value);
         const centerLng = parseFloat(document.getElementById('city-preset-center-lng').value);
         const topLeftLat = parseFloat(document.getElementById('city-preset-top-left-lat').value);
@@ -1096,7 +1220,6 @@ function initializeCityPresetManager() {
         const preset = {
             id,
             name,
-            country,
             center: {
                 lat: centerLat,
                 lng: centerLng
@@ -1122,19 +1245,18 @@ function initializeCityPresetManager() {
             zoom_level: zoomLevel
         };
         
-        // Check if preset already exists
-        const existingIndex = cityPresets.presets.findIndex(p => p.id === id);
-        
-        if (existingIndex !== -1) {
-            // Update existing preset
-            cityPresets.presets[existingIndex] = preset;
-        } else {
-            // Add new preset
-            cityPresets.presets.push(preset);
-        }
-        
-        // Save presets
-        saveCityPresets();
+        // Save just this preset; an edit that moves it to another country or state removes the old entry
+        const originalCountry = form.dataset.originalCountry;
+        const originalStateProvince = form.dataset.originalStateProvince;
+        const moved = originalCountry !== undefined &&
+            (originalCountry !== country || originalStateProvince !== stateProvince);
+        saveCityPreset(country, stateProvince, preset)
+            .then(() => moved ? removeCityPreset(id, originalStateProvince, originalCountry) : null)
+            .then(() => loadCityPresets())
+            .catch(error => {
+                console.error('Error saving city preset:', error);
+                showAlert('Error', error.message || 'Failed to save city preset.');
+            });
         
         // Hide modal
         modal.hide();
@@ -1200,19 +1322,22 @@ function initializeClientPresetManager() {
         if (url) preset.url = url;
         if (keywords) preset.keywords = keywords.split(',').map(k => k.trim()).filter(k => k);
         
-        // Check if preset already exists
-        const existingIndex = clientPresets.presets.findIndex(p => p.id === id);
-        
-        if (existingIndex !== -1) {
-            // Update existing preset
-            clientPresets.presets[existingIndex] = preset;
-        } else {
-            // Add new preset
-            clientPresets.presets.push(preset);
-        }
-        
-        // Save presets
-        saveClientPresets();
+        // Save just this preset
+        sendPresetChange(`/api/presets/client/${encodeURIComponent(id)}`, 'PUT', preset)
+            .then(data => {
+                const existingIndex = clientPresets.presets.findIndex(p => p.id === id);
+                if (existingIndex !== -1) {
+                    clientPresets.presets[existingIndex] = data.preset;
+                } else {
+                    clientPresets.presets.push(data.preset);
+                }
+                updateClientPresetSelects();
+                updateClientPresetsTable();
+            })
+            .catch(error => {
+                console.error('Error saving client preset:', error);
+                showAlert('Error', error.message || 'Failed to save client preset.');
+            });
         
         // Hide modal
         modal.hide();
@@ -1224,21 +1349,56 @@ function generateId(name) {
     return name.toLowerCase().replace(/[^a-z0-9]+/g, '_');
 }
 
+// URL of one city preset in the presets API
+function cityPresetUrl(country, stateProvince, id) {
+    return `/api/presets/city/${encodeURIComponent(country)}/${encodeURIComponent(stateProvince)}/${encodeURIComponent(id)}`;
+}
+
+// Fetch one complete city preset (with boundaries)
+async function fetchCityPreset(country, stateProvince, id) {
+    const response = await fetch(cityPresetUrl(country, stateProvince, id));
+    const data = await response.json();
+    if (!response.ok) {
+        throw new Error(data.details || data.error || 'Failed to load city preset.');
+    }
+    return data;
+}
+
+// Fetch one page of city presets from the catalog (see /api/presets/city/search)
+async function fetchCityPresetPage(params) {
+    const response = await fetch(`/api/presets/city/search?${new URLSearchParams(params)}`);
+    const data = await response.json();
+    if (!response.ok) {
+        throw new Error(data.details || data.error || 'Failed to load city presets.');
+    }
+    return data;
+}
+
+// Fetch every city preset matching params, following the page cursors
+async function fetchAllCityPresets(params) {
+    const presets = [];
+    let cursor = null;
+    do {
+        const page = await fetchCityPresetPage(cursor ? { ...params, limit: 1000, cursor } : { ...params, limit: 1000 });
+        presets.push(...page.presets);
+        cursor = page.next_cursor;
+    } while (cursor);
+    return presets;
+}
+
 // Load city presets (for geotagging form and presets manager)
 async function loadCityPresets() {
     try {
-        const response = await fetch('/api/presets/city');
+        const response = await fetch('/api/presets/city/countries');
         const data = await response.json();
-        cityPresetsData = data.countries; // Store the hierarchical data
 
-        // Populate country select in geotagging form
+        // Populate country select in geotagging form (already sorted by the server)
         const countrySelect = document.getElementById('cityPresetCountrySelect');
         countrySelect.innerHTML = '<option value="">Select Country</option>';
-        // Sort countries alphabetically
-        Object.keys(cityPresetsData).sort().forEach(country => {
+        data.countries.forEach(country => {
             const option = document.createElement('option');
-            option.value = country;
-            option.textContent = country;
+            option.value = country.name;
+            option.textContent = country.name;
             countrySelect.appendChild(option);
         });
 
@@ -1291,29 +1451,33 @@ function loadClientPresets() {
         });
 }
 
-// Save city presets
-function saveCityPresets() {
-    fetch('/api/presets/city', {
-        method: 'POST',
-        headers: {
-            'Content-Type': 'application/json'
-        },
-        body: JSON.stringify({ version: '2.0', countries: cityPresetsData }) // Send the full hierarchical object
-    })
-        .then(response => response.json())
-        .then(data => {
-            if (data.status === 'success') {
-                // After saving, re-populate all dropdowns and tables
-                loadCityPresets(); // This will refresh the geotagging page dropdowns too
-                updateCityPresetsTable();
-            } else {
-                showAlert('Error', data.error || 'Failed to save city presets.');
-            }
-        })
-        .catch(error => {
-            console.error('Error saving city presets:', error);
-            showAlert('Error', 'A network error occurred while saving city presets.');
-        });
+// Send a single-preset change (PUT, PATCH or DELETE) to the presets API
+async function sendPresetChange(url, method, preset) {
+    const options = { method, headers: {} };
+    if (preset !== undefined) {
+        options.headers['Content-Type'] = 'application/json';
+        options.body = JSON.stringify(preset);
+    }
+    const response = await fetch(url, options);
+    const data = await response.json();
+    if (!response.ok || data.status !== 'success') {
+        throw new Error(data.details || data.error || 'Failed to save preset.');
+    }
+    return data;
+}
+
+// Add or update one city preset
+function saveCityPreset(country, stateProvince, preset) {
+    return sendPresetChange(
+        `/api/presets/city/${encodeURIComponent(country)}/${encodeURIComponent(stateProvince)}/${encodeURIComponent(preset.id)}`,
+        'PUT', preset);
+}
+
+// Remove one city preset
+function removeCityPreset(id, stateProvinceName, countryName) {
+    return sendPresetChange(
+        `/api/presets/city/${encodeURIComponent(countryName)}/${encodeURIComponent(stateProvinceName)}/${encodeURIComponent(id)}`,
+        'DELETE');
 }
 
 // Save client presets
@@ -1353,17 +1517,6 @@ function updateCityPresetSelects() {
     // this function would need to be adapted or duplicated.
 }
 
-// Helper function to find a city preset by ID in the hierarchical data
-function findCityPreset(id) {
-    for (const country in cityPresetsData) {
-        for (const stateProvince in cityPresetsData[country]) {
-            const city = cityPresetsData[country][stateProvince].find(c => c.id === id);
-            if (city) return city;
-        }
-    }
-    return null;
-}
-
 // Update client preset selects
 function updateClientPresetSelects() {
     const selects = document.querySelectorAll('select#client-preset');
@@ -1390,44 +1543,33 @@ function updateClientPresetSelects() {
     });
 }
 
-// Update city presets table
-function updateCityPresetsTable() {
+// Rows per page in the city presets table; further pages are appended by the "Load more" button
+const CITY_PRESETS_PAGE_SIZE = 100;
+
+// Update city presets table, one page at a time (cursor: next page to append, or null to start over)
+async function updateCityPresetsTable(cursor = null) {
     const table = document.getElementById('city-presets-table');
     const tbody = table.querySelector('tbody');
     
-    // Clear table
-    tbody.innerHTML = '';
-    
-    // Create array of all entries for sorting
-    const allEntries = [];
-    for (const countryName in cityPresetsData) {
-        for (const stateProvinceName in cityPresetsData[countryName]) {
-            cityPresetsData[countryName][stateProvinceName].forEach(preset => {
-                allEntries.push({
-                    preset,
-                    countryName,
-                    stateProvinceName
-                });
-            });
-        }
+    let data;
+    try {
+        const params = { fields: 'id,name,country,state_province,center', limit: CITY_PRESETS_PAGE_SIZE };
+        data = await fetchCityPresetPage(cursor ? { ...params, cursor } : params);
+    } catch (error) {
+        console.error('Error loading city presets table:', error);
+        return;
     }
 
-    // Sort entries by country, state/province, and city name
-    allEntries.sort((a, b) => {
-        // First sort by country
-        const countryCompare = a.countryName.localeCompare(b.countryName);
-        if (countryCompare !== 0) return countryCompare;
-        
-        // Then by state/province
-        const stateCompare = a.stateProvinceName.localeCompare(b.stateProvinceName);
-        if (stateCompare !== 0) return stateCompare;
-        
-        // Finally by city name
-        return a.preset.name.localeCompare(b.preset.name);
-    });
+    // Clear table, or drop the previous page's "Load more" row
+    if (!cursor) {
+        tbody.innerHTML = '';
+    }
+    tbody.querySelectorAll('.load-more-row').forEach(row => row.remove());
 
-    // Add sorted rows to table
-    allEntries.forEach(({ preset, countryName, stateProvinceName }) => {
+    // Rows arrive sorted by country, state/province and city name
+    data.presets.forEach(preset => {
+        const countryName = preset.country;
+        const stateProvinceName = preset.state_province;
         const tr = document.createElement('tr');
         
         // Name
@@ -1475,6 +1617,21 @@ function updateCityPresetsTable() {
         
         tbody.appendChild(tr);
     });
+
+    // Further pages are loaded on demand
+    if (data.next_cursor) {
+        const tr = document.createElement('tr');
+        tr.className = 'load-more-row';
+        const td = document.createElement('td');
+        td.colSpan = 5;
+        const button = document.createElement('button');
+        button.className = 'btn btn-sm btn-outline-secondary';
+        button.textContent = 'Load more';
+        button.addEventListener('click', () => updateCityPresetsTable(data.next_cursor));
+        td.appendChild(button);
+        tr.appendChild(td);
+        tbody.appendChild(tr);
+    }
 }
 
 // Update client presets table
@@ -1545,12 +1702,24 @@ function updateClientPresetsTable() {
 }
 
 // Edit city preset
-function editCityPreset(preset, stateProvinceName, countryName) {
+async function editCityPreset(summary, stateProvinceName, countryName) {
+    // Table rows only carry a summary; fetch the boundaries
+    let preset;
+    try {
+        preset = await fetchCityPreset(countryName, stateProvinceName, summary.id);
+    } catch (error) {
+        showAlert('Error', error.message);
+        return;
+    }
+
     // Set form values
     document.getElementById('city-preset-id').value = preset.id;
     document.getElementById('city-preset-name').value = preset.name;
     document.getElementById('city-preset-country').value = countryName;
     document.getElementById('city-preset-state-province').value = stateProvinceName;
+    const form = document.getElementById('city-preset-form');
+    form.dataset.originalCountry = countryName;
+    form.dataset.originalStateProvince = stateProvinceName;
     document.getElementById('city-preset-center-lat').value = preset.center.lat;
     document.getElementById('city-preset-center-lng').value = preset.center.lng;
     document.getElementById('city-preset-top-left-lat').value = preset.boundaries.top_left.lat;
@@ -1574,23 +1743,13 @@ function editCityPreset(preset, stateProvinceName, countryName) {
 // Delete city preset
 function deleteCityPreset(id, stateProvinceName, countryName) {
     if (confirm('Are you sure you want to delete this city preset?')) {
-        // Find and remove the preset from the hierarchical data
-        if (cityPresetsData[countryName] && cityPresetsData[countryName][stateProvinceName]) {
-            cityPresetsData[countryName][stateProvinceName] = cityPresetsData[countryName][stateProvinceName].filter(p => p.id !== id);
-            
-            // Clean up empty state/province arrays
-            if (cityPresetsData[countryName][stateProvinceName].length === 0) {
-                delete cityPresetsData[countryName][stateProvinceName];
-            }
-            
-            // Clean up empty country objects
-            if (Object.keys(cityPresetsData[countryName]).length === 0) {
-                delete cityPresetsData[countryName];
-            }
-        }
-        
-        // Save presets
-        saveCityPresets();
+        // Remove just this preset; the server drops empty states and countries
+        removeCityPreset(id, stateProvinceName, countryName)
+            .then(() => loadCityPresets())
+            .catch(error => {
+                console.error('Error deleting city preset:', error);
+                showAlert('Error', error.message || 'Failed to delete city preset.');
+            });
     }
 }
 
@@ -1622,11 +1781,17 @@ function editClientPreset(preset) {
 // Delete client preset
 function deleteClientPreset(id) {
     if (confirm('Are you sure you want to delete this client preset?')) {
-        // Remove preset
-        clientPresets.presets = clientPresets.presets.filter(p => p.id !== id);
-        
-        // Save presets
-        saveClientPresets();
+        // Remove just this preset
+        sendPresetChange(`/api/presets/client/${encodeURIComponent(id)}`, 'DELETE')
+            .then(() => {
+                clientPresets.presets = clientPresets.presets.filter(p => p.id !== id);
+                updateClientPresetSelects();
+                updateClientPresetsTable();
+            })
+            .catch(error => {
+                console.error('Error deleting client preset:', error);
+                showAlert('Error', error.message || 'Failed to delete client preset.');
+            });
     }
 }
 
@@ -1640,7 +1805,7 @@ function showAlert(title, message) {
 }
 
 // Function to load states/provinces for a given country
-function loadStatesForCityPresets(country) {
+async function loadStatesForCityPresets(country) {
     const stateProvinceSelect = document.getElementById('cityPresetStateProvinceSelect');
     const cityPresetSelect = document.getElementById('city-preset');
 
@@ -1649,35 +1814,44 @@ function loadStatesForCityPresets(country) {
     stateProvinceSelect.disabled = true;
     cityPresetSelect.disabled = true;
 
-    if (country && cityPresetsData[country]) {
-        // Sort states/provinces alphabetically
-        Object.keys(cityPresetsData[country]).sort().forEach(state => {
-            const option = document.createElement('option');
-            option.value = state;
-            option.textContent = state;
-            stateProvinceSelect.appendChild(option);
-        });
-        stateProvinceSelect.disabled = false;
+    if (country) {
+        try {
+            const response = await fetch(`/api/presets/city/countries/${encodeURIComponent(country)}/states`);
+            const data = await response.json();
+            // Sorted by the server
+            data.states.forEach(state => {
+                const option = document.createElement('option');
+                option.value = state.name;
+                option.textContent = state.name;
+                stateProvinceSelect.appendChild(option);
+            });
+            stateProvinceSelect.disabled = false;
+        } catch (error) {
+            console.error('Error loading states/provinces:', error);
+        }
     }
 }
 
 // Function to load cities for a given country and state/province
-function loadCitiesForCityPresets(country, stateProvince) {
+async function loadCitiesForCityPresets(country, stateProvince) {
     const cityPresetSelect = document.getElementById('city-preset');
 
     cityPresetSelect.innerHTML = '<option value="">Select a city preset</option>';
     cityPresetSelect.disabled = true;
 
-    if (country && stateProvince && cityPresetsData[country] && cityPresetsData[country][stateProvince]) {
-        // Sort cities alphabetically
-        [...cityPresetsData[country][stateProvince]]
-            .sort((a, b) => a.name.localeCompare(b.name))
-            .forEach(city => {
+    if (country && stateProvince) {
+        try {
+            // Ids and names only, sorted by name by the server
+            const cities = await fetchAllCityPresets({ country, state_province: stateProvince, fields: 'id,name' });
+            cities.forEach(city => {
                 const option = document.createElement('option');
                 option.value = city.id;
                 option.textContent = city.name;
                 cityPresetSelect.appendChild(option);
             });
-        cityPresetSelect.disabled = false;
+            cityPresetSelect.disabled = false;
+        } catch (error) {
+            console.error('Error loading cities:', error);
+        }
     }
 }
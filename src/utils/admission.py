@@ -0,0 +1,332 @@
+"""
+Memory-aware admission control for the image processing endpoints.
+
+Before a batch is decoded, every file's header is probed (no pixel data is
+read) to estimate how much memory decoding and processing it will take. The
+batch then reserves its largest per-file footprint, because files are processed
+one after another, against a memory budget that is shared by every worker on
+the host. If the budget is exhausted the request waits up to
+ADMISSION_QUEUE_TIMEOUT seconds for other batches to finish. After that it is
+rejected with 429 and a Retry-After header.
+
+The shared ledger is a small JSON file protected with flock(). Reservations
+held by processes that no longer exist are dropped automatically. On platforms
+without fcntl the ledger falls back to a per-process one.
+
+Config keys (all optional, environment variables of the same name override the defaults):
+- ADMISSION_MEMORY_BUDGET: bytes that may be reserved host-wide (default: half of physical RAM)
+- ADMISSION_QUEUE_TIMEOUT: seconds a request may wait for budget (default: 30)
+- ADMISSION_LEDGER_PATH: ledger file (default: <tmp>/image_processor_admission.json)
+- MAX_IMAGE_PIXELS: decompression-bomb limit per image (default: ~179 MP, the size Pillow refuses to open)
+"""
+from flask import jsonify, g
+from PIL import Image
+from src.utils import largeimage, heif
+import os
+import json
+import time
+import uuid
+import tempfile
+import threading
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+DEFAULT_QUEUE_TIMEOUT = 30  # seconds
+DEFAULT_RETRY_AFTER = 5  # seconds
+FALLBACK_MEMORY_BUDGET = 2 * 1024 * 1024 * 1024  # used when physical RAM cannot be determined
+POLL_INTERVAL = 0.2  # seconds between budget checks while queued
+DEFAULT_MAX_IMAGE_PIXELS = 2 * Image.MAX_IMAGE_PIXELS
+
+# Bytes per pixel Pillow uses in memory for each mode (multi-band 8-bit modes are stored as 32-bit pixels)
+MODE_BYTES_PER_PIXEL = {
+    '1': 1, 'L': 1, 'P': 1, 'LA': 4, 'PA': 4, 'La': 4,
+    'RGB': 4, 'RGBA': 4, 'RGBa': 4, 'RGBX': 4, 'CMYK': 4, 'YCbCr': 4, 'LAB': 4, 'HSV': 4,
+    'I': 4, 'F': 4, 'I;16': 2, 'I;16L': 2, 'I;16B': 2, 'I;16N': 2,
+}
+
+# Full-size frames alive at the same time while one file is processed, per blueprint
+WORKING_COPIES = {
+    'geotagging': 2,  # decoded frame + RGB copy for the temporary JPEG
+    'conversion': 2,  # decoded frame + mode conversion
+    'resizing': 2,    # decoded frame + resized output (sized from the requested dimensions)
+    'watermark': 4,   # decoded frame + RGBA copy + watermark layer + composite
+}
+DEFAULT_WORKING_COPIES = 2
+
+# Blueprints that switch to strip processing (src/utils/largeimage.py) for very large images
+LARGE_IMAGE_BLUEPRINTS = ('conversion', 'resizing', 'watermark')
+
+
+class AdmissionError(Exception):
+    """Raised when a batch cannot be admitted."""
+
+    def __init__(self, message, details, status=429, retry_after=None):
+        super().__init__(message)
+        self.message = message
+        self.details = details
+        self.status = status
+        self.retry_after = retry_after
+
+
+def physical_memory():
+    """Total physical memory in bytes, or None if it cannot be determined."""
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+def default_memory_budget():
+    """Half of physical memory, leaving the rest to the OS, gunicorn and ExifTool."""
+    total = physical_memory()
+    return total // 2 if total else FALLBACK_MEMORY_BUDGET
+
+
+def _config(app, key, default, cast=int):
+    value = os.environ.get(key)
+    if value is None:
+        value = app.config.get(key, default)
+    return cast(value) if value is not None else None
+
+
+def probe_image(path):
+    """
+    Read an image's dimensions and mode from its header without decoding pixels.
+
+    Returns:
+        tuple: (width, height, mode, strip_readable), or None if the file cannot be identified
+    """
+    if heif.is_heif(path) and not heif.register_opener():
+        return None
+    try:
+        with Image.open(path) as img:
+            return img.width, img.height, img.mode, largeimage.supports_strip_reads(img)
+    except Image.DecompressionBombError as e:
+        # Pillow refuses to even open images over twice its pixel limit
+        raise AdmissionError('Image too large', f"{os.path.basename(path)}: {e}", status=413)
+    except Exception:
+        return None
+
+
+def estimate_footprint(width, height, mode, blueprint, output_pixels=None):
+    """
+    Estimate the peak memory needed to process one image.
+
+    Args:
+        width (int): Image width in pixels
+        height (int): Image height in pixels
+        mode (str): Pillow image mode
+        blueprint (str): Processing blueprint (selects the number of working copies)
+        output_pixels (int): Pixels in the output when it differs from the input (resizing)
+
+    Returns:
+        int: Estimated bytes
+    """
+    pixels = width * height
+    decoded = pixels * MODE_BYTES_PER_PIXEL.get(mode, 4)
+    copies = WORKING_COPIES.get(blueprint, DEFAULT_WORKING_COPIES)
+    # Working copies after the decoded frame are 32-bit RGB(A); size them for the larger of input and output
+    working = max(pixels, output_pixels or 0) * 4
+    return decoded + working * (copies - 1)
+
+
+class MemoryLedger:
+    """
+    Host-wide record of memory reserved by running batches.
+
+    The ledger maps reservation tokens to {pid, bytes}. Every update happens
+    under an exclusive flock() on the ledger file, so all gunicorn workers
+    (and any other process pointed at the same file) share one budget.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = {}  # Used when fcntl is unavailable
+        self._local_lock = threading.Lock()
+
+    @contextmanager
+    def _locked(self):
+        if fcntl is None:
+            with self._local_lock:
+                yield self._local
+            return
+
+        with open(self.path, 'a+') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                f.seek(0)
+                try:
+                    entries = json.loads(f.read() or '{}')
+                except ValueError:
+                    entries = {}
+                yield entries
+                f.seek(0)
+                f.truncate()
+                json.dump(entries, f)
+                f.flush()
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    @staticmethod
+    def _prune(entries):
+        for token, entry in list(entries.items()):
+            try:
+                os.kill(entry['pid'], 0)
+            except ProcessLookupError:
+                del entries[token]  # The worker died without releasing
+            except PermissionError:
+                pass  # Alive, owned by another user
+
+    def try_reserve(self, token, nbytes, budget):
+        """Reserve `nbytes` (replacing what `token` held before) if they fit in `budget`. Returns True on success."""
+        with self._locked() as entries:
+            self._prune(entries)
+            others = [entry['bytes'] for other, entry in entries.items() if other != token]
+            # A batch always gets through on an idle host, even if its estimate exceeds the budget
+            if others and sum(others) + nbytes > budget:
+                return False
+            entries[token] = {'pid': os.getpid(), 'bytes': nbytes, 'since': time.time()}
+            return True
+
+    def release(self, token):
+        with self._locked() as entries:
+            entries.pop(token, None)
+
+    def tokens(self):
+        """Tokens of the reservations held by live processes."""
+        with self._locked() as entries:
+            self._prune(entries)
+            return set(entries)
+
+    def in_use(self):
+        with self._locked() as entries:
+            self._prune(entries)
+            return sum(entry['bytes'] for entry in entries.values())
+
+
+class Reservation:
+    """Memory held by one batch. Release it as soon as the batch stops decoding images."""
+
+    def __init__(self, ledger, token, nbytes):
+        self.ledger = ledger
+        self.token = token
+        self.nbytes = nbytes
+        self.released = False
+
+    def release(self):
+        if not self.released:
+            self.released = True
+            self.ledger.release(self.token)
+
+
+_ledgers = {}
+
+
+def get_ledger(app):
+    path = _config(app, 'ADMISSION_LEDGER_PATH',
+                   os.path.join(tempfile.gettempdir(), 'image_processor_admission.json'), cast=str)
+    if path not in _ledgers:
+        _ledgers[path] = MemoryLedger(path)
+    return _ledgers[path]
+
+
+def check_pixel_limit(path, width, height, max_pixels):
+    """Reject decompression bombs before anything is decoded."""
+    if max_pixels and width * height > max_pixels:
+        raise AdmissionError(
+            'Image too large',
+            f"{os.path.basename(path)} is {width}x{height} ({width * height:,} pixels); "
+            f"the limit is {max_pixels:,} pixels",
+            status=413,
+        )
+
+
+def admit(app, paths, blueprint, output_size=None, decodes=None):
+    """
+    Probe a batch, enforce the pixel limit and reserve memory for it.
+
+    The reservation is stored on flask.g and released at the end of the request
+    if the caller has not released it earlier.
+
+    Args:
+        app (Flask): Application (for configuration)
+        paths (list): Saved upload paths
+        blueprint (str): Processing blueprint name
+        output_size (callable): Maps (width, height) to the output size, for blueprints that resize
+        decodes (callable): Maps (path, mode) to whether the file's pixels are decoded at all
+
+    Returns:
+        Reservation: Release it once the batch is done decoding
+
+    Raises:
+        AdmissionError: 413 for decompression bombs, 429 when the budget stays exhausted
+    """
+    max_pixels = _config(app, 'MAX_IMAGE_PIXELS', DEFAULT_MAX_IMAGE_PIXELS)
+    footprint = 0
+    for path in paths:
+        probed = probe_image(path)
+        if probed is None:
+            continue  # Unreadable files fail later in the processing loop without decoding anything
+        width, height, mode, strip_readable = probed
+        out_width, out_height = output_size(width, height) if output_size else (width, height)
+
+        # Very large images are processed in strips and have their own, higher pixel limit
+        large = blueprint in LARGE_IMAGE_BLUEPRINTS and (
+            largeimage.is_large_image(width, height, app) or largeimage.is_large_image(out_width, out_height, app))
+        limit = largeimage.large_image_max_pixels(app) if large else max_pixels
+        check_pixel_limit(path, width, height, limit)
+        check_pixel_limit(path, out_width, out_height, limit)
+
+        if large:
+            footprint = max(footprint, largeimage.estimate_footprint(
+                max(width, out_width), height, MODE_BYTES_PER_PIXEL.get(mode, 4), strip_readable,
+                WORKING_COPIES.get(blueprint, DEFAULT_WORKING_COPIES), app))
+        elif not decodes or decodes(path, mode):
+            footprint = max(footprint, estimate_footprint(width, height, mode, blueprint, out_width * out_height))
+
+    budget = _config(app, 'ADMISSION_MEMORY_BUDGET', default_memory_budget())
+    timeout = _config(app, 'ADMISSION_QUEUE_TIMEOUT', DEFAULT_QUEUE_TIMEOUT, cast=float)
+    ledger = get_ledger(app)
+    token = f"{os.getpid()}:{uuid.uuid4()}"
+
+    deadline = time.monotonic() + timeout
+    while not ledger.try_reserve(token, footprint, budget):
+        if time.monotonic() >= deadline:
+            raise AdmissionError(
+                'Server busy',
+                'Not enough memory is available to process these images right now, please retry shortly',
+                retry_after=DEFAULT_RETRY_AFTER,
+            )
+        time.sleep(POLL_INTERVAL)
+
+    reservation = Reservation(ledger, token, footprint)
+    g.setdefault('admission_reservations', []).append(reservation)
+    return reservation
+
+
+def error_response(error):
+    """JSON error response for an AdmissionError, with Retry-After on 429."""
+    response = jsonify({'error': error.message, 'details': error.details})
+    response.status_code = error.status
+    if error.retry_after:
+        response.headers['Retry-After'] = str(error.retry_after)
+    return response
+
+
+def init_app(app):
+    """Apply the pixel limit to Pillow and release reservations left over at request teardown."""
+    max_pixels = _config(app, 'MAX_IMAGE_PIXELS', DEFAULT_MAX_IMAGE_PIXELS)
+    # Strip processing opens larger images than whole-frame decoding allows; admit() checks both limits
+    Image.MAX_IMAGE_PIXELS = max(max_pixels, largeimage.large_image_max_pixels(app))
+
+    @app.teardown_request
+    def release_reservations(exc):
+        for reservation in g.pop('admission_reservations', []):
+            try:
+                reservation.release()
+            except OSError as e:
+                app.logger.warning(f"Could not release memory reservation: {e}")
@@ -0,0 +1,98 @@
+"""
+File downloads, optionally handed off to the front proxy.
+
+With DOWNLOAD_OFFLOAD unset, files are streamed by Flask's send_file, which
+answers conditional and Range requests (so interrupted downloads can resume).
+That ties a worker up for the whole transfer, so in production the proxy
+should send the bytes instead:
+
+- DOWNLOAD_OFFLOAD=x-accel-redirect (nginx): the response carries an
+  X-Accel-Redirect header pointing at an `internal` location that maps
+  DOWNLOAD_OFFLOAD_ROOT to DOWNLOAD_OFFLOAD_PREFIX.
+- DOWNLOAD_OFFLOAD=x-sendfile (Apache mod_xsendfile, lighttpd, Caddy plugins):
+  the response carries the absolute path in an X-Sendfile header.
+
+Either way the app still sets Content-Type and Content-Disposition, and the
+response has no body. Files outside DOWNLOAD_OFFLOAD_ROOT are streamed by the
+app as before.
+
+Config keys (environment variables of the same name override them):
+- DOWNLOAD_OFFLOAD: '', 'x-accel-redirect' or 'x-sendfile' (default: '')
+- DOWNLOAD_OFFLOAD_ROOT: directory the proxy may serve from (default: the system temp directory)
+- DOWNLOAD_OFFLOAD_PREFIX: nginx internal location for DOWNLOAD_OFFLOAD_ROOT (default: /_downloads/)
+"""
+from flask import current_app, request, send_file
+from werkzeug.utils import send_file as werkzeug_send_file
+from urllib.parse import quote
+import os
+import tempfile
+
+OFFLOAD_HEADERS = {
+    'x-accel-redirect': 'X-Accel-Redirect',
+    'x-sendfile': 'X-Sendfile',
+}
+DEFAULT_OFFLOAD_PREFIX = '/_downloads/'
+
+
+def _setting(key, default=''):
+    return os.environ.get(key) or current_app.config.get(key) or default
+
+
+def offload_mode():
+    """The configured offload mode, or '' when the app streams files itself."""
+    mode = _setting('DOWNLOAD_OFFLOAD').strip().lower()
+    if mode in ('nginx', 'accel'):
+        return 'x-accel-redirect'
+    if mode in ('apache', 'sendfile'):
+        return 'x-sendfile'
+    return mode if mode in OFFLOAD_HEADERS else ''
+
+
+def offload_target(path, mode):
+    """
+    Header value that tells the proxy which file to send.
+
+    Returns:
+        str: Internal URI (x-accel-redirect) or absolute path (x-sendfile), or None if the
+             file is outside DOWNLOAD_OFFLOAD_ROOT
+    """
+    root = os.path.realpath(_setting('DOWNLOAD_OFFLOAD_ROOT', tempfile.gettempdir()))
+    real_path = os.path.realpath(path)
+    if os.path.commonpath([root, real_path]) != root:
+        return None
+    if mode == 'x-sendfile':
+        return real_path
+    prefix = _setting('DOWNLOAD_OFFLOAD_PREFIX', DEFAULT_OFFLOAD_PREFIX)
+    relative = os.path.relpath(real_path, root).replace(os.sep, '/')
+    return prefix.rstrip('/') + '/' + quote(relative)
+
+
+def send_download(path, download_name, mimetype=None):
+    """
+    Send a file as an attachment, through the front proxy when offloading is configured.
+
+    Args:
+        path (str): File to send
+        download_name (str): Filename offered to the browser
+        mimetype (str): Content type (guessed from download_name if omitted)
+
+    Returns:
+        Response: Header-only offload response, or a streaming response with Range support
+    """
+    mode = offload_mode()
+    target = offload_target(path, mode) if mode else None
+    if target is None:
+        if mode:
+            current_app.logger.warning(f"Not offloading {path}: outside DOWNLOAD_OFFLOAD_ROOT")
+        return send_file(path, as_attachment=True, download_name=download_name, mimetype=mimetype)
+
+    # Let Werkzeug build the headers (type, RFC 6266 disposition, Last-Modified) without opening the file
+    response = werkzeug_send_file(
+        path, request.environ, mimetype=mimetype, as_attachment=True, download_name=download_name,
+        conditional=False, etag=False, use_x_sendfile=True, response_class=current_app.response_class,
+    )
+    del response.headers['X-Sendfile']
+    # The proxy sets the length (and handles Range) for the bytes it sends
+    response.headers.pop('Content-Length', None)
+    response.headers[OFFLOAD_HEADERS[mode]] = target
+    return response
@@ -0,0 +1,361 @@
+"""
+Output formats and named encoder profiles shared by the processing blueprints.
+
+A profile maps each output format to Pillow save options:
+- default: Pillow's defaults (the historical behaviour)
+- web-small: smallest files for web delivery (progressive, optimized, 4:2:0 chroma)
+- archive: high quality with full-resolution chroma, for masters and print
+- lossless: lossless where the format allows it; JPEG falls back to quality 100 with 4:4:4 chroma
+
+WebP, AVIF and HEIC support depend on the installed Pillow build and
+pillow_heif; available_formats() reports what this server can write.
+"""
+from PIL import Image, features
+import io
+import os
+from src.utils import heif
+
+# Output format -> Pillow format name
+OUTPUT_FORMATS = {
+    'jpeg': 'JPEG',
+    'png': 'PNG',
+    'tiff': 'TIFF',
+    'webp': 'WEBP',
+    'avif': 'AVIF',
+    'heic': 'HEIF',
+    'bmp': 'BMP',
+}
+
+# File extensions of everything the blueprints can produce
+OUTPUT_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.tiff', '.tif', '.webp', '.avif', '.heic', '.bmp')
+
+# Formats that can store an alpha channel
+ALPHA_FORMATS = {'png', 'tiff', 'webp', 'avif', 'heic'}
+
+DEFAULT_PROFILE = 'default'
+
+PROFILES = {
+    'default': {},
+    'web-small': {
+        'jpeg': {'quality': 75, 'optimize': True, 'progressive': True, 'subsampling': 2},
+        'png': {'optimize': True},
+        'tiff': {'compression': 'tiff_adobe_deflate'},
+        'webp': {'quality': 75, 'method': 6},
+        'avif': {'quality': 50, 'speed': 6},
+        'heic': {'quality': 45},
+    },
+    'archive': {
+        'jpeg': {'quality': 95, 'optimize': True, 'subsampling': 0},
+        'png': {'compress_level': 9},
+        'tiff': {'compression': 'tiff_lzw'},
+        'webp': {'quality': 95, 'method': 6},
+        'avif': {'quality': 90, 'subsampling': '4:4:4'},
+        'heic': {'quality': 90, 'chroma': 444},
+    },
+    'lossless': {
+        'jpeg': {'quality': 100, 'optimize': True, 'subsampling': 0},
+        'png': {'compress_level': 9},
+        'tiff': {'compression': 'tiff_lzw'},
+        'webp': {'lossless': True, 'quality': 100, 'method': 6},
+        'avif': {'quality': 100, 'subsampling': '4:4:4'},
+        'heic': {'quality': -1, 'chroma': 444},
+    },
+}
+
+
+class EncoderError(ValueError):
+    """Raised for an unknown or unavailable output format or profile."""
+
+
+def _register_plugins(output_format):
+    if output_format == 'heic':
+        heif.register_opener()
+
+
+def is_available(output_format):
+    """Whether this server can write `output_format`."""
+    pil_format = OUTPUT_FORMATS.get(output_format)
+    if pil_format is None:
+        return False
+    _register_plugins(output_format)
+    Image.init()  # Load every plugin so Image.SAVE is complete
+    if output_format == 'webp' and not features.check('webp'):
+        return False
+    return pil_format in Image.SAVE
+
+
+def available_formats():
+    """Output formats this server can write."""
+    return [fmt for fmt in OUTPUT_FORMATS if is_available(fmt)]
+
+
+def resolve(output_format, profile=None, default_format='jpeg'):
+    """
+    Validate an output format and profile from a request.
+
+    Unknown formats fall back to `default_format`, as the blueprints always have.
+
+    Returns:
+        tuple: (output_format, profile)
+
+    Raises:
+        EncoderError: If the format is not available here or the profile is unknown
+    """
+    output_format = (output_format or default_format).lower()
+    if output_format == 'jpg':
+        output_format = 'jpeg'
+    if output_format not in OUTPUT_FORMATS:
+        output_format = default_format
+    if not is_available(output_format):
+        raise EncoderError(f"{output_format.upper()} output is not supported by this server "
+                           f"(available: {', '.join(available_formats())})")
+    profile = profile or DEFAULT_PROFILE
+    if profile not in PROFILES:
+        raise EncoderError(f"Unknown encoder profile '{profile}' (available: {', '.join(PROFILES)})")
+    return output_format, profile
+
+
+def save_options(output_format, profile=None, **overrides):
+    """Pillow save keyword arguments for a format under a profile, with per-call overrides."""
+    options = dict(PROFILES.get(profile or DEFAULT_PROFILE, {}).get(output_format, {}))
+    options.update(overrides)
+    return options
+
+
+def prepare_image(img, output_format):
+    """Convert an image to a mode the output format can store."""
+    if output_format == 'jpeg':
+        return img if img.mode in ('RGB', 'L', 'CMYK') else img.convert('RGB')
+    if output_format in ('png', 'tiff'):
+        return img  # Historically saved as-is; both accept nearly every mode
+    has_alpha = img.mode in ('RGBA', 'LA', 'PA', 'RGBa', 'La') or 'transparency' in img.info
+    if output_format in ALPHA_FORMATS and has_alpha:
+        return img if img.mode == 'RGBA' else img.convert('RGBA')
+    if output_format == 'bmp' and img.mode in ('1', 'L', 'P', 'RGB'):
+        return img
+    return img if img.mode == 'RGB' else img.convert('RGB')
+
+
+def encode(img, fp, output_format, profile=None, **overrides):
+    """
+    Save an image in an output format under an encoder profile.
+
+    Args:
+        img (PIL.Image.Image): Image to save (converted as needed)
+        fp (str or file): Output path or binary file object
+        output_format (str): Output format key (see OUTPUT_FORMATS)
+        profile (str): Encoder profile name
+        **overrides: Save options that take precedence over the profile
+    """
+    _register_plugins(output_format)
+    prepare_image(img, output_format).save(fp, OUTPUT_FORMATS[output_format],
+                                           **save_options(output_format, profile, **overrides))
+
+
+def size_report(input_path, output_path, name=None):
+    """
+    Bytes saved by re-encoding one file.
+
+    Returns:
+        dict: file, input_bytes, output_bytes, saved_bytes and saved_percent
+    """
+    input_bytes = os.path.getsize(input_path)
+    output_bytes = os.path.getsize(output_path)
+    saved = input_bytes - output_bytes
+    return {
+        'file': name or os.path.basename(output_path),
+        'input_bytes': input_bytes,
+        'output_bytes': output_bytes,
+        'saved_bytes': saved,
+        'saved_percent': round(100.0 * saved / input_bytes, 1) if input_bytes else 0.0,
+    }
+
+
+def summarize(reports):
+    """Totals for a list of size_report() entries."""
+    input_bytes = sum(r['input_bytes'] for r in reports)
+    output_bytes = sum(r['output_bytes'] for r in reports)
+    return {
+        'input_bytes': input_bytes,
+        'output_bytes': output_bytes,
+        'saved_bytes': input_bytes - output_bytes,
+        'saved_percent': round(100.0 * (input_bytes - output_bytes) / input_bytes, 1) if input_bytes else 0.0,
+    }
+
+
+# Target-size encoding
+
+# Formats whose size can be steered with the `quality` option
+QUALITY_FORMATS = {'jpeg', 'webp', 'avif', 'heic'}
+MIN_QUALITY = 10
+MAX_QUALITY = 95
+MIN_SCALE = 0.25        # smallest downscale factor tried when quality alone is not enough
+MAX_SCALE_STEPS = 4
+SCALE_HEADROOM = 0.95   # aim slightly below the budget when estimating a downscale
+
+_BYTE_UNITS = {'': 1, 'b': 1, 'k': 1000, 'kb': 1000, 'kib': 1024, 'm': 1000 ** 2, 'mb': 1000 ** 2, 'mib': 1024 ** 2}
+
+
+def parse_byte_size(value):
+    """
+    Parse a byte budget such as '500000', '500KB', '500 KiB' or '1.5MB'.
+
+    Returns:
+        int: Bytes, or None if `value` is empty
+
+    Raises:
+        EncoderError: If the value cannot be parsed or is not positive
+    """
+    if value is None or str(value).strip() == '':
+        return None
+    text = str(value).strip().lower().replace(' ', '')
+    number = text.rstrip('bikm')
+    unit = text[len(number):]
+    try:
+        size = int(float(number) * _BYTE_UNITS[unit])
+    except (KeyError, ValueError):
+        raise EncoderError(f"Invalid target size '{value}' (use bytes or a KB/MB/KiB/MiB suffix)")
+    if size <= 0:
+        raise EncoderError('Target size must be positive')
+    return size
+
+
+class TargetSizeEncoder:
+    """
+    Encode images to fit a byte budget, searching quality (and optionally scale) with in-memory encodes.
+
+    One instance is used per batch: the quality that fitted the previous file
+    is tried first and only a narrow bracket around it is searched, so similar
+    images usually need two or three trial encodes instead of a full binary
+    search.
+    """
+
+    def __init__(self, target_bytes, output_format, profile=None, allow_downscale=False):
+        self.target_bytes = target_bytes
+        self.output_format = output_format
+        self.profile = profile
+        self.allow_downscale = allow_downscale
+        self.last_quality = None
+
+    def _encode(self, img, quality):
+        buffer = io.BytesIO()
+        overrides = {}
+        if quality is not None:
+            overrides['quality'] = quality
+            if self.output_format == 'webp':
+                overrides['lossless'] = False
+        encode(img, buffer, self.output_format, self.profile, **overrides)
+        return buffer.getvalue()
+
+    def _search_quality(self, img, trials):
+        """Highest quality whose encode fits. Returns (data, quality, fits)."""
+        cache = {}
+
+        def attempt(quality):
+            if quality not in cache:
+                cache[quality] = self._encode(img, quality)
+                trials.append(quality)
+            return cache[quality]
+
+        def fits(quality):
+            return len(attempt(quality)) <= self.target_bytes
+
+        lo, hi = MIN_QUALITY, MAX_QUALITY  # invariant: the answer lies in [lo, hi] if any quality fits
+        if self.last_quality is not None:
+            # Gallop away from the previous file's quality (+-1, 2, 4, ...) to bracket the answer
+            hint = self.last_quality
+            step = 1
+            if fits(hint):
+                lo = hint
+                while lo < MAX_QUALITY:
+                    probe = min(MAX_QUALITY, hint + step)
+                    if not fits(probe):
+                        hi = probe - 1
+                        break
+                    lo = probe
+                    step *= 2
+                else:
+                    hi = lo
+            else:
+                hi = hint - 1
+                while hi >= MIN_QUALITY:
+                    probe = max(MIN_QUALITY, hint - step)
+                    if fits(probe):
+                        lo = probe
+                        break
+                    hi = probe - 1
+                    step *= 2
+
+        if hi < lo or not fits(lo):
+            return attempt(MIN_QUALITY), MIN_QUALITY, fits(MIN_QUALITY)
+        while lo < hi:
+            mid = (lo + hi + 1) // 2
+            if fits(mid):
+                lo = mid
+            else:
+                hi = mid - 1
+        return attempt(lo), lo, True
+
+    def encode(self, img):
+        """
+        Encode one image within the budget.
+
+        Returns:
+            tuple: (data, report) where report has quality, scale, trials, bytes and fits.
+                   If nothing fits, data is the smallest encode that was tried.
+        """
+        img = prepare_image(img, self.output_format)
+        has_quality = self.output_format in QUALITY_FORMATS
+        trials = []
+        scale = 1.0
+        frame = img
+
+        for _ in range(MAX_SCALE_STEPS + 1):
+            if has_quality:
+                data, quality, fits = self._search_quality(frame, trials)
+            else:
+                data, quality = self._encode(frame, None), None
+                trials.append(None)
+                fits = len(data) <= self.target_bytes
+            if fits or not self.allow_downscale or scale <= MIN_SCALE:
+                break
+            # Encoded size is roughly proportional to the pixel count
+            scale = max(MIN_SCALE, scale * min(0.9, (self.target_bytes * SCALE_HEADROOM / len(data)) ** 0.5))
+            size = (max(1, round(img.width * scale)), max(1, round(img.height * scale)))
+            frame = img.resize(size, Image.LANCZOS)
+
+        if fits and quality is not None:
+            self.last_quality = quality
+        return data, {
+            'quality': quality,
+            'scale': round(scale, 3),
+            'width': frame.width,
+            'height': frame.height,
+            'bytes': len(data),
+            'target_bytes': self.target_bytes,
+            'trials': len(trials),
+            'fits': fits,
+        }
+
+
+def summarize_targets(reports):
+    """Per-file target-size results plus the batch's trial count and misses."""
+    return {
+        'files': reports,
+        'trials': sum(r['trials'] for r in reports),
+        'missed': [r['file'] for r in reports if not r['fits']],
+    }
+
+
+def strip_target_report(output_path, target_bytes):
+    """Target-size entry for a strip- or frame-processed image, which is encoded once without a search."""
+    output_bytes = os.path.getsize(output_path)
+    return {
+        'file': os.path.basename(output_path),
+        'quality': None,
+        'scale': 1.0,
+        'bytes': output_bytes,
+        'target_bytes': target_bytes,
+        'trials': 0,
+        'fits': output_bytes <= target_bytes,
+    }
@@ -0,0 +1,70 @@
+"""
+Run ExifTool as a subprocess.
+
+Under the WSGI servers every call is a plain blocking subprocess.run. When the
+app is served through src/asgi.py, the ASGI entry point binds its event loop
+here. Calls made from executor threads are then scheduled on that loop with
+asyncio.create_subprocess_exec, so the ExifTool pipes are read by the loop
+instead of by a second set of blocking threads.
+"""
+import asyncio
+import subprocess
+
+_loop = None
+
+
+def bind_event_loop(loop):
+    """Send ExifTool calls from worker threads through `loop` (None to go back to subprocess.run)."""
+    global _loop
+    _loop = loop
+
+
+async def run_async(args, timeout=None):
+    """
+    Run ExifTool on the current event loop.
+
+    Args:
+        args (list): Command line, starting with the exiftool executable
+        timeout (float): Seconds before the process is killed (None waits indefinitely)
+
+    Returns:
+        subprocess.CompletedProcess: With decoded stdout and stderr
+    """
+    process = await asyncio.create_subprocess_exec(
+        *args, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+    try:
+        stdout, stderr = await asyncio.wait_for(process.communicate(), timeout)
+    except asyncio.TimeoutError:
+        process.kill()
+        await process.wait()
+        raise subprocess.TimeoutExpired(args, timeout)
+    return subprocess.CompletedProcess(
+        args, process.returncode,
+        stdout.decode('utf-8', errors='replace'), stderr.decode('utf-8', errors='replace'))
+
+
+def _on_event_loop():
+    try:
+        asyncio.get_running_loop()
+        return True
+    except RuntimeError:
+        return False
+
+
+def run(args, timeout=None):
+    """
+    Run ExifTool and wait for it to finish.
+
+    Args:
+        args (list): Command line, starting with the exiftool executable
+        timeout (float): Seconds before the process is killed (None waits indefinitely)
+
+    Returns:
+        subprocess.CompletedProcess: With decoded stdout and stderr
+    """
+    loop = _loop
+    # Only hand off from other threads; blocking on the loop from its own thread would deadlock
+    if loop is not None and loop.is_running() and not _on_event_loop():
+        return asyncio.run_coroutine_threadsafe(run_async(args, timeout), loop).result()
+    return subprocess.run(args, capture_output=True, text=True, check=False, encoding='utf-8',
+                          errors='replace', timeout=timeout)
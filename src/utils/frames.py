@@ -0,0 +1,100 @@
+"""
+Frame-by-frame processing of multi-frame images: multi-page TIFFs and animated WebP and GIF.
+
+Image.open() returns the first frame, and saving that image drops every other
+one. When the output format can hold several frames (TIFF pages, WebP
+animations), the blueprints call save() instead. It wraps the source in a
+FrameSequence, a lazy image whose seek(n) decodes frame n and runs the
+blueprint's per-frame transform (convert, resize or watermark). Pillow's
+save_all writers seek through it one frame at a time, so only the current frame
+is ever decoded. TIFF pages are appended to the output file as they are
+encoded, and the WebP encoder only keeps compressed frames. Memory stays at
+about one frame however long the sequence is.
+
+Other output formats keep the first frame, as before. Pillow's APNG writer
+holds every frame until the end and its AVIF writer decodes the sequence twice,
+so PNG and AVIF outputs are not offered as multi-frame formats.
+"""
+from PIL import Image
+from src.utils import encoders
+
+# Output formats whose Pillow writers pull frames one at a time
+MULTIFRAME_FORMATS = ('tiff', 'webp')
+
+
+class FrameSequence(Image.Image):
+    """
+    Lazy multi-frame image: seek(n) decodes frame n of the source and transforms it.
+
+    Pillow's save_all writers only seek, load and read the current frame, so this
+    can stand in for an opened multi-frame file. Frame durations are recorded in
+    `durations` as frames are reached; the WebP writer reads each one after
+    seeking to its frame.
+    """
+
+    def __init__(self, source, transform):
+        """
+        Args:
+            source (Image): Opened multi-frame image
+            transform (callable): Maps a decoded frame to the frame to write (may return it unchanged)
+        """
+        super().__init__()
+        self._source = source
+        self._transform = transform
+        self._frame = None
+        self.n_frames = source.n_frames
+        self.is_animated = True
+        self.durations = [0] * self.n_frames
+        self.seek(0)
+
+    def seek(self, frame):
+        if frame == self._frame:
+            return
+        self._source.seek(frame)
+        self._source.load()
+        self.durations[frame] = self._source.info.get('duration', 0)
+        out = self._transform(self._source)
+        self.im = out.im
+        self._mode = out.mode
+        self._size = out.size
+        self.palette = out.palette
+        self.info = dict(out.info)
+        self._frame = frame
+
+    def tell(self):
+        return self._frame
+
+
+def frame_count(path):
+    """Number of frames (pages) in an image file."""
+    with Image.open(path) as img:
+        return getattr(img, 'n_frames', 1)
+
+
+def keeps_frames(path, output_format):
+    """Whether converting `path` to `output_format` should go frame by frame (several frames and a format that holds them)."""
+    return output_format in MULTIFRAME_FORMATS and frame_count(path) > 1
+
+
+def save(path, output_path, output_format, profile=None, transform=None):
+    """
+    Process and write every frame of a multi-frame image, one frame at a time.
+
+    Args:
+        path (str): Source image
+        output_path (str): Output file
+        output_format (str): Output format (one of MULTIFRAME_FORMATS)
+        profile (str): Encoder profile name
+        transform (callable): Applied to each decoded frame before it is encoded (optional)
+    """
+    def prepare(frame):
+        return encoders.prepare_image(transform(frame) if transform else frame, output_format)
+
+    with Image.open(path) as source:
+        sequence = FrameSequence(source, prepare)
+        options = {}
+        if output_format == 'webp':
+            # Keep the animation's timing; durations fill in as the writer reaches each frame
+            options = {'duration': sequence.durations, 'loop': source.info.get('loop', 0)}
+        sequence.save(output_path, encoders.OUTPUT_FORMATS[output_format], save_all=True,
+                      **encoders.save_options(output_format, profile, **options))
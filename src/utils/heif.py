@@ -0,0 +1,112 @@
+"""
+HEIF/HEIC support shared by the blueprints.
+
+iPhone batches are mostly HEIC, and decoding HEVC is the most expensive thing
+we do per file. Three things keep it cheap:
+
+- The pillow_heif opener is registered once per process, at startup
+  (register_opener() in src/app.py and src/main.py); later calls only return
+  the cached result.
+- Phones embed a downscaled copy of every photo (a thumbnail, usually a few
+  hundred pixels wide). open_reduced() decodes the smallest one that still
+  covers the requested size, which takes milliseconds instead of seconds for
+  a 12 MP photo. Resizing to small sizes and the /exif page preview use it.
+- Geotagging can leave HEIC files as HEIC (keep_heic): ExifTool then writes
+  the metadata straight into the container, so the image is never decoded or
+  re-encoded (see geotagging.geotag_batch).
+"""
+
+HEIF_EXTENSIONS = ('.heic', '.heif')
+
+# Thumbnail and image aspect ratios may differ this much (thumbnail dimensions are rounded)
+ASPECT_TOLERANCE = 0.02
+
+_registered = None  # None until the first register_opener() call, then whether it worked
+
+
+def register_opener():
+    """
+    Register pillow_heif's Pillow plugin for this process (only the first call does any work).
+
+    Returns:
+        bool: Whether HEIF/HEIC files can be opened
+    """
+    global _registered
+    if _registered is None:
+        try:
+            import pillow_heif
+            pillow_heif.register_heif_opener()
+            _registered = True
+        except ImportError:
+            _registered = False
+    return _registered
+
+
+def is_heif(path):
+    """Whether `path` is a HEIF/HEIC file, going by its extension."""
+    return path.lower().endswith(HEIF_EXTENSIONS)
+
+
+def _thumbnails(source):
+    """Embedded thumbnails (HeifThumbnail) of a HEIF file's primary image, except those in another aspect ratio."""
+    import pillow_heif
+    if hasattr(source, 'seek'):
+        source.seek(0)
+    heif_file = pillow_heif.open_heif(source)
+    primary = heif_file[heif_file.primary_index]
+    width, height = primary.size
+    thumbnails = []
+    for index in range(len(primary.info.get('thumbnails') or [])):
+        thumbnail = primary.get_thumbnail(index)
+        # A thumbnail of another aspect ratio (e.g. not rotated like the primary image) is no substitute
+        if abs(thumbnail.size[0] * height / (thumbnail.size[1] * width) - 1) <= ASPECT_TOLERANCE:
+            thumbnails.append(thumbnail)
+    return thumbnails
+
+
+def _decode(thumbnail):
+    img = thumbnail.to_pillow()
+    img.load()
+    return img
+
+
+def open_reduced(path, size):
+    """
+    Decode the smallest embedded thumbnail of a HEIF file that covers `size`.
+
+    Args:
+        path (str): HEIF/HEIC file
+        size (tuple): (width, height) the caller needs at least
+
+    Returns:
+        Image: Loaded thumbnail, or None when there is no thumbnail that large (decode the full image then)
+    """
+    if not is_heif(path) or not register_opener():
+        return None
+    try:
+        thumbnails = _thumbnails(path)
+        covering = [t for t in thumbnails if t.size[0] >= size[0] and t.size[1] >= size[1]]
+        if not covering:
+            return None
+        return _decode(min(covering, key=lambda t: t.size[0] * t.size[1]))
+    except Exception:
+        return None
+
+
+def preview_image(img, source):
+    """
+    Image to show as a preview: the largest embedded thumbnail of a HEIF image, or `img` itself.
+
+    Args:
+        img (Image): The opened image
+        source (str or file): Where `img` was opened from
+    """
+    if getattr(img, 'format', None) != 'HEIF' or not register_opener():
+        return img
+    try:
+        thumbnails = _thumbnails(source)
+        if thumbnails:
+            return _decode(max(thumbnails, key=lambda t: t.size[0] * t.size[1]))
+    except Exception:
+        pass
+    return img
@@ -0,0 +1,457 @@
+"""
+Memory-bounded strip processing for very large images.
+
+Images above LARGE_IMAGE_PIXELS are processed in horizontal strips of roughly
+LARGE_IMAGE_STRIP_BYTES each instead of as one decoded frame:
+
+- StripReader decodes only the rows of a strip when the file stores raw
+  (uncompressed) rows, as uncompressed TIFF, BMP and PPM do, reading them
+  straight from the file. Other formats are decoded once and then cut into
+  strips, which still avoids the extra full-size working copies.
+- Strip writers encode strips as they arrive. PNG and TIFF are written
+  incrementally; for other formats the strips are assembled in a memory-mapped
+  scratch file, so the frame lives in the page cache rather than in process
+  memory while the encoder runs.
+"""
+import os
+import zlib
+import struct
+
+import numpy as np
+from PIL import Image
+from src.utils import encoders
+
+DEFAULT_LARGE_IMAGE_PIXELS = 64_000_000
+DEFAULT_LARGE_IMAGE_MAX_PIXELS = 1_000_000_000
+DEFAULT_STRIP_BYTES = 64 * 1024 * 1024
+MIN_STRIP_ROWS = 16
+
+# Candidate bits per pixel when a raw tile does not state its row stride
+_RAW_BITS = (1, 2, 4, 8, 16, 24, 32, 40, 48, 64, 96, 128)
+_row_bytes_cache = {}
+
+
+def _setting(app, key, default):
+    value = os.environ.get(key)
+    if value is None and app is not None:
+        value = app.config.get(key)
+    return int(value) if value is not None else default
+
+
+def large_image_threshold(app=None):
+    """Pixel count from which images are processed in strips."""
+    return _setting(app, 'LARGE_IMAGE_PIXELS', DEFAULT_LARGE_IMAGE_PIXELS)
+
+
+def large_image_max_pixels(app=None):
+    """Largest image (in pixels) accepted for strip processing."""
+    return _setting(app, 'LARGE_IMAGE_MAX_PIXELS', DEFAULT_LARGE_IMAGE_MAX_PIXELS)
+
+
+def is_large_image(width, height, app=None):
+    return width * height >= large_image_threshold(app)
+
+
+def is_large_file(path, app=None):
+    """Check an image file against the strip threshold from its header only."""
+    with Image.open(path) as img:
+        return is_large_image(img.width, img.height, app)
+
+
+def strip_rows(width, app=None, bytes_per_pixel=4):
+    """Rows per strip so that one 32-bit strip stays within LARGE_IMAGE_STRIP_BYTES."""
+    strip_bytes = _setting(app, 'LARGE_IMAGE_STRIP_BYTES', DEFAULT_STRIP_BYTES)
+    return max(MIN_STRIP_ROWS, strip_bytes // max(1, width * bytes_per_pixel))
+
+
+def iter_bands(height, rows):
+    """Yield (top, bottom) row ranges covering `height` rows."""
+    for top in range(0, height, rows):
+        yield top, min(top + rows, height)
+
+
+def _raw_row_bytes(mode, rawmode, width):
+    """Bytes per row for a raw rawmode, found by asking the raw decoder which length it accepts."""
+    key = (mode, rawmode, width)
+    if key not in _row_bytes_cache:
+        for bits in _RAW_BITS:
+            nbytes = (width * bits + 7) // 8
+            try:
+                Image.frombytes(mode, (width, 1), bytes(nbytes), 'raw', rawmode)
+            except ValueError:
+                continue
+            _row_bytes_cache[key] = nbytes
+            break
+        else:
+            _row_bytes_cache[key] = None
+    return _row_bytes_cache[key]
+
+
+def _raw_layout(img):
+    """
+    Describe where each row band of `img` is stored in its file.
+
+    Returns:
+        list: (top, bottom, offset, rawmode, stride, ystep) per stored band, or
+        None if the rows cannot be read individually
+    """
+    if not img.tile or img.mode == 'P' or getattr(img, 'n_frames', 1) > 1:
+        return None
+    if any(tile[0] != 'raw' for tile in img.tile):
+        return None
+    # Pillow applies the EXIF orientation of TIFFs while decoding; strips would come out unrotated
+    if img.getexif().get(0x0112, 1) != 1:
+        return None
+
+    layout = []
+    for tile in img.tile:
+        codec, extents, offset, args = tile[0], tile[1], tile[2], tile[3]
+        if codec != 'raw' or extents[0] != 0 or extents[2] != img.width:
+            return None
+        if isinstance(args, str):
+            args = (args, 0, 1)
+        rawmode = args[0]
+        stride = args[1] if len(args) > 1 else 0
+        ystep = args[2] if len(args) > 2 else 1
+        if not stride:
+            stride = _raw_row_bytes(img.mode, rawmode, img.width)
+        if not stride or ystep not in (1, -1):
+            return None
+        layout.append((extents[1], extents[3], offset, rawmode, stride, ystep))
+    return layout or None
+
+
+def supports_strip_reads(img):
+    """True if strips of `img` can be decoded without decoding the whole frame."""
+    return _raw_layout(img) is not None
+
+
+class StripReader:
+    """
+    Read an image as horizontal strips.
+
+    Use `streamable` to find out whether strips are decoded individually
+    (memory proportional to the strip) or cut from a fully decoded frame.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.img = Image.open(path)
+        self.width, self.height = self.img.size
+        self.mode = self.img.mode
+        self._layout = _raw_layout(self.img)
+        self.streamable = self._layout is not None
+        self._fp = None
+        self._frame = None
+
+    def read(self, top, bottom):
+        """Return rows [top, bottom) as a new image."""
+        if self._layout is None:
+            if self._frame is None:
+                self.img.load()
+                self._frame = self.img
+            return self._frame.crop((0, top, self.width, bottom))
+
+        if self._fp is None:
+            self._fp = open(self.path, 'rb')
+        strip = None
+        for band_top, band_bottom, offset, rawmode, stride, ystep in self._layout:
+            first, last = max(top, band_top), min(bottom, band_bottom)
+            if first >= last:
+                continue
+            # Bottom-up bands (BMP) store their last row first
+            row_index = first - band_top if ystep == 1 else band_bottom - last
+            self._fp.seek(offset + row_index * stride)
+            data = self._fp.read((last - first) * stride)
+            band = Image.frombytes(self.mode, (self.width, last - first), data, 'raw', rawmode, stride, ystep)
+            if first == top and last == bottom:
+                return band
+            if strip is None:
+                strip = Image.new(self.mode, (self.width, bottom - top))
+            strip.paste(band, (0, first - top))
+        return strip
+
+    def draft(self, mode, size):
+        """Let JPEG decode at a reduced scale (1/2 to 1/8) when the output is that small anyway."""
+        if self._layout is None and self._frame is None:
+            self.img.draft(mode, size)
+            self.width, self.height = self.img.size
+
+    def close(self):
+        if self._fp is not None:
+            self._fp.close()
+        self.img.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def estimate_footprint(width, height, frame_bytes_per_pixel, streamable, copies, app=None):
+    """
+    Peak memory of strip processing: a few 32-bit strips, plus the whole frame
+    when the format has to be decoded in one go.
+    """
+    footprint = strip_rows(width, app) * width * 4 * (copies + 1)
+    if not streamable:
+        footprint += width * height * frame_bytes_per_pixel
+    return footprint
+
+
+def write_strips(writer, strips):
+    """Feed strips to a writer and finish the file; a partial output is removed on failure."""
+    try:
+        for strip in strips:
+            writer.write(strip)
+    except Exception:
+        writer.abort()
+        raise
+    writer.close()
+
+
+class PngStripWriter:
+    """Write a PNG strip by strip, with Paeth filtering and zlib streaming compression."""
+
+    COLOR_TYPES = {'L': (0, 1), 'LA': (4, 2), 'RGB': (2, 3), 'RGBA': (6, 4)}
+    FILTER_CHUNK_BYTES = 4 * 1024 * 1024
+
+    def __init__(self, path, size, mode, compress_level=6):
+        self.mode = mode if mode in self.COLOR_TYPES else ('RGBA' if 'A' in mode else 'RGB')
+        color_type, self.channels = self.COLOR_TYPES[self.mode]
+        self.path = path
+        self.width, self.height = size
+        self._previous = np.zeros(self.width * self.channels, dtype=np.uint8)
+        self._compressor = zlib.compressobj(compress_level)
+        self._f = open(path, 'wb')
+        self._f.write(b'\x89PNG\r\n\x1a\n')
+        self._chunk(b'IHDR', struct.pack('>IIBBBBB', self.width, self.height, 8, color_type, 0, 0, 0))
+
+    def _chunk(self, kind, data):
+        self._f.write(struct.pack('>I', len(data)) + kind + data)
+        self._f.write(struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff))
+
+    def write(self, strip):
+        if strip.mode != self.mode:
+            strip = strip.convert(self.mode)
+        rows = np.asarray(strip, dtype=np.uint8).reshape(strip.height, self.width * self.channels)
+        # Filter a few rows at a time; the int16 temporaries are ~10x the size of the rows they cover
+        step = max(1, self.FILTER_CHUNK_BYTES // rows.shape[1])
+        for start in range(0, strip.height, step):
+            data = self._compressor.compress(self._paeth(rows[start:start + step]))
+            if data:
+                self._chunk(b'IDAT', data)
+
+    def _paeth(self, rows):
+        up = np.vstack([self._previous[None, :], rows[:-1]]).astype(np.int16)
+        current = rows.astype(np.int16)
+        left = np.zeros_like(current)
+        left[:, self.channels:] = current[:, :-self.channels]
+        up_left = np.zeros_like(current)
+        up_left[:, self.channels:] = up[:, :-self.channels]
+
+        # Paeth predictor (PNG spec section 9.4), vectorised over the rows
+        estimate = left + up - up_left
+        dist_left, dist_up, dist_up_left = np.abs(estimate - left), np.abs(estimate - up), np.abs(estimate - up_left)
+        predictor = np.where((dist_left <= dist_up) & (dist_left <= dist_up_left), left,
+                             np.where(dist_up <= dist_up_left, up, up_left))
+
+        payload = np.empty((rows.shape[0], rows.shape[1] + 1), dtype=np.uint8)
+        payload[:, 0] = 4  # filter type: Paeth
+        payload[:, 1:] = (current - predictor) & 0xff
+        self._previous = rows[-1].copy()
+        return payload.tobytes()
+
+    def close(self):
+        self._chunk(b'IDAT', self._compressor.flush())
+        self._chunk(b'IEND', b'')
+        self._f.close()
+
+    def abort(self):
+        self._f.close()
+        os.remove(self.path)
+
+
+class TiffStripWriter:
+    """Write an uncompressed baseline TIFF strip by strip (one TIFF strip per written strip)."""
+
+    SAMPLES = {'L': (1, 1), 'RGB': (3, 2), 'RGBA': (4, 2)}  # mode -> (samples per pixel, photometric)
+
+    def __init__(self, path, size, mode):
+        self.mode = mode if mode in self.SAMPLES else ('RGBA' if 'A' in mode else 'RGB')
+        self.samples, self.photometric = self.SAMPLES[self.mode]
+        self.width, self.height = size
+        if self.width * self.height * self.samples >= 2 ** 32 - 2 ** 20:
+            raise ValueError('Image too large for a classic TIFF file')
+        self.path = path
+        self._offsets = []
+        self._counts = []
+        self._rows_per_strip = None
+        self._f = open(path, 'wb')
+        self._f.write(b'II*\x00\x00\x00\x00\x00')  # IFD offset is patched in close()
+
+    def write(self, strip):
+        if strip.mode != self.mode:
+            strip = strip.convert(self.mode)
+        if self._rows_per_strip is None:
+            self._rows_per_strip = strip.height
+        data = strip.tobytes()
+        self._offsets.append(self._f.tell())
+        self._counts.append(len(data))
+        self._f.write(data)
+
+    def close(self):
+        if self._f.tell() % 2:
+            self._f.write(b'\x00')  # IFDs start on a word boundary
+        ifd_offset = self._f.tell()
+        count = len(self._offsets)
+        n_entries = 14 if self.mode == 'RGBA' else 13
+        tail = ifd_offset + 2 + 12 * n_entries + 4  # values that don't fit in an entry follow the IFD
+        extra = b''
+
+        def out_of_line(data):
+            nonlocal tail, extra
+            offset, tail, extra = tail, tail + len(data), extra + data
+            return offset
+
+        if self.samples == 1:
+            bits_value = 8
+        else:
+            bits_value = out_of_line(struct.pack(f'<{self.samples}H', *([8] * self.samples)))
+        offsets_value = self._offsets[0] if count == 1 else out_of_line(struct.pack(f'<{count}I', *self._offsets))
+        counts_value = self._counts[0] if count == 1 else out_of_line(struct.pack(f'<{count}I', *self._counts))
+        resolution_value = out_of_line(struct.pack('<II', 72, 1))
+
+        SHORT, LONG, RATIONAL = 3, 4, 5
+        entries = [
+            (256, LONG, 1, self.width),
+            (257, LONG, 1, self.height),
+            (258, SHORT, self.samples, bits_value),
+            (259, SHORT, 1, 1),  # no compression
+            (262, SHORT, 1, self.photometric),
+            (273, LONG, count, offsets_value),
+            (277, SHORT, 1, self.samples),
+            (278, LONG, 1, self._rows_per_strip or self.height),
+            (279, LONG, count, counts_value),
+            (282, RATIONAL, 1, resolution_value),
+            (283, RATIONAL, 1, resolution_value),
+            (284, SHORT, 1, 1),  # chunky planar configuration
+            (296, SHORT, 1, 2),  # resolution unit: inch
+        ]
+        if self.mode == 'RGBA':
+            entries.append((338, SHORT, 1, 2))  # unassociated alpha
+
+        self._f.write(struct.pack('<H', len(entries)))
+        for tag, kind, n, value in entries:
+            if kind == SHORT and n == 1:
+                self._f.write(struct.pack('<HHIHH', tag, kind, n, value, 0))
+            else:
+                self._f.write(struct.pack('<HHII', tag, kind, n, value))
+        self._f.write(struct.pack('<I', 0))
+        self._f.write(extra)
+        self._f.seek(4)
+        self._f.write(struct.pack('<I', ifd_offset))
+        self._f.close()
+
+    def abort(self):
+        self._f.close()
+        os.remove(self.path)
+
+
+class CanvasStripWriter:
+    """
+    Assemble strips in a memory-mapped scratch file and encode it with Pillow.
+
+    Used for formats whose encoders need the whole frame (JPEG, WebP, AVIF, HEIC, BMP). The frame is
+    backed by the scratch file, so the kernel can page it out under pressure, and it is handed to the
+    encoder without a converted copy (the AVIF and HEIC plugins still take a packed copy to encode from).
+    """
+
+    CANVAS_MODES = {'RGB': ('RGBX', 4), 'L': ('L', 1), 'RGBA': ('RGBA', 4), 'CMYK': ('CMYK', 4)}
+
+    def __init__(self, path, size, mode, pil_format, **save_kwargs):
+        self.path = path
+        self.pil_format = pil_format
+        self.save_kwargs = save_kwargs
+        self.width, self.height = size
+        self.mode = mode if mode in self.CANVAS_MODES else 'RGB'
+        self.canvas_mode, channels = self.CANVAS_MODES[self.mode]
+        self._scratch = path + '.canvas'
+        self._buffer = np.memmap(self._scratch, dtype=np.uint8, mode='w+', shape=(self.height, self.width, channels))
+        self._row = 0
+
+    def write(self, strip):
+        strip = strip.convert(self.canvas_mode) if strip.mode != self.canvas_mode else strip
+        rows = np.asarray(strip, dtype=np.uint8).reshape(strip.height, self.width, -1)
+        self._buffer[self._row:self._row + strip.height] = rows
+        self._row += strip.height
+
+    def close(self):
+        try:
+            self._buffer.flush()
+            self._frame().save(self.path, self.pil_format, **self.save_kwargs)
+        except BaseException:
+            # Never leave a partly written output behind
+            self.abort()
+            raise
+        self._discard_scratch()
+
+    def _frame(self):
+        """The canvas as an image that shares the scratch file's pages instead of copying them."""
+        size = (self.width, self.height)
+        frame = None
+        if self.canvas_mode == 'RGBX' and self.pil_format != 'JPEG':
+            # Only the JPEG encoder takes RGBX. Pillow stores RGB pixels in 4 bytes as well, so the
+            # canvas is mapped as an RGB image directly; converting would copy the whole frame.
+            # frombuffer() cannot do this (it only maps the modes in Image._MAPMODES and copies RGB),
+            # so this uses Pillow's buffer mapping itself (tested in tests/test_largeimage.py).
+            try:
+                frame = Image.new('RGB', (0, 0))._new(
+                    Image.core.map_buffer(self._buffer, size, 'raw', 0, ('RGB', 0, 1)))
+            except (AttributeError, TypeError, ValueError):
+                frame = None  # A Pillow without it: fall back to the converted copy below
+        if frame is None:
+            frame = Image.frombuffer(self.canvas_mode, size, self._buffer, 'raw', self.canvas_mode, 0, 1)
+            if self.canvas_mode == 'RGBX' and self.pil_format != 'JPEG':
+                return frame.convert('RGB')
+        # The buffer is ours; marking it writable stops Pillow from copying it before encoding
+        frame.readonly = 0
+        return frame
+
+    def abort(self):
+        self._discard_scratch()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def _discard_scratch(self):
+        self._buffer = None
+        if os.path.exists(self._scratch):
+            os.remove(self._scratch)
+
+
+def open_strip_writer(path, output_format, size, mode, save_options=None):
+    """
+    Create a strip writer for one of the blueprint output formats.
+
+    Args:
+        path (str): Output path
+        output_format (str): Output format key from src/utils/encoders.py
+        size (tuple): Output (width, height)
+        mode (str): Mode of the strips that will be written
+        save_options (dict): Encoder profile options (PNG honours the compression level;
+                             TIFF strips are always written uncompressed)
+
+    Returns:
+        object: Writer with write(strip) and close()
+    """
+    save_options = save_options or {}
+    if output_format == 'png':
+        level = 9 if save_options.get('optimize') else save_options.get('compress_level', 6)
+        return PngStripWriter(path, size, mode, compress_level=level)
+    if output_format == 'tiff':
+        return TiffStripWriter(path, size, mode)
+    if output_format == 'jpeg':
+        return CanvasStripWriter(path, size, 'L' if mode == 'L' else 'RGB', 'JPEG', **save_options)
+    canvas_mode = 'RGBA' if mode in ('RGBA', 'LA') and output_format != 'bmp' else 'RGB'
+    return CanvasStripWriter(path, size, canvas_mode, encoders.OUTPUT_FORMATS[output_format], **save_options)
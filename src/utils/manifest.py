@@ -0,0 +1,281 @@
+"""
+Per-file metadata manifests for geotagging batches.
+
+A manifest maps each uploaded file (by its `file_paths[]` entry) to its own
+metadata, so one request can cover files from many locations. It is a CSV
+file with a header row, or JSON: a list of objects, or an object of column
+lists.
+
+Columns:
+- path (required): relative path of the file, as sent in file_paths[]; a bare
+  file name matches a file of that name in any folder
+- latitude, longitude: decimal degrees
+- datetime: ISO 8601 ('2025-06-16T12:49') or EXIF style ('2025:06:16 12:49:00')
+- keywords: separated by ';' (or ',' when there is no ';'), or a JSON list
+- client_preset: id of a client preset whose contact details and keywords apply
+- any other column is passed on like a geotagging form field, so friendly names
+  ('Caption', 'City') and ExifTool tags ('XMP-dc:Title') both work
+
+Empty cells fall back to the form values. The manifest is held as columns,
+and rows with identical metadata are factorized into groups, so the write plan
+is built once per distinct row and files in a group can share one ExifTool run.
+"""
+import io
+import csv
+import json
+import datetime
+import posixpath
+
+COLUMN_ALIASES = {
+    'path': 'path', 'file': 'path', 'file_path': 'path',
+    'latitude': 'latitude', 'lat': 'latitude',
+    'longitude': 'longitude', 'lng': 'longitude', 'lon': 'longitude',
+    'datetime': 'datetime', 'date': 'datetime',
+    'keywords': 'keywords',
+    'client_preset': 'client_preset', 'client': 'client_preset',
+}
+
+# Client preset contact fields -> geotagging form fields (as filled in by the form)
+CLIENT_PRESET_FIELDS = {
+    'byline': ['Creator'],
+    'byline_title': ['CreatorTitle'],
+    'address': ['Address'],
+    'city': ['City', 'ContactCity'],
+    'state_province': ['ContactState'],
+    'postal_code': ['PostalCode'],
+    'country': ['ContactCountry'],
+    'phone': ['Phone'],
+    'email': ['Email'],
+    'url': ['URL', 'ContactURL'],
+}
+
+
+class ManifestError(ValueError):
+    """Raised for manifests that cannot be parsed or contain invalid values."""
+
+
+def normalize_path(path):
+    """Manifest/file_paths[] path in a comparable form ('./a\\b.jpg' -> 'a/b.jpg')."""
+    path = posixpath.normpath(str(path).strip().replace('\\', '/')).lstrip('/')
+    return '' if path == '.' else path
+
+
+def _column_name(name):
+    key = str(name).strip()
+    return COLUMN_ALIASES.get(key.lower(), key)
+
+
+def _parse_columns(text, filename):
+    """Raw {column: [values]} from CSV or JSON text."""
+    stripped = text.lstrip()
+    if filename.lower().endswith('.json') or stripped.startswith(('[', '{')):
+        try:
+            data = json.loads(text)
+        except json.JSONDecodeError as e:
+            raise ManifestError(f"Invalid JSON manifest: {e}")
+        if isinstance(data, dict):
+            lengths = {len(v) for v in data.values() if isinstance(v, list)}
+            if len(lengths) != 1 or not all(isinstance(v, list) for v in data.values()):
+                raise ManifestError('A JSON manifest object must map every column to a list of the same length')
+            return {_column_name(k): list(v) for k, v in data.items()}
+        if not isinstance(data, list) or not all(isinstance(row, dict) for row in data):
+            raise ManifestError('A JSON manifest must be a list of objects or an object of column lists')
+        names = []
+        for row in data:
+            names.extend(_column_name(k) for k in row if _column_name(k) not in names)
+        columns = {name: [] for name in names}
+        for row in data:
+            row = {_column_name(k): v for k, v in row.items()}
+            for name in names:
+                columns[name].append(row.get(name))
+        return columns
+
+    reader = csv.reader(io.StringIO(text))
+    try:
+        header = next(reader)
+    except StopIteration:
+        raise ManifestError('The manifest is empty')
+    names = [_column_name(h) for h in header]
+    columns = {name: [] for name in names}
+    for line_number, row in enumerate(reader, start=2):
+        if not any(cell.strip() for cell in row):
+            continue
+        if len(row) > len(names):
+            raise ManifestError(f"Line {line_number}: more cells than header columns")
+        for name, cell in zip(names, row + [''] * (len(names) - len(row))):
+            columns[name].append(cell)
+    return columns
+
+
+def _empty(value):
+    return value is None or (isinstance(value, (str, list)) and not value)
+
+
+def _coordinate(value, limit, name, row):
+    try:
+        number = float(value)
+    except (TypeError, ValueError):
+        raise ManifestError(f"Row {row}: invalid {name} '{value}'")
+    if not -limit <= number <= limit:
+        raise ManifestError(f"Row {row}: {name} {number} is out of range")
+    return number
+
+
+def _datetime(value, row):
+    text = str(value).strip()
+    for parse in (datetime.datetime.fromisoformat, lambda v: datetime.datetime.strptime(v, '%Y:%m:%d %H:%M:%S')):
+        try:
+            return parse(text).replace(tzinfo=None).isoformat(timespec='seconds')
+        except ValueError:
+            pass
+    raise ManifestError(f"Row {row}: invalid datetime '{value}'")
+
+
+def _keywords(value):
+    if isinstance(value, list):
+        return [str(k).strip() for k in value if str(k).strip()]
+    text = str(value)
+    separator = ';' if ';' in text else ','
+    return [k.strip() for k in text.split(separator) if k.strip()]
+
+
+class Manifest:
+    """
+    Columnar per-file metadata.
+
+    Attributes:
+        paths (list): Normalized path of every row
+        columns (dict): Column name -> list of cleaned values (None for empty cells)
+        group_of (list): Group index of every row; rows in a group have identical metadata
+        groups (list): Metadata columns of each group as a dict (empty cells left out)
+    """
+
+    def __init__(self, columns):
+        if 'path' not in columns:
+            raise ManifestError("The manifest needs a 'path' column")
+        self.paths = [normalize_path(p) if not _empty(p) else '' for p in columns.pop('path')]
+        for row, path in enumerate(self.paths, start=1):
+            if not path:
+                raise ManifestError(f"Row {row}: missing path")
+        self.columns = {name: [self._clean(name, value, row) for row, value in enumerate(values, start=1)]
+                        for name, values in columns.items()}
+
+        if ('latitude' in self.columns) != ('longitude' in self.columns):
+            raise ManifestError('The manifest needs both latitude and longitude columns')
+        for row, (lat, lng) in enumerate(zip(self.columns.get('latitude', []), self.columns.get('longitude', [])), start=1):
+            if (lat is None) != (lng is None):
+                raise ManifestError(f"Row {row}: latitude and longitude must be given together")
+
+        # Factorize rows: one group per distinct combination of metadata values
+        names = sorted(self.columns)
+        keys = {}
+        self.group_of = []
+        self.groups = []
+        for row in range(len(self.paths)):
+            key = json.dumps([self.columns[name][row] for name in names])
+            group = keys.get(key)
+            if group is None:
+                group = keys[key] = len(self.groups)
+                self.groups.append({name: self.columns[name][row] for name in names
+                                    if self.columns[name][row] is not None})
+            self.group_of.append(group)
+
+        self._by_path = {}
+        self._by_name = {}
+        for row, path in enumerate(self.paths):
+            if path in self._by_path:
+                raise ManifestError(f"Row {row + 1}: duplicate path '{path}'")
+            self._by_path[path] = row
+            self._by_name.setdefault(posixpath.basename(path), []).append(row)
+
+    @staticmethod
+    def _clean(name, value, row):
+        if isinstance(value, str):
+            value = value.strip()
+        if _empty(value):
+            return None
+        if name == 'latitude':
+            return _coordinate(value, 90, 'latitude', row)
+        if name == 'longitude':
+            return _coordinate(value, 180, 'longitude', row)
+        if name == 'datetime':
+            return _datetime(value, row)
+        if name == 'keywords':
+            return _keywords(value) or None
+        if name == 'client_preset':
+            return str(value)
+        return value
+
+    def __len__(self):
+        return len(self.paths)
+
+    def row_for(self, relative_path):
+        """Row index for an uploaded file's relative path, or None if the manifest does not list it."""
+        path = normalize_path(relative_path)
+        row = self._by_path.get(path)
+        if row is not None:
+            return row
+        # Bare file names in the manifest match files in any folder
+        candidates = [r for r in self._by_name.get(posixpath.basename(path), []) if '/' not in self.paths[r]]
+        return candidates[0] if len(candidates) == 1 else None
+
+
+def parse_manifest(data, filename=''):
+    """
+    Parse a CSV or JSON manifest.
+
+    Args:
+        data (bytes or str): Manifest content
+        filename (str): Original filename ('.json' forces JSON; otherwise the content decides)
+
+    Returns:
+        Manifest
+
+    Raises:
+        ManifestError: If the manifest cannot be parsed or has invalid values
+    """
+    if isinstance(data, bytes):
+        try:
+            data = data.decode('utf-8-sig')
+        except UnicodeDecodeError:
+            raise ManifestError('The manifest must be UTF-8 text')
+    return Manifest(_parse_columns(data, filename or ''))
+
+
+def form_fields(group, client_presets=None):
+    """
+    Geotagging form fields for one manifest group.
+
+    Args:
+        group (dict): Metadata columns of the group (see Manifest.groups)
+        client_presets (dict): Client presets by id, for the client_preset column
+
+    Returns:
+        dict: Fields to layer over the batch's exif_data
+
+    Raises:
+        ManifestError: For an unknown client preset
+    """
+    fields = {}
+    preset_id = group.get('client_preset')
+    if preset_id is not None:
+        preset = (client_presets or {}).get(preset_id)
+        if preset is None:
+            raise ManifestError(f"Unknown client preset '{preset_id}'")
+        for key, value in (preset.get('contact_info') or {}).items():
+            if value:
+                for field in CLIENT_PRESET_FIELDS.get(key, []):
+                    fields[field] = value
+        if preset.get('keywords'):
+            fields['Keywords'] = list(preset['keywords'])
+
+    for name, value in group.items():
+        if name == 'latitude':
+            fields['GPSLatitude'] = value
+        elif name == 'longitude':
+            fields['GPSLongitude'] = value
+        elif name == 'keywords':
+            fields['Keywords'] = value
+        elif name != 'client_preset':
+            fields[name] = value
+    return fields
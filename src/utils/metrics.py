@@ -0,0 +1,231 @@
+"""
+Per-stage batch metrics exposed in the Prometheus text exposition format.
+
+Each process keeps its own counters and histograms in memory. When
+METRICS_MULTIPROC_DIR (or PROMETHEUS_MULTIPROC_DIR) is set, every process also
+snapshots its values to `<dir>/metrics_<pid>.json` after each request, and the
+/metrics endpoint sums the snapshots of all gunicorn workers. Point the variable
+at an empty directory that is cleared when the master starts.
+"""
+from flask import Response
+import os
+import json
+import time
+import atexit
+import threading
+import tempfile
+from contextlib import contextmanager
+
+METRIC_PREFIX = 'image_processor'
+
+# Histogram buckets in seconds, from cheap per-file steps up to multi-minute batches
+STAGE_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+# Stages instrumented in the blueprints
+STAGES = ('upload_save', 'decode', 'convert', 'metadata_write', 'encode', 'zip', 'cleanup')
+
+METRIC_HELP = {
+    'stage_seconds': ('histogram', 'Time spent in each processing stage'),
+    'files_total': ('counter', 'Files handled by the processing endpoints'),
+    'bytes_total': ('counter', 'Bytes received (in) and produced (out) by the processing endpoints'),
+    'errors_total': ('counter', 'Errors raised while processing files'),
+    'exiftool_invocations_total': ('counter', 'ExifTool processes started'),
+    'scratch_bytes_total': ('counter', 'Bytes of working files placed on each scratch tier (ram or disk)'),
+}
+
+_lock = threading.Lock()
+_counters = {}    # (name, labels) -> float
+_histograms = {}  # (name, labels) -> [bucket counts..., +Inf count, sum]
+_dirty = False
+
+
+def _multiproc_dir():
+    return os.environ.get('METRICS_MULTIPROC_DIR') or os.environ.get('PROMETHEUS_MULTIPROC_DIR')
+
+
+def _labels_key(labels):
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def inc_counter(name, amount=1, **labels):
+    """Add `amount` to a counter."""
+    global _dirty
+    key = (name, _labels_key(labels))
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + amount
+        _dirty = True
+
+
+def observe(name, value, **labels):
+    """Record one observation in a histogram."""
+    global _dirty
+    key = (name, _labels_key(labels))
+    with _lock:
+        buckets = _histograms.get(key)
+        if buckets is None:
+            buckets = _histograms[key] = [0] * (len(STAGE_BUCKETS) + 1) + [0.0]
+        for i, bound in enumerate(STAGE_BUCKETS):
+            if value <= bound:
+                buckets[i] += 1
+        buckets[len(STAGE_BUCKETS)] += 1  # +Inf, doubles as the observation count
+        buckets[-1] += value
+        _dirty = True
+
+
+@contextmanager
+def stage_timer(blueprint, stage):
+    """
+    Time a block of work as one processing stage.
+
+    Exceptions are counted in errors_total for the stage and re-raised.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        inc_counter('errors_total', blueprint=blueprint, stage=stage)
+        raise
+    finally:
+        observe('stage_seconds', time.perf_counter() - start, blueprint=blueprint, stage=stage)
+
+
+def count_files(blueprint, outcome, amount=1):
+    """Count files that were processed ('processed'), could not be ('failed') or were rejected on upload ('rejected')."""
+    if amount:
+        inc_counter('files_total', amount, blueprint=blueprint, outcome=outcome)
+
+
+def count_bytes(blueprint, direction, amount):
+    """Count bytes received ('in') or produced ('out')."""
+    if amount:
+        inc_counter('bytes_total', amount, blueprint=blueprint, direction=direction)
+
+
+def count_error(blueprint, stage):
+    """Count an error that was handled without raising out of a stage_timer block."""
+    inc_counter('errors_total', blueprint=blueprint, stage=stage)
+
+
+def count_exiftool(outcome):
+    """Count an ExifTool invocation ('success' or 'failure')."""
+    inc_counter('exiftool_invocations_total', outcome=outcome)
+
+
+def file_size(path):
+    """Size of a file in bytes, or 0 if it is missing."""
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+
+def _snapshot():
+    with _lock:
+        return {
+            'counters': [[name, list(labels), value] for (name, labels), value in _counters.items()],
+            'histograms': [[name, list(labels), list(values)] for (name, labels), values in _histograms.items()],
+        }
+
+
+def flush():
+    """Write this process's values to the multiprocess directory, if one is configured."""
+    global _dirty
+    directory = _multiproc_dir()
+    if not directory or not _dirty:
+        return
+    os.makedirs(directory, exist_ok=True)
+    snapshot = _snapshot()
+    _dirty = False
+    # Write to a temp file and rename so readers never see a partial snapshot
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.metrics_', suffix='.tmp')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(snapshot, f)
+    os.replace(tmp_path, os.path.join(directory, f"metrics_{os.getpid()}.json"))
+
+
+def _collect():
+    """Merge this process's values with the snapshots of every other worker."""
+    counters = {}
+    histograms = {}
+
+    def merge(snapshot):
+        for name, labels, value in snapshot.get('counters', []):
+            key = (name, tuple(tuple(pair) for pair in labels))
+            counters[key] = counters.get(key, 0) + value
+        for name, labels, values in snapshot.get('histograms', []):
+            key = (name, tuple(tuple(pair) for pair in labels))
+            if key in histograms:
+                histograms[key] = [a + b for a, b in zip(histograms[key], values)]
+            else:
+                histograms[key] = list(values)
+
+    merge(_snapshot())
+
+    directory = _multiproc_dir()
+    own_file = f"metrics_{os.getpid()}.json"
+    if directory and os.path.isdir(directory):
+        for filename in os.listdir(directory):
+            if not filename.startswith('metrics_') or not filename.endswith('.json') or filename == own_file:
+                continue
+            try:
+                with open(os.path.join(directory, filename), 'r') as f:
+                    merge(json.load(f))
+            except (OSError, ValueError):
+                continue  # Worker is mid-rename or the file was removed
+    return counters, histograms
+
+
+def _format_labels(labels, extra=None):
+    pairs = list(labels) + (extra or [])
+    if not pairs:
+        return ''
+    escaped = [(k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for k, v in pairs]
+    return '{' + ','.join(f'{k}="{v}"' for k, v in escaped) + '}'
+
+
+def _format_number(value):
+    if isinstance(value, float) and value.is_integer() and abs(value) < 1e15:
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+def render_metrics():
+    """Render all metrics in the Prometheus text exposition format (version 0.0.4)."""
+    counters, histograms = _collect()
+    lines = []
+    for name, (metric_type, help_text) in METRIC_HELP.items():
+        full_name = f"{METRIC_PREFIX}_{name}"
+        lines.append(f"# HELP {full_name} {help_text}")
+        lines.append(f"# TYPE {full_name} {metric_type}")
+        if metric_type == 'counter':
+            for (metric, labels), value in sorted(counters.items()):
+                if metric == name:
+                    lines.append(f"{full_name}{_format_labels(labels)} {_format_number(value)}")
+        else:
+            for (metric, labels), values in sorted(histograms.items()):
+                if metric != name:
+                    continue
+                for bound, count in zip(STAGE_BUCKETS, values):
+                    lines.append(f"{full_name}_bucket{_format_labels(labels, [('le', repr(bound))])} {count}")
+                total = values[len(STAGE_BUCKETS)]
+                lines.append(f"{full_name}_bucket{_format_labels(labels, [('le', '+Inf')])} {total}")
+                lines.append(f"{full_name}_sum{_format_labels(labels)} {_format_number(values[-1])}")
+                lines.append(f"{full_name}_count{_format_labels(labels)} {total}")
+    return '\n'.join(lines) + '\n'
+
+
+def init_app(app):
+    """Register the /metrics endpoint and the per-request snapshot on a Flask app."""
+    @app.route('/metrics')
+    def metrics_endpoint():
+        return Response(render_metrics(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+    @app.after_request
+    def flush_metrics(response):
+        try:
+            flush()
+        except OSError as e:
+            app.logger.warning(f"Could not write metrics snapshot: {e}")
+        return response
+
+    atexit.register(flush)
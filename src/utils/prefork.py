@@ -0,0 +1,69 @@
+"""
+Preloading for forking servers (gunicorn with preload_app, see gunicorn.conf.py).
+
+Without preloading every gunicorn worker imports the app itself: Pillow and its
+codec plugins, the route modules, and the preset documents are loaded and
+parsed once per worker. With preload_app the master builds the app once
+(create_app() in src/app.py and src/main.py) and forks the workers from it, so
+that state is shared copy-on-write.
+
+Only state that survives fork() may be built in the master:
+- preload() (called by create_app through init_app) loads every Pillow plugin,
+  checks which output encoders are available, and parses the city and client
+  preset documents and the city preset catalog.
+- before_fork() runs in the master before each worker is forked. It closes the
+  SQLite connections the master opened (a connection must not be carried
+  across fork()) and moves everything allocated so far into the garbage
+  collector's permanent generation (gc.freeze), so collections in the workers
+  do not write to - and thereby copy - the shared pages.
+- after_fork() runs in each worker and creates its own resources: the storage
+  backend (boto3 clients are not fork-safe). The SQLite connection pools and
+  the score flusher thread are per process already (see
+  src/models/leaderboard.py) and start over in the worker on first use.
+
+ExifTool is started once per call (src/utils/exiftool_runner.py), so there are
+no long-lived ExifTool processes to hand over, and the ASGI thread pool starts
+its threads on first use, in the worker.
+"""
+import gc
+from PIL import Image
+from src.utils import encoders, storage
+
+_apps = []
+
+
+def preload(app):
+    """Build the fork-safe state `app` would otherwise build on first use in every worker."""
+    # Every Pillow plugin, and the check for optional encoders (WebP, AVIF, HEIC)
+    Image.init()
+    encoders.available_formats()
+
+    from src.routes import presets
+    with app.app_context():
+        presets.city_document().read()
+        presets.client_document().read()
+        try:
+            presets.city_catalog().countries()
+        except Exception as e:
+            # The catalog is rebuilt on the first query if this fails
+            app.logger.warning(f"Could not preload the preset catalog: {e}")
+
+
+def before_fork():
+    """Close the master's SQLite connections and freeze what it allocated (call before forking a worker)."""
+    from src.models import leaderboard, preset_catalog
+    leaderboard.get_pool().close_all()
+    preset_catalog.close_all()
+    gc.freeze()
+
+
+def after_fork():
+    """Create the per-worker resources of every app built in this process (call in the worker after the fork)."""
+    for app in _apps:
+        storage.init_app(app)
+
+
+def init_app(app):
+    """Preload `app`'s fork-safe state and remember it for after_fork()."""
+    preload(app)
+    _apps.append(app)
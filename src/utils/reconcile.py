@@ -0,0 +1,154 @@
+"""
+Reconcile mode for geotagging: only write metadata that is not already there.
+
+Re-submitted folders often already carry the right GPS, location and contact
+tags. Before anything is copied or re-encoded, the current values of every tag
+in the batch's write plans are read for all files in one ExifTool pass
+(`exiftool -j -G0:1` over many files at once) and compared with each file's
+plan:
+
+- changed: write only the tags whose value differs
+- fill_missing: write only the tags the file does not have at all
+
+A file with nothing left to write is passed through untouched.
+
+Values are compared the way ExifTool prints them, after normalizing the
+differences between what the plan writes and what ExifTool reads back
+(coordinate signs and references, 'N' vs 'North', ISO vs EXIF date formats,
+units on GPSAltitude, single keywords vs lists).
+"""
+from flask import current_app
+import re
+import json
+from src.utils import exiftool_runner, metrics
+
+MODES = ('off', 'changed', 'fill_missing')
+
+# Files per ExifTool read, to stay well within command line limits
+READ_BATCH_SIZE = 200
+
+_DATETIME_RE = re.compile(r'^(\d{4})[:-](\d{2})[:-](\d{2})(?:[ T](\d{2}):(\d{2})(?::(\d{2}))?)?')
+_NUMBER_RE = re.compile(r'^[+-]?(\d+(\.\d*)?|\.\d+)')
+
+
+def read_tags(paths, tags, timeout=None):
+    """
+    Read the current values of `tags` from many files with as few ExifTool runs as possible.
+
+    Args:
+        paths (list): Image files
+        tags (iterable): Tags as written by the geotagging plan ('GPS:GPSLatitude', 'XMP-dc:Subject', ...)
+        timeout (float): Seconds per ExifTool run
+
+    Returns:
+        dict: path -> {'Family0:Family1:Tag': value}; files that could not be read are left out
+    """
+    tags = sorted(set(tags))
+    current = {}
+    if not paths or not tags:
+        return current
+    command = ['exiftool', '-j', '-G0:1', '-c', '%.8f', '-m', '-q'] + [f'-{tag}' for tag in tags]
+    for start in range(0, len(paths), READ_BATCH_SIZE):
+        batch = paths[start:start + READ_BATCH_SIZE]
+        try:
+            with metrics.stage_timer('geotagging', 'metadata_read'):
+                process = exiftool_runner.run(command + batch, timeout)
+            entries = json.loads(process.stdout or '[]')
+        except Exception as e:
+            current_app.logger.warning(f"Reconcile: could not read current metadata: {e}")
+            continue
+        for entry in entries:
+            source = entry.pop('SourceFile', None)
+            if source is not None:
+                current[source] = entry
+    return current
+
+
+def _find(tag, current):
+    """Current value of a plan tag ('GROUP:Name'), matching the group against family 0 or 1. None if absent."""
+    group, _, name = tag.rpartition(':')
+    for key, value in current.items():
+        parts = key.split(':')
+        if parts[-1] == name and (not group or group in parts[:-1]):
+            return value
+    return None
+
+
+def _missing(value):
+    return value is None or (isinstance(value, (str, list)) and not value)
+
+
+def _number(value):
+    match = _NUMBER_RE.match(str(value).strip())
+    return float(match.group(0)) if match else None
+
+
+def _same(tag, wanted, current):
+    """Whether the file's current value already equals the value the plan would write."""
+    name = tag.rpartition(':')[2]
+    if isinstance(wanted, list) or isinstance(current, list):
+        wanted = wanted if isinstance(wanted, list) else [wanted]
+        current = current if isinstance(current, list) else [current]
+        return sorted(str(v).strip() for v in wanted) == sorted(str(v).strip() for v in current)
+
+    wanted_text, current_text = str(wanted).strip(), str(current).strip()
+    if name in ('GPSLatitudeRef', 'GPSLongitudeRef'):
+        return wanted_text[:1].upper() == current_text[:1].upper()
+    if name in ('GPSLatitude', 'GPSLongitude', 'GPSAltitude'):
+        a, b = _number(wanted_text), _number(current_text)
+        if a is None or b is None:
+            return False
+        if tag.startswith('GPS:'):
+            # The GPS IFD stores magnitudes; the sign lives in the Ref tag
+            a, b = abs(a), abs(b)
+        return abs(a - b) <= (1e-6 if name != 'GPSAltitude' else 0.01)
+
+    wanted_date, current_date = _DATETIME_RE.match(wanted_text), _DATETIME_RE.match(current_text)
+    if wanted_date and current_date:
+        return wanted_date.groups() == current_date.groups()
+
+    a, b = _number(wanted_text), _number(current_text)
+    if a is not None and b is not None and _NUMBER_RE.fullmatch(wanted_text) and _NUMBER_RE.fullmatch(current_text):
+        return abs(a - b) <= 1e-9 * max(1.0, abs(a))
+    return wanted_text == current_text
+
+
+def diff_plan(plan, current, mode):
+    """
+    The part of a write plan a file still needs.
+
+    Args:
+        plan (dict): Flattened ExifTool tags to write
+        current (dict): The file's current values from read_tags, or None if they could not be read
+        mode (str): 'changed' or 'fill_missing'
+
+    Returns:
+        dict: Tags to write (the whole plan when the current values are unknown)
+    """
+    if current is None:
+        return dict(plan)
+    needed = {}
+    for tag, wanted in plan.items():
+        if _missing(wanted):
+            continue
+        value = _find(tag, current)
+        if _missing(value):
+            needed[tag] = wanted
+        elif mode == 'changed' and not _same(tag, wanted, value):
+            needed[tag] = wanted
+    return needed
+
+
+def full_plan(plan, current, mode):
+    """
+    Complete plan for a file that is re-encoded (and so loses its metadata) before writing.
+
+    Tags reconcile would leave alone keep their current value instead of being dropped.
+    """
+    if current is None or mode != 'fill_missing':
+        return dict(plan)
+    merged = {}
+    for tag, wanted in plan.items():
+        value = _find(tag, current)
+        merged[tag] = wanted if _missing(value) else value
+    return merged
@@ -0,0 +1,218 @@
+"""
+Tiered scratch space for the working files of a processing request.
+
+Most batches are phone photos of a few megabytes. Writing them to disk only to
+read them back a moment later costs far more than keeping them in memory, so
+uploads and intermediate files (the temporary JPEGs ExifTool writes from) go to
+a RAM-backed tmpfs such as /dev/shm while they fit:
+
+- The RAM tier has a host-wide budget, shared by every worker through a ledger
+  file (the same flock()-protected ledger admission control uses). Each session
+  reserves what it places there and releases it when the request ends.
+- A file spills to the disk tier (the session's UPLOAD_FOLDER) when it is larger
+  than SCRATCH_MAX_FILE_SIZE, when the budget is used up, or when the kernel
+  reports less than SCRATCH_MIN_AVAILABLE_MEMORY available memory (tmpfs pages
+  cannot be reclaimed, so the RAM tier must not push the host into swap).
+- Processed outputs stay in PROCESSED_FOLDER, which the local storage backend
+  serves downloads from, and uploads claimed from /api/uploads stay on disk,
+  where they are moved without copying.
+
+The blueprints open a session with open_session() and ask it for paths. Sessions
+are closed at the end of the request, which removes their RAM-tier files;
+folders left behind by workers that died are removed at startup.
+
+Config keys (all optional, environment variables of the same name override them):
+- SCRATCH_RAM_DIR: tmpfs directory for the RAM tier (default: /dev/shm when it exists; empty disables the tier)
+- SCRATCH_RAM_BUDGET: bytes the RAM tier may hold host-wide (default: an eighth of physical RAM)
+- SCRATCH_MAX_FILE_SIZE: larger files always go to disk (default: 64 MiB)
+- SCRATCH_MIN_AVAILABLE_MEMORY: spill to disk below this much available memory (default: an eighth of physical RAM)
+- SCRATCH_LEDGER_PATH: ledger file (default: <tmp>/image_processor_scratch.json)
+"""
+from flask import current_app, g
+import os
+import shutil
+import tempfile
+from src.utils import admission, metrics
+
+DEFAULT_RAM_DIR = '/dev/shm'
+DEFAULT_MAX_FILE_SIZE = 64 * 1024 * 1024
+FALLBACK_RAM_BUDGET = 256 * 1024 * 1024  # used when physical RAM cannot be determined
+SCRATCH_DIRNAME = 'image_processor_scratch'  # under SCRATCH_RAM_DIR, one folder per session
+
+_ledgers = {}
+
+
+def _config(app, key, default, cast=int):
+    value = os.environ.get(key)
+    if value is None:
+        value = app.config.get(key, default)
+    return cast(value) if value not in (None, '') else None
+
+
+def ram_root(app):
+    """Folder holding the RAM-tier session folders, or None when the RAM tier is off."""
+    default = DEFAULT_RAM_DIR if os.path.isdir(DEFAULT_RAM_DIR) and os.access(DEFAULT_RAM_DIR, os.W_OK) else None
+    directory = _config(app, 'SCRATCH_RAM_DIR', default, cast=str)
+    return os.path.join(directory, SCRATCH_DIRNAME) if directory else None
+
+
+def _eighth_of_memory():
+    total = admission.physical_memory()
+    return total // 8 if total else FALLBACK_RAM_BUDGET
+
+
+def available_memory():
+    """MemAvailable from /proc/meminfo in bytes, or None where it cannot be read."""
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+def get_ledger(app):
+    path = _config(app, 'SCRATCH_LEDGER_PATH',
+                   os.path.join(tempfile.gettempdir(), 'image_processor_scratch.json'), cast=str)
+    if path not in _ledgers:
+        _ledgers[path] = admission.MemoryLedger(path)
+    return _ledgers[path]
+
+
+def session_folders(session_id):
+    """(upload_folder, processed_folder) of a session on disk."""
+    return (os.path.join(current_app.config['UPLOAD_FOLDER'], session_id),
+            os.path.join(current_app.config['PROCESSED_FOLDER'], session_id))
+
+
+class ScratchSession:
+    """Working files of one processing request, on the RAM tier while they fit and on disk otherwise."""
+
+    def __init__(self, app, session_id):
+        self.app = app
+        self.session_id = session_id
+        self.upload_folder, self.processed_folder = session_folders(session_id)
+        root = ram_root(app)
+        self.ram_folder = os.path.join(root, session_id) if root else None
+        self.token = f"{os.getpid()}:{session_id}"
+        self.ram_files = {}  # path -> bytes reserved for it on the RAM tier
+        self.usage = {'ram': 0, 'disk': 0}  # bytes placed on each tier
+        self.closed = False
+
+    def _reserve_ram(self, size):
+        if self.ram_folder is None or size is None or self.closed:
+            return False
+        if size > _config(self.app, 'SCRATCH_MAX_FILE_SIZE', DEFAULT_MAX_FILE_SIZE):
+            return False
+        available = available_memory()
+        min_available = _config(self.app, 'SCRATCH_MIN_AVAILABLE_MEMORY', _eighth_of_memory())
+        if available is not None and available - size < min_available:
+            return False
+        total = sum(self.ram_files.values()) + size
+        budget = _config(self.app, 'SCRATCH_RAM_BUDGET', _eighth_of_memory())
+        return total <= budget and get_ledger(self.app).try_reserve(self.token, total, budget)
+
+    def path(self, kind, name, size):
+        """
+        Path for a new working file, on the RAM tier if it fits there.
+
+        Args:
+            kind (str): What the file is ('uploads' or 'work'), used as a subfolder on the RAM tier
+            name (str): File name (unique within the session)
+            size (int): Expected size in bytes (None when unknown, which means disk)
+
+        Returns:
+            str: Path whose folder exists
+        """
+        if self._reserve_ram(size):
+            folder = os.path.join(self.ram_folder, kind)
+            self.ram_files[os.path.join(folder, name)] = size
+            tier = 'ram'
+        else:
+            folder = self.upload_folder
+            tier = 'disk'
+        os.makedirs(folder, exist_ok=True)
+        self.usage[tier] += size or 0
+        metrics.inc_counter('scratch_bytes_total', size or 0, tier=tier)
+        return os.path.join(folder, name)
+
+    def save_upload(self, file, name):
+        """
+        Save an uploaded file (werkzeug FileStorage) on the tier it fits.
+
+        Returns:
+            str: Path of the saved file
+        """
+        try:
+            size = file.stream.seek(0, os.SEEK_END)
+            file.stream.seek(0)
+        except (AttributeError, OSError, ValueError):
+            size = None
+        path = self.path('uploads', name, size)
+        file.save(path)
+        return path
+
+    def remove(self, path):
+        """Delete a working file early and return its RAM-tier reservation."""
+        if os.path.exists(path):
+            os.remove(path)
+        if self.ram_files.pop(path, None) is not None and not self.closed:
+            ledger = get_ledger(self.app)
+            total = sum(self.ram_files.values())
+            if total:
+                ledger.try_reserve(self.token, total, _config(self.app, 'SCRATCH_RAM_BUDGET', _eighth_of_memory()))
+            else:
+                ledger.release(self.token)
+
+    def close(self):
+        """Remove the session's RAM-tier files and release its reservation (disk folders are left to the caller)."""
+        if self.closed:
+            return
+        self.closed = True
+        if self.ram_folder is not None:
+            shutil.rmtree(self.ram_folder, ignore_errors=True)
+            if self.ram_files:
+                get_ledger(self.app).release(self.token)
+            self.ram_files = {}
+
+
+def open_session(session_id):
+    """
+    Scratch space for a new processing session, closed automatically at the end of the request.
+
+    Returns:
+        ScratchSession: Ask it for paths; upload_folder and processed_folder are the disk folders
+    """
+    session = ScratchSession(current_app._get_current_object(), session_id)
+    g.setdefault('scratch_sessions', []).append(session)
+    return session
+
+
+def cleanup_stale(app):
+    """Remove RAM-tier session folders whose worker no longer holds a reservation."""
+    root = ram_root(app)
+    if not root or not os.path.isdir(root):
+        return
+    live = {token.partition(':')[2] for token in get_ledger(app).tokens()}
+    for name in os.listdir(root):
+        if name not in live:
+            shutil.rmtree(os.path.join(root, name), ignore_errors=True)
+
+
+def init_app(app):
+    """Create the RAM tier, drop what dead workers left there and close sessions at the end of each request."""
+    root = ram_root(app)
+    if root:
+        try:
+            os.makedirs(root, exist_ok=True)
+            cleanup_stale(app)
+        except OSError as e:
+            app.logger.warning(f"RAM scratch tier unavailable, using disk only: {e}")
+            app.config['SCRATCH_RAM_DIR'] = ''
+
+    @app.teardown_request
+    def close_scratch_sessions(exc):
+        for session in g.pop('scratch_sessions', []):
+            session.close()
@@ -0,0 +1,194 @@
+"""
+Content sniffing for uploaded images.
+
+The blueprints only look at the file extension (allowed_file), so a
+mislabeled or truncated file used to be written to disk in full and fail later
+in Image.open. Instead, the first SNIFF_BYTES of every multipart part whose
+filename has an image extension are held back while the body streams in and
+checked against the JPEG, PNG, TIFF, WebP, HEIF (ftyp box), BMP and GIF
+signatures:
+
+- A part that matches is written to its usual spooled temporary file.
+- A part that does not is never written anywhere: the rest of its bytes are
+  dropped as they arrive, and the file is removed from request.files (with its
+  file_paths[] entry when the two lists are paired) before a route sees it.
+  request.rejected_uploads lists what was dropped and why.
+- When every image part of a request was dropped and nothing was sent through
+  /api/uploads, the request is rejected with 400 before the route creates
+  session folders or reserves memory.
+
+Parts with other extensions (GPX tracks, CSV/JSON manifests) are left alone.
+Resumable uploads sniff the chunk that starts at offset 0 in the same way (see
+src/routes/uploads.py). Only the container is checked, not that it matches the
+extension: a PNG named .jpg still decodes fine.
+"""
+from flask import Request, jsonify, request, current_app
+from werkzeug.formparser import default_stream_factory
+from src.utils import metrics
+
+# Enough for every signature below, including the compatible brands of a typical ftyp box
+SNIFF_BYTES = 64
+
+SNIFFED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'tiff', 'tif', 'bmp', 'heic', 'heif', 'webp', 'gif'}
+
+HEIF_BRANDS = {b'heic', b'heix', b'hevc', b'hevx', b'heim', b'heis', b'hevm', b'hevs', b'mif1', b'msf1'}
+
+REJECTED_REASON = 'Content is not a JPEG, PNG, TIFF, WebP, HEIF, BMP or GIF image'
+
+
+def detect(head):
+    """
+    Identify an image container from its first bytes.
+
+    Args:
+        head (bytes): Start of the file (SNIFF_BYTES covers every format)
+
+    Returns:
+        str: 'JPEG', 'PNG', 'TIFF', 'WEBP', 'HEIF', 'BMP' or 'GIF', or None if none matches
+    """
+    if head.startswith(b'\xff\xd8\xff'):
+        return 'JPEG'
+    if head.startswith(b'\x89PNG\r\n\x1a\n'):
+        return 'PNG'
+    if head[:4] in (b'II*\x00', b'MM\x00*', b'II+\x00', b'MM\x00+'):  # classic and BigTIFF
+        return 'TIFF'
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return 'WEBP'
+    if head[4:8] == b'ftyp':
+        # Major brand, then compatible brands up to the end of the box
+        box_end = min(int.from_bytes(head[:4], 'big'), len(head))
+        brands = [head[8:12]] + [head[i:i + 4] for i in range(16, box_end - 3, 4)]
+        if HEIF_BRANDS.intersection(brands):
+            return 'HEIF'
+    if head[:6] in (b'GIF87a', b'GIF89a'):
+        return 'GIF'
+    if head.startswith(b'BM') and len(head) >= 14:
+        return 'BMP'
+    return None
+
+
+def sniffed(filename):
+    """Whether uploads named `filename` are checked (image extensions only)."""
+    return bool(filename) and '.' in filename and filename.rsplit('.', 1)[1].lower() in SNIFFED_EXTENSIONS
+
+
+class _SniffingStream:
+    """Write target for one multipart file part that holds back its first bytes until they are checked."""
+
+    def __init__(self, open_target):
+        self._open_target = open_target
+        self._head = b''
+        self.target = None  # The real spooled file, once the part is accepted
+        self.rejected = False
+
+    def _decide(self):
+        if detect(self._head) is None:
+            self.rejected = True
+        else:
+            self.target = self._open_target()
+            self.target.write(self._head)
+        self._head = b''
+
+    def write(self, data):
+        if self.target is not None:
+            return self.target.write(data)
+        if not self.rejected:
+            self._head += data
+            if len(self._head) >= SNIFF_BYTES:
+                self._decide()
+        return len(data)
+
+    def seek(self, offset, whence=0):
+        # The parser rewinds once the part is complete; parts shorter than SNIFF_BYTES are decided here
+        if self.target is None and not self.rejected:
+            self._decide()
+        return self.target.seek(offset, whence) if self.target is not None else 0
+
+    def close(self):
+        if self.target is not None:
+            self.target.close()
+
+
+class SniffingRequest(Request):
+    """Request that checks image parts while the multipart body is parsed."""
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        def open_target():
+            return default_stream_factory(
+                total_content_length=total_content_length,
+                filename=filename,
+                content_type=content_type,
+                content_length=content_length,
+            )
+        if not sniffed(filename):
+            return open_target()
+        return _SniffingStream(open_target)
+
+    def _load_form_data(self):
+        if 'form' in self.__dict__:
+            return
+        super()._load_form_data()
+
+        files = self.__dict__['files']
+        rejected = []
+        kept = []
+        rejected_indexes = {}  # field name -> positions of its dropped files
+        positions = {}
+        for name, storage in files.items(multi=True):
+            position = positions[name] = positions.get(name, -1) + 1
+            stream = storage.stream
+            if isinstance(stream, _SniffingStream):
+                if stream.rejected:
+                    rejected.append({'file': storage.filename, 'field': name, 'reason': REJECTED_REASON})
+                    rejected_indexes.setdefault(name, set()).add(position)
+                    continue
+                storage.stream = stream.target
+            kept.append((name, storage))
+        self._rejected_uploads = rejected
+        if not rejected:
+            return
+
+        self.__dict__['files'] = self.parameter_storage_class(kept)
+        # geotagging pairs files[] with file_paths[] by position
+        dropped_paths = rejected_indexes.get('files[]', set())
+        form = self.__dict__['form']
+        if dropped_paths and len(form.getlist('file_paths[]')) == positions.get('files[]', -1) + 1:
+            form_items = []
+            index = 0
+            for name, value in form.items(multi=True):
+                if name == 'file_paths[]':
+                    index += 1
+                    if index - 1 in dropped_paths:
+                        continue
+                form_items.append((name, value))
+            self.__dict__['form'] = self.parameter_storage_class(form_items)
+
+        for item in rejected:
+            current_app.logger.warning(f"Rejected upload {item['file']!r}: {item['reason']}")
+        metrics.count_files(self.blueprint or 'app', 'rejected', len(rejected))
+
+    @property
+    def rejected_uploads(self):
+        """Image parts that were dropped: list of {'file', 'field', 'reason'}."""
+        self._load_form_data()
+        return getattr(self, '_rejected_uploads', [])
+
+
+def init_app(app):
+    """Sniff uploaded images while they stream in and reject requests that contain no valid image."""
+    app.request_class = SniffingRequest
+
+    @app.before_request
+    def reject_invalid_uploads():
+        if request.mimetype != 'multipart/form-data':
+            return None
+        rejected = request.rejected_uploads
+        if not rejected or request.form.getlist('upload_ids[]'):
+            return None
+        if any(sniffed(f.filename) for f in request.files.getlist('files[]')):
+            return None
+        names = ', '.join(item['file'] for item in rejected)
+        return jsonify({
+            'error': 'No valid image files provided',
+            'details': f'{REJECTED_REASON}: {names}'
+        }), 400
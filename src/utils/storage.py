@@ -0,0 +1,401 @@
+"""
+Storage for processed outputs and session state shared between nodes.
+
+Images are still decoded and encoded in node-local scratch folders
+(UPLOAD_FOLDER, PROCESSED_FOLDER), but everything a later request needs -
+zip files, single-file downloads, geotagging progress - is published under a
+storage key such as `processed/<session_id>/converted_images_<session_id>.zip`.
+Any node can then answer the download or progress poll, so the app scales
+horizontally without sticky sessions.
+
+Backends:
+- local (default): keys map onto PROCESSED_FOLDER and SESSION_FOLDER, so
+  publishing a file that is already there costs nothing. Point those folders
+  at a shared mount (NFS, EFS) to run several nodes.
+- s3: any S3-compatible object store (AWS S3, MinIO, Ceph RGW, R2). Large
+  files and zip archives are streamed with multipart uploads, and downloads
+  redirect to presigned URLs so the bytes never pass through the app.
+  Requires boto3, which is not installed by default.
+
+Config keys (environment variables of the same name override them):
+- STORAGE_BACKEND: 'local' or 's3' (default: 'local')
+- STORAGE_S3_BUCKET: bucket name (required for s3)
+- STORAGE_S3_PREFIX: key prefix inside the bucket (default: '')
+- STORAGE_S3_ENDPOINT_URL: endpoint for S3-compatible stores, e.g. http://minio:9000
+- STORAGE_S3_PUBLIC_ENDPOINT_URL: endpoint browsers use for presigned URLs (default: STORAGE_S3_ENDPOINT_URL)
+- STORAGE_S3_REGION: region name (default: boto3's configuration)
+- STORAGE_PRESIGN_EXPIRES: lifetime of presigned download URLs in seconds (default: 3600)
+- STORAGE_PART_SIZE: multipart upload part size in bytes, at least 5 MiB (default: 8 MiB)
+
+Credentials come from boto3's usual chain (AWS_ACCESS_KEY_ID /
+AWS_SECRET_ACCESS_KEY, shared config files or an instance role).
+"""
+from flask import current_app, jsonify, redirect
+import io
+import os
+import json
+import shutil
+import mimetypes
+import tempfile
+import contextlib
+from src.utils import downloads
+
+try:
+    import boto3
+    from botocore.config import Config as BotoConfig
+    from botocore.exceptions import ClientError
+    from boto3.s3.transfer import TransferConfig
+except ImportError:  # boto3 is only needed for STORAGE_BACKEND=s3
+    boto3 = None
+
+DEFAULT_PRESIGN_EXPIRES = 3600
+DEFAULT_PART_SIZE = 8 * 1024 * 1024
+MIN_PART_SIZE = 5 * 1024 * 1024  # S3's lower limit for every part but the last
+
+
+class StorageError(Exception):
+    """Raised when the storage backend is misconfigured or unavailable."""
+
+
+def _setting(key, default=''):
+    return os.environ.get(key) or current_app.config.get(key) or default
+
+
+def processed_key(session_id, *parts):
+    """Storage key for a session's processed outputs (or the session's prefix when no parts are given)."""
+    return '/'.join(('processed', session_id) + tuple(p.replace(os.sep, '/') for p in parts))
+
+
+def session_key(session_id, *parts):
+    """Storage key under the legacy /download/<session_id> session folder."""
+    return '/'.join(('sessions', session_id) + tuple(p.replace(os.sep, '/') for p in parts))
+
+
+def _guess_type(name):
+    return mimetypes.guess_type(name)[0] or 'application/octet-stream'
+
+
+class LocalStorage:
+    """Keys map onto folders of the local (or shared) filesystem."""
+
+    name = 'local'
+
+    def __init__(self, folders):
+        """
+        Args:
+            folders (dict): Folder for each top-level key namespace ('processed', 'sessions')
+        """
+        self.folders = folders
+
+    def local_path(self, key):
+        """Filesystem path for `key`."""
+        namespace, _, rest = key.partition('/')
+        if namespace not in self.folders:
+            raise StorageError(f"Unknown storage namespace '{namespace}'")
+        root = os.path.realpath(self.folders[namespace])
+        path = os.path.realpath(os.path.join(root, *rest.split('/')))
+        if os.path.commonpath([root, path]) != root:
+            raise StorageError(f"Storage key escapes its namespace: {key}")
+        return path
+
+    def publish(self, path, key):
+        """Make the local file `path` available under `key`."""
+        target = self.local_path(key)
+        if os.path.realpath(path) == target:
+            return  # Already in place
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        with self.open_write(key) as dest, open(path, 'rb') as src:
+            shutil.copyfileobj(src, dest, 1024 * 1024)
+
+    @contextlib.contextmanager
+    def open_write(self, key):
+        """Write a new object as a stream; it only appears under `key` once the block completes."""
+        target = self.local_path(key)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(target), prefix='.', suffix='.part')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                yield f
+            os.replace(tmp_path, target)
+        except BaseException:
+            with contextlib.suppress(OSError):
+                os.remove(tmp_path)
+            raise
+
+    def put_json(self, key, data):
+        with self.open_write(key) as f:
+            f.write(json.dumps(data).encode('utf-8'))
+
+    def get_json(self, key, default=None):
+        try:
+            with open(self.local_path(key), 'rb') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return default
+
+    def exists(self, key):
+        return os.path.isfile(self.local_path(key))
+
+    def list(self, prefix):
+        """Keys under `prefix`, relative to it, skipping partial writes."""
+        root = self.local_path(prefix)
+        names = []
+        for dirpath, _, files in os.walk(root):
+            for filename in sorted(files):
+                if not filename.startswith('.'):
+                    names.append(os.path.relpath(os.path.join(dirpath, filename), root).replace(os.sep, '/'))
+        return names
+
+    def delete_prefix(self, prefix):
+        path = self.local_path(prefix)
+        if os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+        elif os.path.exists(path):
+            os.remove(path)
+
+    def discard_scratch(self, *folders):
+        """Nothing to do: the scratch folders are the storage."""
+
+    def send_download(self, key, download_name, mimetype=None):
+        return downloads.send_download(self.local_path(key), download_name=download_name, mimetype=mimetype)
+
+
+class _MultipartWriter(io.RawIOBase):
+    """Non-seekable file object that streams its bytes to S3 as a multipart upload."""
+
+    def __init__(self, client, bucket, key, part_size, content_type):
+        self.client = client
+        self.bucket = bucket
+        self.key = key
+        self.part_size = part_size
+        self.content_type = content_type
+        self.buffer = bytearray()
+        self.upload_id = None
+        self.parts = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.buffer += data
+        while len(self.buffer) >= self.part_size:
+            self._upload_part(bytes(self.buffer[:self.part_size]))
+            del self.buffer[:self.part_size]
+        return len(data)
+
+    def _upload_part(self, body):
+        if self.upload_id is None:
+            self.upload_id = self.client.create_multipart_upload(
+                Bucket=self.bucket, Key=self.key, ContentType=self.content_type)['UploadId']
+        number = len(self.parts) + 1
+        response = self.client.upload_part(
+            Bucket=self.bucket, Key=self.key, UploadId=self.upload_id, PartNumber=number, Body=body)
+        self.parts.append({'ETag': response['ETag'], 'PartNumber': number})
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            if self.upload_id is None:
+                # Small object: a single PUT is cheaper than a one-part multipart upload
+                self.client.put_object(Bucket=self.bucket, Key=self.key, Body=bytes(self.buffer),
+                                       ContentType=self.content_type)
+            else:
+                if self.buffer:
+                    self._upload_part(bytes(self.buffer))
+                self.client.complete_multipart_upload(
+                    Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+                    MultipartUpload={'Parts': self.parts})
+        finally:
+            self.buffer = bytearray()
+            super().close()
+
+    def abort(self):
+        if self.upload_id is not None:
+            with contextlib.suppress(ClientError):
+                self.client.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id)
+        self.buffer = bytearray()
+        super().close()
+
+
+class S3Storage:
+    """Keys map onto objects in an S3-compatible bucket."""
+
+    name = 's3'
+
+    def __init__(self, bucket, prefix='', endpoint_url=None, public_endpoint_url=None, region=None,
+                 presign_expires=DEFAULT_PRESIGN_EXPIRES, part_size=DEFAULT_PART_SIZE):
+        """
+        Args:
+            bucket (str): Bucket name
+            prefix (str): Key prefix inside the bucket
+            endpoint_url (str): Endpoint of an S3-compatible store (None for AWS)
+            public_endpoint_url (str): Endpoint used in presigned URLs (defaults to endpoint_url)
+            region (str): Region name
+            presign_expires (int): Lifetime of presigned download URLs in seconds
+            part_size (int): Multipart upload part size in bytes
+        """
+        if boto3 is None:
+            raise StorageError("STORAGE_BACKEND=s3 requires boto3 (pip install boto3)")
+        if not bucket:
+            raise StorageError("STORAGE_BACKEND=s3 requires STORAGE_S3_BUCKET")
+        self.bucket = bucket
+        self.prefix = prefix.strip('/') + '/' if prefix.strip('/') else ''
+        self.presign_expires = presign_expires
+        self.part_size = max(MIN_PART_SIZE, part_size)
+        # Path-style addressing works with MinIO and other stores without wildcard DNS
+        config = BotoConfig(signature_version='s3v4',
+                            s3={'addressing_style': 'path' if endpoint_url else 'auto'})
+        self.client = boto3.client('s3', endpoint_url=endpoint_url or None, region_name=region or None, config=config)
+        if public_endpoint_url and public_endpoint_url != endpoint_url:
+            self.presign_client = boto3.client('s3', endpoint_url=public_endpoint_url,
+                                               region_name=region or None, config=config)
+        else:
+            self.presign_client = self.client
+        self.transfer_config = TransferConfig(multipart_threshold=self.part_size,
+                                              multipart_chunksize=self.part_size)
+
+    def _object_key(self, key):
+        return self.prefix + key
+
+    def publish(self, path, key):
+        """Upload the local file `path` to `key` (multipart above STORAGE_PART_SIZE)."""
+        self.client.upload_file(path, self.bucket, self._object_key(key),
+                                ExtraArgs={'ContentType': _guess_type(key)}, Config=self.transfer_config)
+
+    @contextlib.contextmanager
+    def open_write(self, key):
+        """Write a new object as a stream; parts are uploaded as they fill and nothing is kept on disk."""
+        writer = _MultipartWriter(self.client, self.bucket, self._object_key(key), self.part_size, _guess_type(key))
+        try:
+            yield writer
+        except BaseException:
+            writer.abort()
+            raise
+        writer.close()
+
+    def put_json(self, key, data):
+        self.client.put_object(Bucket=self.bucket, Key=self._object_key(key),
+                               Body=json.dumps(data).encode('utf-8'), ContentType='application/json')
+
+    def get_json(self, key, default=None):
+        try:
+            response = self.client.get_object(Bucket=self.bucket, Key=self._object_key(key))
+            return json.loads(response['Body'].read())
+        except self.client.exceptions.NoSuchKey:
+            return default
+        except ValueError:
+            return default
+
+    def exists(self, key):
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=self._object_key(key))
+            return True
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound'):
+                return False
+            raise
+
+    def _iter_objects(self, prefix):
+        paginator = self.client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=self._object_key(prefix).rstrip('/') + '/'):
+            yield from page.get('Contents', [])
+
+    def list(self, prefix):
+        """Keys under `prefix`, relative to it."""
+        start = len(self._object_key(prefix).rstrip('/')) + 1
+        return sorted(obj['Key'][start:] for obj in self._iter_objects(prefix))
+
+    def delete_prefix(self, prefix):
+        batch = []
+        for obj in self._iter_objects(prefix):
+            batch.append({'Key': obj['Key']})
+            if len(batch) == 1000:  # DeleteObjects limit
+                self.client.delete_objects(Bucket=self.bucket, Delete={'Objects': batch, 'Quiet': True})
+                batch = []
+        if batch:
+            self.client.delete_objects(Bucket=self.bucket, Delete={'Objects': batch, 'Quiet': True})
+
+    def discard_scratch(self, *folders):
+        """Remove node-local scratch folders once their outputs are published; a later cleanup request may land elsewhere."""
+        for folder in folders:
+            shutil.rmtree(folder, ignore_errors=True)
+
+    def presigned_url(self, key, download_name, mimetype=None):
+        """Time-limited GET URL that makes the browser save the object as `download_name`."""
+        disposition_name = download_name.replace('"', '')
+        return self.presign_client.generate_presigned_url(
+            'get_object',
+            Params={
+                'Bucket': self.bucket,
+                'Key': self._object_key(key),
+                'ResponseContentDisposition': f'attachment; filename="{disposition_name}"',
+                'ResponseContentType': mimetype or _guess_type(download_name),
+            },
+            ExpiresIn=self.presign_expires,
+        )
+
+    def send_download(self, key, download_name, mimetype=None):
+        return redirect(self.presigned_url(key, download_name, mimetype), code=302)
+
+
+def create_storage(app):
+    """
+    Build the storage backend configured for `app`.
+
+    Args:
+        app (Flask): The application
+
+    Returns:
+        LocalStorage or S3Storage
+    """
+    with app.app_context():
+        backend = _setting('STORAGE_BACKEND', 'local').strip().lower()
+        if backend in ('', 'local'):
+            return LocalStorage({
+                'processed': app.config['PROCESSED_FOLDER'],
+                'sessions': app.config['SESSION_FOLDER'],
+            })
+        if backend in ('s3', 'minio'):
+            return S3Storage(
+                bucket=_setting('STORAGE_S3_BUCKET'),
+                prefix=_setting('STORAGE_S3_PREFIX'),
+                endpoint_url=_setting('STORAGE_S3_ENDPOINT_URL') or None,
+                public_endpoint_url=_setting('STORAGE_S3_PUBLIC_ENDPOINT_URL') or None,
+                region=_setting('STORAGE_S3_REGION') or None,
+                presign_expires=int(_setting('STORAGE_PRESIGN_EXPIRES', DEFAULT_PRESIGN_EXPIRES)),
+                part_size=int(_setting('STORAGE_PART_SIZE', DEFAULT_PART_SIZE)),
+            )
+        raise StorageError(f"Unknown STORAGE_BACKEND '{backend}' (expected 'local' or 's3')")
+
+
+def init_app(app):
+    """Create the app's storage backend up front, so misconfiguration fails at startup."""
+    app.extensions['storage'] = create_storage(app)
+
+
+def get_storage():
+    """The current app's storage backend."""
+    store = current_app.extensions.get('storage')
+    if store is None:
+        store = current_app.extensions['storage'] = create_storage(current_app._get_current_object())
+    return store
+
+
+def send_stored(key, download_name, mimetype=None, missing='File not found'):
+    """
+    Send a stored object as an attachment.
+
+    Args:
+        key (str): Storage key
+        download_name (str): Filename offered to the browser
+        mimetype (str): Content type (guessed from download_name if omitted)
+        missing (str): Error message for the 404 response when the key does not exist
+
+    Returns:
+        Response: Local download, presigned-URL redirect, or a 404 JSON error
+    """
+    store = get_storage()
+    if not store.exists(key):
+        return jsonify({'error': missing}), 404
+    return store.send_download(key, download_name, mimetype)
@@ -0,0 +1,336 @@
+"""
+GPS track logs (GPX and KML) for geotagging photos by time.
+
+A track is parsed once into compact NumPy arrays - fix times as int64
+milliseconds since the epoch (UTC), latitude, longitude and elevation as
+float64 - sorted by time. Parsing streams the XML through expat without
+building an element tree, so memory follows the number of fixes (about 32
+bytes each) rather than the size of the document, and tracks with millions
+of points are fine.
+
+A batch of photos is matched in one vectorized pass: np.searchsorted finds
+the fixes on either side of every photo time, and positions are linearly
+interpolated between them. A photo is left unmatched when it falls in a gap
+between fixes longer than `max_gap`, or further than `max_gap` outside the
+track (photos just outside it take the first or last fix).
+
+Supported inputs:
+- GPX: <trkpt> (tracks), <rtept> and <wpt> elements that have a <time>
+- KML: <gx:Track> (<when> / <gx:coord> pairs) and Placemarks with a
+  <TimeStamp><when> and a <Point><coordinates>
+"""
+import re
+import datetime
+from array import array
+from xml.parsers import expat
+import numpy as np
+from PIL import Image
+
+DEFAULT_MAX_GAP = 300  # seconds
+
+EXIF_IFD = 0x8769
+DATETIME_ORIGINAL = 36867
+OFFSET_TIME_ORIGINAL = 36881
+DATETIME = 306  # IFD0 DateTime, used when DateTimeOriginal is missing
+
+GPX_POINT_TAGS = ('trkpt', 'rtept', 'wpt')
+
+_OFFSET_RE = re.compile(r'^([+-])?(\d+):(\d{2})(?::(\d{2}))?$')
+
+
+class TrackError(ValueError):
+    """Raised for track files that cannot be parsed or contain no timed fixes."""
+
+
+def parse_time(value):
+    """
+    Parse an ISO 8601 timestamp (as used by GPX and KML) to UTC milliseconds since the epoch.
+
+    Timestamps without a zone are taken as UTC.
+    """
+    value = value.strip()
+    if value.endswith(('Z', 'z')):
+        value = value[:-1] + '+00:00'
+    dt = datetime.datetime.fromisoformat(value)
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=datetime.timezone.utc)
+    return int(round(dt.timestamp() * 1000))
+
+
+def parse_offset(value):
+    """
+    Parse a camera clock offset.
+
+    Args:
+        value (str): Seconds ('-3600', '12.5') or [+-]H:MM[:SS] ('+02:00', '-0:05:30')
+
+    Returns:
+        int: Offset in milliseconds (0 for an empty value)
+
+    Raises:
+        ValueError: If the value cannot be parsed
+    """
+    value = (value or '').strip()
+    if not value:
+        return 0
+    match = _OFFSET_RE.match(value)
+    if match:
+        sign, hours, minutes, seconds = match.groups()
+        total = int(hours) * 3600 + int(minutes) * 60 + int(seconds or 0)
+        return (-total if sign == '-' else total) * 1000
+    return int(round(float(value) * 1000))
+
+
+class _Collector:
+    """Growable, compact column buffers for track fixes."""
+
+    def __init__(self):
+        self.times = array('q')
+        self.lats = array('d')
+        self.lons = array('d')
+        self.eles = array('d')
+
+    def add(self, time_ms, lat, lon, ele=None):
+        self.times.append(time_ms)
+        self.lats.append(lat)
+        self.lons.append(lon)
+        self.eles.append(float('nan') if ele is None else ele)
+
+
+class _TrackHandler:
+    """
+    expat callbacks collecting timed fixes from GPX and KML.
+
+    No element tree is built: only the text of the few elements that matter is kept,
+    so memory stays flat even for a single <trkseg> or <gx:Track> of millions of fixes.
+    """
+
+    def __init__(self, collector):
+        self.collector = collector
+        self.text = None  # Character data of the element being captured, or None
+        self.point = None  # Attributes and texts of the current GPX point / KML Placemark
+        self.track_whens = None  # Times of the current gx:Track, paired with its gx:coords in order
+        self.track_coords = 0
+        self.in_point = False  # Inside a KML <Point>
+
+    def start(self, name, attrs):
+        tag = name.rpartition(':')[2]
+        if tag in GPX_POINT_TAGS:
+            self.point = {'lat': attrs.get('lat'), 'lon': attrs.get('lon')}
+        elif tag == 'Placemark':
+            self.point = {}
+        elif tag == 'Track':
+            self.track_whens = array('q')
+            self.track_coords = 0
+        elif tag == 'Point':
+            self.in_point = True
+        elif tag in ('time', 'ele', 'when', 'coord', 'coordinates'):
+            self.text = []
+
+    def data(self, text):
+        if self.text is not None:
+            self.text.append(text)
+
+    def end(self, name):
+        tag = name.rpartition(':')[2]
+        if self.text is not None:
+            text = ''.join(self.text).strip()
+            self.text = None
+            if not text:
+                return
+            if self.track_whens is not None and tag == 'when':
+                self.track_whens.append(parse_time(text))
+            elif self.track_whens is not None and tag == 'coord':
+                if self.track_coords < len(self.track_whens):
+                    self.collector.add(self.track_whens[self.track_coords], *_kml_coordinates(text))
+                self.track_coords += 1
+            elif self.point is not None and (tag != 'coordinates' or self.in_point):
+                self.point.setdefault(tag, text)
+        elif tag in GPX_POINT_TAGS:
+            point, self.point = self.point, None
+            if point.get('time') and point['lat'] is not None and point['lon'] is not None:
+                self.collector.add(parse_time(point['time']), float(point['lat']), float(point['lon']),
+                                   float(point['ele']) if point.get('ele') else None)
+        elif tag == 'Placemark':
+            point, self.point = self.point, None
+            if point.get('when') and point.get('coordinates'):
+                self.collector.add(parse_time(point['when']), *_kml_coordinates(point['coordinates']))
+        elif tag == 'Track':
+            self.track_whens = None
+        elif tag == 'Point':
+            self.in_point = False
+
+
+def _kml_coordinates(text):
+    """(lat, lon, ele) from a KML 'lon,lat[,alt]' or gx:coord 'lon lat [alt]' string."""
+    parts = text.replace(',', ' ').split()
+    lon, lat = float(parts[0]), float(parts[1])
+    return lat, lon, float(parts[2]) if len(parts) > 2 else None
+
+
+class Track:
+    """Time-sorted GPS fixes."""
+
+    def __init__(self, times, lats, lons, eles):
+        """
+        Args:
+            times (np.ndarray): int64 UTC milliseconds since the epoch
+            lats, lons, eles (np.ndarray): float64 degrees / metres (NaN for unknown elevation)
+        """
+        order = None
+        if len(times) > 1 and np.any(np.diff(times) < 0):
+            order = np.argsort(times, kind='stable')
+        self.times = times if order is None else times[order]
+        self.lats = lats if order is None else lats[order]
+        self.lons = lons if order is None else lons[order]
+        self.eles = eles if order is None else eles[order]
+
+    def __len__(self):
+        return len(self.times)
+
+    @classmethod
+    def concatenate(cls, tracks):
+        """One track holding the fixes of several (e.g. one file per logger per day)."""
+        tracks = [t for t in tracks if len(t)]
+        if not tracks:
+            raise TrackError('No timed track points found')
+        return cls(np.concatenate([t.times for t in tracks]), np.concatenate([t.lats for t in tracks]),
+                   np.concatenate([t.lons for t in tracks]), np.concatenate([t.eles for t in tracks]))
+
+    def match(self, photo_times, max_gap=DEFAULT_MAX_GAP):
+        """
+        Interpolate positions for photo times.
+
+        Args:
+            photo_times (array-like): UTC milliseconds since the epoch (NaN for photos without a time)
+            max_gap (float): Longest interval in seconds to interpolate across or extrapolate beyond the track
+
+        Returns:
+            tuple: (lat, lon, ele, matched) float64 arrays and a boolean mask
+        """
+        t = np.asarray(photo_times, dtype=np.float64)
+        n = len(self.times)
+        valid = ~np.isnan(t)
+        lat = np.full(t.shape, np.nan)
+        lon = np.full(t.shape, np.nan)
+        ele = np.full(t.shape, np.nan)
+        if n == 0 or not valid.any():
+            return lat, lon, ele, np.zeros(t.shape, dtype=bool)
+
+        times = self.times.astype(np.float64)
+        tv = t[valid]
+        # Index of the first fix at or after each photo, clamped to a valid (left, right) pair
+        right = np.clip(np.searchsorted(times, tv, side='left'), 1, max(n - 1, 1))
+        left = right - 1
+        if n == 1:
+            left = right = np.zeros(tv.shape, dtype=np.int64)
+
+        t0, t1 = times[left], times[right]
+        span = t1 - t0
+        with np.errstate(invalid='ignore', divide='ignore'):
+            w = np.where(span > 0, (tv - t0) / span, 0.0)
+        # Outside the track: hold the end fix instead of extrapolating
+        w = np.clip(w, 0.0, 1.0)
+
+        max_gap_ms = max_gap * 1000.0
+        before = tv < times[0]
+        after = tv > times[-1]
+        inside = ~before & ~after
+        # A photo taken exactly at a fix is matched to it, however long the interval around it
+        at_fix = (tv == t0) | (tv == t1)
+        ok = np.where(inside, (span <= max_gap_ms) | at_fix, False)
+        ok |= before & (times[0] - tv <= max_gap_ms)
+        ok |= after & (tv - times[-1] <= max_gap_ms)
+
+        vlat = self.lats[left] + (self.lats[right] - self.lats[left]) * w
+        vlon = self.lons[left] + (self.lons[right] - self.lons[left]) * w
+        vele = self.eles[left] + (self.eles[right] - self.eles[left]) * w
+        # Interpolate longitude across the antimeridian the short way round
+        dlon = self.lons[right] - self.lons[left]
+        wrap = np.abs(dlon) > 180
+        if wrap.any():
+            dlon = np.where(wrap, dlon - np.sign(dlon) * 360, dlon)
+            vlon = self.lons[left] + dlon * w
+            vlon = (vlon + 180) % 360 - 180
+
+        lat[valid] = np.where(ok, vlat, np.nan)
+        lon[valid] = np.where(ok, vlon, np.nan)
+        ele[valid] = np.where(ok, vele, np.nan)
+        matched = np.zeros(t.shape, dtype=bool)
+        matched[valid] = ok
+        return lat, lon, ele, matched
+
+
+def parse_track(source, filename=''):
+    """
+    Parse a GPX or KML file (the format is recognised from its elements).
+
+    Args:
+        source (str or file): Path or binary file object
+        filename (str): Original filename, for error messages
+
+    Returns:
+        Track
+
+    Raises:
+        TrackError: If the file cannot be parsed or has no timed points
+    """
+    collector = _Collector()
+    handler = _TrackHandler(collector)
+    parser = expat.ParserCreate()
+    parser.buffer_text = True
+    parser.StartElementHandler = handler.start
+    parser.EndElementHandler = handler.end
+    parser.CharacterDataHandler = handler.data
+    try:
+        if isinstance(source, str):
+            with open(source, 'rb') as f:
+                parser.ParseFile(f)
+        else:
+            parser.ParseFile(source)
+    except (expat.ExpatError, ValueError, IndexError) as e:
+        raise TrackError(f"Could not parse track {filename or source}: {e}")
+    if not collector.times:
+        raise TrackError(f"No timed track points found in {filename or source}")
+    return Track(np.frombuffer(collector.times, dtype=np.int64).copy(),
+                 np.frombuffer(collector.lats, dtype=np.float64).copy(),
+                 np.frombuffer(collector.lons, dtype=np.float64).copy(),
+                 np.frombuffer(collector.eles, dtype=np.float64).copy())
+
+
+def photo_time(path, clock_offset_ms=0):
+    """
+    Capture time of a photo from its EXIF DateTimeOriginal, as UTC milliseconds since the epoch.
+
+    Only the file header is read. When the photo records OffsetTimeOriginal it is used to
+    convert to UTC; otherwise the camera clock is taken as UTC. `clock_offset_ms` is then added,
+    so it covers both camera clock drift and the camera's time zone.
+
+    Args:
+        path (str): Image file
+        clock_offset_ms (int): Milliseconds to add to the camera time
+
+    Returns:
+        float: Milliseconds, or NaN if the photo has no usable capture time
+    """
+    try:
+        with Image.open(path) as img:
+            exif = img.getexif()
+            sub = exif.get_ifd(EXIF_IFD)
+            value = sub.get(DATETIME_ORIGINAL) or exif.get(DATETIME)
+            offset = sub.get(OFFSET_TIME_ORIGINAL)
+    except Exception:
+        return float('nan')
+    if not value:
+        return float('nan')
+    try:
+        dt = datetime.datetime.strptime(str(value).strip('\x00 ')[:19], '%Y:%m:%d %H:%M:%S')
+    except ValueError:
+        return float('nan')
+    tz = datetime.timezone.utc
+    if offset:
+        try:
+            tz = datetime.timezone(datetime.timedelta(milliseconds=parse_offset(str(offset).strip('\x00 '))))
+        except ValueError:
+            pass
+    return dt.replace(tzinfo=tz).timestamp() * 1000 + clock_offset_ms
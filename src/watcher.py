@@ -0,0 +1,523 @@
+"""
+Watch-folder daemon that geotags new images as they arrive.
+
+    python -m src.watcher --city-preset "USA/NC/charlotte" --client-preset 1 \
+        --output /nas/geotagged /nas/incoming
+
+New images under the watched directories are geotagged with a city and/or
+client preset by the same code as the geotagging endpoint
+(geotagging.geotag_batch) and written to the output directory, keeping their
+relative paths. The originals are never modified.
+
+- Changes are picked up with inotify on Linux (through libc, no extra
+  packages) and by polling elsewhere or with --poll.
+- Files arriving in a burst are debounced: a batch is processed once nothing
+  new has arrived for --debounce seconds (or after --max-wait seconds of
+  continuous arrivals), at most --batch-size files at a time.
+- A SQLite state database records every processed file (path, size, mtime,
+  SHA-256), so a restart only processes files that are new or have changed.
+  A file that is merely touched (same content) is not processed again.
+  Files that failed (ExifTool missing or timing out, a locked network file)
+  are retried after --retry-delay seconds, twice as long after every further
+  failure (at most MAX_RETRY_DELAY), up to --max-attempts times, or again
+  from the start once their contents change. The next retry time is stored
+  with the file, so the delay also holds across restarts and for polling scans.
+
+Every option can also be set with the environment variable shown in --help.
+"""
+import sys
+import os
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+
+import time
+import errno
+import ctypes
+import ctypes.util
+import select
+import signal
+import struct
+import hashlib
+import logging
+import argparse
+from src.models.leaderboard import ConnectionPool
+
+logger = logging.getLogger('watcher')
+
+DEFAULT_DEBOUNCE = 5.0  # seconds
+DEFAULT_MAX_WAIT = 60.0  # seconds
+DEFAULT_BATCH_SIZE = 200
+DEFAULT_POLL_INTERVAL = 10.0  # seconds
+DEFAULT_MAX_ATTEMPTS = 5
+DEFAULT_RETRY_DELAY = 60.0  # seconds before the first retry, doubled after every further failure
+MAX_RETRY_DELAY = 3600.0  # seconds
+STATE_DB_NAME = '.geotagger_watch.db'
+
+SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS processed_files (
+        path TEXT PRIMARY KEY,
+        size INTEGER NOT NULL,
+        mtime_ns INTEGER NOT NULL,
+        sha256 TEXT NOT NULL,
+        status TEXT NOT NULL,
+        output TEXT,
+        error TEXT,
+        processed_at REAL NOT NULL,
+        attempts INTEGER NOT NULL DEFAULT 0,
+        retry_after REAL NOT NULL DEFAULT 0
+    ) WITHOUT ROWID
+'''
+
+
+def file_hash(path):
+    """SHA-256 of a file's contents."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class StateDB:
+    """Which files have been processed, so restarts resume where they left off."""
+
+    def __init__(self, db_path, max_attempts=DEFAULT_MAX_ATTEMPTS, retry_delay=DEFAULT_RETRY_DELAY):
+        """
+        Args:
+            db_path (str): SQLite database file
+            max_attempts (int): Failed files are retried until they have failed this often
+            retry_delay (float): Seconds before a failed file is retried, doubled after every further failure
+        """
+        self.pool = ConnectionPool(db_path, size=1)
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        with self.pool.connection() as conn:
+            conn.execute(SCHEMA)
+            # State databases written before failures were retried lack these columns
+            columns = {row['name'] for row in conn.execute('PRAGMA table_info(processed_files)')}
+            if 'attempts' not in columns:
+                conn.execute('ALTER TABLE processed_files ADD COLUMN attempts INTEGER NOT NULL DEFAULT 0')
+            if 'retry_after' not in columns:
+                conn.execute('ALTER TABLE processed_files ADD COLUMN retry_after REAL NOT NULL DEFAULT 0')
+
+    def needs_processing(self, path, st):
+        """
+        Whether `path` is new or changed since it was last processed, or failed and is due for a retry.
+
+        A changed size or mtime with unchanged contents (a touch or a copy with the same
+        bytes) only updates the record.
+        """
+        with self.pool.connection() as conn:
+            row = conn.execute('SELECT size, mtime_ns, sha256, status, attempts, retry_after FROM processed_files '
+                               'WHERE path = ?', (path,)).fetchone()
+            if row is None:
+                return True
+            if row['size'] != st.st_size or row['mtime_ns'] != st.st_mtime_ns:
+                if row['size'] != st.st_size or file_hash(path) != row['sha256']:
+                    return True
+                conn.execute('UPDATE processed_files SET mtime_ns = ? WHERE path = ?', (st.st_mtime_ns, path))
+            return (row['status'] != 'done' and row['attempts'] < self.max_attempts
+                    and row['retry_after'] <= time.time())
+
+    def due_retries(self, now):
+        """Paths of failed files whose retry delay has passed by `now`."""
+        with self.pool.connection() as conn:
+            rows = conn.execute("SELECT path FROM processed_files WHERE status != 'done' AND attempts < ? "
+                                'AND retry_after <= ?', (self.max_attempts, now)).fetchall()
+        return [row['path'] for row in rows]
+
+    def next_retry(self, now):
+        """When the next failed file becomes due for a retry after `now` (None if no retry is waiting)."""
+        with self.pool.connection() as conn:
+            row = conn.execute("SELECT MIN(retry_after) AS at FROM processed_files WHERE status != 'done' "
+                               'AND attempts < ? AND retry_after > ?', (self.max_attempts, now)).fetchone()
+        return row['at']
+
+    def record(self, entries):
+        """
+        Record processed files: (path, size, mtime_ns, sha256, status, output, error) tuples.
+
+        Consecutive failures of the same contents are counted, and each one doubles the
+        delay before the next retry; success or new contents reset the count.
+        """
+        now = time.time()
+        with self.pool.connection() as conn:
+            conn.execute('BEGIN')
+            rows = []
+            for entry in entries:
+                path, sha256, status = entry[0], entry[3], entry[4]
+                attempts, retry_after = 0, 0
+                if status != 'done':
+                    previous = conn.execute('SELECT sha256, status, attempts FROM processed_files WHERE path = ?',
+                                            (path,)).fetchone()
+                    same = previous is not None and previous['sha256'] == sha256 and previous['status'] != 'done'
+                    attempts = previous['attempts'] + 1 if same else 1
+                    retry_after = now + min(self.retry_delay * 2 ** (attempts - 1), MAX_RETRY_DELAY)
+                rows.append(entry + (now, attempts, retry_after))
+            conn.executemany(
+                'INSERT OR REPLACE INTO processed_files '
+                '(path, size, mtime_ns, sha256, status, output, error, processed_at, attempts, retry_after) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                rows)
+            conn.execute('COMMIT')
+
+
+class Inotify:
+    """Minimal recursive inotify watcher on top of libc."""
+
+    IN_MODIFY = 0x00000002
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_Q_OVERFLOW = 0x00004000
+    IN_ISDIR = 0x40000000
+    MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_MODIFY
+    _EVENT = struct.Struct('iIII')
+
+    def __init__(self):
+        libc_name = ctypes.util.find_library('c')
+        if not libc_name:
+            raise OSError('libc not found')
+        self._libc = ctypes.CDLL(libc_name, use_errno=True)
+        if not hasattr(self._libc, 'inotify_init1'):
+            raise OSError('inotify is not available')
+        self.fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self._dirs = {}  # watch descriptor -> directory
+
+    def add_tree(self, root, skip=()):
+        """Watch `root` and every directory below it (except those in `skip`)."""
+        for directory, subdirs, _ in os.walk(root):
+            subdirs[:] = [d for d in subdirs if not d.startswith('.') and os.path.join(directory, d) not in skip]
+            wd = self._libc.inotify_add_watch(self.fd, os.fsencode(directory), self.MASK)
+            if wd < 0:
+                error = ctypes.get_errno()
+                if error == errno.ENOSPC:
+                    raise OSError(error, 'Out of inotify watches (raise fs.inotify.max_user_watches)')
+                logger.warning(f"Cannot watch {directory}: {os.strerror(error)}")
+                continue
+            self._dirs[wd] = directory
+
+    def read(self, timeout):
+        """
+        Wait up to `timeout` seconds for events.
+
+        Returns:
+            tuple: (list of (path, is_dir, is_complete) events, overflowed)
+        """
+        events, overflowed = [], False
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return events, overflowed
+        try:
+            data = os.read(self.fd, 256 * 1024)
+        except BlockingIOError:
+            return events, overflowed
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = self._EVENT.unpack_from(data, offset)
+            offset += self._EVENT.size
+            name = data[offset:offset + length].rstrip(b'\0')
+            offset += length
+            if mask & self.IN_Q_OVERFLOW:
+                overflowed = True
+                continue
+            directory = self._dirs.get(wd)
+            if directory is None or not name:
+                continue
+            complete = bool(mask & (self.IN_CLOSE_WRITE | self.IN_MOVED_TO))
+            events.append((os.path.join(directory, os.fsdecode(name)), bool(mask & self.IN_ISDIR), complete))
+        return events, overflowed
+
+    def close(self):
+        os.close(self.fd)
+
+
+class Watcher:
+    """Collects new files under the watched roots and geotags them in debounced batches."""
+
+    def __init__(self, app, roots, output_dir, exif_data, state, debounce=DEFAULT_DEBOUNCE,
+                 max_wait=DEFAULT_MAX_WAIT, batch_size=DEFAULT_BATCH_SIZE, poll_interval=DEFAULT_POLL_INTERVAL,
+                 use_inotify=True, reconcile_mode='off'):
+        self.app = app
+        self.roots = [os.path.realpath(r) for r in roots]
+        self.output_dir = os.path.realpath(output_dir)
+        self.exif_data = exif_data
+        self.state = state
+        self.debounce = debounce
+        self.max_wait = max_wait
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.reconcile_mode = reconcile_mode
+        self.pending = {}  # path -> (first seen, last change, (size, mtime_ns))
+        self.next_retry = None  # When the next failed file is due (see retry_due)
+        self.running = True
+        self.inotify = None
+        if use_inotify:
+            try:
+                self.inotify = Inotify()
+            except (OSError, AttributeError) as e:
+                logger.info(f"inotify unavailable ({e}), polling every {poll_interval:g}s")
+
+    def relative_path(self, path):
+        """Path relative to its watch root, prefixed with the root's name when several roots are watched."""
+        for root in self.roots:
+            if path.startswith(root + os.sep):
+                relative = os.path.relpath(path, root)
+                if len(self.roots) > 1:
+                    relative = os.path.join(os.path.basename(root), relative)
+                return relative.replace(os.sep, '/')
+        return None
+
+    def _wanted(self, path):
+        from src.routes.geotagging import allowed_file
+        name = os.path.basename(path)
+        return (not name.startswith('.') and allowed_file(name)
+                and not (path + os.sep).startswith(self.output_dir + os.sep))
+
+    def _note(self, path, now):
+        """Remember a candidate file; its debounce timer restarts whenever it changes."""
+        if not self._wanted(path):
+            return
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            self.pending.pop(path, None)
+            return
+        signature = (st.st_size, st.st_mtime_ns)
+        first_seen, _, previous = self.pending.get(path, (now, now, None))
+        if previous != signature or path not in self.pending:
+            self.pending[path] = (first_seen, now, signature)
+
+    def scan(self):
+        """Walk all roots and note every file that is new or changed since it was processed."""
+        now = time.time()
+        for root in self.roots:
+            for directory, subdirs, files in os.walk(root):
+                subdirs[:] = [d for d in subdirs if not d.startswith('.')
+                              and os.path.realpath(os.path.join(directory, d)) != self.output_dir]
+                for name in files:
+                    path = os.path.join(directory, name)
+                    if path in self.pending or not self._wanted(path):
+                        continue
+                    try:
+                        if self.state.needs_processing(path, os.stat(path)):
+                            self._note(path, now)
+                    except OSError:
+                        continue
+
+    def retry_due(self, now):
+        """Note the failed files whose retry delay has passed (scans only find them in polling mode)."""
+        for path in self.state.due_retries(now):
+            if path not in self.pending and self.relative_path(path) is not None:
+                self._note(path, now)
+        self.next_retry = self.state.next_retry(now)
+
+    def _ready(self, now):
+        """Files to process now, or [] while the burst is still going on."""
+        if not self.pending:
+            return []
+        last_change = max(entry[1] for entry in self.pending.values())
+        oldest = min(entry[0] for entry in self.pending.values())
+        if now - last_change < self.debounce and now - oldest < self.max_wait:
+            return []
+        # Files still growing (size or mtime changed since last seen) wait for the next round
+        ready = []
+        for path, (first_seen, changed, signature) in list(self.pending.items()):
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                del self.pending[path]
+                continue
+            if (st.st_size, st.st_mtime_ns) != signature:
+                self.pending[path] = (first_seen, now, (st.st_size, st.st_mtime_ns))
+            elif now - changed >= self.debounce or now - first_seen >= self.max_wait:
+                ready.append(path)
+        return sorted(ready)[:self.batch_size]
+
+    def process(self, paths):
+        """Geotag `paths` in one batch and record the outcome in the state database."""
+        from src.routes.geotagging import geotag_batch
+        for path in paths:
+            self.pending.pop(path, None)
+        items, stats = [], {}
+        for path in paths:
+            try:
+                st = os.stat(path)
+                if not self.state.needs_processing(path, st):
+                    continue
+                stats[path] = (st.st_size, st.st_mtime_ns, file_hash(path))
+            except OSError as e:
+                logger.warning(f"Skipping {path}: {e}")
+                continue
+            items.append({
+                'original_relative_path': self.relative_path(path),
+                'uploaded_temp_path': path,
+                'original_filename': os.path.basename(path),
+            })
+        if not items:
+            return
+
+        logger.info(f"Geotagging {len(items)} file(s)")
+        started = time.time()
+        with self.app.app_context():
+            result = geotag_batch(items, self.output_dir, self.exif_data,
+                                  reconcile_mode=self.reconcile_mode, consume_inputs=False)
+
+        outputs = {entry['original_relative_path']: entry['processed_path'] for entry in result['processed_files']}
+        records = []
+        for item in items:
+            path = item['uploaded_temp_path']
+            output = outputs.get(item['original_relative_path'])
+            status = 'done' if output else 'failed'
+            error = None if output else next(
+                (e for e in result['errors'] if item['original_filename'] in e), 'Geotagging failed')
+            records.append((path,) + stats[path] + (status, output, error))
+        self.state.record(records)
+        failed = len(items) - len(outputs)
+        logger.info(f"Geotagged {len(outputs)} file(s), {failed} failed, in {time.time() - started:.1f}s")
+        if failed:
+            self.next_retry = self.state.next_retry(time.time())
+        for message in result['errors']:
+            logger.warning(message)
+
+    def run(self, once=False):
+        """Process existing files, then keep watching until stopped (or return once idle with once=True)."""
+        if self.inotify is not None:
+            for root in self.roots:
+                self.inotify.add_tree(root, skip={self.output_dir})
+        self.scan()
+        last_scan = time.time()
+        self.next_retry = self.state.next_retry(last_scan)
+        while self.running:
+            now = time.time()
+            if self.next_retry is not None and now >= self.next_retry:
+                self.retry_due(now)
+            batch = self._ready(now)
+            if batch:
+                self.process(batch)
+                continue
+            if once and not self.pending:
+                break
+
+            wait = self.debounce if self.pending else self.poll_interval
+            if self.inotify is not None:
+                events, overflowed = self.inotify.read(min(wait, 1.0))
+                now = time.time()
+                for path, is_dir, complete in events:
+                    if is_dir:
+                        # Files can land in a new directory before it is watched
+                        self.inotify.add_tree(path, skip={self.output_dir})
+                        overflowed = True
+                    else:
+                        self._note(path, now)
+                if overflowed:
+                    self.scan()
+            else:
+                time.sleep(min(wait, 1.0))
+                if time.time() - last_scan >= self.poll_interval or self.pending:
+                    self.scan()
+                    last_scan = time.time()
+        if self.inotify is not None:
+            self.inotify.close()
+
+    def stop(self, *_):
+        self.running = False
+
+
+def load_presets(app, city_preset, client_preset):
+    """
+    Look up the presets named on the command line.
+
+    Args:
+        city_preset (str): 'COUNTRY/STATE_PROVINCE/ID' or None
+        client_preset (str): Client preset id or None
+
+    Returns:
+        dict: EXIF data for geotag_batch
+
+    Raises:
+        SystemExit: If a preset does not exist
+    """
+    from src.routes import presets, geotagging
+    from src.models import preset_catalog
+    city = client = None
+    with app.app_context():
+        if city_preset:
+            try:
+                country, state_province, preset_id = city_preset.split('/', 2)
+            except ValueError:
+                raise SystemExit(f"--city-preset must be COUNTRY/STATE_PROVINCE/ID, not '{city_preset}'")
+            city = preset_catalog.get_catalog(presets.city_document()).get(country, state_province, preset_id)
+            if city is None:
+                raise SystemExit(f"City preset '{city_preset}' not found")
+        if client_preset:
+            client = next((p for p in presets.client_document().read().get('presets', [])
+                           if str(p.get('id')) == client_preset), None)
+            if client is None:
+                raise SystemExit(f"Client preset '{client_preset}' not found")
+    return geotagging.exif_data_from_presets(city, client)
+
+
+def parse_args(argv=None):
+    env = os.environ.get
+    parser = argparse.ArgumentParser(description='Geotag images as they arrive in watched directories.')
+    parser.add_argument('directories', nargs='*', default=[d for d in env('WATCH_DIRS', '').split(os.pathsep) if d],
+                        help='Directories to watch (WATCH_DIRS, separated by %r)' % os.pathsep)
+    parser.add_argument('--output', default=env('WATCH_OUTPUT_DIR'), help='Output directory (WATCH_OUTPUT_DIR)')
+    parser.add_argument('--city-preset', default=env('WATCH_CITY_PRESET'),
+                        help='City preset as COUNTRY/STATE_PROVINCE/ID (WATCH_CITY_PRESET)')
+    parser.add_argument('--client-preset', default=env('WATCH_CLIENT_PRESET'), help='Client preset id (WATCH_CLIENT_PRESET)')
+    parser.add_argument('--state-db', default=env('WATCH_STATE_DB'),
+                        help=f'State database (WATCH_STATE_DB, default: {STATE_DB_NAME} in the output directory)')
+    parser.add_argument('--debounce', type=float, default=float(env('WATCH_DEBOUNCE') or DEFAULT_DEBOUNCE),
+                        help='Seconds without new files before a batch starts (WATCH_DEBOUNCE)')
+    parser.add_argument('--max-wait', type=float, default=float(env('WATCH_MAX_WAIT') or DEFAULT_MAX_WAIT),
+                        help='Longest a file waits while new ones keep arriving (WATCH_MAX_WAIT)')
+    parser.add_argument('--batch-size', type=int, default=int(env('WATCH_BATCH_SIZE') or DEFAULT_BATCH_SIZE),
+                        help='Most files per batch (WATCH_BATCH_SIZE)')
+    parser.add_argument('--poll', action='store_true', default=env('WATCH_POLL', '').lower() in ('1', 'true', 'yes'),
+                        help='Poll instead of using inotify (WATCH_POLL)')
+    parser.add_argument('--poll-interval', type=float, default=float(env('WATCH_POLL_INTERVAL') or DEFAULT_POLL_INTERVAL),
+                        help='Seconds between scans when polling (WATCH_POLL_INTERVAL)')
+    parser.add_argument('--reconcile', choices=('off', 'changed', 'fill_missing'), default=env('WATCH_RECONCILE') or 'off',
+                        help='Only write tags that differ or are missing (WATCH_RECONCILE)')
+    parser.add_argument('--max-attempts', type=int, default=int(env('WATCH_MAX_ATTEMPTS') or DEFAULT_MAX_ATTEMPTS),
+                        help='Times a failing file is tried before it is left alone (WATCH_MAX_ATTEMPTS)')
+    parser.add_argument('--retry-delay', type=float, default=float(env('WATCH_RETRY_DELAY') or DEFAULT_RETRY_DELAY),
+                        help='Seconds before a failed file is retried, doubled after every further failure '
+                             '(WATCH_RETRY_DELAY)')
+    parser.add_argument('--once', action='store_true', help='Process what is there and exit')
+    args = parser.parse_args(argv)
+    if not args.directories:
+        parser.error('no directories to watch')
+    if not args.output:
+        parser.error('--output is required')
+    if not args.city_preset and not args.client_preset:
+        parser.error('give --city-preset and/or --client-preset')
+    return args
+
+
+def main(argv=None):
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+    args = parse_args(argv)
+    for directory in args.directories:
+        if not os.path.isdir(directory):
+            raise SystemExit(f"Not a directory: {directory}")
+    os.makedirs(args.output, exist_ok=True)
+
+    from src.app import app
+    exif_data = load_presets(app, args.city_preset, args.client_preset)
+    state = StateDB(args.state_db or os.path.join(args.output, STATE_DB_NAME), max_attempts=args.max_attempts,
+                    retry_delay=args.retry_delay)
+    watcher = Watcher(app, args.directories, args.output, exif_data, state, debounce=args.debounce,
+                      max_wait=args.max_wait, batch_size=args.batch_size, poll_interval=args.poll_interval,
+                      use_inotify=not args.poll, reconcile_mode=args.reconcile)
+    signal.signal(signal.SIGTERM, watcher.stop)
+    signal.signal(signal.SIGINT, watcher.stop)
+    logger.info(f"Watching {', '.join(watcher.roots)} -> {watcher.output_dir}")
+    watcher.run(once=args.once)
+
+
+if __name__ == '__main__':
+    main()
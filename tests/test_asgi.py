@@ -0,0 +1,44 @@
+import asyncio
+import json
+import pytest
+
+asgi = pytest.importorskip('src.asgi')
+
+
+def call(app, chunks, headers=()):
+    """Send `chunks` as one request body through `app`; returns (status, JSON body, chunks read)."""
+    scope = {'type': 'http', 'method': 'POST', 'path': '/api/geotag', 'root_path': '', 'query_string': b'',
+             'http_version': '1.1', 'headers': list(headers)}
+    messages = [{'type': 'http.request', 'body': chunk, 'more_body': i < len(chunks) - 1}
+                for i, chunk in enumerate(chunks)]
+    read, sent = [], []
+
+    async def receive():
+        read.append(messages[len(read)])
+        return read[-1]
+
+    async def send(message):
+        sent.append(message)
+
+    asyncio.run(app(scope, receive, send))
+    body = b''.join(m.get('body', b'') for m in sent if m['type'] == 'http.response.body')
+    return sent[0]['status'], json.loads(body), len(read)
+
+
+def test_chunked_body_over_the_limit_is_refused_while_reading(monkeypatch):
+    monkeypatch.setitem(asgi.flask_app.config, 'MAX_CONTENT_LENGTH', 100)
+    app = asgi.SpooledWSGIApp(lambda environ, start_response: pytest.fail('reached the app'))
+    status, body, read = call(app, [b'x' * 60, b'x' * 60, b'x' * 60])
+
+    assert status == 413
+    assert body['error'] == 'Request too large'
+    assert read == 2
+
+
+def test_declared_length_over_the_limit_is_refused_unread(monkeypatch):
+    monkeypatch.setitem(asgi.flask_app.config, 'MAX_CONTENT_LENGTH', 100)
+    app = asgi.SpooledWSGIApp(lambda environ, start_response: pytest.fail('reached the app'))
+    status, _, read = call(app, [b'x' * 200], headers=[(b'content-length', b'200')])
+
+    assert status == 413
+    assert read == 0
@@ -0,0 +1,49 @@
+import os
+import numpy as np
+import pytest
+from PIL import Image
+from src.utils import largeimage
+
+
+def gradient(width, height):
+    x = np.arange(width, dtype=np.uint8)[None, :].repeat(height, 0)
+    y = np.arange(height, dtype=np.uint8)[:, None].repeat(width, 1)
+    return Image.fromarray(np.dstack([x, y, x ^ y]), 'RGB')
+
+
+def write_in_strips(path, output_format, img, rows=16, **options):
+    writer = largeimage.open_strip_writer(str(path), output_format, img.size, img.mode, options)
+    for top in range(0, img.height, rows):
+        writer.write(img.crop((0, top, img.width, min(top + rows, img.height))))
+    writer.close()
+
+
+@pytest.mark.parametrize('output_format, options', [('bmp', {}), ('webp', {'lossless': True})])
+def test_canvas_round_trip_is_lossless(tmp_path, output_format, options):
+    img = gradient(120, 70)
+    path = tmp_path / f'out.{output_format}'
+    write_in_strips(path, output_format, img, **options)
+    with Image.open(path) as out:
+        assert out.size == img.size
+        assert np.array_equal(np.asarray(out.convert('RGB')), np.asarray(img))
+    assert not os.path.exists(str(path) + '.canvas')
+
+
+def test_rgb_frame_shares_the_canvas(tmp_path):
+    writer = largeimage.CanvasStripWriter(str(tmp_path / 'out.webp'), (8, 4), 'RGB', 'WEBP')
+    writer.write(Image.new('RGB', (8, 4), (1, 2, 3)))
+    frame = writer._frame()
+    assert frame.mode == 'RGB'
+    writer._buffer[0, 0, :3] = (200, 100, 50)
+    assert frame.getpixel((0, 0)) == (200, 100, 50)  # no copy was made
+    writer.abort()
+
+
+def test_failed_encode_removes_partial_output(tmp_path):
+    path = tmp_path / 'out.webp'
+    writer = largeimage.open_strip_writer(str(path), 'webp', (32, 32), 'RGB', {'quality': 'bad'})
+    writer.write(Image.new('RGB', (32, 32)))
+    with pytest.raises(Exception):
+        writer.close()
+    assert not path.exists()
+    assert not os.path.exists(str(path) + '.canvas')
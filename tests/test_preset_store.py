@@ -0,0 +1,87 @@
+import json
+import os
+from src.models import preset_store
+from src.models.preset_store import PresetDocument
+
+EMPTY = {'version': '2.0', 'countries': {}}
+
+
+def city(preset_id, name):
+    corner = {'lat': 1.0, 'lng': 2.0}
+    return {'id': preset_id, 'name': name, 'center': corner,
+            'boundaries': dict.fromkeys(preset_store.BOUNDARY_CORNERS, corner)}
+
+
+def make_document(tmp_path):
+    path = tmp_path / 'city_presets.json'
+    path.write_text(json.dumps({'version': '2.0', 'countries': {'USA': {'Ohio': [city('a', 'Akron')]}}, 'revision': 4}))
+    return PresetDocument(str(path), EMPTY)
+
+
+def cities(document):
+    return [p['name'] for p in document.read()['countries']['USA']['Ohio']]
+
+
+def test_single_change_goes_to_the_journal(tmp_path):
+    document = make_document(tmp_path)
+    before = open(document.path).read()
+    revision, _ = document.update(preset_store.upsert_city('USA', 'Ohio', city('b', 'Berea')))
+    document.update(preset_store.upsert_city('USA', 'Ohio', {'id': 'a', 'name': 'Akron City'}, merge=True))
+
+    assert revision == 5
+    assert open(document.path).read() == before
+    assert len(open(document.journal_path).read().splitlines()) == 3  # header and two changes
+    # Another process sees the changes
+    other = PresetDocument(document.path, EMPTY)
+    assert cities(other) == ['Akron City', 'Berea']
+    assert other.read()['revision'] == 6
+
+    document.update(preset_store.delete_city('USA', 'Ohio', 'b'))
+    assert cities(other) == ['Akron City']
+    assert other.read()['revision'] == 7
+
+
+def test_journal_is_folded_into_the_file(tmp_path, monkeypatch):
+    monkeypatch.setattr(preset_store, 'COMPACT_AFTER', 3)
+    document = make_document(tmp_path)
+    for preset_id in 'bcd':
+        document.update(preset_store.upsert_city('USA', 'Ohio', city(preset_id, preset_id.upper())))
+
+    assert not os.path.exists(document.journal_path)
+    stored = json.load(open(document.path))
+    assert stored['revision'] == 7
+    assert [p['name'] for p in stored['countries']['USA']['Ohio']] == ['Akron', 'B', 'C', 'D']
+
+
+def test_journal_of_a_replaced_file_is_ignored(tmp_path):
+    document = make_document(tmp_path)
+    document.update(preset_store.upsert_city('USA', 'Ohio', city('b', 'Berea')))
+    # Edited by hand (or deployed): the journal was for the old file
+    with open(document.path, 'w') as f:
+        json.dump({'version': '2.0', 'countries': {'USA': {'Ohio': [city('c', 'Canton')]}}, 'revision': 9}, f)
+
+    assert cities(PresetDocument(document.path, EMPTY)) == ['Canton']
+    document.update(preset_store.upsert_city('USA', 'Ohio', city('d', 'Dover')))
+    assert cities(PresetDocument(document.path, EMPTY)) == ['Canton', 'Dover']
+
+
+def test_partial_line_is_dropped(tmp_path):
+    document = make_document(tmp_path)
+    document.update(preset_store.upsert_city('USA', 'Ohio', city('b', 'Berea')))
+    # A writer that crashed halfway through its line
+    with open(document.journal_path, 'a') as f:
+        f.write('{"op": "delete_city", "coun')
+
+    assert cities(PresetDocument(document.path, EMPTY)) == ['Akron', 'Berea']
+    document.update(preset_store.delete_city('USA', 'Ohio', 'a'))
+    assert cities(PresetDocument(document.path, EMPTY)) == ['Berea']
+
+
+def test_replace_writes_the_whole_file(tmp_path):
+    document = make_document(tmp_path)
+    document.update(preset_store.upsert_city('USA', 'Ohio', city('b', 'Berea')))
+    revision = document.replace({'version': '2.0', 'countries': {}})
+
+    assert revision == 6
+    assert not os.path.exists(document.journal_path)
+    assert json.load(open(document.path)) == {'version': '2.0', 'countries': {}, 'revision': 6}
@@ -0,0 +1,91 @@
+import pytest
+from urllib.parse import urlsplit, parse_qs
+from flask import Flask
+
+boto3 = pytest.importorskip('boto3')
+moto = pytest.importorskip('moto')
+
+from src.utils import storage
+
+BUCKET = 'geotagger-test'
+
+
+@pytest.fixture
+def s3(monkeypatch):
+    for name, value in (('AWS_ACCESS_KEY_ID', 'testing'), ('AWS_SECRET_ACCESS_KEY', 'testing'),
+                        ('AWS_DEFAULT_REGION', 'us-east-1')):
+        monkeypatch.setenv(name, value)
+    with moto.mock_aws():
+        boto3.client('s3', region_name='us-east-1').create_bucket(Bucket=BUCKET)
+        yield storage.S3Storage(BUCKET, prefix='app', region='us-east-1',
+                                public_endpoint_url='https://files.example.com')
+
+
+def stored(store, key):
+    return store.client.get_object(Bucket=BUCKET, Key='app/' + key)
+
+
+def test_open_write_small_object_is_one_put(s3):
+    with s3.open_write('processed/s1/out.zip') as f:
+        f.write(b'PK' + b'\0' * 100)
+        writer = f
+
+    assert writer.upload_id is None
+    obj = stored(s3, 'processed/s1/out.zip')
+    assert obj['Body'].read() == b'PK' + b'\0' * 100
+    assert obj['ContentType'] == 'application/zip'
+
+
+def test_open_write_streams_parts_across_the_threshold(s3):
+    data = bytes(range(256)) * (s3.part_size * 2 // 256 + 4)  # Two full parts and a short last one
+    with s3.open_write('processed/s1/big.zip') as f:
+        for start in range(0, len(data), 1024 * 1024):
+            f.write(data[start:start + 1024 * 1024])
+        writer = f
+
+    assert [part['PartNumber'] for part in writer.parts] == [1, 2, 3]
+    assert stored(s3, 'processed/s1/big.zip')['Body'].read() == data
+
+
+def test_open_write_aborts_the_multipart_upload_on_error(s3):
+    with pytest.raises(RuntimeError):
+        with s3.open_write('processed/s1/broken.zip') as f:
+            f.write(b'\0' * (storage.MIN_PART_SIZE + 1))
+            raise RuntimeError('zip failed')
+
+    assert not s3.exists('processed/s1/broken.zip')
+    assert s3.client.list_multipart_uploads(Bucket=BUCKET).get('Uploads', []) == []
+
+
+def test_publish_list_and_delete_prefix(s3, tmp_path):
+    for name in ('a.jpg', 'b.zip'):
+        (tmp_path / name).write_bytes(name.encode())
+    s3.publish(str(tmp_path / 'a.jpg'), 'processed/s1/a.jpg')
+    s3.publish(str(tmp_path / 'b.zip'), 'processed/s1/sub/b.zip')
+    s3.publish(str(tmp_path / 'a.jpg'), 'processed/s10/a.jpg')
+
+    assert stored(s3, 'processed/s1/a.jpg')['ContentType'] == 'image/jpeg'
+    assert s3.list('processed/s1') == ['a.jpg', 'sub/b.zip']
+
+    s3.delete_prefix('processed/s1')
+    assert s3.list('processed/s1') == []
+    # A sibling whose name starts the same is not under the prefix
+    assert s3.list('processed/s10') == ['a.jpg']
+
+
+def test_send_stored_redirects_to_a_presigned_url(s3):
+    s3.put_json('sessions/s1/progress.json', {'done': 1})
+    app = Flask(__name__)
+    app.extensions['storage'] = s3
+    with app.test_request_context():
+        response = storage.send_stored('sessions/s1/progress.json', 'progress "1".json')
+        missing = storage.send_stored('sessions/s1/other.json', 'other.json')
+
+    assert response.status_code == 302
+    location = urlsplit(response.headers['Location'])
+    query = parse_qs(location.query)
+    assert location.netloc.endswith('files.example.com')
+    assert location.path.endswith('/app/sessions/s1/progress.json')
+    assert query['response-content-disposition'] == ['attachment; filename="progress 1.json"']
+    assert query['response-content-type'] == ['application/json']
+    assert missing[1] == 404
@@ -0,0 +1,25 @@
+import numpy as np
+from src.utils.tracklog import Track
+
+
+def make_track(seconds, lats, lons):
+    times = np.array(seconds, dtype=np.int64) * 1000
+    return Track(times, np.array(lats, dtype=np.float64), np.array(lons, dtype=np.float64),
+                 np.full(len(seconds), np.nan))
+
+
+def test_photo_at_fix_after_long_gap_is_matched():
+    # Fixes at 10:00 and 12:00: the two-hour interval is far longer than max_gap
+    track = make_track([36000, 43200], [10.0, 20.0], [30.0, 40.0])
+    lat, lon, _, matched = track.match([36000 * 1000, 43200 * 1000, 39600 * 1000], max_gap=300)
+    assert matched.tolist() == [True, True, False]
+    assert lat[:2].tolist() == [10.0, 20.0]
+    assert lon[:2].tolist() == [30.0, 40.0]
+
+
+def test_photo_at_inner_fix_after_long_gap_is_matched():
+    track = make_track([0, 7200, 7260], [1.0, 2.0, 3.0], [4.0, 5.0, 6.0])
+    lat, lon, _, matched = track.match([7200 * 1000, 7199 * 1000, 7230 * 1000], max_gap=300)
+    assert matched.tolist() == [True, False, True]
+    assert (lat[0], lon[0]) == (2.0, 5.0)
+    assert lat[2] == 2.5
@@ -0,0 +1,105 @@
+import hashlib
+import os
+import pytest
+from flask import Flask
+from src.routes import uploads
+
+DATA = b'\xff\xd8\xff\xe0\0\x10JFIF\0' + bytes(range(256)) * 40
+
+
+@pytest.fixture
+def app(tmp_path, monkeypatch):
+    monkeypatch.delenv('CHUNKED_UPLOAD_FOLDER', raising=False)
+    app = Flask(__name__)
+    app.config['CHUNKED_UPLOAD_FOLDER'] = str(tmp_path / 'chunks')
+    app.register_blueprint(uploads.uploads_bp, url_prefix='/api/uploads')
+    return app
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+
+def create(client, data=DATA, name='photo.jpg'):
+    response = client.post('/api/uploads', json={'filename': name, 'length': len(data)})
+    assert response.status_code == 201
+    return response.json['upload_id']
+
+
+def put(client, upload_id, offset, chunk):
+    return client.put(f'/api/uploads/{upload_id}', data=chunk, headers={'Upload-Offset': str(offset)})
+
+
+def finalize(client, upload_id, checksum=None):
+    return client.post(f'/api/uploads/{upload_id}/finalize', json={'checksum': checksum} if checksum else {})
+
+
+def test_bad_signature_at_offset_zero_deletes_the_upload(client):
+    data = b'<?php echo 1; ?>' + b'\0' * 200
+    upload_id = create(client, data)
+    response = put(client, upload_id, 0, data)
+
+    assert response.status_code == 415
+    assert response.json['error'] == 'Not an image'
+    assert client.get(f'/api/uploads/{upload_id}').status_code == 404
+
+
+def test_out_of_order_and_overlapping_chunks(client, app):
+    upload_id = create(client)
+    response = put(client, upload_id, 6000, DATA[6000:])
+    assert response.headers['Upload-Offset'] == '0'
+    assert response.json['received'] == [[6000, len(DATA)]]
+    assert finalize(client, upload_id).status_code == 409
+
+    assert put(client, upload_id, 0, DATA[:4000]).headers['Upload-Offset'] == '4000'
+    response = put(client, upload_id, 3000, DATA[3000:7000])
+    assert response.json['received'] == [[0, len(DATA)]]
+    assert response.json['complete']
+
+    assert finalize(client, upload_id, hashlib.sha256(DATA).hexdigest()).status_code == 200
+    with app.app_context():
+        with open(uploads.data_path(upload_id), 'rb') as f:
+            assert f.read() == DATA
+
+
+def test_chunk_past_the_end_is_refused(client):
+    upload_id = create(client)
+    response = put(client, upload_id, len(DATA) - 10, b'\0' * 20)
+
+    assert response.status_code == 416
+    assert client.get(f'/api/uploads/{upload_id}').json['received'] == []
+
+
+def test_finalize_with_wrong_sha256(client):
+    upload_id = create(client)
+    put(client, upload_id, 0, DATA)
+    response = finalize(client, upload_id, hashlib.sha256(b'something else').hexdigest())
+
+    assert response.status_code == 422
+    assert response.json['error'] == 'Checksum mismatch'
+    assert not client.get(f'/api/uploads/{upload_id}').json['finalized']
+    assert finalize(client, upload_id, hashlib.sha256(DATA).hexdigest()).status_code == 200
+
+
+def test_claim_with_a_missing_id_claims_nothing(client, app, tmp_path):
+    upload_ids = []
+    for name in ('a.jpg', 'b.jpg'):
+        upload_id = create(client, name=name)
+        put(client, upload_id, 0, DATA)
+        assert finalize(client, upload_id).status_code == 200
+        upload_ids.append(upload_id)
+    dest = tmp_path / 'session'
+    dest.mkdir()
+
+    with app.app_context():
+        with pytest.raises(uploads.UploadError) as error:
+            uploads.claim_uploads(upload_ids + ['0' * 32], str(dest))
+        assert error.value.status == 404
+        assert os.listdir(dest) == []
+        assert all(os.path.exists(uploads.data_path(upload_id)) for upload_id in upload_ids)
+
+        claimed = uploads.claim_uploads(upload_ids, str(dest))
+    assert sorted(os.listdir(dest)) == ['a.jpg', 'b.jpg']
+    assert [c['filename'] for c in claimed] == ['a.jpg', 'b.jpg']
+    assert client.get(f'/api/uploads/{upload_ids[0]}').status_code == 404
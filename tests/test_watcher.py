@@ -0,0 +1,52 @@
+import threading
+import time
+import pytest
+from flask import Flask
+from src import watcher as watch
+from src.routes import geotagging
+
+
+@pytest.mark.parametrize('use_inotify', [True, False], ids=['inotify', 'poll'])
+def test_failed_file_is_retried_after_the_delay(tmp_path, monkeypatch, use_inotify):
+    incoming, output = tmp_path / 'incoming', tmp_path / 'output'
+    incoming.mkdir()
+    output.mkdir()
+    (incoming / 'a.jpg').write_bytes(b'\xff\xd8\xff' + b'\0' * 64)
+
+    calls = []
+
+    def geotag_batch(items, output_dir, exif_data, reconcile_mode='off', consume_inputs=True):
+        calls.append(time.time())
+        if len(calls) == 1:
+            return {'processed_files': [], 'errors': ['Failed to process a.jpg with ExifTool.']}
+        worker.stop()
+        return {'processed_files': [{'original_relative_path': 'a.jpg', 'processed_path': str(output / 'a.jpg')}],
+                'errors': []}
+
+    monkeypatch.setattr(geotagging, 'geotag_batch', geotag_batch)
+    state = watch.StateDB(str(tmp_path / 'state.db'), retry_delay=0.3)
+    worker = watch.Watcher(Flask(__name__), [str(incoming)], str(output), {}, state, debounce=0,
+                           poll_interval=0.05, use_inotify=use_inotify)
+    thread = threading.Thread(target=worker.run)
+    thread.start()
+    thread.join(timeout=10)
+    worker.stop()
+    thread.join()
+
+    assert len(calls) == 2
+    assert calls[1] - calls[0] >= 0.3
+    assert not state.needs_processing(str(incoming / 'a.jpg'), (incoming / 'a.jpg').stat())
+
+
+def test_retry_delay_doubles(tmp_path):
+    state = watch.StateDB(str(tmp_path / 'state.db'), retry_delay=10)
+    failure = ('/in/a.jpg', 1, 1, 'hash', 'failed', None, 'error')
+    delays = []
+    for _ in range(3):
+        before = time.time()
+        state.record([failure])
+        delays.append(round(state.next_retry(before) - before))
+
+    assert delays == [10, 20, 40]
+    assert state.due_retries(time.time()) == []
+    assert state.due_retries(time.time() + 41) == ['/in/a.jpg']